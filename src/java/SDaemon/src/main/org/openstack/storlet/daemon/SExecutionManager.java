@@ -40,6 +40,7 @@ public class SExecutionManager {
     private String strStorletName_;
     private int nPoolSize;
     private HashMap<String, Future> taskIdToTask_;
+    private HashMap<String, SExecutionTask> taskIdToExecTask_;
     private static int nDefaultTimeoutToWaitBeforeShutdown_ = 3;
 
     public SExecutionManager(final String strStorletName,
@@ -54,6 +55,7 @@ public class SExecutionManager {
             + nPoolSize + " threads");
         this.threadPool_ = Executors.newFixedThreadPool(nPoolSize);
         this.taskIdToTask_ = new HashMap<String, Future>();
+        this.taskIdToExecTask_ = new HashMap<String, SExecutionTask>();
     }
 
     public void terminate() {
@@ -75,6 +77,7 @@ public class SExecutionManager {
 
         synchronized (this.taskIdToTask_) {
             this.taskIdToTask_.put(taskId, futureTask);
+            this.taskIdToExecTask_.put(taskId, sTask);
         }
         return taskId;
     }
@@ -87,8 +90,16 @@ public class SExecutionManager {
         } else {
             this.logger_.trace(this.strStorletName_ + ": cancelling " + taskId);
             (this.taskIdToTask_.get(taskId)).cancel(true);
+            SExecutionTask sTask;
             synchronized (this.taskIdToTask_) {
                 this.taskIdToTask_.remove(taskId);
+                sTask = this.taskIdToExecTask_.remove(taskId);
+            }
+            // Interrupting the worker thread does not unblock stream I/O,
+            // and a task still waiting in the queue never runs its cleanup,
+            // so close the task streams here to release them right away.
+            if (sTask != null) {
+                sTask.closeStorletStreams();
             }
         }
         return bStatus;
@@ -97,6 +108,7 @@ public class SExecutionManager {
     public void cleanupTask(final String taskId) {
         synchronized (this.taskIdToTask_) {
             this.taskIdToTask_.remove(taskId);
+            this.taskIdToExecTask_.remove(taskId);
         }
     }
 }
@@ -83,7 +83,7 @@ public class SExecutionTask extends SAbstractTask implements Runnable {
         }
     }
 
-    private void closeStorletStreams(){
+    public void closeStorletStreams(){
         this.closeStorletInputStreams();
         this.closeStorletOutputStreams();
     }
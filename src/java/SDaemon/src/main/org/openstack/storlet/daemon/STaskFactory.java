@@ -116,9 +116,13 @@ public class STaskFactory {
                 } else {
                     inStreams.add(new StorletInputStream(fd, storageMetadata));
                 }
-            } else if (strFDtype.equals("SBUS_FD_OUTPUT_OBJECT")) {
+            } else if (strFDtype.equals("SBUS_FD_OUTPUT_OBJECT")
+                    || strFDtype.equals("SBUS_FD_OUTPUT_OBJECT_AND_METADATA")) {
+                // SBUS_FD_OUTPUT_OBJECT_AND_METADATA only tells that the
+                // gateway reads metadata after the body, so the storlet
+                // can set metadata at any time
                 this.logger_.trace("createStorletTask: fd " + i
-                        + " is of type SBUS_FD_OUTPUT_OBJECT");
+                        + " is of type " + strFDtype);
                 String strNextFDtype = dtg.getFilesMetadata()[i + 1]
                         .get("storlets").get("type");
                 if (!strNextFDtype.equals("SBUS_FD_OUTPUT_OBJECT_METADATA")) {
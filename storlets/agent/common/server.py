@@ -15,6 +15,7 @@
 from functools import partial
 import json
 import os
+import select
 
 from storlets.sbus import SBus
 import storlets.sbus.command as sbus_cmd
@@ -68,9 +69,16 @@ class SBusServer(object):
                   _terminate and halt, otherwise they raise
                   NotImplementedError.
     """
+    # Seconds to wait for a request before running housekeeping tasks, or
+    # None to wait forever
+    housekeeping_interval = None
+
     def __init__(self, sbus_path, logger):
         self.sbus_path = sbus_path
         self.logger = logger
+        # Map the extra fds watched in the main loop to the functions called
+        # when they get readable
+        self.fd_handlers = {}
 
     def get_handler(self, command):
         """
@@ -155,6 +163,41 @@ class SBusServer(object):
     def _terminate(self):
         raise NotImplementedError()
 
+    def _ready(self):
+        """
+        Called once the server listens on its SBus
+        """
+        pass
+
+    def _housekeep(self):
+        """
+        Run housekeeping tasks. This is called after each request, and when
+        no request arrives in housekeeping_interval
+        """
+        pass
+
+    def _listen(self, sbus, fd):
+        """
+        Wait until a request arrives, while handling the extra fds which
+        get readable
+
+        :returns: positive value when a request arrives, 0 when no request
+                  arrives in housekeeping_interval or only the extra fds
+                  get readable, and negative value when it fails to wait
+        """
+        if self.housekeeping_interval is None and not self.fd_handlers:
+            return sbus.listen(fd)
+        try:
+            readable, _, _ = select.select([fd] + list(self.fd_handlers),
+                                           [], [],
+                                           self.housekeeping_interval)
+        except (IOError, OSError, select.error):
+            return -1
+        for extra_fd in readable:
+            if extra_fd in self.fd_handlers:
+                self.fd_handlers[extra_fd]()
+        return 1 if fd in readable else 0
+
     def main_loop(self):
         """
         Main loop to run storlet application
@@ -167,12 +210,16 @@ class SBusServer(object):
         if fd < 0:
             self.logger.error("Failed to create SBus. exiting.")
             return EXIT_FAILURE
+        self._ready()
 
         while True:
-            rc = sbus.listen(fd)
+            rc = self._listen(sbus, fd)
             if rc < 0:
                 self.logger.error("Failed to wait on SBus. exiting.")
                 return EXIT_FAILURE
+            elif rc == 0:
+                self._housekeep()
+                continue
 
             dtg = sbus.receive(fd)
             if dtg is None:
@@ -181,6 +228,7 @@ class SBusServer(object):
 
             if not self.dispatch_command(dtg):
                 break
+            self._housekeep()
 
         self.logger.debug('Leaving main loop')
         self._terminate()
@@ -19,6 +19,14 @@ from logging.handlers import SysLogHandler
 DEFAULT_PY2 = 2.7
 DEFAULT_PY3 = 3.6
 
+# The file in the pipe directory where the daemon factory keeps the
+# history of the storlet daemons
+DAEMON_HISTORY_FILE = 'storlet_daemon_history.json'
+
+# The file in the pipe directory which the daemon factory creates once it
+# listens on its SBus
+FACTORY_READY_FILE = 'factory_ready'
+
 
 def get_logger(logger_name, log_level, container_id):
     """
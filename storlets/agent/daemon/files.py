@@ -83,10 +83,16 @@ class StorletFile(object):
 class StorletOutputFile(StorletFile):
     mode = 'wb'
 
-    def __init__(self, md_fd, obj_fd):
+    def __init__(self, md_fd, obj_fd, trailing_metadata=False):
+        """
+        :param md_fd: file descriptor to write metadata
+        :param obj_fd: file descriptor to write body
+        :param trailing_metadata: whether metadata can be sent after body
+        """
         super(StorletOutputFile, self).__init__(obj_fd)
         self._metadata = None
         self.md_file = os.fdopen(md_fd, 'wb')
+        self.trailing_metadata = trailing_metadata
 
     def get_metadata(self):
         if self._metadata is None:
@@ -105,20 +111,91 @@ class StorletOutputFile(StorletFile):
             self.md_file.close()
         super(StorletOutputFile, self).close()
 
-    def write(self, buf):
-        if not self.md_file.closed:
+    def _check_metadata_sent(self):
+        if not self.trailing_metadata and not self.md_file.closed:
             raise IOError('Body should be sent after metadata is sent')
+
+    def write(self, buf):
+        self._check_metadata_sent()
         self.obj_file.write(buf)
 
     def writelines(self, seq):
-        if not self.md_file.closed:
-            raise IOError('Body should be sent after metadata is sent')
+        self._check_metadata_sent()
         self.obj_file.writelines(seq)
 
     def flush(self):
         self.obj_file.flush()
 
 
+class StorletOutputContainer(object):
+    """
+    Handle to open extra outputs of a storlet, each of which is stored as
+    an object named by the storlet
+
+    :param fd: file descriptor to announce the opened outputs
+    :param out_files: a list of StorletOutputFile for the extra outputs
+    """
+
+    def __init__(self, fd, out_files):
+        self.fd = fd
+        self.container_file = os.fdopen(fd, 'wb')
+        self.out_files = out_files
+        self._opened = 0
+
+    def fileno(self):
+        return self.fd
+
+    @property
+    def closed(self):
+        return self.container_file.closed
+
+    def _announce(self, entry):
+        self.container_file.write(json.dumps(entry).encode('utf-8') + b'\n')
+        self.container_file.flush()
+
+    def open(self, name):
+        """
+        Open an extra output
+
+        :param name: the name of the object to store the output
+        :returns: StorletOutputFile instance to write the output
+        :raises IOError: when all of the extra outputs are already opened
+        """
+        if self.closed:
+            raise IOError('Output container is already closed')
+        if self._opened >= len(self.out_files):
+            raise IOError('No more output can be opened')
+        index = self._opened
+        self._announce({'object_name': name, 'index': index})
+        self._opened += 1
+        return self.out_files[index]
+
+    def complete(self):
+        """
+        Tell that the storlet has completed, so that the extra outputs can
+        be stored
+        """
+        if self.closed:
+            return
+        for out_file in self.out_files:
+            if not out_file.closed:
+                out_file.close()
+        self._announce({'completed': True})
+        self.close()
+
+    def close(self):
+        for out_file in self.out_files:
+            if not out_file.closed:
+                out_file.close()
+        self.container_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 class StorletInputFile(StorletFile):
     def __init__(self, md, obj_fd):
         super(StorletInputFile, self).__init__(obj_fd)
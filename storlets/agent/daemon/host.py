@@ -0,0 +1,228 @@
+# Copyright (c) 2010-2016 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import select
+
+from storlets.sbus import SBus
+from storlets.sbus import command as sbus_cmd
+from storlets.agent.common.server import EXIT_FAILURE, EXIT_SUCCESS
+from storlets.agent.common.utils import get_logger
+from storlets.agent.daemon.server import StorletDaemon
+
+HOST_CMD_ADD = 'add'
+HOST_CMD_REMOVE = 'remove'
+
+DEFAULT_HOST_POOL_SIZE = 16
+
+
+class StorletHostDaemon(object):
+    """
+    A daemon process which serves several python storlets
+
+    The host daemon listens on the SBus sockets of all the storlets it
+    serves, and dispatches the received commands to the storlet daemon
+    instances for each storlet. Every invocation runs in its own forked
+    process, which imports the storlet, so that the storlets do not share
+    their modules and the updated storlet is used once it is added again.
+    The number of the concurrent invocations is limited by a pool shared
+    among all the storlets.
+
+    The storlets are added and removed by the daemon factory, which sends
+    json lines via the control pipe.
+
+    :param control_fd: the read end of the control pipe
+    :param logger: a logger instance
+    :param pool_size: the maximum number of the storlet applications
+                      running concurrently
+    """
+
+    def __init__(self, control_fd, logger, pool_size):
+        self.control_fd = control_fd
+        self.logger = logger
+        self.pool_size = pool_size
+        self.sbus = None
+        self.epoll = None
+        self.control_buf = b''
+        # Map sbus fd to storlet daemon instance
+        self.fd_to_daemon = {}
+        # Map storlet name to sbus fd
+        self.storlet_name_to_fd = {}
+        # The pids of the running storlet applications, shared by all the
+        # storlet daemon instances
+        self.task_id_to_pid = {}
+
+    def add_storlet(self, storlet_name, sbus_path, python_path):
+        """
+        Start serving a storlet
+
+        :param storlet_name: the storlet name formatted as 'module.class'
+        :param sbus_path: the path to unix domain socket for the storlet
+        :param python_path: PYTHONPATH to import the storlet
+        """
+        if storlet_name in self.storlet_name_to_fd:
+            self.remove_storlet(storlet_name)
+
+        try:
+            daemon = StorletDaemon(storlet_name, sbus_path, self.logger,
+                                   self.pool_size, python_path=python_path)
+        except ValueError:
+            self.logger.exception('Failed to add storlet %s' % storlet_name)
+            return
+        daemon.task_id_to_pid = self.task_id_to_pid
+
+        fd = self.sbus.create(sbus_path)
+        if fd < 0:
+            self.logger.error('Failed to create SBus for storlet %s' %
+                              storlet_name)
+            return
+        self.epoll.register(fd, select.EPOLLIN)
+        self.fd_to_daemon[fd] = daemon
+        self.storlet_name_to_fd[storlet_name] = fd
+        self.logger.debug('Added storlet %s' % storlet_name)
+
+    def remove_storlet(self, storlet_name):
+        """
+        Stop serving a storlet
+
+        :param storlet_name: the storlet name formatted as 'module.class'
+        """
+        fd = self.storlet_name_to_fd.pop(storlet_name, None)
+        if fd is None:
+            return
+        self.epoll.unregister(fd)
+        os.close(fd)
+        self.fd_to_daemon.pop(fd)
+        self.logger.debug('Removed storlet %s' % storlet_name)
+
+    def handle_control(self):
+        """
+        Handle the commands sent from the daemon factory
+
+        :returns: False if the daemon factory closed the control pipe
+        """
+        data = os.read(self.control_fd, 65536)
+        if not data:
+            return False
+
+        lines = (self.control_buf + data).split(b'\n')
+        self.control_buf = lines.pop()
+        for line in lines:
+            try:
+                cmd = json.loads(line.decode('utf-8'))
+                if cmd['command'] == HOST_CMD_ADD:
+                    self.add_storlet(cmd['storlet_name'], cmd['uds_path'],
+                                     cmd['python_path'])
+                elif cmd['command'] == HOST_CMD_REMOVE:
+                    self.remove_storlet(cmd['storlet_name'])
+                else:
+                    self.logger.error('Unknown host command %s' %
+                                      cmd['command'])
+            except (ValueError, KeyError):
+                self.logger.exception('Invalid host command')
+        return True
+
+    def handle_request(self, fd):
+        """
+        Dispatch a command received via the sbus of a storlet
+
+        :param fd: the sbus fd
+        """
+        daemon = self.fd_to_daemon[fd]
+        dtg = self.sbus.receive(fd)
+        if dtg is None:
+            self.logger.error('Failed to receive message for storlet %s' %
+                              daemon.storlet_name)
+            return
+
+        if not daemon.dispatch_command(dtg) and \
+                dtg.command == sbus_cmd.SBUS_CMD_HALT:
+            # NOTE: Other storlets are still served by this process, so
+            #       we stop serving only the halted storlet
+            self.remove_storlet(daemon.storlet_name)
+
+    def main_loop(self):
+        """
+        Main loop to serve the storlets
+
+        :returns: EXIT_SUCCESS when the daemon factory closes the control
+                  pipe, EXIT_FAILURE when some error occurs in main loop
+        """
+        self.sbus = SBus()
+        self.epoll = select.epoll()
+        self.epoll.register(self.control_fd, select.EPOLLIN)
+
+        running = True
+        while running:
+            try:
+                events = self.epoll.poll()
+            except (IOError, OSError):
+                self.logger.exception('Failed to wait on SBus. exiting.')
+                return EXIT_FAILURE
+
+            for fd, _event in events:
+                if fd == self.control_fd:
+                    running = self.handle_control()
+                elif fd in self.fd_to_daemon:
+                    self.handle_request(fd)
+
+        self.logger.debug('Leaving main loop')
+        for storlet_name in list(self.storlet_name_to_fd):
+            self.remove_storlet(storlet_name)
+        self.epoll.close()
+
+        self.wait_all_tasks()
+        return EXIT_SUCCESS
+
+    def wait_all_tasks(self):
+        """
+        Wait until all of the storlet applications get terminated
+        """
+        self.logger.debug('Wait until all of the subprocesses are '
+                          'terminated')
+        while self.task_id_to_pid:
+            try:
+                pid = os.wait()[0]
+            except OSError:
+                # We do not have any subprocesses any more
+                break
+            for task_id, task_pid in list(self.task_id_to_pid.items()):
+                if task_pid == pid:
+                    self.task_id_to_pid.pop(task_id)
+        self.task_id_to_pid.clear()
+
+
+def run_host_daemon(control_fd, log_level, pool_size, container_id):
+    """
+    Run a storlet host daemon in this process
+
+    :param control_fd: the read end of the control pipe
+    :param log_level: log level
+    :param pool_size: the maximum number of the storlet applications
+                      running concurrently
+    :param container_id: container id
+    :returns: exit code of the host daemon
+    """
+    logger = get_logger("storlets-host-daemon", log_level, container_id)
+    logger.debug("Storlet Host Daemon started")
+
+    try:
+        SBus.start_logger("DEBUG", container_id=container_id)
+        host = StorletHostDaemon(control_fd, logger, pool_size)
+        return host.main_loop()
+    except Exception:
+        logger.exception('Unhandled exception')
+        return EXIT_FAILURE
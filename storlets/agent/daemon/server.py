@@ -12,20 +12,24 @@
 # implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import argparse
+# NOTE: The storlet daemon is started for the first invocation of each
+#       storlet, so keep the imports of this module small. e.g. argparse
+#       and uuid are not used to save the startup time.
+import binascii
 import errno
 import importlib
+import importlib.machinery
 import os
 import pwd
 import signal
 import sys
-import uuid
 from storlets.sbus import SBus
 from storlets.agent.common.server import command_handler, EXIT_FAILURE, \
     CommandSuccess, CommandFailure, SBusServer
 from storlets.agent.common.utils import get_logger
 from storlets.agent.daemon.files import StorletInputFile, \
-    StorletRangeInputFile, StorletOutputFile, StorletLogger
+    StorletRangeInputFile, StorletOutputFile, StorletOutputContainer, \
+    StorletLogger
 
 
 class StorletDaemonLoadError(Exception):
@@ -42,28 +46,71 @@ class StorletDaemon(SBusServer):
     :param sbus_path: path string to sbus
     :param logger: a logger instance
     :param pool_size: an integer for concurrency running the storlet apps
+    :param python_path: PYTHONPATH to import the storlet. If it is given,
+                        the storlet is imported in the process of each
+                        storlet application instead of this process, so
+                        that the storlets served by one process do not
+                        share their modules.
     """
 
-    def __init__(self, storlet_name, sbus_path, logger, pool_size):
+    def __init__(self, storlet_name, sbus_path, logger, pool_size,
+                 python_path=None):
         super(StorletDaemon, self).__init__(sbus_path, logger)
 
         self.storlet_name = str(storlet_name)
         try:
-            module_name, cls_name = self.storlet_name.split('.')
+            self.module_name, self.cls_name = self.storlet_name.split('.')
         except ValueError:
             raise ValueError("Invalid storlet name %s" % storlet_name)
 
-        try:
-            module = importlib.import_module(module_name)
-            self.storlet_cls = getattr(module, cls_name)
-        except (ImportError, AttributeError):
-            raise StorletDaemonLoadError(
-                "Failed to load storlet %s" % self.storlet_name)
+        self.python_path = python_path
+        self.storlet_cls = None
+        if python_path is None:
+            self.load_storlet()
 
         self.pool_size = pool_size
         self.task_id_to_pid = {}
         self.chunk_size = 16
 
+    def load_storlet(self):
+        """
+        Import the storlet class, unless it is already imported
+
+        :returns: the storlet class
+        :raises StorletDaemonLoadError: when it fails to import the storlet
+        """
+        if self.storlet_cls is None:
+            try:
+                module = importlib.import_module(self.module_name)
+                self.storlet_cls = getattr(module, self.cls_name)
+            except (ImportError, AttributeError):
+                raise StorletDaemonLoadError(
+                    "Failed to load storlet %s" % self.storlet_name)
+        return self.storlet_cls
+
+    def find_storlet(self):
+        """
+        Check if the storlet module is found in the PYTHONPATH, without
+        importing it into this process
+
+        :raises StorletDaemonLoadError: when the storlet module is not found
+        """
+        spec = importlib.machinery.PathFinder.find_spec(
+            self.module_name, self.python_path.split(':'))
+        if spec is None:
+            raise StorletDaemonLoadError(
+                "Failed to load storlet %s" % self.storlet_name)
+
+    def _close_fds(self, fds):
+        for fd in fds:
+            # We do not use fds in main process, so close them
+            try:
+                os.close(fd)
+            except OSError as e:
+                if e.errno != errno.EBADF:
+                    raise
+                pass
+
     def _cleanup_pids(self):
         """
         Remove pids which are already terminated
@@ -149,9 +196,19 @@ class StorletDaemon(SBusServer):
 
     @command_handler
     def execute(self, dtg):
+        try:
+            if self.python_path is None:
+                self.load_storlet()
+            else:
+                self.find_storlet()
+        except StorletDaemonLoadError as err:
+            self.logger.exception('Failed to load storlet')
+            self._close_fds(dtg.fds)
+            return CommandFailure(err.args[0])
+
         task_id_out_fd = dtg.task_id_out_fd
 
-        task_id = str(uuid.uuid4())[:8]
+        task_id = binascii.hexlify(os.urandom(4)).decode('ascii')
 
         while len(self.task_id_to_pid) >= self.pool_size:
             self._wait_child_process()
@@ -166,6 +223,8 @@ class StorletDaemon(SBusServer):
         in_fds = dtg.object_in_fds
         out_md_fds = dtg.object_metadata_out_fds
         out_fds = dtg.object_out_fds
+        trailing_md_fds = dtg.object_trailing_metadata_out_fds
+        container_fd = dtg.container_out_fd
         logger_fd = dtg.logger_out_fd
 
         pid = os.fork()
@@ -173,15 +232,7 @@ class StorletDaemon(SBusServer):
             self.logger.debug('Create a subprocess %d for task %s' %
                               (pid, task_id))
             self.task_id_to_pid[task_id] = pid
-
-            for fd in dtg.fds:
-                # We do not use fds in main process, so close them
-                try:
-                    os.close(fd)
-                except OSError as e:
-                    if e.errno != errno.EBADF:
-                        raise
-                    pass
+            self._close_fds(dtg.fds)
         else:
             try:
                 self.logger.debug('Start storlet invocation')
@@ -195,14 +246,31 @@ class StorletDaemon(SBusServer):
                             for st_md, md, in_fd
                             in zip(storlet_md, in_md, in_fds)]
 
-                out_files = [StorletOutputFile(out_md_fd, out_fd)
+                out_files = [StorletOutputFile(out_md_fd, out_fd,
+                                               out_fd in trailing_md_fds)
                              for out_md_fd, out_fd
                              in zip(out_md_fds, out_fds)]
 
+                container = None
+                if container_fd is not None:
+                    # The outputs after the first one are opened by the
+                    # storlet via the output container
+                    container = StorletOutputContainer(container_fd,
+                                                       out_files[1:])
+                    out_files = out_files[:1] + [container]
+
+                if self.python_path is not None:
+                    # The storlet is imported only in this process, so the
+                    # updated one is used from the next invocation
+                    sys.path[:0] = self.python_path.split(':')
+                    self.load_storlet()
+
                 self.logger.debug('Start storlet execution')
                 with StorletLogger(self.storlet_name, logger_fd) as slogger:
                     handler = self.storlet_cls(slogger)
                     handler(in_files, out_files, params)
+                if container is not None:
+                    container.complete()
                 self.logger.debug('Completed')
             except Exception:
                 self.logger.exception('Error in storlet invocation')
@@ -236,27 +304,27 @@ class StorletDaemon(SBusServer):
         self._wait_all_child_processes()
 
 
-def main():
+def run_daemon(storlet_name, sbus_path, log_level, pool_size, container_id):
     """
-    The entry point of daemon_factory process
+    Run a storlet daemon in this process
+
+    This is used both by the storlets-daemon command and by the daemon
+    factory, which forks storlet daemons from itself.
+
+    :param storlet_name: the storlet name formatted as 'module.class'
+    :param sbus_path: the path to unix domain socket
+    :param log_level: log level
+    :param pool_size: the maximum number of the storlet applications
+                      running concurrently
+    :param container_id: container id
+    :returns: exit code of the storlet daemon
     """
-    parser = argparse.ArgumentParser(
-        description='Daemon process to execute storlet applications')
-    parser.add_argument('storlet_name', help='storlet name')
-    parser.add_argument('sbus_path', help='the path to unix domain socket')
-    parser.add_argument('log_level', help='log level')
-    parser.add_argument('pool_size', type=int,
-                        help='the maximun thread numbers used swapns for '
-                             'one storlet application')
-    parser.add_argument('container_id', help='container id')
-    opts = parser.parse_args()
-
     # Initialize logger
-    logger = get_logger("storlets-daemon", opts.log_level, opts.container_id)
+    logger = get_logger("storlets-daemon", log_level, container_id)
     logger.debug("Storlet Daemon started")
 
     try:
-        SBus.start_logger("DEBUG", container_id=opts.container_id)
+        SBus.start_logger("DEBUG", container_id=container_id)
 
         # Impersonate the swift user
         pw = pwd.getpwnam('swift')
@@ -264,12 +332,39 @@ def main():
         os.setresuid(pw.pw_uid, pw.pw_uid, pw.pw_uid)
 
         # create an instance of storlet daemon
-        daemon = StorletDaemon(opts.storlet_name, opts.sbus_path,
-                               logger, opts.pool_size)
+        daemon = StorletDaemon(storlet_name, sbus_path, logger, pool_size)
 
         # Start the main loop
-        sys.exit(daemon.main_loop())
+        return daemon.main_loop()
 
     except Exception:
         logger.error('Unhandled exception')
-        sys.exit(EXIT_FAILURE)
+        return EXIT_FAILURE
+
+
+USAGE = 'usage: storlets-daemon storlet_name sbus_path log_level ' \
+    'pool_size container_id'
+
+
+def main():
+    """
+    The entry point of storlet daemon process
+
+    The arguments are
+      storlet_name: storlet name
+      sbus_path: the path to unix domain socket
+      log_level: log level
+      pool_size: the maximun thread numbers used swapns for one storlet
+                 application
+      container_id: container id
+    """
+    try:
+        storlet_name, sbus_path, log_level, pool_size, container_id = \
+            sys.argv[1:]
+        pool_size = int(pool_size)
+    except ValueError:
+        sys.stderr.write(USAGE + '\n')
+        sys.exit(2)
+
+    sys.exit(run_daemon(storlet_name, sbus_path, log_level, pool_size,
+                        container_id))
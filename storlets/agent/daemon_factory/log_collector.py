@@ -0,0 +1,149 @@
+# Copyright (c) 2010-2016 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+
+# The default number of lines logged for each storlet daemon per second
+DEFAULT_STDERR_RATE_LIMIT = 100
+
+# Lines longer than this are split
+MAX_LINE_LENGTH = 4096
+
+
+class StderrStream(object):
+    """
+    The stderr pipe of a storlet daemon
+
+    :param storlet_name: the storlet name used to tag the lines
+    :param fobj: the file object of the read end of the pipe
+    """
+
+    def __init__(self, storlet_name, fobj):
+        self.storlet_name = storlet_name
+        self.fobj = fobj
+        self.buf = b''
+        # The second when the current rate limit window started, and the
+        # numbers of the lines logged and suppressed in the window
+        self.window = None
+        self.logged = 0
+        self.suppressed = 0
+
+
+class StderrCollector(object):
+    """
+    Forward the stderr output of the storlet daemons to the logger
+
+    The daemon factory watches the stderr pipes of all the storlet daemons
+    in its main loop, and passes the readable ones to this collector, which
+    logs each line tagged with the storlet name. At most rate_limit lines
+    are logged for each storlet daemon per second, so that a noisy daemon
+    does not flood the log.
+
+    :param logger: a logger instance
+    :param rate_limit: the number of lines logged for each storlet daemon
+                       per second, or 0 for no limit
+    """
+
+    def __init__(self, logger, rate_limit=DEFAULT_STDERR_RATE_LIMIT):
+        self.logger = logger
+        self.rate_limit = rate_limit
+        # Map fd to StderrStream instance
+        self.fd_to_stream = {}
+
+    def add(self, storlet_name, fobj):
+        """
+        Start collecting the output of a stderr pipe
+
+        :param storlet_name: the storlet name used to tag the lines
+        :param fobj: the file object of the read end of the pipe
+        :returns: the fd to watch
+        """
+        fd = fobj.fileno()
+        os.set_blocking(fd, False)
+        self.fd_to_stream[fd] = StderrStream(storlet_name, fobj)
+        return fd
+
+    def read(self, fd):
+        """
+        Read the available output from a stderr pipe and log it
+
+        :param fd: the fd of the pipe
+        :returns: False when the pipe is closed and no longer collected
+        """
+        stream = self.fd_to_stream[fd]
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return True
+        except OSError:
+            self.logger.exception('Failed to read stderr of the storlet '
+                                  'daemon %s' % stream.storlet_name)
+            data = b''
+
+        if not data:
+            # The storlet daemon exited
+            if stream.buf:
+                self._log(stream, stream.buf)
+            self._flush_suppressed(stream)
+            self.remove(fd)
+            return False
+
+        lines = (stream.buf + data).split(b'\n')
+        stream.buf = lines.pop()
+        while len(stream.buf) > MAX_LINE_LENGTH:
+            lines.append(stream.buf[:MAX_LINE_LENGTH])
+            stream.buf = stream.buf[MAX_LINE_LENGTH:]
+        for line in lines:
+            self._log(stream, line)
+        return True
+
+    def _log(self, stream, line):
+        if self.rate_limit:
+            now = int(time.time())
+            if stream.window != now:
+                self._flush_suppressed(stream)
+                stream.window = now
+                stream.logged = 0
+            if stream.logged >= self.rate_limit:
+                stream.suppressed += 1
+                return
+            stream.logged += 1
+
+        self.logger.warning('[%s] %s' % (
+            stream.storlet_name, line.decode('utf-8', 'replace').rstrip()))
+
+    def _flush_suppressed(self, stream):
+        if stream.suppressed:
+            self.logger.warning('[%s] %d lines suppressed' %
+                                (stream.storlet_name, stream.suppressed))
+            stream.suppressed = 0
+
+    def remove(self, fd):
+        """
+        Stop collecting the output of a stderr pipe, and close it
+
+        :param fd: the fd of the pipe
+        """
+        stream = self.fd_to_stream.pop(fd, None)
+        if stream is not None:
+            stream.fobj.close()
+
+    def close(self):
+        """
+        Close all of the stderr pipes
+        """
+        for fd in list(self.fd_to_stream):
+            self.remove(fd)
@@ -14,8 +14,10 @@
 # limitations under the License.
 import argparse
 import errno
+import json
 import os
 import pwd
+import select
 import signal
 import subprocess
 import sys
@@ -27,7 +29,38 @@ from storlets.sbus.client.exceptions import SBusClientException, \
     SBusClientSendError
 from storlets.agent.common.server import command_handler, EXIT_FAILURE, \
     CommandSuccess, CommandFailure, SBusServer
-from storlets.agent.common.utils import get_logger, DEFAULT_PY2, DEFAULT_PY3
+from storlets.agent.common.utils import get_logger, DEFAULT_PY2, \
+    DEFAULT_PY3, DAEMON_HISTORY_FILE, FACTORY_READY_FILE
+# NOTE: The daemon modules are imported here so that the python storlet
+#       daemons forked from the factory process do not have to import them
+from storlets.agent.daemon.host import run_host_daemon, HOST_CMD_ADD, \
+    HOST_CMD_REMOVE, DEFAULT_HOST_POOL_SIZE
+from storlets.agent.daemon.server import run_daemon
+from storlets.agent.daemon_factory.log_collector import \
+    DEFAULT_STDERR_RATE_LIMIT, StderrCollector
+
+
+# Seconds between the housekeeping tasks, like evicting the storlet daemons
+# and saving the history
+HOUSEKEEPING_INTERVAL = 10
+# The storlet daemons used in this period are not evicted to keep the memory
+# budget, because the gateway may be about to execute them
+EVICTION_GRACE_PERIOD = 30
+# The number of the storlets kept in the history
+HISTORY_SIZE = 10
+# Seconds between the checks of the crashed storlet daemons waiting for
+# restart
+RESTART_CHECK_INTERVAL = 1
+# The backoff before restarting a storlet daemon which crashed again, which
+# doubles for each crash up to the max
+RESTART_BACKOFF_BASE = 1
+RESTART_BACKOFF_MAX = 60
+# The name the stderr output of the storlet host daemon is tagged with
+HOST_DAEMON_NAME = 'storlet-host-daemon'
+# A storlet daemon which crashes this number of times in the window is not
+# restarted any more until the gateway starts it
+CRASH_LOOP_THRESHOLD = 5
+CRASH_LOOP_WINDOW = 300
 
 
 class SDaemonError(Exception):
@@ -39,14 +72,86 @@ class StorletDaemonFactory(SBusServer):
     An SBusServer implementation for storlets application factory
     """
 
-    def __init__(self, sbus_path, logger, container_id):
+    def __init__(self, sbus_path, logger, container_id, use_zygote=True,
+                 use_host_daemon=False,
+                 host_pool_size=DEFAULT_HOST_POOL_SIZE,
+                 daemon_idle_timeout=0, memory_budget=0,
+                 history_path=None, ready_path=None,
+                 stderr_rate_limit=DEFAULT_STDERR_RATE_LIMIT,
+                 restart_crashed_daemons=False):
         """
         :param sbus_path: Path to the pipe file internal SBus listens to
         :param logger: Logger to dump the information to
         :param container_id: Container id
+        :param use_zygote: Whether python storlet daemons are forked from
+                           the factory process instead of being started
+                           as new interpreters
+        :param use_host_daemon: Whether python storlets are served by one
+                                shared storlet host daemon
+        :param host_pool_size: Number of the storlet applications the
+                               storlet host daemon runs concurrently
+        :param daemon_idle_timeout: Seconds after which the unused storlet
+                                    daemons are stopped, or 0 to keep them
+                                    running
+        :param memory_budget: Bytes of resident memory the storlet daemons
+                              can use in total, or 0 for no limit. The least
+                              recently used daemons are stopped to keep it.
+        :param history_path: Path to the file where the history of the most
+                             used storlets and their start parameters is
+                             saved, so that the gateway can pre-start them
+                             after the sandbox restarts
+        :param ready_path: Path to the file created once the factory
+                           listens on its SBus, so that the gateway need
+                           not poll it with ping
+        :param stderr_rate_limit: Number of lines of the stderr output
+                                  logged for each storlet daemon per second
+        :param restart_crashed_daemons: Whether the storlet daemons which
+                                        exit unexpectedly are restarted
+                                        without waiting for the next request
         """
         super(StorletDaemonFactory, self).__init__(sbus_path, logger)
         self.container_id = container_id
+        self.use_zygote = use_zygote
+        self.use_host_daemon = use_host_daemon
+        self.host_pool_size = host_pool_size
+        # PID of the storlet host daemon, and the pipe to control it
+        self.host_pid = None
+        self.host_control_fd = None
+        # Dictionary: map storlet name served by the host daemon to
+        # pipe name
+        self.hosted_storlets = dict()
+        # Dictionary: map storlet name to the time when it is used last
+        self.storlet_name_to_last_use = dict()
+
+        self.daemon_idle_timeout = daemon_idle_timeout
+        self.memory_budget = memory_budget
+        self.history_path = history_path
+        self.ready_path = ready_path
+        self.stderr_collector = StderrCollector(logger, stderr_rate_limit)
+        # Dictionary: map storlet name to the number of uses and the start
+        # parameters
+        self.history = self.load_history()
+        self.history_updated = False
+        if daemon_idle_timeout or memory_budget or history_path:
+            self.housekeeping_interval = HOUSEKEEPING_INTERVAL
+        self.restart_crashed_daemons = restart_crashed_daemons
+        if restart_crashed_daemons:
+            self.housekeeping_interval = RESTART_CHECK_INTERVAL
+        # The pipe which the SIGCHLD handler writes to
+        self.sigchld_fds = None
+        # Dictionary: map storlet name to the start parameters
+        self.storlet_name_to_params = dict()
+        # Dictionary: map storlet name to the times when it crashed
+        self.storlet_name_to_crashes = dict()
+        # Dictionary: map storlet name to the time when it is restarted
+        self.pending_restarts = dict()
+        # Dictionary: map storlet name being restarted to the time when its
+        # daemon is spawned, until the daemon responds
+        self.starting_daemons = dict()
+        # Dictionary: map PID of the storlet daemon reaped while its status
+        # is checked to its exit status
+        self.reaped_statuses = dict()
+        self.last_housekeeping = time.time()
         # Dictionary: map storlet name to pipe name
         self.storlet_name_to_pipe_name = dict()
         # Dictionary: map storlet name to daemon process PID
@@ -101,20 +206,34 @@ class StorletDaemonFactory(SBusServer):
                  uds_path, log_level, str(pool_size), self.container_id]
         return pargs, env
 
-    def get_python_args(self, daemon_language, storlet_path, storlet_name,
-                        pool_size, uds_path, log_level,
-                        daemon_language_version):
+    def get_python_version(self, daemon_language_version):
+        """
+        Resolve the python version the storlet daemon runs with
+
+        :param daemon_language_version: daemon language version
+        :returns: the version of the python interpreter
+        """
         daemon_language_version = daemon_language_version or 3
         # TODO(takashi): Drop Py2 support
         if int(float(daemon_language_version)) == 2:
-            daemon_language_version = DEFAULT_PY2
+            return DEFAULT_PY2
         else:
-            daemon_language_version = DEFAULT_PY3
+            return DEFAULT_PY3
+
+    def get_python_args(self, daemon_language, storlet_path, storlet_name,
+                        pool_size, uds_path, log_level,
+                        daemon_language_version):
+        daemon_language_version = \
+            self.get_python_version(daemon_language_version)
 
         python_interpreter = '/usr/bin/python%s' % daemon_language_version
         str_daemon_main_file = '/usr/local/libexec/storlets/storlets-daemon'
-        pargs = [python_interpreter, str_daemon_main_file, storlet_name,
-                 uds_path, log_level, str(pool_size), self.container_id]
+        # -s: the user site directory is not used in the sandbox
+        # -B: the storlet directory is read-only, and the bytecode of the
+        #     storlets is compiled by the gateway
+        pargs = [python_interpreter, '-s', '-B', str_daemon_main_file,
+                 storlet_name, uds_path, log_level, str(pool_size),
+                 self.container_id]
 
         python_path = os.path.join('/home/swift/', storlet_name)
         if os.environ.get('PYTHONPATH'):
@@ -122,13 +241,240 @@ class StorletDaemonFactory(SBusServer):
         env = {'PYTHONPATH': python_path}
         return pargs, env
 
-    def spawn_subprocess(self, pargs, env, storlet_name):
+    def can_fork_python_daemon(self, daemon_language_version):
+        """
+        Check if the python storlet daemon can be forked from the factory
+        process, which requires the factory to run with the same python
+        the storlet daemon is started with
+
+        :param daemon_language_version: daemon language version
+        :returns: True if the storlet daemon can be forked
+        """
+        if not self.use_zygote:
+            return False
+        version = str(self.get_python_version(daemon_language_version))
+        return version == '%d.%d' % sys.version_info[:2]
+
+    def fork_python_daemon(self, storlet_name, uds_path, log_level,
+                           pool_size, python_path):
+        """
+        Fork a python storlet daemon from the factory process
+
+        The factory process has already imported the storlet daemon
+        framework, so the forked process only has to import the storlet
+        itself before it starts its main loop.
+
+        :param storlet_name: Storlet main class name
+        :param uds_path: Path to pipe daemon is going to listen to
+        :param log_level: Logger verbosity level
+        :param pool_size: Number of the storlet applications the storlet
+                          daemon runs concurrently
+        :param python_path: PYTHONPATH for the storlet daemon
+        :returns: PID of the forked storlet daemon
+        :raises SDaemonError: when it fails to fork the storlet daemon
+        """
+        try:
+            pid = self._fork_with_stderr(storlet_name)
+        except OSError:
+            self.logger.exception('Unable to fork the storlet daemon')
+            raise SDaemonError('Unable to start the storlet daemon {0}'.
+                               format(storlet_name))
+        if pid:
+            return pid
+
+        # In the forked storlet daemon
+        code = EXIT_FAILURE
+        try:
+            self._init_forked_daemon(python_path)
+            code = run_daemon(storlet_name, uds_path, log_level,
+                              int(pool_size), self.container_id)
+        finally:
+            os._exit(code)
+
+    def _fork_with_stderr(self, name):
+        """
+        Fork a daemon whose stderr is collected by the factory process, the
+        same as the storlet daemons started as new processes
+
+        :param name: the name the stderr output is tagged with
+        :returns: PID of the forked daemon in the factory process, and 0 in
+                  the forked daemon
+        :raises OSError: when it fails to fork the daemon
+        """
+        read_fd, write_fd = os.pipe()
+        try:
+            pid = os.fork()
+        except OSError:
+            os.close(read_fd)
+            os.close(write_fd)
+            raise
+
+        if pid:
+            os.close(write_fd)
+            self.collect_stderr(name, os.fdopen(read_fd, 'rb'))
+        else:
+            os.close(read_fd)
+            os.dup2(write_fd, 2)
+            os.close(write_fd)
+        return pid
+
+    def _init_forked_daemon(self, python_path, keep_fds=()):
+        # The forked daemon waits for its own children
+        if self.sigchld_fds is not None:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+        # Drop the file descriptors inherited from the factory process,
+        # the same as the subprocess started with close_fds=True
+        with open(os.devnull, 'wb') as dn:
+            os.dup2(dn.fileno(), 1)
+        low = 3
+        for fd in sorted(keep_fds):
+            os.closerange(low, fd)
+            low = fd + 1
+        os.closerange(low, os.sysconf('SC_OPEN_MAX'))
+
+        if python_path:
+            os.environ['PYTHONPATH'] = python_path
+            for path in reversed(python_path.split(':')):
+                if path not in sys.path:
+                    sys.path.insert(0, path)
+
+    def spawn_python_daemon(self, storlet_name, uds_path, log_level,
+                            pool_size, python_path, wait=True):
+        """
+        Fork a python storlet daemon and wait until it gets ready
+
+        :param storlet_name: Storlet main class name
+        :param uds_path: Path to pipe daemon is going to listen to
+        :param log_level: Logger verbosity level
+        :param pool_size: Number of the storlet applications the storlet
+                          daemon runs concurrently
+        :param python_path: PYTHONPATH for the storlet daemon
+        :param wait: Whether to wait until the storlet daemon responds
+        :raises SDaemonError: when it fails to fork the storlet daemon, or
+                              the forked daemon is not responsive
+        """
+        self.logger.debug('Forking the storlet daemon {0}'
+                          .format(storlet_name))
+        pid = self.fork_python_daemon(storlet_name, uds_path, log_level,
+                                      pool_size, python_path)
+        self.logger.debug('Forked the storlet daemon {0} with pid {1}'
+                          .format(storlet_name, pid))
+        # The forked daemon does not have to initialize the interpreter,
+        # so we can start pinging it right away
+        self.check_spawned_daemon(pid, storlet_name, wait)
+
+    def can_host_python_daemon(self, storlet_name, daemon_language_version):
+        """
+        Check if the python storlet can be served by the storlet host daemon
+
+        :param storlet_name: Storlet main class name
+        :param daemon_language_version: daemon language version
+        :returns: True if the storlet can be served by the host daemon
+        """
+        # NOTE: The host daemon imports each storlet only in the process of
+        #       each invocation, so the storlets can have the modules with
+        #       the same names
+        return self.use_host_daemon and \
+            self.can_fork_python_daemon(daemon_language_version)
+
+    def start_host_daemon(self, log_level):
+        """
+        Fork the storlet host daemon from the factory process
+
+        :param log_level: Logger verbosity level
+        :raises SDaemonError: when it fails to fork the host daemon
+        """
+        read_fd, write_fd = os.pipe()
+        try:
+            pid = self._fork_with_stderr(HOST_DAEMON_NAME)
+        except OSError:
+            os.close(read_fd)
+            os.close(write_fd)
+            self.logger.exception('Unable to fork the storlet host daemon')
+            raise SDaemonError('Unable to start the storlet host daemon')
+
+        if pid:
+            os.close(read_fd)
+            self.logger.debug('Forked the storlet host daemon with pid {0}'
+                              .format(pid))
+            self.host_pid = pid
+            self.host_control_fd = write_fd
+            return
+
+        # In the forked host daemon
+        code = EXIT_FAILURE
+        try:
+            os.close(write_fd)
+            self._init_forked_daemon(None, keep_fds=(read_fd,))
+            code = run_host_daemon(read_fd, log_level, self.host_pool_size,
+                                   self.container_id)
+        finally:
+            os._exit(code)
+
+    def stop_host_daemon(self):
+        """
+        Stop the storlet host daemon, by closing its control pipe
+        """
+        if self.host_control_fd is not None:
+            os.close(self.host_control_fd)
+            self.host_control_fd = None
+        if self.host_pid is not None:
+            try:
+                os.waitpid(self.host_pid, 0)
+            except OSError as err:
+                if err.errno != errno.ECHILD:
+                    self.logger.exception(
+                        'Failed to wait the storlet host daemon')
+            self.host_pid = None
+        for storlet_name in self.hosted_storlets:
+            self.storlet_name_to_pid.pop(storlet_name, None)
+        self.hosted_storlets = dict()
+
+    def _send_host_command(self, command, **params):
+        params['command'] = command
+        line = json.dumps(params) + '\n'
+        try:
+            os.write(self.host_control_fd, line.encode('utf-8'))
+        except OSError:
+            self.logger.exception('Failed to send command to the storlet '
+                                  'host daemon')
+            raise SDaemonError('Failed to send {0} command to the storlet '
+                               'host daemon'.format(command))
+
+    def spawn_hosted_daemon(self, storlet_name, uds_path, log_level,
+                            python_path, wait=True):
+        """
+        Let the storlet host daemon serve a python storlet, and wait until
+        it gets ready
+
+        :param storlet_name: Storlet main class name
+        :param uds_path: Path to pipe daemon is going to listen to
+        :param log_level: Logger verbosity level
+        :param python_path: PYTHONPATH for the storlet
+        :param wait: Whether to wait until the storlet responds
+        :raises SDaemonError: when it fails to start the host daemon, or
+                              the storlet is not responsive
+        """
+        if self.host_pid is None or not self.get_process_status_by_pid(
+                self.host_pid, 'storlet host daemon'):
+            self.stop_host_daemon()
+            self.start_host_daemon(log_level)
+
+        self._send_host_command(HOST_CMD_ADD, storlet_name=storlet_name,
+                                uds_path=uds_path, python_path=python_path)
+        self.hosted_storlets[storlet_name] = uds_path
+        self.check_spawned_daemon(self.host_pid, storlet_name, wait)
+
+    def spawn_subprocess(self, pargs, env, storlet_name, wait=True):
         """
         Launch a JVM process for some storlet daemon
 
         :param pargs: Arguments for the JVM
         :param env: Environment value
         :param storlet_name: Name of the storlet to be executed
+        :param wait: Whether to wait until the storlet daemon responds
 
         :raises StorletDaemonError: when it fails to start subprocess, or it
                                     can not check the status of the subprocess
@@ -137,37 +483,85 @@ class StorletDaemonFactory(SBusServer):
         str_pargs = ' '.join(pargs)
         self.logger.debug('Starting subprocess: pargs:{0} env:{1}'
                           .format(str_pargs, env))
-        # TODO(takashi): We had better use contextmanager
-        # TODO(takashi): Where is this closed?
         try:
-            dn = open(os.devnull, 'wb')
             daemon_p = subprocess.Popen(
-                pargs, stdout=dn, stderr=subprocess.PIPE,
+                pargs, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
                 close_fds=True, shell=False, env=env)
-            logger_p = subprocess.Popen(
-                'logger', stdin=daemon_p.stderr, stdout=dn, stderr=dn,
-                close_fds=True, shell=False)
         except OSError:
             self.logger.exception('Unable to start subprocess')
             raise SDaemonError('Unable to start the storlet daemon {0}'.
                                format(storlet_name))
+        self.collect_stderr(storlet_name, daemon_p.stderr)
 
-        # Wait for the storlet daemon initializes itself
-        time.sleep(1)
+        if wait:
+            # Wait for the storlet daemon initializes itself
+            self.wait_collecting_stderr(1)
         self.logger.debug('Started the storlet daemon {0} with pid {1}'
-                          .format(daemon_p.pid, logger_p.pid))
+                          .format(storlet_name, daemon_p.pid))
+        self.check_spawned_daemon(daemon_p.pid, storlet_name, wait)
+
+    def collect_stderr(self, storlet_name, fobj):
+        """
+        Log the stderr output of a storlet daemon from the main loop
+
+        :param storlet_name: Name of the storlet
+        :param fobj: File object of the stderr pipe of the storlet daemon
+        """
+        fd = self.stderr_collector.add(storlet_name, fobj)
+
+        def handler():
+            if not self.stderr_collector.read(fd):
+                self.fd_handlers.pop(fd)
+
+        self.fd_handlers[fd] = handler
+
+    def wait_collecting_stderr(self, seconds):
+        """
+        Wait while logging the stderr output of the storlet daemons, which
+        is usually done in the main loop, so that a starting storlet daemon
+        does not block on its full stderr pipe
 
+        :param seconds: Seconds to wait
+        """
+        deadline = time.time() + seconds
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return
+            fds = [fd for fd in self.stderr_collector.fd_to_stream
+                   if fd in self.fd_handlers]
+            if not fds:
+                time.sleep(timeout)
+                return
+            readable = select.select(fds, [], [], timeout)[0]
+            for fd in readable:
+                self.fd_handlers[fd]()
+
+    def check_spawned_daemon(self, pid, storlet_name, wait=True):
+        """
+        Check that the spawned storlet daemon keeps running, and wait until
+        it responds
+
+        :param pid: PID of the storlet daemon
+        :param storlet_name: Name of the storlet to be executed
+        :param wait: Whether to wait until the storlet daemon responds.
+                     Otherwise it is pinged in the housekeeping.
+        :raises SDaemonError: when the storlet daemon is terminated or
+                              not responsive
+        """
         # Does the storlet daemon keep running?
         try:
-            status = self.get_process_status_by_pid(daemon_p.pid,
-                                                    storlet_name)
+            status = self.get_process_status_by_pid(pid, storlet_name)
         except SDaemonError:
             raise SDaemonError('The storlet daemon {0} is terminated'
                                .format(storlet_name))
 
         if status:
             # Keep PID of the storlet daemon subprocess
-            self.storlet_name_to_pid[storlet_name] = daemon_p.pid
+            self.storlet_name_to_pid[storlet_name] = pid
+            if not wait:
+                self.starting_daemons[storlet_name] = time.time()
+                return
             if not self.wait_for_daemon_to_initialize(storlet_name):
                 raise SDaemonError('No response from the storlet daemon '
                                    '{0}'.format(storlet_name))
@@ -201,12 +595,27 @@ class StorletDaemonFactory(SBusServer):
             except SBusClientException:
                 self.logger.exception('Failed to send sbus command')
                 break
-            time.sleep(1)
+            self.wait_collecting_stderr(1)
         return False
 
+    def wait_for_starting_daemon(self, storlet_name):
+        """
+        Wait until the storlet daemon being restarted responds, before it
+        is used
+
+        :param storlet_name: Storlet name
+        :raises SDaemonError: when the storlet daemon is not responsive
+        """
+        if self.starting_daemons.pop(storlet_name, None) is None:
+            return
+        if not self.wait_for_daemon_to_initialize(storlet_name):
+            raise SDaemonError('No response from the storlet daemon '
+                               '{0}'.format(storlet_name))
+
     def process_start_daemon(self, daemon_language, storlet_path, storlet_name,
                              pool_size, uds_path, log_level,
-                             daemon_language_version=None):
+                             daemon_language_version=None, record=True,
+                             wait=True):
         """
         Start storlet daemon process
 
@@ -220,6 +629,8 @@ class StorletDaemonFactory(SBusServer):
         :param log_level: Logger verbosity level
         :param daemon_language_version: daemon language version (e.g. py2, py3)
             only python lang supports this option
+        :param record: Whether this is recorded as a use of the storlet
+        :param wait: Whether to wait until the storlet daemon responds
 
         :returns: True if it starts a new subprocess
                   False if there already exists a running process
@@ -242,15 +653,37 @@ class StorletDaemonFactory(SBusServer):
 
         self.logger.debug('Validating that {0} is not already running'.
                           format(storlet_name))
+        params = {
+            'daemon_language': daemon_language,
+            'storlet_path': storlet_path,
+            'pool_size': pool_size,
+            'uds_path': uds_path,
+            'log_level': log_level,
+            'daemon_language_version': daemon_language_version}
+        self.storlet_name_to_params[storlet_name] = params
+        if record:
+            self.record_use(storlet_name, params)
         if self.get_process_status_by_name(storlet_name):
             self.logger.debug('The storlet daemon for {0} is already running'.
                               format(storlet_name))
+            if wait:
+                self.wait_for_starting_daemon(storlet_name)
             return False
         else:
             self.logger.debug('The storlet daemon {0} is not running. '
                               'Spawn the storlet daemon'.
                               format(storlet_name))
-            self.spawn_subprocess(pargs, env, storlet_name)
+            if daemon_language.lower() == 'python' and \
+                    self.can_host_python_daemon(storlet_name,
+                                                daemon_language_version):
+                self.spawn_hosted_daemon(storlet_name, uds_path, log_level,
+                                         env['PYTHONPATH'], wait)
+            elif daemon_language.lower() == 'python' and \
+                    self.can_fork_python_daemon(daemon_language_version):
+                self.spawn_python_daemon(storlet_name, uds_path, log_level,
+                                         pool_size, env['PYTHONPATH'], wait)
+            else:
+                self.spawn_subprocess(pargs, env, storlet_name, wait)
             return True
 
     def get_process_status_by_name(self, storlet_name):
@@ -303,6 +736,9 @@ class StorletDaemonFactory(SBusServer):
         else:
             self.logger.debug('The storlet daemon {0} is terminated'
                               .format(storlet_name))
+            if pid and self.sigchld_fds is not None:
+                # Let check_daemon_exits know how it exited
+                self.reaped_statuses[pid] = rc
             return False
 
     def process_kill(self, storlet_name):
@@ -321,6 +757,15 @@ class StorletDaemonFactory(SBusServer):
         if dmn_pid is None:
             raise SDaemonError('{0} is not found'.format(storlet_name))
 
+        if storlet_name in self.hosted_storlets:
+            # Other storlets are served by the same process, so we just
+            # stop serving the storlet
+            self._send_host_command(HOST_CMD_REMOVE,
+                                    storlet_name=storlet_name)
+            self.hosted_storlets.pop(storlet_name)
+            self.storlet_name_to_pid.pop(storlet_name)
+            return dmn_pid, 0
+
         try:
             os.kill(dmn_pid, signal.SIGKILL)
             obtained_pid, obtained_code = os.waitpid(dmn_pid, os.WNOHANG)
@@ -425,6 +870,13 @@ class StorletDaemonFactory(SBusServer):
                 'Failed to send halt command to the storlet daemon {0}'
                 .format(storlet_name))
 
+        if storlet_name in self.hosted_storlets:
+            # The host daemon stops serving the halted storlet, but it keeps
+            # running for the other storlets
+            self.hosted_storlets.pop(storlet_name)
+            self.storlet_name_to_pid.pop(storlet_name)
+            return
+
         try:
             os.waitpid(dmn_pid, 0)
             self.storlet_name_to_pid.pop(storlet_name)
@@ -435,6 +887,330 @@ class StorletDaemonFactory(SBusServer):
             raise SDaemonError('Failed to wait the storlet daemon {0}'
                                .format(storlet_name))
 
+    def record_use(self, storlet_name, params=None):
+        """
+        Record that a storlet is used
+
+        :param storlet_name: Storlet name
+        :param params: a dict of the start parameters of the storlet daemon
+        """
+        self.storlet_name_to_last_use[storlet_name] = time.time()
+        if not self.history_path:
+            return
+        entry = self.history.setdefault(storlet_name, {'count': 0})
+        entry['count'] += 1
+        if params is not None:
+            entry['params'] = params
+        self.history_updated = True
+
+    def load_history(self):
+        """
+        Load the history saved by the previous daemon factory process
+
+        :returns: a dict which maps storlet name to the history entry
+        """
+        if not self.history_path:
+            return dict()
+        try:
+            with open(self.history_path) as f:
+                history = json.load(f)
+        except (IOError, OSError, ValueError):
+            return dict()
+        if not isinstance(history, dict):
+            return dict()
+        return history
+
+    def save_history(self):
+        """
+        Save the history of the most used storlets
+        """
+        # We can not start the storlets without the start parameters
+        entries = sorted(
+            [(entry['count'], name) for name, entry in self.history.items()
+             if 'params' in entry], reverse=True)[:HISTORY_SIZE]
+        self.history = dict((name, self.history[name])
+                            for _count, name in entries)
+        tmp_path = self.history_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.history, f)
+            os.rename(tmp_path, self.history_path)
+        except (IOError, OSError):
+            self.logger.exception('Failed to save the storlet daemon '
+                                  'history')
+            return
+        self.history_updated = False
+
+    def get_process_rss(self, pid):
+        """
+        Get the resident memory size of a process
+
+        The storlet daemons forked from the factory process share most of
+        their pages with it by copy-on-write, so the proportional set size,
+        which divides the shared pages among the processes sharing them, is
+        used. When it is not available, the resident pages except the
+        shared ones are counted.
+
+        :param pid: Process ID
+        :returns: the resident memory size in bytes, or 0 if it is unknown
+        """
+        try:
+            with open('/proc/%d/smaps_rollup' % pid) as f:
+                for line in f:
+                    if line.startswith('Pss:'):
+                        return int(line.split()[1]) * 1024
+        except (IOError, OSError, ValueError, IndexError):
+            pass
+
+        try:
+            with open('/proc/%d/statm' % pid) as f:
+                fields = f.read().split()
+            pages = int(fields[1]) - int(fields[2])
+        except (IOError, OSError, ValueError, IndexError):
+            return 0
+        return pages * os.sysconf('SC_PAGE_SIZE')
+
+    def evict_daemon(self, storlet_name, reason):
+        """
+        Stop a storlet daemon which is not needed to be kept running. The
+        gateway starts it again when the storlet is invoked next time.
+
+        :param storlet_name: Storlet name
+        :param reason: the reason why the daemon is evicted
+        """
+        self.logger.info('Evicting the storlet daemon {0}: {1}'
+                         .format(storlet_name, reason))
+        dmn_pid = self.storlet_name_to_pid.get(storlet_name)
+        try:
+            pid, _code = self.process_kill(storlet_name)
+        except SDaemonError:
+            self.logger.exception('Failed to evict the storlet daemon {0}'
+                                  .format(storlet_name))
+            return
+        self.storlet_name_to_last_use.pop(storlet_name, None)
+        if not pid:
+            # Reap the killed daemon
+            try:
+                os.waitpid(dmn_pid, 0)
+            except OSError:
+                pass
+
+    def evict_idle_daemons(self, now):
+        """
+        Stop the storlet daemons not used in daemon_idle_timeout
+
+        :param now: current time
+        """
+        for storlet_name in list(self.storlet_name_to_pid):
+            last_use = self.storlet_name_to_last_use.get(storlet_name, now)
+            if now - last_use > self.daemon_idle_timeout:
+                self.evict_daemon(storlet_name, 'idle for %d seconds' %
+                                  (now - last_use))
+
+    def evict_daemons_over_budget(self, now):
+        """
+        Stop the least recently used storlet daemons until the storlet
+        daemons use less memory than memory_budget in total
+
+        :param now: current time
+        """
+        # NOTE: The storlets served by the host daemon share the process
+        #       so stopping them does not reduce the memory usage
+        rss = dict()
+        for storlet_name, pid in self.storlet_name_to_pid.items():
+            if storlet_name not in self.hosted_storlets:
+                rss[storlet_name] = self.get_process_rss(pid)
+        total = sum(rss.values())
+        if self.host_pid is not None:
+            total += self.get_process_rss(self.host_pid)
+
+        for storlet_name in sorted(
+                rss, key=lambda x: self.storlet_name_to_last_use.get(x, 0)):
+            if total <= self.memory_budget:
+                break
+            last_use = self.storlet_name_to_last_use.get(storlet_name, 0)
+            if now - last_use < EVICTION_GRACE_PERIOD:
+                break
+            self.evict_daemon(storlet_name, 'memory usage %d exceeds '
+                              'the budget %d' % (total, self.memory_budget))
+            total -= rss[storlet_name]
+
+    def start_supervision(self):
+        """
+        Get notified of the exits of the storlet daemons in the main loop
+        """
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(read_fd, False)
+        os.set_blocking(write_fd, False)
+        # NOTE: The handler does nothing, but the signal makes python write
+        #       to the wakeup fd, which is watched in the main loop
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.set_wakeup_fd(write_fd)
+        self.sigchld_fds = (read_fd, write_fd)
+        self.fd_handlers[read_fd] = self.handle_sigchld
+
+    def stop_supervision(self):
+        if self.sigchld_fds is None:
+            return
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        read_fd, write_fd = self.sigchld_fds
+        self.fd_handlers.pop(read_fd, None)
+        os.close(read_fd)
+        os.close(write_fd)
+        self.sigchld_fds = None
+
+    def handle_sigchld(self):
+        try:
+            while os.read(self.sigchld_fds[0], 4096):
+                pass
+        except BlockingIOError:
+            pass
+        self.check_daemon_exits(time.time())
+
+    def check_daemon_exits(self, now):
+        """
+        Find the storlet daemons which exited without being stopped by the
+        factory, and schedule the restart of the crashed ones
+
+        :param now: current time
+        """
+        for storlet_name, pid in list(self.storlet_name_to_pid.items()):
+            if storlet_name in self.hosted_storlets:
+                continue
+            try:
+                obtained_pid, status = os.waitpid(pid, os.WNOHANG)
+            except OSError as err:
+                if err.errno != errno.ECHILD:
+                    continue
+                # Already reaped while its status was checked. The status
+                # is unknown if it was reaped elsewhere.
+                obtained_pid = pid
+                status = self.reaped_statuses.get(pid)
+            if not obtained_pid:
+                continue
+
+            self.storlet_name_to_pid.pop(storlet_name)
+            self.starting_daemons.pop(storlet_name, None)
+            if status is not None and os.WIFEXITED(status) and \
+                    os.WEXITSTATUS(status) == 0:
+                self.logger.debug('The storlet daemon {0} exited'
+                                  .format(storlet_name))
+                continue
+            self.handle_daemon_crash(storlet_name, now)
+        # All the statuses recorded before the SIGCHLD are consumed above
+        self.reaped_statuses = dict()
+
+    def handle_daemon_crash(self, storlet_name, now):
+        """
+        Schedule the restart of a crashed storlet daemon, with exponential
+        backoff. The daemon is not restarted when it crashes too often.
+
+        :param storlet_name: Storlet name
+        :param now: current time
+        """
+        crashes = [crashed for crashed in
+                   self.storlet_name_to_crashes.get(storlet_name, [])
+                   if now - crashed < CRASH_LOOP_WINDOW]
+        crashes.append(now)
+        self.storlet_name_to_crashes[storlet_name] = crashes
+
+        if len(crashes) >= CRASH_LOOP_THRESHOLD:
+            self.pending_restarts.pop(storlet_name, None)
+            self.logger.error('The storlet daemon {0} crashed {1} times in '
+                              '{2} seconds. It is not restarted until it is '
+                              'requested'.format(storlet_name, len(crashes),
+                                                 CRASH_LOOP_WINDOW))
+            return
+
+        if len(crashes) == 1:
+            delay = 0
+        else:
+            delay = min(RESTART_BACKOFF_BASE * 2 ** (len(crashes) - 2),
+                        RESTART_BACKOFF_MAX)
+        self.pending_restarts[storlet_name] = now + delay
+        self.logger.warning('The storlet daemon {0} crashed. Restarting it '
+                            'in {1} seconds'.format(storlet_name, delay))
+
+    def restart_daemons(self, now):
+        """
+        Restart the crashed storlet daemons whose backoff has passed. This
+        does not wait until the restarted daemons respond, so that the
+        requests for the other storlets are not delayed.
+
+        :param now: current time
+        """
+        for storlet_name, restart_at in list(self.pending_restarts.items()):
+            if restart_at > now:
+                continue
+            self.pending_restarts.pop(storlet_name)
+            params = self.storlet_name_to_params.get(storlet_name)
+            if params is None:
+                continue
+            try:
+                if self.process_start_daemon(
+                        params['daemon_language'], params['storlet_path'],
+                        storlet_name, params['pool_size'],
+                        params['uds_path'], params['log_level'],
+                        params['daemon_language_version'], record=False,
+                        wait=False):
+                    self.logger.debug('Restarting the storlet daemon {0}'
+                                      .format(storlet_name))
+            except SDaemonError:
+                self.logger.exception('Failed to restart the storlet '
+                                      'daemon {0}'.format(storlet_name))
+                self.storlet_name_to_pid.pop(storlet_name, None)
+                self.handle_daemon_crash(storlet_name, now)
+
+    def check_starting_daemons(self, now):
+        """
+        Ping the restarted storlet daemons once, and handle the ones which
+        do not respond in time as crashed
+
+        :param now: current time
+        """
+        for storlet_name, started in list(self.starting_daemons.items()):
+            if storlet_name not in self.storlet_name_to_pid:
+                # Stopped while starting
+                self.starting_daemons.pop(storlet_name)
+                continue
+            client = SBusClient(self.storlet_name_to_pipe_name[storlet_name])
+            try:
+                ready = client.ping().status
+            except SBusClientException:
+                ready = False
+            if ready:
+                self.starting_daemons.pop(storlet_name)
+                self.logger.info('Restarted the storlet daemon {0}'
+                                 .format(storlet_name))
+            elif now - started >= self.NUM_OF_TRIES_PINGING_STARTING_DAEMON:
+                self.starting_daemons.pop(storlet_name)
+                self.logger.error('No response from the restarted storlet '
+                                  'daemon {0}'.format(storlet_name))
+                try:
+                    self.process_kill(storlet_name)
+                except SDaemonError:
+                    self.logger.exception('Failed to kill the storlet '
+                                          'daemon {0}'.format(storlet_name))
+                    self.storlet_name_to_pid.pop(storlet_name, None)
+                self.handle_daemon_crash(storlet_name, now)
+
+    def _housekeep(self):
+        now = time.time()
+        if self.pending_restarts:
+            self.restart_daemons(now)
+        if self.starting_daemons:
+            self.check_starting_daemons(now)
+        if now - self.last_housekeeping < HOUSEKEEPING_INTERVAL:
+            return
+        self.last_housekeeping = now
+        if self.daemon_idle_timeout:
+            self.evict_idle_daemons(now)
+        if self.memory_budget:
+            self.evict_daemons_over_budget(now)
+        if self.history_updated:
+            self.save_history()
+
     @command_handler
     def start_daemon(self, dtg):
         params = dtg.params
@@ -475,6 +1251,10 @@ class StorletDaemonFactory(SBusServer):
         storlet_name = params['storlet_name']
         try:
             if self.get_process_status_by_name(storlet_name):
+                # The gateway checks the status before it executes the
+                # storlet, so the daemon is going to be used
+                self.wait_for_starting_daemon(storlet_name)
+                self.record_use(storlet_name)
                 msg = 'The storlet daemon {0} seems to be OK'.format(
                     storlet_name)
                 return CommandSuccess(msg)
@@ -505,8 +1285,28 @@ class StorletDaemonFactory(SBusServer):
             self.logger.exception('Failed to halt some storlet daemons')
             return CommandFailure(err.args[0], False)
 
+    def _ready(self):
+        if self.restart_crashed_daemons:
+            self.start_supervision()
+        if not self.ready_path:
+            return
+        try:
+            open(self.ready_path, 'w').close()
+        except (IOError, OSError):
+            self.logger.exception('Failed to create %s' % self.ready_path)
+
     def _terminate(self):
-        pass
+        if self.ready_path:
+            try:
+                os.unlink(self.ready_path)
+            except OSError:
+                pass
+        self.stop_supervision()
+        self.stop_host_daemon()
+        self.stderr_collector.close()
+        self.fd_handlers.clear()
+        if self.history_updated:
+            self.save_history()
 
 
 def main():
@@ -518,6 +1318,32 @@ def main():
     parser.add_argument('sbus_path', help='the path to unix domain socket')
     parser.add_argument('log_level', help='log level')
     parser.add_argument('container_id', help='container id')
+    parser.add_argument('--no-zygote', dest='use_zygote',
+                        action='store_false',
+                        help='start python storlet daemons as new '
+                             'interpreters instead of forking them')
+    parser.add_argument('--host-daemon', dest='use_host_daemon',
+                        action='store_true',
+                        help='serve python storlets by one shared storlet '
+                             'host daemon')
+    parser.add_argument('--daemon-idle-timeout', type=int, default=0,
+                        help='seconds after which unused storlet daemons '
+                             'are stopped (0 to keep them running)')
+    parser.add_argument('--memory-budget', type=int, default=0,
+                        help='bytes of resident memory the storlet daemons '
+                             'can use in total (0 for no limit)')
+    parser.add_argument('--host-pool-size', type=int,
+                        default=DEFAULT_HOST_POOL_SIZE,
+                        help='the maximum number of storlet applications '
+                             'the storlet host daemon runs concurrently')
+    parser.add_argument('--stderr-rate-limit', type=int,
+                        default=DEFAULT_STDERR_RATE_LIMIT,
+                        help='the number of lines of stderr output logged '
+                             'for each storlet daemon per second '
+                             '(0 for no limit)')
+    parser.add_argument('--restart-crashed-daemons', action='store_true',
+                        help='restart the storlet daemons which exit '
+                             'unexpectedly, with exponential backoff')
     opts = parser.parse_args()
 
     # Initialize logger
@@ -534,7 +1360,23 @@ def main():
 
         # create an instance of daemon_factory
         factory = StorletDaemonFactory(opts.sbus_path, logger,
-                                       opts.container_id)
+                                       opts.container_id,
+                                       use_zygote=opts.use_zygote,
+                                       use_host_daemon=opts.use_host_daemon,
+                                       host_pool_size=opts.host_pool_size,
+                                       daemon_idle_timeout=(
+                                           opts.daemon_idle_timeout),
+                                       memory_budget=opts.memory_budget,
+                                       history_path=os.path.join(
+                                           os.path.dirname(opts.sbus_path),
+                                           DAEMON_HISTORY_FILE),
+                                       ready_path=os.path.join(
+                                           os.path.dirname(opts.sbus_path),
+                                           FACTORY_READY_FILE),
+                                       stderr_rate_limit=(
+                                           opts.stderr_rate_limit),
+                                       restart_crashed_daemons=(
+                                           opts.restart_crashed_daemons))
 
         # Start the main loop
         sys.exit(factory.main_loop())
@@ -0,0 +1,293 @@
+# Copyright (c) 2010-2016 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import uuid
+
+from swift.common.utils import close_if_possible
+
+# The default byte budget of the result cache (1GiB)
+DEFAULT_RESULT_CACHE_SIZE = 1024 * 1024 * 1024
+
+TMP_PREFIX = '.tmp-'
+
+
+class CachedResultIterator(object):
+    """
+    Iterator over a storlet output stored in the result cache
+
+    :param fobj: the file object of the cache entry, positioned at the
+                 beginning of the output
+    :param chunk_size: the size of chunks to read
+    """
+
+    def __init__(self, fobj, chunk_size):
+        self.fobj = fobj
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        chunk = self.fobj.read(self.chunk_size)
+        if not chunk:
+            self.close()
+            raise StopIteration()
+        return chunk
+
+    __next__ = next
+
+    def close(self):
+        self.fobj.close()
+
+
+class CacheWriteIterator(object):
+    """
+    Iterator which stores the storlet output into the result cache while
+    it is returned
+
+    The output is written to a temporary file, which becomes the cache
+    entry only when the whole output is read. If the output is closed
+    early or exceeds the cache size, nothing is stored.
+
+    :param cache: StorletResultCache instance
+    :param key: the cache key
+    :param metadata: the output metadata to be stored with the output
+    :param data_iter: iterator over the storlet output
+    """
+
+    def __init__(self, cache, key, metadata, data_iter):
+        self.cache = cache
+        self.key = key
+        self.metadata = metadata
+        self.data_iter = data_iter
+        self._iter = iter(data_iter)
+        self.tmp_path = None
+        self.fobj = None
+        self.size = 0
+        self.finished = False
+        self.aborted = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.finished:
+            raise StopIteration()
+        try:
+            chunk = next(self._iter)
+        except StopIteration:
+            self.finished = True
+            self._commit()
+            close_if_possible(self.data_iter)
+            raise
+        except Exception:
+            self.close()
+            raise
+        self._write(chunk)
+        return chunk
+
+    __next__ = next
+
+    def _write(self, chunk):
+        if self.aborted:
+            return
+        if self.fobj is None:
+            header = json.dumps(self.metadata).encode('utf-8') + b'\n'
+            self.size = len(header)
+            try:
+                self.tmp_path = self.cache.get_tmp_path()
+                self.fobj = open(self.tmp_path, 'wb')
+                self.fobj.write(header)
+            except (IOError, OSError) as err:
+                self._abort('Failed to create cache entry: %s' % err)
+                return
+
+        self.size += len(chunk)
+        if self.size > self.cache.max_bytes:
+            self._abort()
+            return
+        try:
+            self.fobj.write(chunk)
+        except (IOError, OSError) as err:
+            self._abort('Failed to write cache entry: %s' % err)
+
+    def _commit(self):
+        if self.fobj is None:
+            # The output is empty
+            self._write(b'')
+        if self.aborted:
+            return
+        try:
+            self.fobj.close()
+            self.fobj = None
+            self.cache.commit(self.tmp_path, self.key)
+        except (IOError, OSError) as err:
+            self._abort('Failed to store cache entry: %s' % err)
+
+    def _abort(self, msg=None):
+        if msg:
+            self.cache.logger.warning(msg)
+        self.aborted = True
+        if self.fobj is not None:
+            self.fobj.close()
+            self.fobj = None
+        if self.tmp_path is not None:
+            try:
+                os.unlink(self.tmp_path)
+            except OSError:
+                pass
+
+    def close(self):
+        if not self.finished:
+            self.finished = True
+            self._abort()
+            close_if_possible(self.data_iter)
+
+
+class StorletResultCache(object):
+    """
+    Disk backed cache of storlet outputs
+
+    Each entry is a file named by the cache key, which has the output
+    metadata as a json line followed by the output data. The entries are
+    evicted in least recently used order, to keep the total size within
+    the byte budget.
+
+    :param cache_dir: the directory to store the cache entries
+    :param max_bytes: the byte budget of the cache
+    :param logger: a logger instance
+    :param chunk_size: the size of chunks to read the cached output
+    """
+
+    def __init__(self, cache_dir, max_bytes, logger, chunk_size=65536):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.logger = logger
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def from_conf(cls, conf, logger):
+        """
+        Create a result cache from the gateway conf
+
+        :param conf: a dict for gateway conf
+        :param logger: a logger instance
+        :return: StorletResultCache instance, or None if the result cache
+                 is not enabled
+        """
+        cache_dir = conf.get('result_cache_dir')
+        if not cache_dir:
+            return None
+        max_bytes = int(conf.get('result_cache_size',
+                                 DEFAULT_RESULT_CACHE_SIZE))
+        return cls(cache_dir, max_bytes, logger)
+
+    @staticmethod
+    def make_key(*parts):
+        """
+        Make a cache key from the given parts
+
+        :param parts: json serializable values which identify the output
+        :return: the cache key
+        """
+        data = json.dumps(parts, sort_keys=True).encode('utf-8')
+        return hashlib.sha256(data).hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get_tmp_path(self):
+        """
+        Get a path to write a new entry
+        """
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        return os.path.join(self.cache_dir, TMP_PREFIX + uuid.uuid4().hex)
+
+    def get(self, key):
+        """
+        Get the cached output
+
+        :param key: the cache key
+        :return: a tuple of the output metadata and an iterator over the
+                 output, or None if the output is not cached
+        """
+        path = self._get_path(key)
+        try:
+            fobj = open(path, 'rb')
+        except (IOError, OSError):
+            return None
+
+        try:
+            metadata = json.loads(fobj.readline().decode('utf-8'))
+            # Mark the entry as recently used
+            os.utime(path, None)
+        except (IOError, OSError, ValueError) as err:
+            self.logger.warning('Failed to read cache entry %s: %s' %
+                                (key, err))
+            fobj.close()
+            return None
+        return metadata, CachedResultIterator(fobj, self.chunk_size)
+
+    def write_through(self, key, metadata, data_iter):
+        """
+        Store the output into the cache while it is returned
+
+        :param key: the cache key
+        :param metadata: the output metadata
+        :param data_iter: iterator over the output
+        :return: iterator over the output
+        """
+        return CacheWriteIterator(self, key, metadata, data_iter)
+
+    def commit(self, tmp_path, key):
+        """
+        Make the written entry available, and evict old entries if the
+        cache exceeds the byte budget
+
+        :param tmp_path: the path where the entry is written
+        :param key: the cache key
+        """
+        os.rename(tmp_path, self._get_path(key))
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the total size of
+        the entries gets within the byte budget
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(TMP_PREFIX):
+                continue
+            try:
+                stat = os.stat(self._get_path(name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+
+        for _mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(self._get_path(name))
+            except OSError:
+                pass
+            total -= size
@@ -16,16 +16,24 @@
 import copy
 import os
 import select
-from storlets.gateway.common.exceptions import StorletTimeout
+from storlets.gateway.common.exceptions import StorletRuntimeException, \
+    StorletTimeout
 
 
 class FileDescriptorIterator(object):
-    def __init__(self, fd, timeout, cancel_func):
+    def __init__(self, fd, timeout, cancel_func, limit=None):
         self.closed = False
         self.fd = fd
         self.timeout = timeout
         self.cancel_func = cancel_func
         self.buf = b''
+        self.eof = False
+        # The number of bytes we can still read from fd. None means no limit
+        self.remaining = limit
+
+    @property
+    def limit_reached(self):
+        return self.remaining is not None and self.remaining <= 0
 
     def __iter__(self):
         return self
@@ -35,8 +43,7 @@ class FileDescriptorIterator(object):
             with StorletTimeout(self.timeout):
                 chunk = os.read(self.fd, size)
         except StorletTimeout:
-            if self.cancel_func:
-                self.cancel_func()
+            self._cancel()
             self.close()
             raise
         except Exception:
@@ -45,18 +52,33 @@ class FileDescriptorIterator(object):
         return chunk
 
     def next(self, size=64 * 1024):
-        if len(self.buf) < size:
+        if len(self.buf) < size and not self.limit_reached:
             r, w, e = select.select([self.fd], [], [], self.timeout)
             if len(r) == 0:
                 self.close()
 
             if self.fd in r:
-                self.buf += self.read_with_timeout(size - len(self.buf))
+                read_size = size - len(self.buf)
+                if self.remaining is not None:
+                    read_size = min(read_size, self.remaining)
+                chunk = self.read_with_timeout(read_size)
+                self.buf += chunk
                 if self.buf == b'':
+                    self.eof = True
                     raise StopIteration('Stopped iterator ex')
+                if self.remaining is not None:
+                    self.remaining -= len(chunk)
+                    if self.limit_reached:
+                        # We do not need any more output, so stop the
+                        # storlet right away
+                        self._stop_task()
             else:
                 raise StopIteration('Stopped iterator ex')
 
+        if self.buf == b'':
+            # All of the output allowed by the limit is already returned
+            raise StopIteration('Reached the output limit')
+
         if len(self.buf) > size:
             data = self.buf[:size]
             self.buf = self.buf[size:]
@@ -81,13 +103,21 @@ class FileDescriptorIterator(object):
         # read data into self.buf if there is not enough data
         while b'\n' not in self.buf and \
               (size < 0 or len(self.buf) < size):
-            if size < 0:
-                chunk = self.read()
-            else:
-                chunk = self.read(size - len(self.buf))
+            # Take the buffered data out, so that read returns only new data
+            buffered, self.buf = self.buf, b''
+            try:
+                if size < 0:
+                    chunk = self.read()
+                else:
+                    chunk = self.read(size - len(buffered))
+            except StopIteration:
+                if not buffered:
+                    raise
+                # The last line is not terminated by a new line
+                chunk = b''
+            self.buf = buffered + chunk
             if not chunk:
                 break
-            self.buf += chunk
 
         # Retrieve one line from buf
         data, sep, rest = self.buf.partition(b'\n')
@@ -118,14 +148,40 @@ class FileDescriptorIterator(object):
             pass
         return lines
 
+    def _cancel(self):
+        # Make sure that we cancel the task only once
+        cancel_func, self.cancel_func = self.cancel_func, None
+        if cancel_func:
+            cancel_func()
+
+    def _stop_task(self):
+        try:
+            self._cancel()
+        except StorletRuntimeException:
+            # The task might have completed already
+            pass
+
     def close(self):
+        if self.closed:
+            return
+        if not self.eof:
+            # The output is abandoned before the end (e.g. the client has
+            # disconnected), so stop the storlet instead of letting it run
+            # until it hits a broken pipe or the timeout
+            self._stop_task()
+        self._close_fd()
+
+    def _close_fd(self):
         if self.closed:
             return
         os.close(self.fd)
         self.closed = True
 
     def __del__(self):
-        self.close()
+        # NOTE: Only release the fd here. Canceling the task may block and
+        #       requires a round trip to the daemon, which we should not do
+        #       in a finalizer.
+        self._close_fd()
 
 
 class StorletData(object):
@@ -188,6 +244,53 @@ class StorletRequest(StorletData):
 
 class StorletResponse(StorletData):
     def __init__(self, user_metadata, data_iter=None, data_fd=None,
-                 timeout=10, cancel=None):
+                 timeout=10, cancel=None, trailing_metadata_reader=None,
+                 output_limit=None, extra_outputs=None):
+        """
+        :param user_metadata: user metadata of the output
+        :param data_iter: iterator to read the output
+        :param data_fd: File descriptor to read the output
+        :param timeout: Timeout to be set for data reading
+        :param cancel: cancel operation to be executed when timeout happens
+        :param trailing_metadata_reader: function to read the user metadata
+                                         which the storlet sends after the
+                                         output body
+        :param output_limit: the maximum number of bytes to read from
+                             data_fd. The storlet task is canceled once the
+                             limit is reached
+        :param extra_outputs: iterator of tuples of the object name and a
+                              function to get StorletResponse instance of
+                              each extra output, as the storlet opens them
+        """
         super(StorletResponse, self).__init__(
             user_metadata, data_iter, data_fd, timeout, cancel)
+        self.trailing_metadata_reader = trailing_metadata_reader
+        self.output_limit = output_limit
+        self.extra_outputs = extra_outputs or []
+
+    @property
+    def data_iter(self):
+        if self._data_iter is None:
+            self._data_iter = FileDescriptorIterator(
+                self.data_fd, self.timeout, self.cancel, self.output_limit)
+        return self._data_iter
+
+    @property
+    def has_trailing_metadata(self):
+        return self.trailing_metadata_reader is not None
+
+    def read_trailing_metadata(self, discard=False):
+        """
+        Read the user metadata sent after the output body, and merge it into
+        user_metadata. This should be called once the body is consumed.
+
+        :param discard: release the resources without reading the metadata,
+                        when the body is not consumed completely
+        :returns: a dict of the metadata sent after the body
+        """
+        if not self.has_trailing_metadata:
+            return {}
+        metadata = self.trailing_metadata_reader(discard)
+        self.trailing_metadata_reader = None
+        self.user_metadata.update(metadata)
+        return metadata
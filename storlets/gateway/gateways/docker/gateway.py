@@ -14,10 +14,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import importlib.util
 import os
+import py_compile
 import shutil
+import sys
+
+from swift.common.utils import config_true_value
 
 from storlets.agent.common.utils import DEFAULT_PY2, DEFAULT_PY3
+from storlets.gateway.common.exceptions import StorletRuntimeException
 from storlets.gateway.common.stob import StorletRequest
 from storlets.gateway.gateways.base import StorletGatewayBase
 from storlets.gateway.gateways.docker.runtime import RunTimePaths, \
@@ -88,6 +94,24 @@ class DockerStorletRequest(StorletRequest):
         self.start = self.options.get('range_start')
         self.end = self.options.get('range_end')
 
+        # The maximum number of output bytes the client wants
+        self.output_limit = self.options.get('output_limit')
+        # The output range which a seekable storlet should start from
+        self.output_range = self.options.get('output_range')
+
+        # Whether the storlet can send its output metadata after the body
+        self.trailing_metadata = config_true_value(
+            self.options.get('storlet_trailing_metadata'))
+
+        # The later stages of the pipeline, which are dicts of the storlet
+        # id, the options and the parameters of each storlet
+        self.pipeline = self.options.get('pipeline') or []
+
+        # The container to store the extra outputs, and the number of the
+        # extra outputs the storlet can open
+        self.output_container = self.options.get('output_container')
+        self.extra_outputs = int(self.options.get('extra_outputs') or 0)
+
     @property
     def has_range(self):
         """
@@ -108,6 +132,10 @@ class StorletGatewayDocker(StorletGatewayBase):
         """
         super(StorletGatewayDocker, self).__init__(conf, logger, scope)
         self.storlet_timeout = int(self.conf.get('storlet_timeout', 40))
+        # The storlet directory is mounted read-only, so the python storlet
+        # daemons can not write the bytecode cache by themselves
+        self.precompile_python_storlets = config_true_value(
+            self.conf.get('precompile_python_storlets', 'true'))
         self.paths = RunTimePaths(scope, conf)
 
     @classmethod
@@ -207,14 +235,10 @@ class StorletGatewayDocker(StorletGatewayBase):
                                     container as data source
         :return: StorletResponse instance
         """
-        run_time_sbox = RunTimeSandbox(self.scope, self.conf, self.logger)
-        docker_updated = self.update_docker_container_from_cache(sreq)
-        run_time_sbox.activate_storlet_daemon(sreq, docker_updated)
-        self._add_system_params(sreq)
+        if sreq.pipeline:
+            return self._pipeline_invocation_flow(sreq, extra_sources)
 
-        slog_path = self.paths.get_host_slog_path(sreq.storlet_main)
-        storlet_pipe_path = \
-            self.paths.get_host_storlet_pipe(sreq.storlet_main)
+        slog_path, storlet_pipe_path = self._prepare_invocation(sreq)
 
         sprotocol = StorletInvocationProtocol(sreq,
                                               storlet_pipe_path,
@@ -229,17 +253,141 @@ class StorletGatewayDocker(StorletGatewayBase):
 
         return sresp
 
+    def _prepare_invocation(self, sreq):
+        """
+        Make the storlet daemon ready to invoke the storlet
+
+        :param sreq: DockerStorletRequest instance
+        :return: a tuple of the storlet log path and the storlet pipe path
+        """
+        run_time_sbox = RunTimeSandbox(self.scope, self.conf, self.logger)
+        # NOTE: The pooled sandbox should be bound before the storlet
+        #       directory of the scope is created
+        run_time_sbox.bind_pooled_sandbox()
+        docker_updated = self.update_docker_container_from_cache(sreq)
+        run_time_sbox.activate_storlet_daemon(sreq, docker_updated)
+        self._add_system_params(sreq)
+
+        return (self.paths.get_host_slog_path(sreq.storlet_main),
+                self.paths.get_host_storlet_pipe(sreq.storlet_main))
+
+    def _make_stage_request(self, sreq, stage, data_fd, user_metadata):
+        """
+        Make the request of a later stage of the pipeline
+
+        :param sreq: DockerStorletRequest instance of the first stage
+        :param stage: a dict given in the pipeline
+        :param data_fd: the output fd of the previous stage
+        :param user_metadata: the output metadata of the previous stage
+        :return: DockerStorletRequest instance
+        """
+        options = dict(stage['options'])
+        options['file_manager'] = sreq.file_manager
+        options['scope'] = sreq.options.get('scope')
+        return self.request_class(stage['storlet'], stage['params'],
+                                  user_metadata, data_fd=data_fd,
+                                  options=options)
+
+    def _pipeline_invocation_flow(self, sreq, extra_sources=None):
+        """
+        Invoke the storlets of the pipeline, connecting the output of each
+        stage to the input of the next one directly, so that intermediate
+        data does not come back to the middleware
+
+        :param sreq: DockerStorletRequest instance of the first stage
+        :param extra_sources: A list of StorletRequest instance to feed to
+                              the first stage
+        :return: StorletResponse instance of the last stage
+        """
+        # The output limit and range are applied to the last output, and
+        # only the last stage can send metadata after the output
+        output_limit, output_range = sreq.output_limit, sreq.output_range
+        sreq.output_limit = sreq.output_range = None
+        sreq.trailing_metadata = False
+
+        protocols = []
+        try:
+            slog_path, storlet_pipe_path = self._prepare_invocation(sreq)
+            sprotocol = StorletInvocationProtocol(
+                sreq, storlet_pipe_path, slog_path, self.storlet_timeout,
+                self.logger, extra_sources=extra_sources)
+            sresp = sprotocol.communicate()
+            protocols.append(sprotocol)
+
+            for i, stage_info in enumerate(sreq.pipeline):
+                prev_fd = sresp.data_fd
+                try:
+                    stage = self._make_stage_request(
+                        sreq, stage_info, prev_fd, sresp.user_metadata)
+                    if i == len(sreq.pipeline) - 1:
+                        stage.output_limit = output_limit
+                        stage.output_range = output_range
+                    else:
+                        stage.trailing_metadata = False
+                    slog_path, storlet_pipe_path = \
+                        self._prepare_invocation(stage)
+                    sprotocol = StorletInvocationProtocol(
+                        stage, storlet_pipe_path, slog_path,
+                        self.storlet_timeout, self.logger)
+                    sresp = sprotocol.communicate()
+                    protocols.append(sprotocol)
+                finally:
+                    # The previous output is passed to the stage, or is no
+                    # longer needed
+                    os.close(prev_fd)
+        except Exception:
+            try:
+                self._cancel_pipeline(protocols)
+            except StorletRuntimeException:
+                self.logger.warning('Failed to cancel the pipeline of %s' %
+                                    sreq.storlet_id)
+            raise
+
+        def cancel():
+            self._cancel_pipeline(protocols)
+
+        sresp.cancel = cancel
+
+        for sprotocol in protocols:
+            self._upload_storlet_logs(
+                sprotocol.storlet_logger.log_path, sprotocol.srequest)
+        return sresp
+
+    def _cancel_pipeline(self, protocols):
+        """
+        Cancel the stages of the pipeline
+
+        :param protocols: StorletInvocationProtocol instances of the stages
+        :raises StorletRuntimeException: If it fails to cancel any of them
+        """
+        failed = False
+        for sprotocol in protocols:
+            try:
+                sprotocol._cancel()
+            except StorletRuntimeException:
+                failed = True
+        if failed:
+            raise StorletRuntimeException('Failed to cancel pipeline')
+
     def _add_system_params(self, sreq):
         """
         Adds Storlet engine specific parameters to the invocation
 
-        currently, this consists only of the execution path of the
-        Storlet within the Docker container.
+        currently, this consists of the execution path of the Storlet
+        within the Docker container, and the output limit if it is given
+        so that the storlet can stop reading its input early. A seekable
+        storlet also gets the output range it should start from.
 
         :params params: Request parameters
         """
         sreq.params['storlet_execution_path'] = self. \
             paths.get_sbox_storlet_dir(sreq.storlet_main)
+        if sreq.output_limit is not None:
+            sreq.params['storlet_output_limit'] = str(sreq.output_limit)
+        if sreq.output_range is not None:
+            start, end = sreq.output_range
+            sreq.params['storlet_output_range_start'] = str(start)
+            sreq.params['storlet_output_range_end'] = str(end)
 
     def _upload_storlet_logs(self, slog_path, sreq):
         """
@@ -355,8 +503,48 @@ class StorletGatewayDocker(StorletGatewayBase):
             # copy2 also copies the permissions
             shutil.copy2(cache_target_path, docker_target_path)
 
+        if self.precompile_python_storlets and \
+                sreq.storlet_language.lower() == 'python' and \
+                docker_target_path.endswith('.py'):
+            self.precompile_python_module(sreq, docker_target_path,
+                                          update_docker)
+
         return update_docker
 
+    def precompile_python_module(self, sreq, path, force=False):
+        """
+        Write the bytecode cache of a python module copied into the
+        Docker container, so that the storlet daemon does not compile it
+        every time it starts
+
+        The bytecode is compiled by the interpreter running the gateway,
+        so this is skipped when the storlet daemon runs another version
+        of python.
+
+        :params sreq: DockerStorletRequest instance
+        :params path: the path to the module in the host storlet directory
+        :params force: True to compile the module even if the bytecode
+                       cache exists
+        """
+        version = sreq.storlet_language_version or 3
+        if int(float(version)) == 2:
+            version = DEFAULT_PY2
+        else:
+            version = DEFAULT_PY3
+        if str(version) != '%d.%d' % sys.version_info[:2]:
+            self.logger.debug('Skip compiling %s for python %s' %
+                              (path, version))
+            return
+
+        cache_path = importlib.util.cache_from_source(path)
+        if not force and os.path.isfile(cache_path):
+            return
+        try:
+            py_compile.compile(path, cfile=cache_path, doraise=True)
+        except (py_compile.PyCompileError, IOError, OSError) as err:
+            # The storlet daemon reports the error when it loads the module
+            self.logger.warning('Failed to compile %s: %s' % (path, err))
+
     def update_docker_container_from_cache(self, sreq):
         """
         Iterates over the storlet name and its dependencies appearing
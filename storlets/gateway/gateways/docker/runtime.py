@@ -14,18 +14,27 @@
 # limitations under the License.
 
 import errno
+import fcntl
 import os
 import select
+import shutil
 import stat
 import subprocess
 import sys
 import time
+import uuid
 import six
+from six.moves import http_client
+from six.moves.urllib.parse import quote
 
 import eventlet
+from eventlet.event import Event
+import functools
 import json
 from contextlib import contextmanager
 
+from storlets.agent.common.utils import DAEMON_HISTORY_FILE, \
+    FACTORY_READY_FILE
 from storlets.sbus import SBus
 from storlets.sbus.command import SBUS_CMD_EXECUTE
 from storlets.sbus.datagram import SBusFileDescriptor, SBusExecuteDatagram
@@ -35,10 +44,31 @@ from storlets.sbus.client.exceptions import SBusClientException
 from storlets.gateway.common.exceptions import StorletRuntimeException, \
     StorletTimeout
 from storlets.gateway.common.logger import StorletLogger
-from storlets.gateway.common.stob import StorletResponse
+from storlets.gateway.common.stob import FileDescriptorIterator, \
+    StorletResponse
 
 MAX_METADATA_SIZE = 4096
 
+# The file in the pipe directory which has the name of the container
+# running the sandbox, when it differs from the one given by the scope
+SANDBOX_NAME_FILE = 'sandbox_name'
+
+# The names of the pipe and storlet directories of the pooled sandboxes
+POOL_SLOT_PREFIX = '.pool-'
+POOL_STARTING_PREFIX = '.starting-'
+# The file which keeps the storlet directory of a pooled sandbox non-empty
+POOL_MARKER_FILE = '.pooled_sandbox'
+POOL_LOCK_FILE = '.sandbox_pool.lock'
+
+# Seconds to wait for the docker repository to tell whether the image of a
+# scope exists
+DOCKER_REPO_TIMEOUT = 5
+DOCKER_MANIFEST_TYPES = ', '.join([
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.oci.image.index.v1+json'])
+
 
 eventlet.monkey_patch()
 
@@ -154,6 +184,10 @@ class RunTimePaths(object):
     def host_factory_pipe(self):
         return os.path.join(self.host_pipe_dir, self.factory_pipe_name)
 
+    @property
+    def host_factory_ready_file(self):
+        return os.path.join(self.host_pipe_dir, FACTORY_READY_FILE)
+
     def get_host_storlet_pipe(self, storlet_id):
         return os.path.join(self.host_pipe_dir, storlet_id)
 
@@ -201,6 +235,8 @@ class RunTimeSandbox(object):
     ping - pings the sandbox for liveness
     wait - wait for the sandbox to be ready for processing commands
     restart - restart the sandbox
+    bind_pooled_sandbox - take a pre-started sandbox for a new scope
+    prewarm - start the most used storlet daemons
     start_storlet_daemon - start a daemon for a given storlet
     stop_storlet_daemon - stop a daemon of a given storlet
     get_storlet_daemon_status - test if a given storlet daemon is running
@@ -212,10 +248,14 @@ class RunTimeSandbox(object):
         :param conf: gateway conf
         :param logger: logger instance
         """
+        self.conf = conf
         self.paths = RunTimePaths(scope, conf)
         self.scope = scope
 
         self.sandbox_ping_interval = 0.5
+        # Interval to check the file which the daemon factory creates once
+        # it gets ready
+        self.sandbox_ready_check_interval = 0.01
         self.sandbox_wait_timeout = \
             int(conf.get('restart_linux_container_timeout', 10))
 
@@ -227,6 +267,13 @@ class RunTimeSandbox(object):
             int(conf.get('storlet_daemon_thread_pool_size', 5))
         self.storlet_daemon_debug_level = \
             conf.get('storlet_daemon_debug_level', 'DEBUG')
+        # The number of the most used storlet daemons started in the
+        # background after the sandbox restarts
+        self.prewarm_storlet_daemons = \
+            int(conf.get('prewarm_storlet_daemons', 0))
+        # The number of the generic sandboxes started in advance for new
+        # scopes
+        self.sandbox_pool_size = int(conf.get('sandbox_pool_size', 0))
 
         # TODO(change logger's route if possible)
         self.logger = logger
@@ -260,23 +307,48 @@ class RunTimeSandbox(object):
         """
         Wait while scope's sandbox is starting
 
+        The daemon factory creates a file in the pipe directory once it
+        listens on its pipe, so the sandbox is pinged as soon as the file
+        appears. The sandbox is also pinged every sandbox_ping_interval in
+        case the daemon factory does not create the file.
+
         :raises StorletTimeout: the sandbox has not started in
                                 sandbox_wait_timeout
         """
+        ready_file = self.paths.host_factory_ready_file
+        ready_file_found = False
+        next_ping = 0
         try:
             with StorletTimeout(self.sandbox_wait_timeout):
                 while True:
-                    rc = self.ping()
-                    if (rc != 1):
-                        time.sleep(self.sandbox_ping_interval)
-                        continue
-                    else:
-                        return
+                    now = time.time()
+                    if not ready_file_found and os.path.exists(ready_file):
+                        ready_file_found = True
+                        next_ping = now
+                    if now >= next_ping:
+                        if self.ping() == 1:
+                            return
+                        next_ping = now + self.sandbox_ping_interval
+                    time.sleep(self.sandbox_ready_check_interval)
         except StorletTimeout:
             self.logger.exception("wait for sandbox %s timedout"
                                   % self.scope)
             raise
 
+    @property
+    def docker_container_name(self):
+        """
+        The name of the container running the scope's sandbox. A sandbox
+        taken from the pool keeps the name it was started with.
+        """
+        path = os.path.join(self.paths.host_pipe_dir, SANDBOX_NAME_FILE)
+        try:
+            with open(path) as f:
+                name = f.read().strip()
+        except (IOError, OSError):
+            name = None
+        return name or '%s_%s' % (self.docker_image_name_prefix, self.scope)
+
     def _restart(self, docker_image_name):
         """
         Restarts the scope's sandbox using the specified docker image
@@ -288,8 +360,7 @@ class RunTimeSandbox(object):
             docker_image_name = '%s/%s' % (self.docker_repo,
                                            docker_image_name)
 
-        docker_container_name = '%s_%s' % (self.docker_image_name_prefix,
-                                           self.scope)
+        docker_container_name = self.docker_container_name
 
         pipe_mount = '%s:%s' % (self.paths.host_pipe_dir,
                                 self.paths.sandbox_pipe_dir)
@@ -308,6 +379,15 @@ class RunTimeSandbox(object):
                storlet_mount, storlet_native_lib_mount,
                storlet_native_bin_mount]
 
+        # Remove the file created by the previous daemon factory, so that
+        # wait does not find it
+        try:
+            os.unlink(self.paths.host_factory_ready_file)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise StorletRuntimeException(
+                    'Failed to remove %s' % self.paths.host_factory_ready_file)
+
         proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
                                 stderr=subprocess.PIPE)
         stdout, stderr = proc.communicate()
@@ -348,6 +428,105 @@ class RunTimeSandbox(object):
             self._restart(self.default_docker_image_name)
             self.wait()
 
+        if self.prewarm_storlet_daemons > 0:
+            eventlet.spawn_n(self.prewarm)
+
+    def has_scope_image(self):
+        """
+        Check if the scope has its own docker image, by asking the docker
+        repository for the manifest of the image
+
+        :returns: False only when the docker repository tells that the
+                  scope's image does not exist
+        """
+        if not self.docker_repo:
+            # The local images can not be looked up by the gateway
+            return True
+
+        host, _sep, namespace = self.docker_repo.partition('/')
+        name = '%s/%s' % (namespace, self.scope) if namespace else self.scope
+        path = '/v2/%s/manifests/latest' % quote(name)
+        # NOTE: Like docker, fall back to http for the insecure repository
+        for conn_cls in (http_client.HTTPSConnection,
+                         http_client.HTTPConnection):
+            conn = conn_cls(host, timeout=DOCKER_REPO_TIMEOUT)
+            try:
+                conn.request('HEAD', path,
+                             headers={'Accept': DOCKER_MANIFEST_TYPES})
+                status = conn.getresponse().status
+            except (IOError, OSError, http_client.HTTPException):
+                continue
+            finally:
+                conn.close()
+            return status != 404
+        self.logger.warning('Failed to look up the image of scope %s in %s' %
+                            (self.scope, self.docker_repo))
+        return True
+
+    def bind_pooled_sandbox(self):
+        """
+        Take a pre-started sandbox from the pool, if the scope has not
+        used any sandbox yet and does not have its own image, and replenish
+        the pool in the background
+
+        :returns: True if the scope got a sandbox from the pool
+        """
+        if self.sandbox_pool_size <= 0 or \
+                os.path.exists(self.paths.host_storlet_base_dir):
+            return False
+        if self.has_scope_image():
+            # The pooled sandboxes run the default image, which does not
+            # have the dependencies installed in the scope's image
+            return False
+
+        pool = SandboxPool(self.conf, self.logger, self.sandbox_pool_size)
+        bound = pool.bind(self.paths)
+        eventlet.spawn_n(pool.replenish)
+        return bound
+
+    def get_daemon_history(self):
+        """
+        Get the history of the storlet daemons kept by the daemon factory
+
+        :returns: a list of the start parameters of the storlet daemons,
+                  most used first
+        """
+        path = os.path.join(self.paths.host_pipe_dir, DAEMON_HISTORY_FILE)
+        try:
+            with open(path) as f:
+                history = json.load(f)
+            entries = sorted(
+                [(entry['count'], name, entry['params'])
+                 for name, entry in history.items()],
+                key=lambda x: x[:2], reverse=True)
+        except (IOError, OSError, ValueError, KeyError, TypeError,
+                AttributeError):
+            return []
+        return [(name, params) for _count, name, params in entries]
+
+    def prewarm(self):
+        """
+        Start the most used storlet daemons, so that the first requests
+        after the sandbox restarts do not have to wait for them
+        """
+        history = self.get_daemon_history()
+        for storlet_name, params in \
+                history[:self.prewarm_storlet_daemons]:
+            client = SBusClient(self.paths.host_factory_pipe)
+            try:
+                resp = client.start_daemon(
+                    params['daemon_language'], params['storlet_path'],
+                    storlet_name, params['uds_path'], params['log_level'],
+                    params['pool_size'],
+                    params.get('daemon_language_version'))
+                if not resp.status:
+                    self.logger.warning('Failed to pre-start storlet daemon '
+                                        '%s: %s' %
+                                        (storlet_name, resp.message))
+            except (SBusClientException, KeyError):
+                self.logger.exception('Failed to pre-start storlet daemon '
+                                      '%s' % storlet_name)
+
     def start_storlet_daemon(
             self, spath, storlet_id, language, language_version=None):
         """
@@ -400,8 +579,10 @@ class RunTimeSandbox(object):
             if resp.status:
                 return 1
             else:
-                self.logger.error('Failed to get status about storlet '
-                                  'daemon: %s' % resp.message)
+                # NOTE: The daemon factory stops idle storlet daemons, so
+                #       this is a normal cold start rather than an error
+                self.logger.debug('The storlet daemon is not running: %s' %
+                                  resp.message)
                 return 0
         except SBusClientException:
             return -1
@@ -465,6 +646,145 @@ class RunTimeSandbox(object):
             else:
                 self.logger.debug('Daemon started')
 
+
+class SandboxPool(object):
+    """
+    A pool of generic sandboxes started in advance for new scopes
+
+    Each pooled sandbox runs the default docker image, and has its own pipe
+    directory and storlet directory named by POOL_SLOT_PREFIX. A new scope
+    takes a pooled sandbox by renaming these directories to the ones of the
+    scope. The bind mounts of the running container follow the renamed
+    directories, so the first request of the scope does not have to wait
+    for the container to start. The name of the container is kept in the
+    pipe directory, so that the sandbox can be restarted later. The scopes
+    which have their own images do not use the pool.
+
+    :param conf: gateway conf
+    :param logger: logger instance
+    :param size: the number of the sandboxes kept in the pool
+    """
+
+    def __init__(self, conf, logger, size):
+        self.conf = conf
+        self.logger = logger
+        self.size = size
+        self.pipe_root_dir = RunTimePaths('', conf).host_pipe_root_dir
+
+    def list_slots(self):
+        """
+        Get the names of the sandboxes ready in the pool
+        """
+        try:
+            names = os.listdir(self.pipe_root_dir)
+        except OSError:
+            return []
+        return sorted(name for name in names
+                      if name.startswith(POOL_SLOT_PREFIX))
+
+    def bind(self, scope_paths):
+        """
+        Bind a pooled sandbox to a scope
+
+        :param scope_paths: RunTimePaths instance of the scope
+        :returns: True if a pooled sandbox is bound to the scope
+        """
+        for slot in self.list_slots():
+            slot_paths = RunTimePaths(slot, self.conf)
+            try:
+                # NOTE: The marker file keeps the storlet directory of the
+                #       slot non-empty, so this fails when the slot or the
+                #       scope is taken by another process
+                os.rename(slot_paths.host_storlet_base_dir,
+                          scope_paths.host_storlet_base_dir)
+            except OSError:
+                continue
+
+            try:
+                os.rename(slot_paths.host_pipe_dir, scope_paths.host_pipe_dir)
+            except OSError:
+                # The scope already has its pipe directory, so give the
+                # sandbox back to the pool
+                self.logger.exception('Failed to bind pooled sandbox %s to '
+                                      'scope %s' % (slot, scope_paths.scope))
+                try:
+                    os.rename(scope_paths.host_storlet_base_dir,
+                              slot_paths.host_storlet_base_dir)
+                except OSError:
+                    pass
+                return False
+
+            self.logger.info('Bound pooled sandbox %s to scope %s' %
+                             (slot, scope_paths.scope))
+            return True
+        return False
+
+    def replenish(self):
+        """
+        Start sandboxes until the pool gets full
+
+        Only one process replenishes the pool at a time, and the others
+        return immediately.
+        """
+        try:
+            if not os.path.exists(self.pipe_root_dir):
+                os.makedirs(self.pipe_root_dir)
+            lock_fd = os.open(os.path.join(self.pipe_root_dir,
+                                           POOL_LOCK_FILE),
+                              os.O_WRONLY | os.O_CREAT, 0o600)
+        except OSError:
+            self.logger.exception('Failed to open the sandbox pool lock')
+            return
+
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                # Another process is replenishing the pool
+                return
+            while len(self.list_slots()) < self.size:
+                if not self.start_sandbox():
+                    break
+        finally:
+            os.close(lock_fd)
+
+    def start_sandbox(self):
+        """
+        Start a sandbox and add it to the pool
+
+        :returns: True if the sandbox is added to the pool
+        """
+        slot_id = uuid.uuid4().hex
+        sbox = RunTimeSandbox(POOL_STARTING_PREFIX + slot_id, self.conf,
+                              self.logger)
+        paths = sbox.paths
+        ready_paths = RunTimePaths(POOL_SLOT_PREFIX + slot_id, self.conf)
+        try:
+            paths.create_host_pipe_dir()
+            with open(os.path.join(paths.host_pipe_dir, SANDBOX_NAME_FILE),
+                      'w') as f:
+                f.write(sbox.docker_container_name)
+            os.makedirs(paths.host_storlet_base_dir, 0o755)
+            open(os.path.join(paths.host_storlet_base_dir,
+                              POOL_MARKER_FILE), 'w').close()
+
+            sbox._restart(sbox.default_docker_image_name)
+            sbox.wait()
+
+            # The pipe directory is renamed last, because the pool is
+            # listed by the pipe directories
+            os.rename(paths.host_storlet_base_dir,
+                      ready_paths.host_storlet_base_dir)
+            os.rename(paths.host_pipe_dir, ready_paths.host_pipe_dir)
+        except (IOError, OSError, StorletRuntimeException, StorletTimeout):
+            self.logger.exception('Failed to start pooled sandbox')
+            shutil.rmtree(paths.host_pipe_dir, ignore_errors=True)
+            shutil.rmtree(paths.host_storlet_base_dir, ignore_errors=True)
+            return False
+
+        self.logger.debug('Started pooled sandbox %s' % slot_id)
+        return True
+
 """---------------------------------------------------------------------------
 Storlet Daemon API
 StorletInvocationProtocol
@@ -506,9 +826,20 @@ class StorletInvocationProtocol(object):
         self.taskid_read_fd = None
         self.taskid_write_fd = None
         self.task_id = None
+        self._task_id_reader = None
         self._input_data_read_fd = None
         self._input_data_write_fd = None
 
+        # The extra outputs which the storlet can open via the output
+        # container
+        self.container_read_fd = None
+        self.container_write_fd = None
+        self.extra_outputs = [
+            {'data_read_fd': None, 'data_write_fd': None,
+             'md_read_fd': None, 'md_write_fd': None}
+            for _ in range(srequest.extra_outputs)]
+        self._extra_outputs_completed = Event()
+
         self.extra_data_sources = []
         extra_sources = extra_sources or []
         for source in extra_sources:
@@ -542,19 +873,37 @@ class StorletInvocationProtocol(object):
                 {'start': str(self.srequest.start),
                  'end': str(self.srequest.end)})
 
+        if self.srequest.trailing_metadata:
+            out_fd_type = sbus_fd.SBUS_FD_OUTPUT_OBJECT_AND_METADATA
+        else:
+            out_fd_type = sbus_fd.SBUS_FD_OUTPUT_OBJECT
+
         fds = [SBusFileDescriptor(sbus_fd.SBUS_FD_INPUT_OBJECT,
                                   self.input_data_read_fd,
                                   storage_metadata=self.srequest.user_metadata,
                                   storlets_metadata=storlets_metadata),
                SBusFileDescriptor(sbus_fd.SBUS_FD_OUTPUT_TASK_ID,
                                   self.taskid_write_fd),
-               SBusFileDescriptor(sbus_fd.SBUS_FD_OUTPUT_OBJECT,
-                                  self.data_write_fd),
+               SBusFileDescriptor(out_fd_type, self.data_write_fd),
                SBusFileDescriptor(sbus_fd.SBUS_FD_OUTPUT_OBJECT_METADATA,
                                   self.metadata_write_fd),
                SBusFileDescriptor(sbus_fd.SBUS_FD_LOGGER,
                                   self.storlet_logger.getfd())]
 
+        if self.extra_outputs:
+            fds.append(SBusFileDescriptor(
+                sbus_fd.SBUS_FD_OUTPUT_CONTAINER,
+                self.container_write_fd,
+                storage_metadata={
+                    'storlet_container_name': self.srequest.output_container
+                }))
+            for output in self.extra_outputs:
+                fds.extend([
+                    SBusFileDescriptor(sbus_fd.SBUS_FD_OUTPUT_OBJECT,
+                                       output['data_write_fd']),
+                    SBusFileDescriptor(sbus_fd.SBUS_FD_OUTPUT_OBJECT_METADATA,
+                                       output['md_write_fd'])])
+
         for source in self.extra_data_sources:
             fd = SBusFileDescriptor(
                 sbus_fd.SBUS_FD_INPUT_OBJECT,
@@ -588,6 +937,12 @@ class StorletInvocationProtocol(object):
         self.taskid_read_fd, self.taskid_write_fd = os.pipe()
         self.metadata_read_fd, self.metadata_write_fd = os.pipe()
 
+        if self.extra_outputs:
+            self.container_read_fd, self.container_write_fd = os.pipe()
+        for output in self.extra_outputs:
+            output['data_read_fd'], output['data_write_fd'] = os.pipe()
+            output['md_read_fd'], output['md_write_fd'] = os.pipe()
+
         for source in self.extra_data_sources:
             source['read_fd'], source['write_fd'] = os.pipe()
 
@@ -598,6 +953,8 @@ class StorletInvocationProtocol(object):
         :param fds: a list of file descriptors
         """
         for fd in fds:
+            if fd is None:
+                continue
             try:
                 os.close(fd)
             except OSError as err:
@@ -616,6 +973,10 @@ class StorletInvocationProtocol(object):
                self.taskid_write_fd]
         if not self.srequest.has_fd:
             fds.append(self.input_data_read_fd)
+        if self.extra_outputs:
+            fds.append(self.container_write_fd)
+        for output in self.extra_outputs:
+            fds.extend([output['data_write_fd'], output['md_write_fd']])
         fds.extend([source['read_fd'] for source in self.extra_data_sources])
         for fd in fds:
             os.close(fd)
@@ -624,15 +985,58 @@ class StorletInvocationProtocol(object):
         """
         Close all of the host side descriptors
         """
+        if self._task_id_reader is not None:
+            # The reader closes the task id fd by itself once it starts, so
+            # stop it before we close the remaining descriptors
+            self._task_id_reader.kill()
         fds = [self.data_read_fd, self.metadata_read_fd,
-               self.taskid_read_fd]
+               self.taskid_read_fd, self.container_read_fd]
+        for output in self.extra_outputs:
+            fds.extend([output['data_read_fd'], output['md_read_fd']])
         fds.extend([source['write_fd'] for source in self.extra_data_sources])
         self._safe_close(fds)
 
+    def _read_task_id(self):
+        """
+        Read the task id returned by the remote daemon
+
+        This is supposed to run in a green thread spawned at invocation, so
+        that we don't have to wait for the task id before starting to feed
+        the input data.
+
+        :returns: task id string, or None when it fails to get the task id
+        """
+        fd = self.taskid_read_fd
+        try:
+            self._wait_for_read_with_timeout(fd)
+            # TODO(kota_): need an assertion for task_id format
+            task_id = os.read(fd, 10)
+            if not isinstance(task_id, str):
+                task_id = task_id.decode('utf-8')
+            self.task_id = task_id
+        except Exception:
+            self.logger.exception('Failed to read task id')
+        finally:
+            self.taskid_read_fd = None
+            self._safe_close([fd])
+        return self.task_id
+
+    def _get_task_id(self):
+        """
+        Get the task id, waiting for the remote daemon to return it if needed
+
+        :returns: task id string, or None when the task id is not available
+        """
+        if self.task_id is None and self._task_id_reader is not None:
+            self._task_id_reader.wait()
+        return self.task_id
+
     def _cancel(self):
         """
         Cancel on-going storlet execution
         """
+        if not self._get_task_id():
+            raise StorletRuntimeException('Failed to cancel task')
         client = SBusClient(self.storlet_pipe_path)
         try:
             resp = client.cancel(self.task_id)
@@ -648,12 +1052,10 @@ class StorletInvocationProtocol(object):
         with self.storlet_logger.activate(),\
                 self._activate_invocation_descriptors():
             self._send_execute_command()
-        self._wait_for_read_with_timeout(self.taskid_read_fd)
-        # TODO(kota_): need an assertion for task_id format
-        self.task_id = os.read(self.taskid_read_fd, 10)
-        if not isinstance(self.task_id, str):
-            self.task_id = self.task_id.decode('utf-8')
-        os.close(self.taskid_read_fd)
+        # The task id is required only to cancel the task, so we collect it
+        # asynchronously, instead of waiting for one more round trip to the
+        # daemon before we start feeding the input data.
+        self._task_id_reader = eventlet.spawn(self._read_task_id)
 
     def _send_execute_command(self):
         """
@@ -686,7 +1088,8 @@ class StorletInvocationProtocol(object):
             exc_type, exc_value, exc_traceback = sys.exc_info()
 
             # When there is a task already running, we should cancel it.
-            if self.task_id:
+            if self._task_id_reader is not None and \
+                    fd != self.taskid_read_fd:
                 try:
                     self._cancel()
                 except StorletRuntimeException:
@@ -714,6 +1117,51 @@ class StorletInvocationProtocol(object):
             self.logger.exception('Failed to load metadata from json')
             raise StorletRuntimeException('Got invalid format about metadata')
 
+    def _is_metadata_ready(self):
+        """
+        Check whether metadata can be read without waiting
+
+        :returns: True if the metadata fd is readable
+        """
+        r, w, e = select.select([self.metadata_read_fd], [], [], 0)
+        return self.metadata_read_fd in r
+
+    def _read_trailing_metadata(self, discard=False):
+        """
+        Read metadata which the storlet sent after the output body
+
+        :param discard: close the metadata fd without reading metadata
+        :returns: a dict of metadata
+        """
+        fd = self.metadata_read_fd
+        self.metadata_read_fd = None
+        if discard:
+            self._safe_close([fd])
+            return {}
+        return self._read_metadata_until_closed(fd)
+
+    def _read_metadata_until_closed(self, fd):
+        """
+        Read metadata from fd, which may be closed without any metadata
+
+        :param fd: File descriptor to read metadata, which is closed here
+        :returns: a dict of metadata
+        """
+        try:
+            self._wait_for_read_with_timeout(fd)
+            flat_json = os.read(fd, MAX_METADATA_SIZE)
+        finally:
+            self._safe_close([fd])
+
+        if not flat_json:
+            # The storlet did not set any metadata
+            return {}
+        try:
+            return json.loads(flat_json)
+        except ValueError:
+            self.logger.exception('Failed to load metadata from json')
+            raise StorletRuntimeException('Got invalid format about metadata')
+
     def _wait_for_write_with_timeout(self, fd):
         """
         Wait while the write file descriptor gets ready
@@ -761,17 +1209,116 @@ class StorletInvocationProtocol(object):
                                  source['write_fd'],
                                  source['data_iter'])
 
-            out_md = self._read_metadata()
-            self._wait_for_read_with_timeout(self.data_read_fd)
-
-            return StorletResponse(out_md, data_fd=self.data_read_fd,
-                                   cancel=self._cancel)
+            if self.srequest.trailing_metadata:
+                self._wait_for_read_with_timeout(self.data_read_fd)
+                if self._is_metadata_ready():
+                    # The storlet has set metadata before the body, so we
+                    # can return it as usual
+                    out_md = self._read_trailing_metadata()
+                    trailing_metadata_reader = None
+                else:
+                    # Metadata is read once the body is consumed
+                    out_md = {}
+                    trailing_metadata_reader = self._read_trailing_metadata
+            else:
+                out_md = self._read_metadata()
+                trailing_metadata_reader = None
+                self._wait_for_read_with_timeout(self.data_read_fd)
+
+            extra_outputs = None
+            if self.extra_outputs:
+                extra_outputs = self._iter_extra_outputs()
+
+            return StorletResponse(
+                out_md, data_fd=self.data_read_fd, cancel=self._cancel,
+                trailing_metadata_reader=trailing_metadata_reader,
+                output_limit=self.srequest.output_limit,
+                extra_outputs=extra_outputs)
         except Exception:
             self._close_local_side_descriptors()
             if not self.srequest.has_fd:
                 self._close_input_data_descriptors()
             raise
 
+    def _iter_extra_outputs(self):
+        """
+        Iterate over the extra outputs, as the storlet opens them
+
+        :returns: a generator of tuples of the object name and a function
+                  to get StorletResponse instance of each extra output
+        """
+        reader = FileDescriptorIterator(self.container_read_fd,
+                                        self.timeout, None)
+        self.container_read_fd = None
+        opened = set()
+        completed = False
+        try:
+            while True:
+                try:
+                    line = reader.readline()
+                except StopIteration:
+                    break
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    raise StorletRuntimeException(
+                        'Got invalid format about extra output')
+                if entry.get('completed'):
+                    completed = True
+                    break
+
+                index = entry.get('index')
+                if not entry.get('object_name') or index in opened or \
+                        index not in range(len(self.extra_outputs)):
+                    raise StorletRuntimeException(
+                        'Got invalid extra output %s' % entry)
+                opened.add(index)
+                yield (entry['object_name'],
+                       functools.partial(self._get_extra_output, index))
+        finally:
+            reader.close()
+            self._extra_outputs_completed.send(completed)
+            for index, output in enumerate(self.extra_outputs):
+                if index not in opened:
+                    self._safe_close([output['data_read_fd'],
+                                      output['md_read_fd']])
+
+    def _get_extra_output(self, index):
+        """
+        Get an extra output which the storlet has opened
+
+        :param index: the index of the extra output
+        :returns: StorletResponse instance
+        """
+        output = self.extra_outputs[index]
+        data_iter = FileDescriptorIterator(output['data_read_fd'],
+                                           self.timeout, None)
+        try:
+            user_metadata = self._read_metadata_until_closed(
+                output['md_read_fd'])
+        except Exception:
+            data_iter.close()
+            raise
+        return StorletResponse(
+            user_metadata, data_iter=self._iter_extra_output_data(data_iter))
+
+    def _iter_extra_output_data(self, data_iter):
+        """
+        Iterate over the body of an extra output, which ends with an error
+        unless the storlet completes, so that we never store a partial
+        output of a failed storlet
+
+        :param data_iter: FileDescriptorIterator instance of the body
+        """
+        try:
+            for chunk in data_iter:
+                yield chunk
+            if not self._extra_outputs_completed.wait():
+                raise StorletRuntimeException(
+                    'Storlet did not complete, so drop the extra output')
+        finally:
+            data_iter.close()
+
     @contextmanager
     def _open_writer(self, fd):
         with os.fdopen(fd, 'wb') as writer:
@@ -196,30 +196,54 @@ class SBusExecuteDatagram(SBusDatagram):
                           sbus_fd.SBUS_FD_OUTPUT_OBJECT,
                           sbus_fd.SBUS_FD_OUTPUT_OBJECT_METADATA,
                           sbus_fd.SBUS_FD_LOGGER]
+    _extra_fd_types = [sbus_fd.SBUS_FD_INPUT_OBJECT,
+                       sbus_fd.SBUS_FD_OUTPUT_CONTAINER,
+                       sbus_fd.SBUS_FD_OUTPUT_OBJECT,
+                       sbus_fd.SBUS_FD_OUTPUT_OBJECT_METADATA]
 
     def __init__(self, command, sfds, params=None, task_id=None):
         # TODO(kota_): the args command is not used in ExecuteDatagram
         #              but it could be worthful to taransparent init
         #              for other datagram classes.
-        # TODO(takashi): When we add extra output sources, we should
-        #                consider how we can specify the number of the
-        #                extra input/output sources, because currently
-        #                this implementation is based on the idea that
-        #                we only have extra input sources, which is
-        #                added at the end of fd list
+        # NOTE: Extra outputs are given as SBUS_FD_OUTPUT_CONTAINER followed
+        #       by pairs of SBUS_FD_OUTPUT_OBJECT and
+        #       SBUS_FD_OUTPUT_OBJECT_METADATA, and extra input sources are
+        #       added at the end of fd list
         extra_fd_types = [sfd.fdtype for sfd in
                           sfds[len(self._required_fd_types):]]
 
-        if [t for t in extra_fd_types if t != sbus_fd.SBUS_FD_INPUT_OBJECT]:
+        if [t for t in extra_fd_types if t not in self._extra_fd_types]:
             raise ValueError(
-                'Extra data should be SBUS_FD_INPUT_OBJECT')
+                'Extra data should be SBUS_FD_INPUT_OBJECT or extra outputs')
+        if extra_fd_types.count(sbus_fd.SBUS_FD_OUTPUT_CONTAINER) > 1:
+            raise ValueError('Only one SBUS_FD_OUTPUT_CONTAINER is allowed')
 
         super(SBusExecuteDatagram, self).__init__(
             SBUS_CMD_EXECUTE, sfds, params, task_id)
 
+    def _check_required_fd_types(self, given_fd_types):
+        # SBUS_FD_OUTPUT_OBJECT_AND_METADATA can be given instead of
+        # SBUS_FD_OUTPUT_OBJECT, when the storlet is allowed to send
+        # the output metadata after the output body
+        given_fd_types = [
+            sbus_fd.SBUS_FD_OUTPUT_OBJECT
+            if fd_type == sbus_fd.SBUS_FD_OUTPUT_OBJECT_AND_METADATA
+            else fd_type for fd_type in given_fd_types]
+        super(SBusExecuteDatagram, self)._check_required_fd_types(
+            given_fd_types)
+
     @property
     def object_out_fds(self):
-        return self._find_fds(sbus_fd.SBUS_FD_OUTPUT_OBJECT)
+        return [sfd.fileno for sfd in self.sfds
+                if sfd.fdtype in (sbus_fd.SBUS_FD_OUTPUT_OBJECT,
+                                  sbus_fd.SBUS_FD_OUTPUT_OBJECT_AND_METADATA)]
+
+    @property
+    def object_trailing_metadata_out_fds(self):
+        """
+        A list of output object fds whose metadata can be sent after the body
+        """
+        return self._find_fds(sbus_fd.SBUS_FD_OUTPUT_OBJECT_AND_METADATA)
 
     @property
     def object_metadata_out_fds(self):
@@ -229,6 +253,14 @@ class SBusExecuteDatagram(SBusDatagram):
     def task_id_out_fd(self):
         return self._find_fd(sbus_fd.SBUS_FD_OUTPUT_TASK_ID)
 
+    @property
+    def container_out_fd(self):
+        """
+        A fd to announce the extra outputs, which are the output object fds
+        after the first one
+        """
+        return self._find_fd(sbus_fd.SBUS_FD_OUTPUT_CONTAINER)
+
     @property
     def logger_out_fd(self):
         return self._find_fd(sbus_fd.SBUS_FD_LOGGER)
@@ -13,12 +13,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import json
+import math
+from email.utils import formatdate, mktime_tz, parsedate_tz
 from six.moves.urllib.parse import unquote
 from swift.common.internal_client import InternalClient
 from swift.common.swob import HTTPBadRequest, Response, Range, \
-    HTTPServiceUnavailable
-from swift.common.utils import config_true_value
+    HTTPServiceUnavailable, HTTPNotModified, Match
+from swift.common.utils import close_if_possible, config_true_value, \
+    list_from_csv
 
+from storlets.gateway.common.cache import StorletResultCache
 from storlets.gateway.common.exceptions import FileManagementError
 from storlets.gateway.common.file_manager import FileManager
 from storlets.gateway.common.exceptions import StorletRuntimeException
@@ -35,7 +41,9 @@ class NotStorletExecution(NotStorletRequest):
 def get_container_names(conf):
     return {'storlet': conf.get('storlet_container', 'storlet'),
             'dependency': conf.get('storlet_dependency', 'dependency'),
-            'log': conf.get('storlet_logcontainer', 'storletlog')}
+            'log': conf.get('storlet_logcontainer', 'storletlog'),
+            'materialized': conf.get('storlet_materialized_container',
+                                     'storletmaterialized')}
 
 
 class SwiftFileManager(FileManager):
@@ -177,6 +185,98 @@ def _request_instance_property():
                     doc="Force to tie the request to acc/con/obj vars")
 
 
+class TrailingMetadataIterator(object):
+    """
+    Iterator over the storlet output, which passes the metadata the storlet
+    sent after the body to the callback once the body is consumed
+
+    :param sresp: StorletResponse instance
+    :param callback: function called with a dict of the metadata
+    """
+
+    def __init__(self, sresp, callback):
+        self.sresp = sresp
+        self.callback = callback
+        self.data_iter = iter(sresp.data_iter)
+        self.finished = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.finished:
+            raise StopIteration()
+        try:
+            return next(self.data_iter)
+        except StopIteration:
+            self.finished = True
+            try:
+                self.callback(self.sresp.read_trailing_metadata())
+            finally:
+                close_if_possible(self.sresp.data_iter)
+            raise
+        except Exception:
+            self.close()
+            raise
+
+    __next__ = next
+
+    def close(self):
+        if self.finished:
+            return
+        self.finished = True
+        # Propagate close (e.g. client disconnect) to the storlet, and
+        # release the metadata fd
+        try:
+            close_if_possible(self.sresp.data_iter)
+        finally:
+            self.sresp.read_trailing_metadata(discard=True)
+
+
+class OutputRangeIterator(object):
+    """
+    Iterator over a byte range of the storlet output
+
+    The underlying iterator is closed as soon as the range is returned, so
+    that the storlet task is canceled instead of producing unused output.
+
+    :param data_iter: iterator over the storlet output
+    :param skip: the number of bytes to skip at the beginning
+    :param length: the number of bytes to return after the skipped ones
+    """
+
+    def __init__(self, data_iter, skip, length):
+        self.data_iter = data_iter
+        self._iter = iter(data_iter)
+        self.to_skip = skip
+        self.remaining = length
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while self.remaining > 0:
+            chunk = next(self._iter)
+            if self.to_skip:
+                skipped = min(len(chunk), self.to_skip)
+                chunk = chunk[skipped:]
+                self.to_skip -= skipped
+            if chunk:
+                chunk = chunk[:self.remaining]
+                self.remaining -= len(chunk)
+                return chunk
+        self.close()
+        raise StopIteration()
+
+    __next__ = next
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            close_if_possible(self.data_iter)
+
+
 class StorletBaseHandler(object):
     """
     This is an abstract handler for Proxy/Object Server middleware
@@ -205,7 +305,10 @@ class StorletBaseHandler(object):
         self.storlet_container = containers['storlet']
         self.storlet_dependency = containers['dependency']
         self.log_container = containers['log']
+        self.materialized_container = containers['materialized']
         self.client_conf_file = '/etc/swift/storlet-proxy-server.conf'
+        self.result_cache = StorletResultCache.from_conf(gateway_conf,
+                                                         logger)
 
     def _setup_gateway(self):
         """
@@ -313,6 +416,64 @@ class StorletBaseHandler(object):
         r = self.request.headers['X-Storlet-Range']
         return len(Range(r).ranges) > 1
 
+    @property
+    def storlet_output_limit(self):
+        """
+        Get the maximum number of storlet output bytes the client wants
+
+        :return: the output limit, or None if no limit is given
+        :raises HTTPBadRequest: if the limit is not a non-negative integer
+        """
+        limit = self.request.headers.get('X-Storlet-Output-Limit')
+        if limit is None:
+            return None
+        try:
+            limit = int(limit)
+            if limit < 0:
+                raise ValueError()
+        except ValueError:
+            raise HTTPBadRequest(b'X-Storlet-Output-Limit header should be '
+                                 b'a non-negative integer',
+                                 request=self.request)
+        return limit
+
+    @property
+    def storlet_output_range(self):
+        """
+        Get the byte range of the storlet output the client wants
+
+        X-Storlet-Output-Range is set by the proxy from the client's Range
+        header, which is validated there.
+
+        :return: a tuple of the first and the last byte position, or None
+                 if the whole output is wanted
+        """
+        if 'X-Storlet-Output-Range' not in self.request.headers:
+            return None
+        return Range(self.request.headers['X-Storlet-Output-Range']).ranges[0]
+
+    @property
+    def is_output_seekable(self):
+        """
+        Check whether the storlet can start its output from a given offset,
+        according to the storlet registration
+
+        :return: Whether the storlet output is seekable
+        """
+        return config_true_value(
+            self.request.headers.get('X-Storlet-Output-Seekable'))
+
+    @property
+    def is_deterministic(self):
+        """
+        Check whether the storlet always returns the same output for the
+        same input and parameters, according to the storlet registration
+
+        :return: Whether the storlet is deterministic
+        """
+        return config_true_value(
+            self.request.headers.get('X-Storlet-Deterministic'))
+
     @property
     def has_run_on_proxy_header(self):
         """
@@ -340,10 +501,22 @@ class StorletBaseHandler(object):
         """
         return 'X-Storlet-Extra-Resources' in self.request.headers
 
+    @property
+    def has_output_container_header(self):
+        """
+        Check whether the client wants to store the extra outputs of the
+        storlet into a container, which happens in proxy-server
+
+        :return: Whether the request contains X-Storlet-Output-Container
+                 header
+        """
+        return 'X-Storlet-Output-Container' in self.request.headers
+
     @property
     def execute_on_proxy(self):
         return (self.has_run_on_proxy_header or
                 self.has_extra_resources_header or
+                self.has_output_container_header or
                 self.storlet_execute_on_proxy)
 
     @property
@@ -404,6 +577,13 @@ class StorletBaseHandler(object):
                 else:
                     headers['X-Object-Meta-%s' % key] = val
 
+    def _log_trailing_metadata(self, metadata):
+        # NOTE: We can not send trailers in GET response because wsgi does
+        #       not support them, so just leave the metadata in log
+        if metadata:
+            self.logger.warning('Drop metadata sent after body for %s: %s' %
+                                (self.path, metadata))
+
     def _call_gateway(self, resp):
         """
         Call gateway module to get result of storlet execution
@@ -413,6 +593,117 @@ class StorletBaseHandler(object):
         """
         raise NotImplementedError()
 
+    def _get_output_identity(self, resp):
+        """
+        Get the values which identify the output of a deterministic storlet
+
+        :param resp: swob.Response instance of the storlet input
+        :return: a list of the values, or None if the output can not be
+                 identified
+        """
+        if not self.is_deterministic or self.has_extra_resources_header:
+            return None
+
+        etag = resp.headers.get('Etag')
+        storlet_timestamp = self.request.headers.get('X-Storlet-X-Timestamp')
+        if not etag or not storlet_timestamp:
+            return None
+
+        # Dependency versions are given by the proxy
+        dependency_versions = self.request.headers.get(
+            'X-Storlet-Dependency-Versions')
+        if self.request.headers.get('X-Storlet-Dependency') and \
+                not dependency_versions:
+            return None
+
+        return [self.account, self.request.headers['X-Run-Storlet'],
+                storlet_timestamp, dependency_versions, etag.strip('"'),
+                resp.headers.get('Content-Range'),
+                sorted(self.request.params.items())]
+
+    def _get_output_validators(self, resp, identity):
+        """
+        Get the validators of the output of a deterministic storlet
+
+        The output changes only when the input, the storlet or its
+        dependencies change, so its ETag is derived from the values which
+        identify them, and its Last-Modified is the latest of their times.
+
+        :param resp: swob.Response instance of the storlet input
+        :param identity: the values which identify the output
+        :return: a tuple of the output ETag and Last-Modified time in
+                 seconds since the epoch
+        """
+        etag = hashlib.md5(
+            json.dumps(identity).encode('utf-8')).hexdigest()
+
+        timestamps = [identity[2]]
+        for version in list_from_csv(identity[3]):
+            timestamps.append(version.rsplit(':', 1)[1])
+        last_modified = max(int(math.ceil(float(ts))) for ts in timestamps)
+
+        input_last_modified = parsedate_tz(
+            resp.headers.get('Last-Modified', ''))
+        if input_last_modified:
+            last_modified = max(last_modified,
+                                mktime_tz(input_last_modified))
+        return etag, last_modified
+
+    def _is_output_not_modified(self, etag, last_modified):
+        """
+        Evaluate the conditional request headers on the storlet output
+
+        :param etag: the output ETag
+        :param last_modified: the output Last-Modified time in seconds
+                              since the epoch
+        :return: Whether the client already has the output
+        """
+        if_none_match = self.request.headers.get('X-Storlet-If-None-Match')
+        if if_none_match:
+            # If-Modified-Since is ignored when If-None-Match is given
+            return etag in Match(if_none_match)
+
+        if_modified_since = parsedate_tz(
+            self.request.headers.get('X-Storlet-If-Modified-Since', ''))
+        if if_modified_since:
+            return last_modified <= mktime_tz(if_modified_since)
+        return False
+
+    def _get_result_cache_key(self, identity):
+        """
+        Get the key of the storlet output in the result cache
+
+        :param identity: the values which identify the output
+        :return: the cache key, or None if the output can not be cached
+        """
+        if self.result_cache is None or self.request.method != 'GET' or \
+                identity is None:
+            return None
+        return self.result_cache.make_key(*identity)
+
+    def _get_cached_result(self, resp, cache_key):
+        """
+        Get the storlet output from the result cache
+
+        :param resp: swob.Response instance of the storlet input
+        :param cache_key: the cache key
+        :return: a tuple of the output metadata and an iterator over the
+                 output, or None if the output is not cached
+        """
+        cached = self.result_cache.get(cache_key)
+        if cached is None:
+            return None
+        self.logger.debug('Storlet output for %s is found in cache' %
+                          self.path)
+        # We do not need the input anymore
+        close_if_possible(resp.app_iter)
+
+        user_metadata, app_iter = cached
+        if self.storlet_output_limit is not None:
+            app_iter = OutputRangeIterator(app_iter, 0,
+                                           self.storlet_output_limit)
+        return user_metadata, app_iter
+
     def apply_storlet(self, resp):
         """
         Apply storlet on response
@@ -421,7 +712,44 @@ class StorletBaseHandler(object):
         :return: processed response
         """
         try:
-            sresp = self._call_gateway(resp)
+            identity = self._get_output_identity(resp)
+            if identity is not None:
+                etag, last_modified = self._get_output_validators(
+                    resp, identity)
+                validators = {'Etag': etag,
+                              'Last-Modified': formatdate(last_modified,
+                                                          usegmt=True)}
+                if self._is_output_not_modified(etag, last_modified):
+                    # We do not need to run the storlet
+                    close_if_possible(resp.app_iter)
+                    return HTTPNotModified(request=self.request,
+                                           headers=validators)
+
+            cache_key = self._get_result_cache_key(identity)
+            cached = None
+            if cache_key:
+                cached = self._get_cached_result(resp, cache_key)
+
+            if cached:
+                user_metadata, app_iter = cached
+                # The whole output is cached
+                seekable = False
+            else:
+                sresp = self._call_gateway(resp)
+                user_metadata = sresp.user_metadata
+                if sresp.has_trailing_metadata:
+                    app_iter = TrailingMetadataIterator(
+                        sresp, self._log_trailing_metadata)
+                else:
+                    app_iter = sresp.data_iter
+                seekable = self.is_output_seekable
+
+                # NOTE: The output is truncated when its limit or range is
+                # given, so it can not be stored
+                if cache_key and self.storlet_output_limit is None and \
+                        self.storlet_output_range is None:
+                    app_iter = self.result_cache.write_through(
+                        cache_key, user_metadata, app_iter)
 
             new_headers = resp.headers.copy()
 
@@ -439,8 +767,23 @@ class StorletBaseHandler(object):
                     resp.headers['Content-Range']
                 new_headers.pop('Content-Range')
 
-            self._set_metadata_in_headers(new_headers, sresp.user_metadata)
-            response = Response(headers=new_headers, app_iter=sresp.data_iter,
+            if identity is not None:
+                new_headers.update(validators)
+
+            self._set_metadata_in_headers(new_headers, user_metadata)
+
+            output_range = self.storlet_output_range
+            if output_range is not None:
+                start, end = output_range
+                # A seekable storlet starts its output from the range start
+                skip = 0 if seekable else start
+                app_iter = OutputRangeIterator(app_iter, skip,
+                                               end - start + 1)
+                # NOTE: We don't know the whole output length. This is
+                # turned into Content-Range of 206 response in proxy
+                new_headers['X-Storlet-Output-Content-Range'] = \
+                    'bytes %d-%d/*' % (start, end)
+            response = Response(headers=new_headers, app_iter=app_iter,
                                 reuqest=self.request)
         except StorletRuntimeException:
             response = HTTPServiceUnavailable()
@@ -460,7 +803,14 @@ class StorletBaseHandler(object):
     def _get_storlet_invocation_options(self, req):
         options = dict()
 
-        filtered_key = ['X-Storlet-Range', 'X-Storlet-Generate-Log']
+        filtered_key = ['X-Storlet-Range', 'X-Storlet-Generate-Log',
+                        'X-Storlet-Output-Limit', 'X-Storlet-Output-Range',
+                        'X-Storlet-If-None-Match',
+                        'X-Storlet-If-Modified-Since',
+                        'X-Storlet-Reduce', 'X-Storlet-Partitions',
+                        'X-Storlet-Max-Record-Line', 'X-Storlet-Objects',
+                        'X-Storlet-Prefix', 'X-Storlet-Pipeline',
+                        'X-Storlet-Output-Container', 'X-Storlet-Outputs']
 
         for key in req.headers:
             prefix = 'X-Storlet-'
@@ -477,6 +827,35 @@ class StorletBaseHandler(object):
         options['generate_log'] = \
             config_true_value(req.headers.get('X-Storlet-Generate-Log'))
 
+        # The later stages of the pipeline, which are verified on proxy
+        pipeline = req.headers.get('X-Storlet-Pipeline')
+        options['pipeline'] = json.loads(pipeline) if pipeline else []
+
+        # The output limit and range are applied only when the output is
+        # returned to the client, as we should not store a truncated object
+        options['output_limit'] = None
+        options['output_range'] = None
+        options['output_container'] = None
+        options['extra_outputs'] = 0
+        if req.method == 'GET':
+            if self.has_output_container_header:
+                # The extra outputs are stored by proxy
+                options['output_container'] = \
+                    req.headers['X-Storlet-Output-Container']
+                options['extra_outputs'] = \
+                    int(req.headers.get('X-Storlet-Outputs', 0))
+            options['output_limit'] = self.storlet_output_limit
+            output_range = self.storlet_output_range
+            if output_range is not None:
+                start, end = output_range
+                if self.is_output_seekable:
+                    # The storlet starts its output from the range start
+                    options['output_range'] = output_range
+                    options['output_limit'] = end - start + 1
+                else:
+                    # We do not need any output after the range
+                    options['output_limit'] = end + 1
+
         options['file_manager'] = \
             SwiftFileManager(self.account, self.storlet_container,
                              self.storlet_dependency, self.log_container,
@@ -13,20 +13,34 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from six.moves.urllib.parse import quote
+from collections import deque
+import eventlet
+import json
+import math
+import re
+import tarfile
+import uuid
+from six.moves.urllib.parse import quote, unquote, urlencode
 from swift.common.middleware.copy import \
     _check_copy_from_header as check_copy_from_header, \
     _check_destination_header as check_destination_header, \
     _copy_headers as copy_headers
 from swift.common.swob import HTTPBadRequest, HTTPUnauthorized, \
-    HTTPMethodNotAllowed, HTTPPreconditionFailed, HTTPForbidden
+    HTTPMethodNotAllowed, HTTPPreconditionFailed, HTTPForbidden, Range, \
+    Request, Response, HTTPNotAcceptable, HTTPRequestEntityTooLarge, \
+    HTTPInternalServerError, HTTPAccepted, HTTPServiceUnavailable, \
+    status_map
 from swift.common.utils import config_true_value, public, FileLikeIter, \
-    list_from_csv, split_path
+    list_from_csv, split_path, close_if_possible
 from swift.common.middleware.acl import clean_acl
 from swift.common.wsgi import make_subrequest
 from swift.proxy.controllers.base import get_account_info
+from storlets.gateway.common.exceptions import StorletRuntimeException, \
+    StorletTimeout
+from storlets.gateway.common.stob import StorletResponse
 from storlets.swift_middleware.handlers.base import StorletBaseHandler, \
-    NotStorletRequest, NotStorletExecution
+    NotStorletRequest, NotStorletExecution, TrailingMetadataIterator, \
+    OutputRangeIterator
 
 
 CONDITIONAL_KEYS = ['IF_MATCH', 'IF_NONE_MATCH', 'IF_MODIFIED_SINCE',
@@ -34,6 +48,208 @@ CONDITIONAL_KEYS = ['IF_MATCH', 'IF_NONE_MATCH', 'IF_MODIFIED_SINCE',
 
 REFERER_PREFIX = 'storlets'
 
+# Conditional headers which are evaluated on the storlet output
+OUTPUT_CONDITIONAL_HEADERS = ['If-None-Match', 'If-Modified-Since']
+
+# Storlet request headers which are set only from the storlet registration
+REGISTRATION_ONLY_HEADERS = ['X-Storlet-Trailing-Metadata',
+                             'X-Storlet-Output-Seekable',
+                             'X-Storlet-Deterministic',
+                             'X-Storlet-Dependency-Versions',
+                             'X-Storlet-Materialize',
+                             'X-Storlet-Segment-Mappable',
+                             'X-Storlet-Pipeline']
+
+# Storlet properties which hold only for the storlet itself, not for a
+# pipeline starting from it
+PIPELINE_FILTERED_PARAMS = ['Trailing-Metadata', 'Output-Seekable',
+                            'Deterministic', 'Materialize',
+                            'Segment-Mappable']
+
+# Parameters of the later stages of a pipeline,
+# X-Storlet-Stage-<N>-Parameter-<M>: <key>:<value>
+STAGE_PARAMETER_HEADER = re.compile(r'^X-Storlet-Stage-(\d+)-Parameter-',
+                                    re.IGNORECASE)
+
+# Storlet request headers which are not passed to the invocations fanned out
+# from the request, because they are applied to the whole output
+FAN_OUT_FILTERED_HEADERS = ['X-Storlet-Output-Range',
+                            'X-Storlet-Output-Limit',
+                            'X-Storlet-If-None-Match',
+                            'X-Storlet-If-Modified-Since',
+                            'X-Storlet-Reduce',
+                            'X-Storlet-Range',
+                            'X-Storlet-Partitions',
+                            'X-Storlet-Max-Record-Line',
+                            'X-Storlet-Objects',
+                            'X-Storlet-Prefix']
+
+# Storlet properties which do not hold when the storlet stores extra
+# outputs, as the storlet has to run every time to store them
+MULTI_OUTPUT_FILTERED_PARAMS = ['Output-Seekable', 'Deterministic',
+                                'Materialize', 'Segment-Mappable']
+
+# Formats of the bulk storlet invocation response
+BULK_CONTENT_TYPES = ['multipart/mixed', 'application/x-tar']
+
+# The maximum length of each object path in the bulk storlet invocation
+MAX_BULK_PATH_LENGTH = 2048
+
+# The suffix of the object which tells the status of an asynchronous storlet
+# job, which is stored next to the job output
+JOB_STATUS_SUFFIX = '.storlet-job'
+
+# System metadata of a materialized storlet output, which tells the source
+# object version and the parameters the output is generated from
+MATERIALIZED_SOURCE_TIMESTAMP = 'X-Object-Sysmeta-Storlet-Source-Timestamp'
+MATERIALIZED_PARAMETERS = 'X-Object-Sysmeta-Storlet-Parameters'
+
+
+class ParallelOutputIterator(object):
+    """
+    Iterator over the outputs of storlet invocations run in parallel
+
+    The outputs are returned in the order of the given items. At most
+    concurrency invocations are in flight (or waiting to be read) at once.
+
+    :param invoke: a function to invoke the storlet on an item, which
+                   returns swob.Response instance
+    :param items: the items to invoke the storlet on
+    :param concurrency: the maximum number of invocations in flight
+    """
+
+    def __init__(self, invoke, items, concurrency):
+        self.invoke = invoke
+        self.items = iter(items)
+        self.concurrency = max(concurrency, 1)
+        self.pending = deque()
+        self.resp = None
+        self.resp_iter = None
+        self._spawn()
+
+    def _spawn(self):
+        while len(self.pending) < self.concurrency:
+            try:
+                item = next(self.items)
+            except StopIteration:
+                return
+            self.pending.append(eventlet.spawn(self.invoke, item))
+
+    def _close_response(self):
+        if self.resp is not None:
+            close_if_possible(self.resp.app_iter)
+            self.resp = self.resp_iter = None
+
+    def next_response(self):
+        """
+        Wait for the next invocation
+
+        :return: swob.Response instance of the next invocation, or None if
+                 all of the invocations are already returned
+        """
+        self._close_response()
+        if not self.pending:
+            return None
+        thread = self.pending.popleft()
+        self._spawn()
+        self.resp = thread.wait()
+        self.resp_iter = iter(self.resp.app_iter or [])
+        return self.resp
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while True:
+            if self.resp is None:
+                try:
+                    resp = self.next_response()
+                except Exception:
+                    self.close()
+                    raise
+                if resp is None:
+                    raise StopIteration()
+                if not resp.is_success:
+                    # NOTE: We can not tell the error to the client, as
+                    # the response is already started
+                    self.close()
+                    raise StorletRuntimeException(
+                        'Storlet invocation failed with %s' % resp.status)
+            try:
+                return next(self.resp_iter)
+            except StopIteration:
+                self._close_response()
+
+    __next__ = next
+
+    def close(self):
+        self._close_response()
+        while self.pending:
+            thread = self.pending.popleft()
+            try:
+                close_if_possible(thread.wait().app_iter)
+            except Exception:
+                pass
+
+
+class StorletJobQueue(object):
+    """
+    Queue of asynchronous storlet jobs in a proxy server process
+
+    :param max_running: the maximum number of jobs running at once
+    :param max_queued: the maximum number of jobs waiting to run
+    :param logger: a logger instance
+    """
+
+    def __init__(self, max_running, max_queued, logger):
+        self.max_running = max(max_running, 1)
+        self.max_queued = max_queued
+        self.logger = logger
+        self.jobs = deque()
+        self.running = 0
+
+    @classmethod
+    def from_conf(cls, conf, logger):
+        """
+        Create a job queue from the middleware conf
+
+        :param conf: a dict for middleware conf
+        :param logger: a logger instance
+        :return: StorletJobQueue instance
+        """
+        return cls(int(conf.get('storlet_max_jobs', 4)),
+                   int(conf.get('storlet_job_queue_size', 100)),
+                   logger)
+
+    def submit(self, func, *args):
+        """
+        Queue a job, which runs once a running job completes
+
+        :param func: a function to run the job
+        :param args: the arguments given to func
+        :return: False if the queue is full
+        """
+        if len(self.jobs) >= self.max_queued:
+            return False
+        self.jobs.append((func, args))
+        self._start()
+        return True
+
+    def _start(self):
+        while self.jobs and self.running < self.max_running:
+            func, args = self.jobs.popleft()
+            self.running += 1
+            eventlet.spawn_n(self._run, func, args)
+
+    def _run(self, func, args):
+        try:
+            func(*args)
+        except Exception:
+            self.logger.exception('Asynchronous storlet job failed')
+        finally:
+            self.running -= 1
+            self._start()
+
 
 class StorletProxyHandler(StorletBaseHandler):
     def __init__(self, request, conf, gateway_conf, app, logger):
@@ -43,6 +259,16 @@ class StorletProxyHandler(StorletBaseHandler):
                                    self.storlet_dependency]
         self.agent = 'ST'
         self.extra_sources = []
+        self.storlet_params = {}
+        self.segment_concurrency = \
+            int(conf.get('storlet_segment_concurrency', 4))
+        self.partition_size = \
+            int(conf.get('storlet_partition_size', 64 * 1024 * 1024))
+        self.max_partitions = int(conf.get('storlet_max_partitions', 8))
+        self.bulk_max_objects = \
+            int(conf.get('storlet_bulk_max_objects', 1000))
+        self.max_outputs = int(conf.get('storlet_max_outputs', 8))
+        self.job_queue = conf.get('storlet_job_queue')
 
         # A very initial hook for blocking requests
         self._should_block(request)
@@ -67,11 +293,74 @@ class StorletProxyHandler(StorletBaseHandler):
             # TODO(takashi): We have to validate metadata in COPY case
             self._validate_registration(self.request)
             raise NotStorletExecution()
-        elif self.is_storlet_execution:
+        elif self.is_storlet_execution or \
+                self.is_storlet_container_execution or \
+                self.is_storlet_bulk_execution:
             self._setup_gateway()
+            self._validate_output_limit()
+            self._validate_output_container()
         else:
             raise NotStorletExecution()
 
+    def _validate_output_limit(self):
+        """
+        Validate X-Storlet-Output-Limit header
+
+        :raises HTTPBadRequest: If the header is malformed, or is given in
+                                a request which stores the storlet output
+        """
+        limit = self.storlet_output_limit
+        if limit is not None and self.request.method != 'GET':
+            # We should not store a truncated object silently
+            msg = 'X-Storlet-Output-Limit header is supported only in GET'
+            raise HTTPBadRequest(msg.encode('utf8'), request=self.request)
+
+    def _validate_output_container(self):
+        """
+        Validate X-Storlet-Output-Container and X-Storlet-Outputs headers,
+        and set the number of the extra outputs to X-Storlet-Outputs
+
+        :raises HTTPBadRequest: If the headers are malformed, or are given
+                                in a request which can not store the
+                                extra outputs
+        """
+        if not self.has_output_container_header:
+            return
+
+        if self.request.method != 'GET' or not self.obj:
+            msg = 'X-Storlet-Output-Container header is supported only ' \
+                  'in GET of an object'
+            raise HTTPBadRequest(msg.encode('utf8'), request=self.request)
+
+        # The storlet should run on the whole input to the end, every time
+        storlets = list_from_csv(self.request.headers['X-Run-Storlet'])
+        if self.is_range_request or \
+                self.storlet_output_limit is not None or \
+                'X-Storlet-Reduce' in self.request.headers or \
+                self.is_partitioned_request or len(storlets) > 1:
+            msg = 'X-Storlet-Output-Container header is not supported ' \
+                  'with Range, X-Storlet-Output-Limit, X-Storlet-Reduce, ' \
+                  'X-Storlet-Partitions or a storlet pipeline'
+            raise HTTPBadRequest(msg.encode('utf8'), request=self.request)
+
+        container = self.request.headers['X-Storlet-Output-Container']
+        if not container or '/' in container:
+            msg = 'X-Storlet-Output-Container header should be a ' \
+                  'container name'
+            raise HTTPBadRequest(msg.encode('utf8'), request=self.request)
+
+        outputs = self.request.headers.get('X-Storlet-Outputs',
+                                           self.max_outputs)
+        try:
+            outputs = int(outputs)
+            if outputs < 1 or outputs > self.max_outputs:
+                raise ValueError()
+        except ValueError:
+            msg = 'X-Storlet-Outputs header should be an integer ' \
+                  'between 1 and %d' % self.max_outputs
+            raise HTTPBadRequest(msg.encode('utf8'), request=self.request)
+        self.request.headers['X-Storlet-Outputs'] = str(outputs)
+
     def _should_block(self, request):
         # Currently, we have only one reason to block
         # requests at such an early stage of the processing:
@@ -83,7 +372,7 @@ class StorletProxyHandler(StorletBaseHandler):
             raise HTTPForbidden(msg.encode('utf8'), request=self.request)
 
     def _parse_vaco(self):
-        return self.request.split_path(3, 4, rest_with_last=True)
+        return self.request.split_path(2, 4, rest_with_last=True)
 
     def is_proxy_runnable(self, resp=None):
         """
@@ -107,7 +396,36 @@ class StorletProxyHandler(StorletBaseHandler):
     @property
     def is_storlet_request(self):
         return (self.is_storlet_execution or self.is_storlet_object_update
-                or self.is_storlet_acl_update)
+                or self.is_storlet_acl_update
+                or self.is_storlet_container_execution
+                or self.is_storlet_bulk_execution)
+
+    @property
+    def is_storlet_bulk_execution(self):
+        """
+        Check if the request requires storlet execution on the objects
+        listed in the request body
+
+        :return: Whether storlet should be executed on the objects
+        """
+        return ('X-Run-Storlet' in self.request.headers and
+                not self.container and self.request.method == 'POST' and
+                'bulk-storlet' in self.request.params)
+
+    @property
+    def is_storlet_container_execution(self):
+        """
+        Check if the request requires storlet execution on the objects in
+        a container, which are selected by X-Storlet-Objects or
+        X-Storlet-Prefix header
+
+        :return: Whether storlet should be executed on the objects
+        """
+        return ('X-Run-Storlet' in self.request.headers and
+                self.container and not self.obj and
+                self.request.method == 'GET' and
+                ('X-Storlet-Objects' in self.request.headers or
+                 'X-Storlet-Prefix' in self.request.headers))
 
     @property
     def is_storlet_object_update(self):
@@ -116,7 +434,8 @@ class StorletProxyHandler(StorletBaseHandler):
 
     @property
     def is_storlet_acl_update(self):
-        return (self.request.method == 'POST' and not self.obj and
+        return (self.request.method == 'POST' and self.container and
+                not self.obj and
                 'X-Storlet-Container-Read' in self.request.headers)
 
     @property
@@ -201,18 +520,11 @@ class StorletProxyHandler(StorletBaseHandler):
         # The request is valid. Keep the ACL string
         return acl_string
 
-    def verify_access_to_storlet(self):
+    def _make_verify_env(self):
         """
-        Verify access to the storlet object
-
-        :return: storlet parameters
-        :raises HTTPUnauthorized: If it fails to verify access
+        Make a WSGI environment for the subrequests to verify access on
+        behalf of the client
         """
-        sobj = self.request.headers.get('X-Run-Storlet')
-        spath = '/'.join(['', self.api_version, self.account,
-                          self.storlet_container, sobj])
-        self.logger.debug('Verify access to %s' % spath)
-
         new_env = dict(self.request.environ)
         if 'HTTP_TRANSFER_ENCODING' in new_env:
             del new_env['HTTP_TRANSFER_ENCODING']
@@ -221,7 +533,21 @@ class StorletProxyHandler(StorletBaseHandler):
             env_key = 'HTTP_' + key
             if env_key in new_env:
                 del new_env[env_key]
+        return new_env
+
+    def _get_storlet_params(self, sobj):
+        """
+        Get the parameters of the storlet, verifying access to it
+
+        :param sobj: the storlet object name
+        :return: storlet parameters
+        :raises HTTPUnauthorized: If it fails to verify access
+        """
+        spath = '/'.join(['', self.api_version, self.account,
+                          self.storlet_container, sobj])
+        self.logger.debug('Verify access to %s' % spath)
 
+        new_env = self._make_verify_env()
         auth_token = self.request.headers.get('X-Auth-Token')
         storlet_req = make_subrequest(
             new_env, 'HEAD', spath,
@@ -240,8 +566,182 @@ class StorletProxyHandler(StorletBaseHandler):
         params = self._parse_storlet_params(resp.headers)
         for key in ['Content-Length', 'X-Timestamp']:
             params[key] = resp.headers[key]
+
+        # The output of a deterministic storlet may be cached, which needs
+        # the versions of the dependencies as well as the storlet's one
+        if config_true_value(params.get('Deterministic')) and \
+                params.get('Dependency'):
+            versions = self._get_dependency_versions(
+                new_env, auth_token, params['Dependency'])
+            if versions:
+                params['Dependency-Versions'] = versions
+        return params
+
+    def verify_access_to_storlet(self):
+        """
+        Verify access to the storlet object
+
+        :return: storlet parameters
+        :raises HTTPUnauthorized: If it fails to verify access
+        """
+        # Some storlet properties are given only by the storlet
+        # registration, never by the client
+        for key in REGISTRATION_ONLY_HEADERS:
+            self.request.headers.pop(key, None)
+
+        storlets = list_from_csv(self.request.headers.get('X-Run-Storlet'))
+        if len(storlets) > 1:
+            # The first storlet is invoked as usual, and the rest are
+            # chained to it by the gateway
+            self.request.headers['X-Run-Storlet'] = storlets[0]
+        params = self._get_storlet_params(storlets[0])
+        if len(storlets) > 1:
+            params = self._set_storlet_pipeline(params, storlets[1:])
+        self.storlet_params = params
+        return params
+
+    def _get_stage_parameters(self, count):
+        """
+        Get the parameters of the later stages of a pipeline from
+        X-Storlet-Stage-<N>-Parameter-<M> headers, where N is 2 for the
+        second storlet
+
+        :param count: the number of the stages
+        :return: a list of the parameters of each later stage
+        :raises HTTPBadRequest: If the stage does not exist
+        """
+        stage_params = [{} for _ in range(count - 1)]
+        for key in list(self.request.headers):
+            match = STAGE_PARAMETER_HEADER.match(key)
+            if not match:
+                continue
+            stage = int(match.group(1))
+            keyvalue = unquote(self.request.headers.pop(key))
+            if stage < 2 or stage > count or ':' not in keyvalue:
+                msg = 'Invalid pipeline stage parameter: %s' % key
+                raise HTTPBadRequest(msg.encode('utf8'),
+                                     request=self.request)
+            param_key, param_value = keyvalue.split(':', 1)
+            stage_params[stage - 2][param_key] = param_value
+        return stage_params
+
+    def _set_storlet_pipeline(self, params, storlets):
+        """
+        Set the later stages of a pipeline to the request, which are
+        passed to the gateway via X-Storlet-Pipeline header
+
+        :param params: the parameters of the first storlet
+        :param storlets: the later storlets of the pipeline
+        :return: the parameters of the first storlet, for the pipeline
+        :raises HTTPUnauthorized: If it fails to verify access to a storlet
+        """
+        stage_params = self._get_stage_parameters(len(storlets) + 1)
+        stages = []
+        for storlet, stage_param in zip(storlets, stage_params):
+            sparams = self._get_storlet_params(storlet)
+            options = dict(
+                ('storlet_' + key.lower().replace('-', '_'), val)
+                for key, val in sparams.items())
+            stages.append({'storlet': storlet, 'options': options,
+                           'params': stage_param})
+        self.request.headers['X-Storlet-Pipeline'] = json.dumps(stages)
+
+        params = dict(params)
+        for key in PIPELINE_FILTERED_PARAMS:
+            params.pop(key, None)
+        # The output is sent by the last stage
+        if 'Trailing-Metadata' in sparams:
+            params['Trailing-Metadata'] = sparams['Trailing-Metadata']
         return params
 
+    def _get_dependency_versions(self, env, auth_token, dependencies):
+        """
+        Get the versions of the storlet dependencies
+
+        :param env: WSGI environment to make subrequests
+        :param auth_token: auth token to make subrequests
+        :param dependencies: a comma separated list of the dependencies
+        :return: a comma separated list of <dependency>:<timestamp>, or None
+                 if it fails to get any of them
+        """
+        versions = []
+        for dep in list_from_csv(dependencies):
+            dpath = '/'.join(['', self.api_version, self.account,
+                              self.storlet_dependency, dep])
+            dep_req = make_subrequest(
+                env, 'HEAD', dpath,
+                headers={'X-Auth-Token': auth_token},
+                swift_source=self.agent)
+            resp = dep_req.get_response(self.app)
+            if not resp.is_success:
+                self.logger.warning('Failed to get the version of the '
+                                    'dependency %s' % dpath)
+                return None
+            versions.append('%s:%s' % (dep, resp.headers['X-Timestamp']))
+        return ','.join(versions)
+
+    @property
+    def is_materialized(self):
+        """
+        Check whether the storlet output is materialized at PUT time,
+        according to the storlet registration
+
+        :return: Whether the storlet output is materialized
+        """
+        return config_true_value(
+            self.storlet_params.get('Materialize'))
+
+    @property
+    def materialized_object(self):
+        """
+        The name of the materialized storlet output of the object
+        """
+        return '/'.join([self.request.headers['X-Run-Storlet'],
+                         self.container, self.obj])
+
+    @property
+    def materialized_parameters(self):
+        """
+        The invocation parameters, serialized to be compared with the ones
+        the materialized output is generated with
+        """
+        return json.dumps(sorted(self.request.params.items()))
+
+    def _allow_materialized_access(self, env):
+        """
+        Allow the request to access the materialized container
+
+        The client may not be allowed to access the materialized container,
+        so the access to the object itself is verified separately.
+
+        :param env: WSGI environment of the request
+        """
+        env['swift.authorize_override'] = True
+        env['swift.authorize'] = lambda req: None
+
+    @property
+    def is_segment_mappable(self):
+        """
+        Check whether the storlet can be invoked on each segment of an
+        object, so that the concatenated outputs make the output of the
+        whole object, according to the storlet registration
+
+        :return: Whether the storlet is segment mappable
+        """
+        return config_true_value(
+            self.storlet_params.get('Segment-Mappable'))
+
+    @property
+    def has_trailing_metadata(self):
+        """
+        Check whether the storlet may send output metadata after the body,
+        according to the storlet registration
+
+        :return: Whether the storlet may send metadata after the body
+        """
+        return config_true_value(
+            self.storlet_params.get('Trailing-Metadata'))
+
     def handle_request(self):
         if hasattr(self, self.request.method):
             try:
@@ -257,7 +757,71 @@ class StorletProxyHandler(StorletBaseHandler):
     def _call_gateway(self, resp):
         sreq = self._build_storlet_request(self.request, resp.headers,
                                            resp.app_iter)
-        return self.gateway.invocation_flow(sreq, self.extra_sources)
+        sresp = self.gateway.invocation_flow(sreq, self.extra_sources)
+        if sresp.extra_outputs:
+            sresp = self._store_extra_outputs(sresp)
+        return sresp
+
+    def _put_extra_output(self, name, get_output):
+        """
+        Store an extra output of the storlet as an object in the output
+        container
+
+        :param name: the object name
+        :param get_output: a function to get StorletResponse instance of
+                           the extra output
+        :return: a tuple of the object name and swob.Response instance
+        """
+        sresp = get_output()
+        headers = {'Transfer-Encoding': 'chunked'}
+        self._set_metadata_in_headers(headers, sresp.user_metadata)
+        path = '/'.join(['', self.api_version, self.account,
+                         self.request.headers['X-Storlet-Output-Container'],
+                         name])
+        put_req = make_subrequest(
+            self.request.environ, 'PUT', quote(path), headers=headers,
+            swift_source=self.agent)
+        put_req.environ['wsgi.input'] = FileLikeIter(sresp.data_iter)
+        resp = put_req.get_response(self.app)
+        close_if_possible(resp.app_iter)
+        return name, resp
+
+    def _store_extra_outputs(self, sresp):
+        """
+        Store the extra outputs of the storlet concurrently, while the
+        output is returned to the client
+
+        :param sresp: StorletResponse instance
+        :return: StorletResponse instance whose body ends with an error
+                 unless all of the extra outputs are stored
+        """
+        def store():
+            pile = eventlet.GreenPile()
+            for name, get_output in sresp.extra_outputs:
+                pile.spawn(self._put_extra_output, name, get_output)
+            return list(pile)
+
+        storer = eventlet.spawn(store)
+
+        def data_iter():
+            output_iter = sresp.data_iter
+            try:
+                for chunk in output_iter:
+                    yield chunk
+            finally:
+                close_if_possible(output_iter)
+
+            failed = [name for name, resp in storer.wait()
+                      if not resp.is_success]
+            if failed:
+                self.logger.error('Failed to store extra outputs of %s: %s'
+                                  % (self.path, ', '.join(failed)))
+                raise StorletRuntimeException(
+                    'Failed to store extra outputs')
+
+        return StorletResponse(
+            sresp.user_metadata, data_iter=data_iter(),
+            trailing_metadata_reader=sresp.trailing_metadata_reader)
 
     def augment_storlet_request(self, params):
         """
@@ -288,6 +852,11 @@ class StorletProxyHandler(StorletBaseHandler):
                         'GET', '/'.join(swift_path),
                         agent=self.agent)
                     sub_resp = sub_req.get_response(self.app)
+                    if not sub_resp.is_success:
+                        # e.g. the client is not allowed to read it
+                        close_if_possible(sub_resp.app_iter)
+                        raise status_map[sub_resp.status_int](
+                            request=self.request)
                     # TODO(kota_): make this in another green thread
                     # expicially, in parallel with primary GET
 
@@ -305,18 +874,59 @@ class StorletProxyHandler(StorletBaseHandler):
         """
         GET handler on Proxy
         """
+        # The output range is given only via Range header
+        self.request.headers.pop('X-Storlet-Output-Range', None)
         if self.is_range_request:
-            msg = 'Storlet execution with range header is not supported'
-            raise HTTPBadRequest(msg.encode('utf8'),
-                                 request=self.request)
+            self._set_output_range()
+        if 'X-Storlet-Reduce' in self.request.headers:
+            self._validate_reduce_request()
+        if self.is_partitioned_request:
+            self._validate_partitioned_request()
+        if self.is_async_request:
+            destination = self._get_async_destination()
+
+        # Conditional headers on the output are given only via the
+        # original ones
+        for key in OUTPUT_CONDITIONAL_HEADERS:
+            self.request.headers.pop('X-Storlet-' + key, None)
 
         params = self.verify_access_to_storlet()
+        if self.has_output_container_header:
+            for key in MULTI_OUTPUT_FILTERED_PARAMS:
+                params.pop(key, None)
         self.augment_storlet_request(params)
 
+        if self.is_async_request:
+            return self._submit_async_job(*destination)
+
+        if self.is_storlet_container_execution:
+            return self._set_output_range_response(
+                self._apply_reduce_storlet(
+                    self._get_container_parallel_response()))
+
+        if self.is_deterministic:
+            # The output of a deterministic storlet has its own validators,
+            # so the conditional headers are evaluated on the output rather
+            # than on the object, before the storlet is invoked
+            for key in OUTPUT_CONDITIONAL_HEADERS:
+                if key in self.request.headers:
+                    self.request.headers['X-Storlet-' + key] = \
+                        self.request.headers.pop(key)
+
+        if self.is_materialized:
+            resp = self._get_materialized_response()
+            if resp is not None:
+                return resp
+
+        if self.is_partitioned_request:
+            return self._set_output_range_response(
+                self._apply_reduce_storlet(
+                    self._get_partition_parallel_response()))
+
         # Range requests:
-        # Range requests are not allowed with storlet invocation.
-        # To run a storlet on a selected input range use the X-Storlet-Range
-        # header.
+        # Range header is applied to the storlet output (see
+        # _set_output_range). To run a storlet on a selected input range
+        # use the X-Storlet-Range header.
         # If the range request is to be executed on the proxy we
         # create an HTTP Range request based on X-Storlet-Range
         # and let the request continue so that we get the required
@@ -362,8 +972,18 @@ class StorletProxyHandler(StorletBaseHandler):
             # full object to detect if we are in SLO case,
             # and invoke Storlet only if in SLO case.
             if self.is_proxy_runnable(original_resp):
-                self.gather_extra_sources()
-                return self.apply_storlet(original_resp)
+                resp = None
+                if self.is_segment_mappable and \
+                        not self.execute_on_proxy and \
+                        not self.is_storlet_range_request and \
+                        self.is_slo_response(original_resp):
+                    resp = self._get_segment_parallel_response(
+                        original_resp)
+                if resp is None:
+                    self.gather_extra_sources()
+                    resp = self.apply_storlet(original_resp)
+                return self._set_output_range_response(
+                    self._apply_reduce_storlet(resp))
             else:
                 # Non proxy GET case: Storlet was already invoked at
                 # object side
@@ -373,13 +993,620 @@ class StorletProxyHandler(StorletBaseHandler):
                     original_resp.headers.pop('Transfer-Encoding')
 
                 original_resp.headers['Content-Length'] = None
-                return original_resp
+                return self._set_output_range_response(
+                    self._apply_reduce_storlet(original_resp))
 
         else:
             # In failure case, we need nothing to do, just return original
             # response
             return original_resp
 
+    @property
+    def is_async_request(self):
+        return 'X-Storlet-Async' in self.request.headers
+
+    def _get_async_destination(self):
+        """
+        Validate the request with X-Storlet-Async header
+
+        :return: a tuple of the container and the object to store the
+                 output of the job
+        :raises HTTPBadRequest: If the header is malformed, or is given with
+                                the headers which the job does not support
+        """
+        if not self.obj or \
+                'X-Storlet-Output-Range' in self.request.headers or \
+                self.storlet_output_limit is not None or \
+                'X-Storlet-Reduce' in self.request.headers or \
+                self.is_partitioned_request or \
+                self.has_output_container_header:
+            msg = 'X-Storlet-Async header is supported only in GET of an ' \
+                  'object, without Range, X-Storlet-Output-Limit, ' \
+                  'X-Storlet-Reduce, X-Storlet-Partitions or ' \
+                  'X-Storlet-Output-Container'
+            raise HTTPBadRequest(msg.encode('utf8'), request=self.request)
+        if self.job_queue is None:
+            msg = 'Asynchronous storlet jobs are not enabled'
+            raise HTTPBadRequest(msg.encode('utf8'), request=self.request)
+
+        destination = unquote(self.request.headers['X-Storlet-Async'])
+        try:
+            return split_path('/' + destination, 2, 2, True)
+        except ValueError:
+            msg = 'X-Storlet-Async header should be <container>/<object>'
+            raise HTTPBadRequest(msg.encode('utf8'), request=self.request)
+
+    def _put_job_status(self, job, status, detail=None):
+        """
+        Store the status of an asynchronous storlet job
+
+        The status is given by the object body, and by
+        X-Object-Meta-Storlet-Job-Status header so that it can be polled
+        by HEAD.
+
+        :param job: a dict which describes the job
+        :param status: the job status, which is one of queued, running,
+                       completed and failed
+        :param detail: the detail of the status
+        :return: swob.Response instance of the status object PUT
+        """
+        body = dict(job, status=status)
+        if detail:
+            body['detail'] = detail
+        path = '/'.join(['', self.api_version, self.account,
+                         job['status_object']])
+        status_req = make_subrequest(
+            self.request.environ, 'PUT', quote(path),
+            headers={'Content-Type': 'application/json',
+                     'X-Object-Meta-Storlet-Job-Status': status},
+            body=json.dumps(body).encode('utf-8'),
+            swift_source=self.agent)
+        resp = status_req.get_response(self.app)
+        close_if_possible(resp.app_iter)
+        if not resp.is_success:
+            self.logger.warning('Failed to store the status of storlet job '
+                                '%s: %s' % (job['job_id'], resp.status))
+        return resp
+
+    def _submit_async_job(self, dest_container, dest_object):
+        """
+        Queue a storlet job which stores the output into the destination,
+        instead of returning it to the client
+
+        :param dest_container: the container to store the output
+        :param dest_object: the object to store the output
+        :return: swob.Response instance
+        """
+        job_id = uuid.uuid4().hex
+        job = {'job_id': job_id,
+               'source': '/'.join([self.container, self.obj]),
+               'destination': '/'.join([dest_container, dest_object]),
+               'status_object': '/'.join(
+                   [dest_container, dest_object + JOB_STATUS_SUFFIX])}
+
+        # The job runs detached from the client request, as a copy of the
+        # object into the destination
+        job_req = Request(self._make_verify_env())
+        job_req.headers.pop('X-Storlet-Async')
+        job_req.method = 'PUT'
+        job_req.path_info = '/'.join(['', self.api_version, self.account,
+                                      dest_container, dest_object])
+        job_req.headers['Content-Length'] = '0'
+
+        # The status object tells whether the client can store the output
+        resp = self._put_job_status(job, 'queued')
+        if not resp.is_success:
+            return resp
+
+        if not self.job_queue.submit(self._run_async_job, job_req, job):
+            self._put_job_status(job, 'failed', 'Too many storlet jobs')
+            msg = 'Too many storlet jobs'
+            raise HTTPServiceUnavailable(msg.encode('utf8'),
+                                         request=self.request)
+
+        self.logger.debug('Queued storlet job %s for %s' %
+                          (job_id, self.path))
+        return HTTPAccepted(
+            request=self.request,
+            headers={'X-Storlet-Job-Id': job_id,
+                     'X-Storlet-Job-Status-Object':
+                         quote(job['status_object'])})
+
+    def _run_async_job(self, job_req, job):
+        """
+        Run a storlet job queued by _submit_async_job
+
+        :param job_req: swob.Request instance to store the output
+        :param job: a dict which describes the job
+        """
+        self.request = job_req
+        self._put_job_status(job, 'running')
+        src_container, src_obj = job['source'].split('/', 1)
+        dest_container, dest_object = job['destination'].split('/', 1)
+        try:
+            resp = self.base_handle_copy_request(
+                src_container, src_obj, dest_container, dest_object)
+            close_if_possible(resp.app_iter)
+            status = 'completed' if resp.is_success else 'failed'
+            detail = resp.status
+        except StorletTimeout:
+            self.logger.exception('Storlet job %s timed out' % job['job_id'])
+            status, detail = 'failed', 'Storlet execution timed out'
+        except Exception:
+            self.logger.exception('Storlet job %s failed' % job['job_id'])
+            status, detail = 'failed', 'Storlet execution failed'
+        self._put_job_status(job, status, detail)
+
+    def _validate_reduce_request(self):
+        """
+        Validate the request with X-Storlet-Reduce header
+
+        :raises HTTPBadRequest: If the range or the limit of the output is
+                                also given
+        """
+        if 'X-Storlet-Output-Range' in self.request.headers or \
+                self.storlet_output_limit is not None:
+            msg = 'X-Storlet-Reduce header is not supported with ' \
+                  'Range or X-Storlet-Output-Limit'
+            raise HTTPBadRequest(msg.encode('utf8'), request=self.request)
+
+    def _get_fan_out_headers(self):
+        """
+        Get the headers of the storlet invocations fanned out from the
+        request
+        """
+        headers = {'X-Auth-Token': self.request.headers.get('X-Auth-Token'),
+                   'X-Run-Storlet': self.request.headers['X-Run-Storlet']}
+        for key, val in self.request.headers.items():
+            if key.startswith('X-Storlet-') and \
+                    key not in FAN_OUT_FILTERED_HEADERS:
+                headers[key] = val
+        return headers
+
+    def _invoke_on_part(self, part):
+        """
+        Invoke the storlet on a part of the object, which is run on an
+        object server holding the part
+
+        :param part: a tuple of the object path, the range in the object,
+                     and the storlet parameters. The parameters are None
+                     if the ones of the request are used as they are.
+        :return: swob.Response instance
+        """
+        path, srange, params = part
+        headers = self._get_fan_out_headers()
+        if srange:
+            headers['X-Storlet-Range'] = 'bytes=%s' % srange
+        if params is not None:
+            # The parameters given via headers are already in the params
+            for key in list(headers):
+                if key.lower().startswith('x-storlet-parameter'):
+                    del headers[key]
+            path = path + '?' + urlencode(params)
+        part_req = make_subrequest(
+            self._make_verify_env(), 'GET', path, headers=headers,
+            swift_source=self.agent)
+        return part_req.get_response(self.app)
+
+    def _get_slo_segments(self):
+        """
+        Get the segments of the SLO object
+
+        :return: a list of tuples of the segment path and range, or None if
+                 the segments can not be processed one by one
+        """
+        manifest_req = make_subrequest(
+            self._make_verify_env(), 'GET',
+            self.path + '?multipart-manifest=get',
+            headers={'X-Auth-Token': self.request.headers.get('X-Auth-Token')},
+            swift_source=self.agent)
+        resp = manifest_req.get_response(self.app)
+        if not resp.is_success:
+            return None
+        try:
+            manifest = json.loads(resp.body)
+        except ValueError:
+            return None
+
+        segments = []
+        for seg in manifest:
+            # NOTE: We do not go into nested SLO or inline data segments
+            if 'name' not in seg or seg.get('sub_slo'):
+                return None
+            # The segment name in the manifest is not quoted
+            path = quote('/'.join(['', self.api_version, self.account]) +
+                         seg['name'])
+            segments.append((path, seg.get('range'), None))
+        return segments
+
+    def _get_segment_parallel_response(self, original_resp):
+        """
+        Invoke the storlet on each segment of the SLO object in parallel,
+        and concatenate the outputs in the segment order
+
+        :param original_resp: swob.Response instance of the SLO object
+        :return: swob.Response instance, or None if the segments can not
+                 be processed one by one
+        """
+        segments = self._get_slo_segments()
+        if not segments:
+            return None
+        self.logger.debug('Invoke storlet on %d segments of %s' %
+                          (len(segments), self.path))
+        close_if_possible(original_resp.app_iter)
+        return self._get_fan_out_response(original_resp.headers, segments)
+
+    @property
+    def is_partitioned_request(self):
+        return 'X-Storlet-Partitions' in self.request.headers
+
+    def _validate_partitioned_request(self):
+        """
+        Validate the request with X-Storlet-Partitions header
+
+        :raises HTTPBadRequest: If the partitioning is not valid
+        """
+        partitions = self.request.headers['X-Storlet-Partitions']
+        if partitions != 'auto':
+            try:
+                if int(partitions) < 1:
+                    raise ValueError()
+            except ValueError:
+                msg = 'X-Storlet-Partitions must be auto or a positive ' \
+                      'integer'
+                raise HTTPBadRequest(msg.encode('utf8'),
+                                     request=self.request)
+
+        try:
+            max_record_line = int(
+                self.request.headers.get('X-Storlet-Max-Record-Line', ''))
+            if max_record_line < 0:
+                raise ValueError()
+        except ValueError:
+            msg = 'X-Storlet-Partitions requires X-Storlet-Max-Record-Line ' \
+                  'as a non-negative integer'
+            raise HTTPBadRequest(msg.encode('utf8'), request=self.request)
+
+        if self.is_storlet_range_request or self.execute_on_proxy:
+            msg = 'X-Storlet-Partitions header is not supported with ' \
+                  'X-Storlet-Range or execution on proxy'
+            raise HTTPBadRequest(msg.encode('utf8'), request=self.request)
+
+    def _get_partitions(self, size):
+        """
+        Split the object into partitions following the max_record_line
+        convention. Each partition is given [start, end] in the
+        parameters, while the storlet gets [start, end + max_record_line]
+        of the object so that it can complete the last record.
+
+        :param size: the object size
+        :return: a list of tuples of the object path, range and parameters
+        """
+        max_record_line = int(
+            self.request.headers['X-Storlet-Max-Record-Line'])
+        count = self.request.headers['X-Storlet-Partitions']
+        if count == 'auto':
+            count = int(math.ceil(float(size) / self.partition_size))
+        else:
+            count = int(count)
+        # Too small partitions can not hold a record
+        count = min(count, self.max_partitions,
+                    size // max(max_record_line, 1))
+        count = max(count, 1)
+
+        bounds = [size * i // count for i in range(count + 1)]
+        partitions = []
+        for i in range(count):
+            start, end = bounds[i], bounds[i + 1]
+            params = dict(self.request.params)
+            params.update({'start': str(start),
+                           'end': str(end),
+                           'max_record_line': str(max_record_line),
+                           'first_partition': str(i == 0).lower()})
+            srange = None
+            if size:
+                srange = '%d-%d' % (start,
+                                    min(end + max_record_line, size - 1))
+            partitions.append((self.path, srange, params))
+        return partitions
+
+    def _get_partition_parallel_response(self):
+        """
+        Invoke the storlet on partitions of the object in parallel, and
+        concatenate the outputs in the partition order
+
+        :return: swob.Response instance
+        """
+        head_req = make_subrequest(
+            self._make_verify_env(), 'HEAD', self.path,
+            headers={'X-Auth-Token': self.request.headers.get('X-Auth-Token')},
+            swift_source=self.agent)
+        head_resp = head_req.get_response(self.app)
+        if not head_resp.is_success:
+            return head_resp
+        if self.is_slo_response(head_resp):
+            msg = 'X-Storlet-Partitions header is not supported for SLO'
+            raise HTTPBadRequest(msg.encode('utf8'), request=self.request)
+
+        partitions = self._get_partitions(head_resp.content_length or 0)
+        self.logger.debug('Invoke storlet on %d partitions of %s' %
+                          (len(partitions), self.path))
+        return self._get_fan_out_response(head_resp.headers, partitions)
+
+    def _validate_container_execution(self):
+        """
+        Validate the storlet request on the objects in a container
+
+        :raises HTTPBadRequest: If the request is not supported
+        """
+        if self.is_storlet_range_request or self.execute_on_proxy:
+            msg = 'Storlet execution on a container is not supported ' \
+                  'with X-Storlet-Range or execution on proxy'
+            raise HTTPBadRequest(msg.encode('utf8'), request=self.request)
+
+        if 'X-Storlet-Objects' in self.request.headers:
+            names = list_from_csv(self.request.headers['X-Storlet-Objects'])
+            if not names:
+                msg = 'X-Storlet-Objects must be a csv of object names'
+                raise HTTPBadRequest(msg.encode('utf8'),
+                                     request=self.request)
+
+    def _get_object_part(self, name):
+        path = '/'.join(['', self.api_version, self.account, self.container,
+                         quote(name)])
+        return (path, None, None)
+
+    def _get_container_listing(self, prefix, marker):
+        """
+        Get a page of the container listing
+
+        :param prefix: the prefix of the object names
+        :param marker: the object name to start the listing after
+        :return: swob.Response instance
+        """
+        path = '/'.join(['', self.api_version, self.account, self.container])
+        query = urlencode({'format': 'json', 'prefix': prefix,
+                           'marker': marker})
+        listing_req = make_subrequest(
+            self._make_verify_env(), 'GET', path + '?' + query,
+            headers={'X-Auth-Token': self.request.headers.get('X-Auth-Token')},
+            swift_source=self.agent)
+        return listing_req.get_response(self.app)
+
+    def _iter_container_parts(self, prefix, listing):
+        """
+        Iterate over the objects in the container page by page
+
+        :param prefix: the prefix of the object names
+        :param listing: the first page of the container listing
+        """
+        while listing:
+            for obj in listing:
+                yield self._get_object_part(obj['name'])
+            resp = self._get_container_listing(prefix, listing[-1]['name'])
+            if not resp.is_success:
+                raise StorletRuntimeException(
+                    'Failed to list container: %s' % resp.status)
+            listing = json.loads(resp.body)
+
+    def _invoke_on_object(self, part):
+        """
+        Invoke the storlet on an object in the container. As the storlet
+        is not run on the object servers for an SLO, it is run here.
+
+        :param part: a tuple given to _invoke_on_part
+        :return: swob.Response instance
+        """
+        resp = self._invoke_on_part(part)
+        if not resp.is_success or not self.is_slo_response(resp):
+            return resp
+
+        sresp = self._call_gateway(resp)
+        new_headers = resp.headers.copy()
+        for key in ('Content-Length', 'Etag', 'Transfer-Encoding'):
+            new_headers.pop(key, None)
+        return Response(headers=new_headers, app_iter=sresp.data_iter,
+                        request=self.request)
+
+    def _get_container_parallel_response(self):
+        """
+        Invoke the storlet on the objects in the container in parallel,
+        and concatenate the outputs in the order of the objects
+
+        :return: swob.Response instance
+        """
+        self._validate_container_execution()
+        if 'X-Storlet-Objects' in self.request.headers:
+            parts = [self._get_object_part(name) for name in list_from_csv(
+                self.request.headers['X-Storlet-Objects'])]
+        else:
+            prefix = self.request.headers['X-Storlet-Prefix']
+            resp = self._get_container_listing(prefix, '')
+            if not resp.is_success:
+                return resp
+            parts = self._iter_container_parts(prefix, json.loads(resp.body))
+        return self._get_fan_out_response({}, parts, self._invoke_on_object)
+
+    def _get_fan_out_response(self, base_headers, parts, invoke=None):
+        """
+        Invoke the storlet on the parts in parallel, and make the response
+        of the concatenated outputs
+
+        :param base_headers: the headers of the whole object
+        :param parts: a list of the parts given to _invoke_on_part
+        :param invoke: a function to invoke the storlet on a part, which is
+                       _invoke_on_part by default
+        :return: swob.Response instance
+        """
+        app_iter = ParallelOutputIterator(
+            invoke or self._invoke_on_part, parts, self.segment_concurrency)
+        first_resp = app_iter.next_response()
+        if first_resp is not None and not first_resp.is_success:
+            app_iter.close()
+            return Response(status=first_resp.status_int,
+                            request=self.request)
+
+        new_headers = base_headers.copy()
+        for key in ('Content-Length', 'Content-Range', 'Etag',
+                    'Transfer-Encoding'):
+            new_headers.pop(key, None)
+        if first_resp is not None and 'Content-Type' in first_resp.headers:
+            new_headers['Content-Type'] = first_resp.headers['Content-Type']
+
+        output_range = self.storlet_output_range
+        if output_range is not None:
+            start, end = output_range
+            app_iter = OutputRangeIterator(app_iter, start, end - start + 1)
+            new_headers['X-Storlet-Output-Content-Range'] = \
+                'bytes %d-%d/*' % (start, end)
+        elif self.storlet_output_limit is not None:
+            app_iter = OutputRangeIterator(app_iter, 0,
+                                           self.storlet_output_limit)
+        return Response(headers=new_headers, app_iter=app_iter,
+                        request=self.request)
+
+    def _apply_reduce_storlet(self, resp):
+        """
+        Apply the reduce storlet given by X-Storlet-Reduce header on the
+        storlet output, on proxy
+
+        :param resp: swob.Response instance of the storlet output
+        :return: swob.Response instance of the reduce storlet output
+        """
+        reduce_storlet = self.request.headers.get('X-Storlet-Reduce')
+        if not reduce_storlet or not resp.is_success:
+            return resp
+
+        params = self._get_storlet_params(reduce_storlet)
+        headers = {'X-Run-Storlet': reduce_storlet}
+        for key, val in params.items():
+            headers['X-Storlet-' + key] = val
+        reduce_req = Request.blank(
+            self.request.path_info,
+            environ={'REQUEST_METHOD': 'GET',
+                     'QUERY_STRING': self.request.query_string or ''},
+            headers=headers)
+
+        sreq = self._build_storlet_request(reduce_req, resp.headers,
+                                           resp.app_iter)
+        sresp = self.gateway.invocation_flow(sreq)
+
+        new_headers = resp.headers.copy()
+        for key in ('Content-Length', 'Etag', 'Transfer-Encoding'):
+            new_headers.pop(key, None)
+        self._set_metadata_in_headers(new_headers, sresp.user_metadata)
+        if sresp.has_trailing_metadata:
+            app_iter = TrailingMetadataIterator(
+                sresp, self._log_trailing_metadata)
+        else:
+            app_iter = sresp.data_iter
+        return Response(headers=new_headers, app_iter=app_iter,
+                        request=self.request)
+
+    def _get_materialized_response(self):
+        """
+        Get the materialized storlet output, if it is generated from the
+        current version of the object with the same parameters
+
+        :return: swob.Response instance, or None if we have to run the
+                 storlet
+        """
+        if self.has_extra_resources_header or \
+                self.is_storlet_range_request or \
+                self.storlet_output_limit == 0:
+            return None
+
+        # The client should be able to read the object
+        new_env = dict(self.request.environ)
+        new_env.pop('HTTP_TRANSFER_ENCODING', None)
+        for key in CONDITIONAL_KEYS:
+            new_env.pop('HTTP_' + key, None)
+        auth_token = self.request.headers.get('X-Auth-Token')
+        source_req = make_subrequest(
+            new_env, 'HEAD', self.path,
+            headers={'X-Auth-Token': auth_token},
+            swift_source=self.agent)
+        source_resp = source_req.get_response(self.app)
+        if not source_resp.is_success or \
+                not source_resp.headers.get('X-Timestamp'):
+            return None
+
+        headers = {}
+        output_range = self.storlet_output_range
+        if output_range is not None:
+            headers['Range'] = 'bytes=%d-%d' % output_range
+        elif self.storlet_output_limit is not None:
+            headers['Range'] = 'bytes=0-%d' % (self.storlet_output_limit - 1)
+        for key in OUTPUT_CONDITIONAL_HEADERS:
+            value = self.request.headers.get(
+                key, self.request.headers.get('X-Storlet-' + key))
+            if value:
+                headers[key] = value
+
+        path = quote('/'.join(['', self.api_version, self.account,
+                               self.materialized_container,
+                               self.materialized_object]))
+        materialized_req = make_subrequest(
+            new_env, 'GET', path, headers=headers, swift_source=self.agent)
+        self._allow_materialized_access(materialized_req.environ)
+        resp = materialized_req.get_response(self.app)
+
+        if not (resp.is_success or resp.status_int == 304) or \
+                resp.headers.get(MATERIALIZED_SOURCE_TIMESTAMP) != \
+                source_resp.headers.get('X-Timestamp') or \
+                resp.headers.get(MATERIALIZED_PARAMETERS) != \
+                self.materialized_parameters:
+            close_if_possible(resp.app_iter)
+            return None
+
+        self.logger.debug('Materialized storlet output is found for %s' %
+                          self.path)
+        resp.headers.pop(MATERIALIZED_SOURCE_TIMESTAMP, None)
+        resp.headers.pop(MATERIALIZED_PARAMETERS, None)
+        if output_range is None and resp.status_int == 206:
+            # The output limit is given, which returns the truncated output
+            # as a whole
+            resp.status = 200
+            resp.headers.pop('Content-Range', None)
+        return resp
+
+    def _set_output_range(self):
+        """
+        Turn the Range header into the range over the storlet output, so
+        that the whole input is given to the storlet
+
+        :raises HTTPBadRequest: If the range is not a single range with
+                                both the first and the last positions, or
+                                is given with X-Storlet-Output-Limit
+        """
+        try:
+            ranges = Range(self.request.headers['Range']).ranges
+        except ValueError:
+            ranges = []
+        if len(ranges) != 1 or None in ranges[0] or \
+                self.storlet_output_limit is not None:
+            msg = ('Storlet execution supports only a single byte range '
+                   'with both the first and the last positions, without '
+                   'X-Storlet-Output-Limit')
+            raise HTTPBadRequest(msg.encode('utf8'), request=self.request)
+        self.request.headers['X-Storlet-Output-Range'] = \
+            self.request.headers.pop('Range')
+
+    def _set_output_range_response(self, resp):
+        """
+        Make the response a partial content one when the storlet output
+        range is applied
+
+        :param resp: swob.Response instance
+        :return: the response
+        """
+        content_range = resp.headers.pop('X-Storlet-Output-Content-Range',
+                                         None)
+        if content_range and resp.status_int == 200:
+            resp.status = 206
+            resp.headers['Content-Range'] = content_range
+        return resp
+
     def _validate_copy_request(self):
         # We currently block copy from account
         unsupported_headers = ['X-Copy-From-Account',
@@ -391,6 +1618,45 @@ class StorletProxyHandler(StorletBaseHandler):
                 msg = 'Storlet on copy with %s is not supported' % header
                 raise HTTPBadRequest(msg.encode('utf8'))
 
+    def _set_metadata_in_footers(self, footers, user_metadata):
+        for key, val in user_metadata.items():
+            if key.lower() == 'content-type':
+                # Object server accepts only metadata headers in footers
+                self.logger.warning('Content-Type sent after body is '
+                                    'ignored for %s' % self.path)
+                continue
+            footers['X-Object-Meta-%s' % key] = val
+
+    def _get_put_data_iter(self, sresp):
+        """
+        Get an iterator over the storlet output to be put, setting the
+        output metadata into the PUT request
+
+        If the storlet sends metadata after the body, the metadata is set
+        as PUT footers
+
+        :param sresp: StorletResponse instance
+        :return: an iterator over the storlet output
+        """
+        self._set_metadata_in_headers(self.request.headers,
+                                      sresp.user_metadata)
+        if not sresp.has_trailing_metadata:
+            return sresp.data_iter
+
+        trailing_metadata = {}
+        orig_footers_callback = self.request.environ.get(
+            'swift.callback.update_footers')
+
+        def footers_callback(footers):
+            if orig_footers_callback:
+                orig_footers_callback(footers)
+            self._set_metadata_in_footers(footers, trailing_metadata)
+
+        self.request.environ['swift.callback.update_footers'] = \
+            footers_callback
+        return TrailingMetadataIterator(
+            sresp, trailing_metadata.update)
+
     def handle_put_copy_response(self, app_iter):
         self._remove_storlet_headers(self.request.headers)
         if 'CONTENT_LENGTH' in self.request.environ:
@@ -408,11 +1674,16 @@ class StorletProxyHandler(StorletBaseHandler):
                 headers.pop(key)
 
     def base_handle_copy_request(self, src_container, src_obj,
-                                 dest_container, dest_object):
+                                 dest_container, dest_object,
+                                 materialize=False):
         """
         Unified path for:
         PUT verb with X-Copy-From and
-        COPY verb with Destination
+        COPY verb with Destination and
+        PUT verb to materialize the storlet output
+
+        :param materialize: Whether to record the source object version in
+                            the destination object as a materialized output
         """
         # Get an iterator over the source object
         source_path = '/%s/%s/%s/%s' % (self.api_version, self.account,
@@ -431,28 +1702,41 @@ class StorletProxyHandler(StorletBaseHandler):
         #    should be called without 'X-Run-Storlet'
         # 2. The metadata in the response from the object node
         #    should not be prefixed with X-Object-Meta
-        if self.is_proxy_runnable():
+        # 3. If the storlet may send metadata after the body, we run on
+        #    the proxy so that the metadata can be set as PUT footers
+        if self.is_proxy_runnable() or self.has_trailing_metadata:
             source_req.headers.pop('X-Run-Storlet', None)
 
         src_resp = source_req.get_response(self.app)
+        if materialize and not src_resp.is_success:
+            # e.g. the client is not allowed to read the object
+            return src_resp
         copy_headers(src_resp.headers, self.request.headers)
+        if materialize:
+            self.request.headers[MATERIALIZED_SOURCE_TIMESTAMP] = \
+                src_resp.headers['X-Timestamp']
+            self.request.headers[MATERIALIZED_PARAMETERS] = \
+                self.materialized_parameters
 
         # We check here again, because src_resp may reveal that
         # the object is an SLO and so even if the above check was
         # False, we now may need to run on proxy
-        if self.is_proxy_runnable(src_resp):
+        if self.is_proxy_runnable(src_resp) or self.has_trailing_metadata:
             # We need to run on proxy.
             # Do it and fixup the user metadata headers.
             sreq = self._build_storlet_request(self.request, src_resp.headers,
                                                src_resp.app_iter)
             self.gather_extra_sources()
             sresp = self.gateway.invocation_flow(sreq, self.extra_sources)
-            data_iter = sresp.data_iter
-            self._set_metadata_in_headers(self.request.headers,
-                                          sresp.user_metadata)
+            data_iter = self._get_put_data_iter(sresp)
         else:
             data_iter = src_resp.app_iter
 
+        if materialize:
+            # Only the PUT into the materialized container bypasses the
+            # authorization, after the client has read the source object
+            # with its own credentials
+            self._allow_materialized_access(self.request.environ)
         resp = self.handle_put_copy_response(data_iter)
 
         acct, path = src_resp.environ['PATH_INFO'].split('/', 3)[2:4]
@@ -480,6 +1764,9 @@ class StorletProxyHandler(StorletBaseHandler):
             return self.base_handle_copy_request(src_container, src_obj,
                                                  dest_container, dest_object)
 
+        if self.is_materialized:
+            return self._handle_materialize_request()
+
         # TODO(takashi): chunk size should be configurable
         reader = self.request.environ['wsgi.input'].read
         body_iter = iter(lambda: reader(65536), b'')
@@ -487,9 +1774,49 @@ class StorletProxyHandler(StorletBaseHandler):
             self.request, self.request.headers, body_iter)
 
         sresp = self.gateway.invocation_flow(sreq)
-        self._set_metadata_in_headers(self.request.headers,
-                                      sresp.user_metadata)
-        return self.handle_put_copy_response(sresp.data_iter)
+        return self.handle_put_copy_response(self._get_put_data_iter(sresp))
+
+    def _handle_materialize_request(self):
+        """
+        Store the object as it is, and then the storlet output generated
+        from it into the materialized container
+
+        :return: the response of the object PUT
+        """
+        source_req = Request(dict(self.request.environ))
+        self._remove_storlet_headers(source_req.headers)
+        source_resp = source_req.get_response(self.app)
+        if not source_resp.is_success:
+            return source_resp
+
+        if self.has_extra_resources_header:
+            # The output depends on the other objects, so it can not be
+            # served to the plain GET of the object
+            self.logger.debug('Storlet output of %s is not materialized '
+                              'because of the extra resources' %
+                              source_req.path)
+            return source_resp
+
+        # The storlet output is generated from the stored object, like COPY
+        for key in CONDITIONAL_KEYS:
+            self.request.environ.pop('HTTP_' + key, None)
+        self.request.path_info = '/'.join(
+            ['', self.api_version, self.account,
+             self.materialized_container, self.materialized_object])
+        self.request.headers['Content-Length'] = 0
+        try:
+            resp = self.base_handle_copy_request(
+                self.container, self.obj, self.materialized_container,
+                self.materialized_object, materialize=True)
+            if not resp.is_success:
+                self.logger.warning('Failed to materialize storlet output '
+                                    'of %s: %s' % (source_req.path,
+                                                   resp.status))
+        except Exception:
+            # The object itself is stored successfully
+            self.logger.exception('Failed to materialize storlet output '
+                                  'of %s' % source_req.path)
+        return source_resp
 
     @public
     def COPY(self):
@@ -517,13 +1844,164 @@ class StorletProxyHandler(StorletBaseHandler):
         return self.base_handle_copy_request(self.container, self.obj,
                                              dest_container, dest_object)
 
+    def _get_bulk_items(self):
+        """
+        Get the objects to invoke the storlet on from the request body,
+        which has an object path of the form /<container>/<object> in each
+        line
+
+        :return: a list of tuples of the object path given in the body and
+                 the part given to _invoke_on_part, which is None if the
+                 path is invalid
+        :raises HTTPRequestEntityTooLarge: If too many objects are given
+        """
+        limit = self.bulk_max_objects * MAX_BULK_PATH_LENGTH
+        body = self.request.body_file.read(limit + 1)
+        lines = [line.strip() for line in body.decode('utf8').splitlines()]
+        lines = [line for line in lines if line]
+        if len(body) > limit or len(lines) > self.bulk_max_objects:
+            msg = 'Maximum bulk storlet objects: %d' % self.bulk_max_objects
+            raise HTTPRequestEntityTooLarge(msg.encode('utf8'),
+                                            request=self.request)
+
+        # The parameters are given to each invocation explicitly, not to
+        # pass bulk-storlet in the query of this request to the storlet
+        params = dict(self.request.params)
+        params.pop('bulk-storlet', None)
+
+        items = []
+        for line in lines:
+            name = '/' + unquote(line).lstrip('/')
+            try:
+                container, obj = split_path(name, 2, 2, True)
+            except ValueError:
+                items.append((name, None))
+                continue
+            path = '/'.join(['', self.api_version, self.account,
+                             quote(container), quote(obj)])
+            items.append((name, (path, None, params)))
+        return items
+
+    def _invoke_on_bulk_item(self, item):
+        """
+        Invoke the storlet on an object of the bulk storlet invocation
+
+        :param item: a tuple given by _get_bulk_items
+        :return: swob.Response instance
+        """
+        name, part = item
+        if part is None:
+            return HTTPBadRequest(request=self.request)
+        try:
+            return self._invoke_on_object(part)
+        except Exception:
+            self.logger.exception('Storlet execution on %s failed' % name)
+            return HTTPInternalServerError(request=self.request)
+
+    def _iter_bulk_outputs(self, items):
+        """
+        Iterate over the outputs of the bulk storlet invocation
+
+        :param items: a list of tuples given by _get_bulk_items
+        :return: an iterator of tuples of the object path, the response,
+                 and the iterator over the output
+        """
+        app_iter = ParallelOutputIterator(
+            self._invoke_on_bulk_item, items, self.segment_concurrency)
+        try:
+            for name, _part in items:
+                resp = app_iter.next_response()
+                yield name, resp, app_iter.resp_iter
+        finally:
+            app_iter.close()
+
+    def _iter_bulk_multipart(self, items, boundary):
+        """
+        Make multipart/mixed body of the outputs, where each part has the
+        object path and the status of the invocation on it
+        """
+        for name, resp, output_iter in self._iter_bulk_outputs(items):
+            headers = ['Content-Location: %s' % quote(name),
+                       'X-Storlet-Status: %s' % resp.status]
+            if resp.is_success and 'Content-Type' in resp.headers:
+                headers.append('Content-Type: %s' %
+                               resp.headers['Content-Type'])
+            yield ('--%s\r\n%s\r\n\r\n' %
+                   (boundary, '\r\n'.join(headers))).encode('utf8')
+            if resp.is_success:
+                for chunk in output_iter:
+                    yield chunk
+            yield b'\r\n'
+        yield ('--%s--\r\n' % boundary).encode('utf8')
+
+    def _make_tar_member(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        padding = (tarfile.BLOCKSIZE - len(data) % tarfile.BLOCKSIZE) % \
+            tarfile.BLOCKSIZE
+        return info.tobuf(tarfile.GNU_FORMAT) + data + b'\0' * padding
+
+    def _iter_bulk_tar(self, items):
+        """
+        Make tar body of the outputs. The status of the invocation on each
+        object is given by the last member, storlet-bulk-status.json.
+
+        NOTE: Each output is read into memory, as the tar header needs its
+        size.
+        """
+        statuses = []
+        for name, resp, output_iter in self._iter_bulk_outputs(items):
+            statuses.append({'name': name, 'status': resp.status})
+            if resp.is_success:
+                yield self._make_tar_member(
+                    name.lstrip('/'), b''.join(output_iter))
+        yield self._make_tar_member(
+            'storlet-bulk-status.json', json.dumps(statuses).encode('utf8'))
+        yield b'\0' * (tarfile.BLOCKSIZE * 2)
+
+    def _handle_bulk_execution(self):
+        """
+        Invoke the storlet on the objects listed in the request body in
+        parallel, verifying the access to the storlet only once
+
+        :return: swob.Response instance
+        """
+        if self.is_range_request or self.is_storlet_range_request or \
+                self.storlet_output_limit is not None or \
+                self.execute_on_proxy or \
+                'X-Storlet-Reduce' in self.request.headers:
+            msg = 'Bulk storlet execution is not supported with range, ' \
+                  'output limit, reduce or execution on proxy'
+            raise HTTPBadRequest(msg.encode('utf8'), request=self.request)
+
+        content_type = self.request.accept.best_match(BULK_CONTENT_TYPES)
+        if content_type is None:
+            return HTTPNotAcceptable(request=self.request)
+
+        items = self._get_bulk_items()
+        params = self.verify_access_to_storlet()
+        self.augment_storlet_request(params)
+
+        if content_type == 'application/x-tar':
+            return Response(content_type=content_type,
+                            app_iter=self._iter_bulk_tar(items),
+                            request=self.request)
+        boundary = uuid.uuid4().hex
+        return Response(
+            content_type='multipart/mixed; boundary=%s' % boundary,
+            app_iter=self._iter_bulk_multipart(items, boundary),
+            request=self.request)
+
     @public
     def POST(self):
         """
         POST handler on Proxy
 
-        Deals with storlet ACL updates
+        Deals with storlet ACL updates, and bulk storlet execution
         """
+        if self.is_storlet_bulk_execution:
+            return self._handle_bulk_execution()
+
         # Get the current container's ACL
         # We perform a sub request rather than get_container_info
         # since get_container_info bypasses authorization, and we
@@ -24,6 +24,7 @@ from storlets.swift_middleware.handlers.base import NotStorletRequest, \
     get_container_names
 from storlets.swift_middleware.handlers import StorletProxyHandler, \
     StorletObjectHandler
+from storlets.swift_middleware.handlers.proxy import StorletJobQueue
 
 
 class StorletHandlerMiddleware(object):
@@ -34,6 +35,13 @@ class StorletHandlerMiddleware(object):
         self.exec_server = conf.get('execution_server')
         self.handler_class = self._get_handler(self.exec_server)
         self.conf = conf
+        if self.exec_server == 'proxy':
+            # Asynchronous storlet jobs are queued in each proxy server
+            # process
+            self.conf = dict(
+                conf,
+                storlet_job_queue=StorletJobQueue.from_conf(conf,
+                                                            self.logger))
         self.gateway_conf = gateway_conf
 
     def _get_handler(self, exec_server):
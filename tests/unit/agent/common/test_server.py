@@ -95,6 +95,30 @@ class TestSBusServer(unittest.TestCase):
         with self.assertRaises(ValueError):
             self.server.get_handler('SBUS_CMD_UNKNOWN')
 
+    def test_listen_extra_fds(self):
+        handler = mock.MagicMock()
+        self.server.fd_handlers = {5: handler}
+        sbus = mock.MagicMock()
+        with mock.patch('storlets.agent.common.server.select.select') \
+                as fake_select:
+            # Only the extra fd gets readable
+            fake_select.return_value = ([5], [], [])
+            self.assertEqual(0, self.server._listen(sbus, 1))
+            self.assertIsNone(fake_select.call_args[0][3])
+            self.assertEqual(1, handler.call_count)
+
+            fake_select.return_value = ([1, 5], [], [])
+            self.assertEqual(1, self.server._listen(sbus, 1))
+            self.assertEqual(2, handler.call_count)
+
+            fake_select.side_effect = OSError()
+            self.assertEqual(-1, self.server._listen(sbus, 1))
+        sbus.listen.assert_not_called()
+
+        self.server.fd_handlers = {}
+        self.server._listen(sbus, 1)
+        sbus.listen.assert_called_once_with(1)
+
 
 def create_fake_sbus_class(scenario):
     """
@@ -168,6 +192,42 @@ class TestSBusServerMain(unittest.TestCase):
         self.assertEqual([], self.logger.get_log_lines('error'))
         self.assertEqual([], self.logger.get_log_lines('warn'))
 
+    def test_main_loop_housekeeping(self):
+        sfds = [SBusFileDescriptor(SBUS_FD_SERVICE_OUT, 1)]
+        scenario = [
+            ('create', 1),
+            ('receive', SBusServiceDatagram(
+                command=sbus_cmd.SBUS_CMD_PING, sfds=sfds, params=None,
+                task_id=None)),
+            ('receive', SBusServiceDatagram(
+                command=sbus_cmd.SBUS_CMD_HALT, sfds=sfds, params=None,
+                task_id=None)),
+        ]
+
+        self.server.housekeeping_interval = 10
+        fake_sbus_class = create_fake_sbus_class(scenario)
+        with mock.patch('storlets.agent.common.server.SBus',
+                        fake_sbus_class), \
+                mock.patch('storlets.agent.common.server.select.select') \
+                as fake_select, \
+                mock.patch('os.fdopen'), \
+                mock.patch.object(self.server, 'halt') as halt, \
+                mock.patch.object(self.server, '_terminate'), \
+                mock.patch.object(self.server, '_ready') as ready, \
+                mock.patch.object(self.server, '_housekeep') as housekeep:
+            halt.is_command_handler = True
+            halt.return_value = CommandSuccess('OK', False)
+            # A request, a timeout, and another request
+            fake_select.side_effect = [([1], [], []), ([], [], []),
+                                       ([1], [], [])]
+            ret = self.server.main_loop()
+
+        self.assertEqual(EXIT_SUCCESS, ret)
+        self.assertEqual(10, fake_select.call_args[0][3])
+        # After the first request and the timeout
+        self.assertEqual(2, housekeep.call_count)
+        ready.assert_called_once_with()
+
 
 if __name__ == '__main__':
     unittest.main()
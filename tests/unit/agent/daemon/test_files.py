@@ -17,7 +17,7 @@ import os
 import tempfile
 import unittest
 from storlets.agent.daemon.files import StorletFile, StorletInputFile, \
-    StorletRangeInputFile, StorletOutputFile
+    StorletRangeInputFile, StorletOutputFile, StorletOutputContainer
 
 
 class TestStorletFile(unittest.TestCase):
@@ -114,6 +114,74 @@ class TestStorletOutputFile(TestStorletFile):
             self.assertEqual(b'testing', f.read())
 
 
+class TestStorletOutputFileTrailingMetadata(TestStorletOutputFile):
+
+    def _create_file(self):
+        return StorletOutputFile(self.md_fd, self.fd, True)
+
+    def test_write_before_set_metadata(self):
+        with self.sfile as sfile:
+            sfile.write(b'testing')
+            sfile.flush()
+            sfile.set_metadata(self.metadata)
+
+        with open(self.fname, 'rb') as f:
+            self.assertEqual(b'testing', f.read())
+        with open(self.md_fname, 'r') as f:
+            self.assertEqual(self.metadata,
+                             json.loads(f.read()))
+
+
+class TestStorletOutputContainer(unittest.TestCase):
+
+    def setUp(self):
+        self.fd, self.fname = tempfile.mkstemp()
+        self.out_files = []
+        self.tmpfiles = [self.fname]
+        for _ in range(2):
+            md_fd, md_fname = tempfile.mkstemp()
+            obj_fd, obj_fname = tempfile.mkstemp()
+            self.out_files.append(StorletOutputFile(md_fd, obj_fd))
+            self.tmpfiles.extend([md_fname, obj_fname])
+        self.container = StorletOutputContainer(self.fd, self.out_files)
+
+    def tearDown(self):
+        self.container.close()
+        for fname in self.tmpfiles:
+            os.unlink(fname)
+
+    def _read_announcements(self):
+        with open(self.fname, 'rb') as f:
+            return [json.loads(line) for line in f.read().splitlines()]
+
+    def test_open(self):
+        self.assertIs(self.out_files[0], self.container.open('obj1'))
+        self.assertIs(self.out_files[1], self.container.open('obj2'))
+        with self.assertRaises(IOError):
+            self.container.open('obj3')
+        self.assertEqual([{'object_name': 'obj1', 'index': 0},
+                          {'object_name': 'obj2', 'index': 1}],
+                         self._read_announcements())
+
+    def test_complete(self):
+        self.container.open('obj1')
+        self.container.complete()
+        self.assertTrue(self.container.closed)
+        self.assertTrue(all(f.closed for f in self.out_files))
+        self.assertEqual([{'object_name': 'obj1', 'index': 0},
+                          {'completed': True}],
+                         self._read_announcements())
+        with self.assertRaises(IOError):
+            self.container.open('obj2')
+
+    def test_close_without_complete(self):
+        with self.container as container:
+            container.open('obj1')
+        self.assertTrue(all(f.closed for f in self.out_files))
+        self.assertEqual([{'object_name': 'obj1', 'index': 0}],
+                         self._read_announcements())
+
+
 class TestStorletInputFile(TestStorletFile):
 
     def setUp(self, content=None):
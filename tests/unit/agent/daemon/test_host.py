@@ -0,0 +1,186 @@
+# Copyright (c) 2010-2016 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from eventlet import patcher
+import json
+import mock
+import os
+import sys
+import unittest
+
+from storlets.sbus import command as sbus_cmd
+from storlets.agent.common.server import EXIT_SUCCESS
+from storlets.agent.daemon.host import StorletHostDaemon, HOST_CMD_ADD, \
+    HOST_CMD_REMOVE
+
+from tests.unit import FakeLogger
+
+# NOTE: The gateway modules monkey patch select module, but the host daemon
+#       runs without eventlet
+select = patcher.original('select')
+
+
+class FakeDatagram(object):
+    def __init__(self, command):
+        self.command = command
+
+
+class TestStorletHostDaemon(unittest.TestCase):
+
+    def setUp(self):
+        select_patcher = mock.patch('storlets.agent.daemon.host.select',
+                                    select)
+        select_patcher.start()
+        self.addCleanup(select_patcher.stop)
+        self.logger = FakeLogger()
+        self.control_fd, self.factory_fd = os.pipe()
+        self.host = StorletHostDaemon(self.control_fd, self.logger, 4)
+        self.host.sbus = mock.MagicMock()
+        self.host.epoll = select.epoll()
+        self.pipes = []
+
+    def tearDown(self):
+        for fd in list(self.host.storlet_name_to_fd.values()):
+            os.close(fd)
+        for fd in self.pipes:
+            os.close(fd)
+        self.host.epoll.close()
+        os.close(self.control_fd)
+        os.close(self.factory_fd)
+
+    def _create_sbus(self, path):
+        read_fd, write_fd = os.pipe()
+        self.pipes.append(write_fd)
+        return read_fd
+
+    def _send(self, **cmd):
+        os.write(self.factory_fd, (json.dumps(cmd) + '\n').encode('utf-8'))
+
+    def test_add_and_remove_storlet(self):
+        self.host.sbus.create.side_effect = self._create_sbus
+        with mock.patch('storlets.agent.daemon.server.importlib.'
+                        'import_module') as import_module:
+            self.host.add_storlet('storleta.StorletA', 'path/to/uds/a',
+                                  'path/to/a')
+            self.host.add_storlet('storletb.StorletB', 'path/to/uds/b',
+                                  'path/to/b')
+            # The storlets are imported only when they are executed, in
+            # the process of each invocation
+            import_module.assert_not_called()
+        self.assertNotIn('path/to/a', sys.path)
+
+        self.assertEqual(['storleta.StorletA', 'storletb.StorletB'],
+                         sorted(self.host.storlet_name_to_fd))
+        fd_a = self.host.storlet_name_to_fd['storleta.StorletA']
+        daemon_a = self.host.fd_to_daemon[fd_a]
+        self.assertEqual('path/to/uds/a', daemon_a.sbus_path)
+        self.assertEqual(4, daemon_a.pool_size)
+        self.assertEqual('path/to/a', daemon_a.python_path)
+        # The pool is shared by the storlets
+        self.assertIs(self.host.task_id_to_pid, daemon_a.task_id_to_pid)
+
+        self.host.remove_storlet('storleta.StorletA')
+        self.assertEqual(['storletb.StorletB'],
+                         list(self.host.storlet_name_to_fd))
+        self.assertNotIn(fd_a, self.host.fd_to_daemon)
+        # Removing unknown storlet is ignored
+        self.host.remove_storlet('storleta.StorletA')
+
+    def test_add_storlet_failure(self):
+        self.host.add_storlet('invalid', 'path/to/uds/a', 'path/to/a')
+        self.assertEqual({}, self.host.storlet_name_to_fd)
+        self.assertEqual(1, len(self.logger.get_log_lines('exception')))
+
+        self.host.sbus.create.return_value = -1
+        self.host.add_storlet('storleta.StorletA', 'path/to/uds/a',
+                              'path/to/a')
+        self.assertEqual({}, self.host.storlet_name_to_fd)
+        self.assertEqual(1, len(self.logger.get_log_lines('error')))
+
+    def test_handle_control(self):
+        self.host.sbus.create.side_effect = self._create_sbus
+        self._send(command=HOST_CMD_ADD, storlet_name='storleta.StorletA',
+                   uds_path='path/to/uds/a', python_path='path/to/a')
+        self._send(command=HOST_CMD_ADD, storlet_name='storletb.StorletB',
+                   uds_path='path/to/uds/b', python_path='path/to/b')
+        self._send(command=HOST_CMD_REMOVE, storlet_name='storleta.StorletA')
+        self.assertTrue(self.host.handle_control())
+        self.assertEqual(['storletb.StorletB'],
+                         list(self.host.storlet_name_to_fd))
+
+        # Invalid commands are ignored
+        os.write(self.factory_fd, b'invalid\n{"command": "foo"}\n')
+        self.assertTrue(self.host.handle_control())
+        self.assertEqual(1, len(self.logger.get_log_lines('exception')))
+        self.assertEqual(1, len(self.logger.get_log_lines('error')))
+
+        # A partial line is kept until the remaining comes
+        os.write(self.factory_fd, b'{"command": "remove", ')
+        self.assertTrue(self.host.handle_control())
+        self.assertEqual(['storletb.StorletB'],
+                         list(self.host.storlet_name_to_fd))
+        os.write(self.factory_fd, b'"storlet_name": "storletb.StorletB"}\n')
+        self.assertTrue(self.host.handle_control())
+        self.assertEqual({}, self.host.storlet_name_to_fd)
+
+    def test_handle_request(self):
+        self.host.sbus.create.side_effect = self._create_sbus
+        self.host.add_storlet('storleta.StorletA', 'path/to/uds/a',
+                              'path/to/a')
+        fd = self.host.storlet_name_to_fd['storleta.StorletA']
+        daemon = self.host.fd_to_daemon[fd]
+
+        # The storlet keeps being served after the cancel command
+        self.host.sbus.receive.return_value = \
+            FakeDatagram(sbus_cmd.SBUS_CMD_CANCEL)
+        with mock.patch.object(daemon, 'dispatch_command') as dispatch:
+            dispatch.return_value = False
+            self.host.handle_request(fd)
+        self.assertIn('storleta.StorletA', self.host.storlet_name_to_fd)
+
+        self.host.sbus.receive.return_value = None
+        self.host.handle_request(fd)
+        self.assertIn('storleta.StorletA', self.host.storlet_name_to_fd)
+        self.assertEqual(1, len(self.logger.get_log_lines('error')))
+
+        # The storlet is removed after the halt command
+        self.host.sbus.receive.return_value = \
+            FakeDatagram(sbus_cmd.SBUS_CMD_HALT)
+        self.host.handle_request(fd)
+        self.assertEqual({}, self.host.storlet_name_to_fd)
+
+    def test_main_loop(self):
+        self.host.epoll.close()
+        self._send(command=HOST_CMD_ADD, storlet_name='storleta.StorletA',
+                   uds_path='path/to/uds/a', python_path='path/to/a')
+        os.close(self.factory_fd)
+        # Keep the fd number used by tearDown
+        self.factory_fd = os.dup(self.control_fd)
+
+        with mock.patch('storlets.agent.daemon.host.SBus') as sbus:
+            sbus.return_value.create.side_effect = self._create_sbus
+            with mock.patch('storlets.agent.daemon.host.os.wait') as wait:
+                wait.side_effect = OSError()
+                self.host.task_id_to_pid['task'] = 1000
+                self.assertEqual(EXIT_SUCCESS, self.host.main_loop())
+
+        sbus.return_value.create.assert_called_once_with('path/to/uds/a')
+        self.assertEqual({}, self.host.storlet_name_to_fd)
+        self.assertEqual({}, self.host.task_id_to_pid)
+        self.host.epoll = select.epoll()
+
+
+if __name__ == '__main__':
+    unittest.main()
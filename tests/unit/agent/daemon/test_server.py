@@ -12,11 +12,18 @@
 # implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import json
 import mock
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
 
 from storlets.sbus import command as sbus_cmd
-from storlets.agent.daemon.server import StorletDaemon, StorletDaemonLoadError
+from storlets.agent.daemon.server import StorletDaemon, \
+    StorletDaemonLoadError, main
 
 from tests.unit import FakeLogger
 from tests.unit.agent.common import test_server
@@ -49,6 +56,88 @@ class TestStorletDaemon(unittest.TestCase):
         self.assertEqual('Failed to load storlet nomodule.Nothing',
                          cm.exception.args[0])
 
+    def _create_storlet_dir(self):
+        storlet_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storlet_dir)
+        with open(os.path.join(storlet_dir, 'storleta.py'), 'w') as f:
+            f.write('class StorletA(object):\n'
+                    '    def __init__(self, logger):\n'
+                    '        self.logger = logger\n\n'
+                    '    def __call__(self, in_files, out_files, params):\n'
+                    '        self.logger.info(params["key"])\n')
+        # The storlet should not be left imported in the test process
+        self.addCleanup(sys.modules.pop, 'storleta', None)
+        return storlet_dir
+
+    def _create_execute_datagram(self, storlet_dir):
+        dtg = mock.MagicMock()
+        dtg.fds = []
+        dtg.params = {'key': 'value'}
+        for key in ('object_in_storlet_metadata', 'object_in_metadata',
+                    'object_in_fds', 'object_metadata_out_fds',
+                    'object_out_fds', 'object_trailing_metadata_out_fds'):
+            setattr(dtg, key, [])
+        dtg.container_out_fd = None
+        dtg.task_id_out_fd = os.open(os.path.join(storlet_dir, 'task_id'),
+                                     os.O_WRONLY | os.O_CREAT)
+        dtg.logger_out_fd = os.open(os.path.join(storlet_dir, 'log'),
+                                    os.O_WRONLY | os.O_CREAT)
+        return dtg
+
+    def test_python_path(self):
+        storlet_dir = self._create_storlet_dir()
+        with mock.patch('importlib.import_module') as fake_import:
+            daemon = StorletDaemon('storleta.StorletA', 'fake_path',
+                                   self.logger, 16, python_path=storlet_dir)
+            fake_import.assert_not_called()
+            self.assertIsNone(daemon.storlet_cls)
+            daemon.find_storlet()
+            fake_import.assert_not_called()
+
+        # The storlet is not imported in the storlet daemon process
+        dtg = self._create_execute_datagram(storlet_dir)
+        with mock.patch('storlets.agent.daemon.server.os.fork') as fork:
+            fork.return_value = 1000
+            resp = daemon.execute(dtg)
+        self.assertTrue(resp.status)
+        self.assertEqual({1000}, set(daemon.task_id_to_pid.values()))
+        self.assertNotIn('storleta', sys.modules)
+        self.assertNotIn(storlet_dir, sys.path)
+        os.close(dtg.logger_out_fd)
+
+        # The storlet is imported in the storlet application process
+        dtg = self._create_execute_datagram(storlet_dir)
+        with mock.patch('storlets.agent.daemon.server.os.fork') as fork, \
+                mock.patch.object(sys, 'path', list(sys.path)):
+            fork.return_value = 0
+            with self.assertRaises(SystemExit):
+                daemon.execute(dtg)
+            self.assertEqual(storlet_dir, sys.path[0])
+        self.assertIsNotNone(daemon.storlet_cls)
+        with open(os.path.join(storlet_dir, 'log'), 'rb') as f:
+            self.assertEqual(b'storleta.StorletA INFO: value', f.read())
+
+    def test_execute_load_failure(self):
+        empty_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, empty_dir)
+        for python_path in (empty_dir, None):
+            daemon = StorletDaemon('nomodule.Nothing', 'fake_path',
+                                   self.logger, 16, python_path=empty_dir)
+            # The storlet is imported in this process unless the PYTHONPATH
+            # is given
+            daemon.python_path = python_path
+            read_fd, write_fd = os.pipe()
+            dtg = mock.MagicMock()
+            dtg.fds = [read_fd, write_fd]
+            resp = daemon.execute(dtg)
+            self.assertFalse(resp.status)
+            self.assertEqual('Failed to load storlet nomodule.Nothing',
+                             resp.message)
+            # The fds are closed, so that the gateway does not wait for them
+            for fd in (read_fd, write_fd):
+                with self.assertRaises(OSError):
+                    os.fstat(fd)
+
 
 class TestStorletDaemonMain(test_server.TestSBusServerMain):
 
@@ -72,5 +161,77 @@ class TestStorletDaemonMain(test_server.TestSBusServerMain):
         self._test_main_loop_stop(sbus_cmd.SBUS_CMD_CANCEL)
 
 
+# The budget of the time to import the storlet daemon module, in
+# microseconds. This is much larger than the actual time (about 30ms) so
+# that the test is stable on slow machines.
+IMPORT_TIME_BUDGET = 300000
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))))))
+
+
+class TestStorletDaemonStartup(unittest.TestCase):
+
+    def _run_python(self, args):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = TOP_DIR
+        proc = subprocess.Popen(
+            [sys.executable] + args, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, env=env)
+        stdout, stderr = proc.communicate()
+        self.assertEqual(0, proc.returncode, stderr)
+        return stdout.decode('utf-8'), stderr.decode('utf-8')
+
+    def test_main(self):
+        with mock.patch('storlets.agent.daemon.server.run_daemon') as run, \
+                mock.patch.object(sys, 'argv',
+                                  ['storlets-daemon', 'storlet.Storlet',
+                                   'path/to/uds', 'DEBUG', '4', 'contid']):
+            run.return_value = 0
+            with self.assertRaises(SystemExit) as cm:
+                main()
+        self.assertEqual(0, cm.exception.code)
+        run.assert_called_once_with('storlet.Storlet', 'path/to/uds',
+                                    'DEBUG', 4, 'contid')
+
+        for argv in (['storlets-daemon'],
+                     ['storlets-daemon', 'storlet.Storlet', 'path/to/uds',
+                      'DEBUG', 'invalid', 'contid']):
+            with mock.patch('storlets.agent.daemon.server.run_daemon') \
+                    as run, \
+                    mock.patch.object(sys, 'argv', argv), \
+                    mock.patch.object(sys, 'stderr'):
+                with self.assertRaises(SystemExit) as cm:
+                    main()
+            self.assertEqual(2, cm.exception.code)
+            run.assert_not_called()
+
+    def test_imported_modules(self):
+        stdout, _stderr = self._run_python([
+            '-c', 'import json, sys; before = set(sys.modules); '
+                  'import storlets.agent.daemon.server; '
+                  'print(json.dumps(sorted(set(sys.modules) - before)))'])
+        modules = json.loads(stdout)
+        self.assertIn('storlets.agent.daemon.server', modules)
+        for module in ('argparse', 'uuid'):
+            self.assertNotIn(module, modules)
+
+    @unittest.skipIf(sys.version_info < (3, 7), '-X importtime is required')
+    def test_import_time(self):
+        # Run once so that the bytecode is cached
+        self._run_python(['-c', 'import storlets.agent.daemon.server'])
+        _stdout, stderr = self._run_python(
+            ['-X', 'importtime', '-c', 'import storlets.agent.daemon.server'])
+        for line in stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            fields = line.split('|')
+            if len(fields) == 3 and \
+                    fields[2].strip() == 'storlets.agent.daemon.server':
+                self.assertLess(int(fields[1]), IMPORT_TIME_BUDGET)
+                break
+        else:
+            self.fail('No import time is reported: %s' % stderr)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,117 @@
+# Copyright (c) 2010-2016 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from eventlet import patcher
+import mock
+import os
+import unittest
+
+from storlets.agent.daemon_factory.log_collector import StderrCollector, \
+    MAX_LINE_LENGTH
+
+from tests.unit import FakeLogger
+
+# NOTE: The gateway modules monkey patch os module, but the daemon factory
+#       runs without eventlet
+original_os = patcher.original('os')
+
+
+class TestStderrCollector(unittest.TestCase):
+
+    def setUp(self):
+        read_patcher = mock.patch(
+            'storlets.agent.daemon_factory.log_collector.os.read',
+            original_os.read)
+        read_patcher.start()
+        self.addCleanup(read_patcher.stop)
+        self.logger = FakeLogger()
+        self.collector = StderrCollector(self.logger, rate_limit=3)
+        self.addCleanup(self.collector.close)
+        read_fd, self.write_fd = os.pipe()
+        self.fd = self.collector.add('storleta', os.fdopen(read_fd, 'rb'))
+
+    def tearDown(self):
+        if self.write_fd is not None:
+            os.close(self.write_fd)
+
+    def _close_writer(self):
+        os.close(self.write_fd)
+        self.write_fd = None
+
+    def test_read(self):
+        self.collector.rate_limit = 0
+        # Nothing to read yet
+        self.assertTrue(self.collector.read(self.fd))
+        self.assertEqual([], self.logger.get_log_lines('warn'))
+
+        os.write(self.write_fd, b'line1\nline2\nparti')
+        self.assertTrue(self.collector.read(self.fd))
+        self.assertEqual(['[storleta] line1', '[storleta] line2'],
+                         self.logger.get_log_lines('warn'))
+
+        os.write(self.write_fd, b'al\n')
+        self.assertTrue(self.collector.read(self.fd))
+        self.assertEqual('[storleta] partial',
+                         self.logger.get_log_lines('warn')[-1])
+
+        # The remaining is logged when the storlet daemon exits
+        os.write(self.write_fd, b'last')
+        self._close_writer()
+        self.assertTrue(self.collector.read(self.fd))
+        self.assertFalse(self.collector.read(self.fd))
+        self.assertEqual('[storleta] last',
+                         self.logger.get_log_lines('warn')[-1])
+        self.assertEqual({}, self.collector.fd_to_stream)
+
+    def test_read_long_line(self):
+        os.write(self.write_fd, b'a' * (MAX_LINE_LENGTH + 10))
+        self.collector.read(self.fd)
+        self.assertEqual(['[storleta] ' + 'a' * MAX_LINE_LENGTH],
+                         self.logger.get_log_lines('warn'))
+
+    def test_rate_limit(self):
+        with mock.patch('storlets.agent.daemon_factory.log_collector.'
+                        'time.time') as fake_time:
+            fake_time.return_value = 100
+            os.write(self.write_fd, b'1\n2\n3\n4\n5\n')
+            self.collector.read(self.fd)
+            self.assertEqual(['[storleta] 1', '[storleta] 2',
+                              '[storleta] 3'],
+                             self.logger.get_log_lines('warn'))
+
+            # The number of the suppressed lines is logged in the next
+            # second
+            fake_time.return_value = 101
+            os.write(self.write_fd, b'6\n')
+            self.collector.read(self.fd)
+            self.assertEqual(['[storleta] 2 lines suppressed',
+                              '[storleta] 6'],
+                             self.logger.get_log_lines('warn')[3:])
+
+    def test_no_rate_limit(self):
+        self.collector.rate_limit = 0
+        os.write(self.write_fd, b'line\n' * 10)
+        self.collector.read(self.fd)
+        self.assertEqual(10, len(self.logger.get_log_lines('warn')))
+
+    def test_close(self):
+        stream = self.collector.fd_to_stream[self.fd]
+        self.collector.close()
+        self.assertEqual({}, self.collector.fd_to_stream)
+        self.assertTrue(stream.fobj.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
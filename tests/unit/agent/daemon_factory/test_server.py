@@ -13,8 +13,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from contextlib import contextmanager
+from eventlet import patcher
 import errno
+import json
 import mock
+import os
+import shutil
+import signal
+import sys
+import tempfile
 import unittest
 
 from storlets.sbus import command as sbus_cmd
@@ -23,11 +30,24 @@ from storlets.sbus.client.exceptions import SBusClientSendError
 
 from storlets.agent.daemon_factory.server import SDaemonError, \
     StorletDaemonFactory
+from storlets.agent.common.server import EXIT_FAILURE
 from storlets.agent.common.utils import DEFAULT_PY2, DEFAULT_PY3
 
 from tests.unit import FakeLogger
 from tests.unit.agent.common import test_server
 
+# NOTE: The gateway modules monkey patch select module, but the daemon
+#       factory runs without eventlet
+select = patcher.original('select')
+
+
+class FakePopenObject(object):
+    def __init__(self, pid):
+        self.pid = pid
+        read_fd, write_fd = os.pipe()
+        os.close(write_fd)
+        self.stderr = os.fdopen(read_fd, 'rb')
+
 
 class DummyDatagram(object):
     def __init__(self, prms=None):
@@ -51,6 +71,7 @@ class TestStorletDaemonFactory(unittest.TestCase):
         self.container_id = 'contid'
         self.dfactory = StorletDaemonFactory(self.pipe_path, self.logger,
                                              self.container_id)
+        self.addCleanup(self.dfactory.stderr_collector.close)
 
     def test_get_jvm_args(self):
         dummy_env = {'CLASSPATH': '/default/classpath',
@@ -102,7 +123,7 @@ class TestStorletDaemonFactory(unittest.TestCase):
                 'python', 'path/to/storlet', 'test_storlet.TestStorlet',
                 1, 'path/to/uds', 'DEBUG', version)
         self.assertEqual(
-            ['/usr/bin/python%s' % expected,
+            ['/usr/bin/python%s' % expected, '-s', '-B',
              '/usr/local/libexec/storlets/storlets-daemon',
              'test_storlet.TestStorlet',
              'path/to/uds', 'DEBUG', '1', self.container_id],
@@ -116,32 +137,65 @@ class TestStorletDaemonFactory(unittest.TestCase):
         self.dfactory.storlet_name_to_pipe_name = \
             {'storleta': 'path/to/uds/a'}
 
-        class FakePopenObject(object):
-            def __init__(self, pid):
-                self.pid = pid
-                self.stderr = mock.MagicMock()
-
         with mock.patch(self.base_path + '.subprocess.Popen') as popen, \
-                mock.patch(self.base_path + '.time.sleep'), \
+                mock.patch.object(self.dfactory,
+                                  'wait_collecting_stderr') as wait, \
                 mock.patch(self.waitpid_path) as waitpid, \
                 self._mock_sbus_client('ping') as ping:
-            popen.side_effect = [FakePopenObject(1000),
-                                 FakePopenObject(1001)]
+            popen.side_effect = [FakePopenObject(1000)]
             waitpid.return_value = 0, 0
             ping.return_value = SBusResponse(True, 'OK')
             self.dfactory.spawn_subprocess(
                 ['arg0', 'argv1', 'argv2'],
                 {'envk0': 'envv0'}, 'storleta')
+            # The stderr is collected while the factory waits for the
+            # storlet daemon
+            wait.assert_called_once_with(1)
             self.assertEqual((1000, 1), waitpid.call_args[0])
             self.assertEqual({'storleta': 1000},
                              self.dfactory.storlet_name_to_pid)
+            # The stderr of the storlet daemon is watched in the main loop
+            # without any logger process
+            self.assertEqual(1, popen.call_count)
+            self.assertEqual(1, len(self.dfactory.fd_handlers))
+            fd = list(self.dfactory.fd_handlers)[0]
+            self.assertEqual(
+                'storleta',
+                self.dfactory.stderr_collector.fd_to_stream[fd].storlet_name)
+            # The stderr pipe is closed when the storlet daemon exits
+            self.dfactory.fd_handlers[fd]()
+            self.assertEqual({}, self.dfactory.fd_handlers)
+            self.assertEqual({}, self.dfactory.stderr_collector.fd_to_stream)
+
+        # The restarted storlet daemon is pinged in the housekeeping
+        self.dfactory.storlet_name_to_pid = {}
+        with mock.patch(self.base_path + '.subprocess.Popen') as popen, \
+                mock.patch.object(self.dfactory,
+                                  'wait_collecting_stderr') as wait, \
+                mock.patch(self.waitpid_path) as waitpid, \
+                mock.patch(self.base_path + '.time.time') as fake_time, \
+                self._mock_sbus_client('ping') as ping:
+            popen.side_effect = [FakePopenObject(1000)]
+            waitpid.return_value = 0, 0
+            fake_time.return_value = 100
+            self.dfactory.spawn_subprocess(
+                ['arg0', 'argv1', 'argv2'],
+                {'envk0': 'envv0'}, 'storleta', wait=False)
+            wait.assert_not_called()
+            ping.assert_not_called()
+            self.assertEqual({'storleta': 1000},
+                             self.dfactory.storlet_name_to_pid)
+            self.assertEqual({'storleta': 100},
+                             self.dfactory.starting_daemons)
+        self.dfactory.stderr_collector.close()
+        self.dfactory.fd_handlers = {}
+        self.dfactory.starting_daemons = {}
 
         with mock.patch(self.base_path + '.subprocess.Popen') as popen, \
                 mock.patch(self.base_path + '.time.sleep'), \
                 mock.patch(self.waitpid_path) as waitpid, \
                 self._mock_sbus_client('ping') as ping:
-            popen.side_effect = [FakePopenObject(1000),
-                                 FakePopenObject(1001)]
+            popen.side_effect = [FakePopenObject(1000)]
             waitpid.return_value = 0, 0
             ping.return_value = SBusResponse(False, 'NG')
             with self.assertRaises(SDaemonError):
@@ -155,8 +209,7 @@ class TestStorletDaemonFactory(unittest.TestCase):
         with mock.patch(self.base_path + '.subprocess.Popen') as popen, \
                 mock.patch(self.base_path + '.time.sleep'), \
                 mock.patch(self.waitpid_path) as waitpid:
-            popen.side_effect = [FakePopenObject(1000),
-                                 FakePopenObject(1001)]
+            popen.side_effect = [FakePopenObject(1000)]
             waitpid.return_value = 1000, -1
             with self.assertRaises(SDaemonError):
                 self.dfactory.spawn_subprocess(
@@ -171,6 +224,302 @@ class TestStorletDaemonFactory(unittest.TestCase):
                     ['arg0', 'argv1', 'argv2'],
                     {'envk0': 'envv0'}, 'storleta')
 
+    def _mock_default_py3(self, version=None):
+        # The python 3 storlet daemons run with the same python as the
+        # factory process, unless the version is given
+        version = version or float('%d.%d' % sys.version_info[:2])
+        return mock.patch(self.base_path + '.DEFAULT_PY3', version)
+
+    def test_can_fork_python_daemon(self):
+        major, minor = sys.version_info[:2]
+        with self._mock_default_py3():
+            self.assertTrue(self.dfactory.can_fork_python_daemon(major))
+            self.assertTrue(self.dfactory.can_fork_python_daemon(
+                '%d.%d' % (major, minor)))
+            self.assertTrue(self.dfactory.can_fork_python_daemon(None))
+
+            self.dfactory.use_zygote = False
+            self.assertFalse(self.dfactory.can_fork_python_daemon(major))
+            self.dfactory.use_zygote = True
+
+            # The python 2 storlet daemon runs with another python
+            self.assertFalse(self.dfactory.can_fork_python_daemon(2))
+
+        # The storlet daemon is started with another minor version
+        with self._mock_default_py3(float('%d.%d' % (major, minor + 1))):
+            self.assertFalse(self.dfactory.can_fork_python_daemon(major))
+            self.assertFalse(self.dfactory.can_fork_python_daemon(None))
+
+    def test_fork_python_daemon(self):
+        # In the factory process
+        with mock.patch.object(self.dfactory,
+                               '_fork_with_stderr') as fork, \
+                mock.patch(self.base_path + '.run_daemon') as run_daemon:
+            fork.return_value = 1000
+            self.assertEqual(1000, self.dfactory.fork_python_daemon(
+                'storleta', 'path/to/uds/a', 'DEBUG', '2', 'path/to/a'))
+            run_daemon.assert_not_called()
+
+        # In the forked storlet daemon
+        with mock.patch.object(self.dfactory,
+                               '_fork_with_stderr') as fork, \
+                mock.patch(self.base_path + '.os._exit') as _exit, \
+                mock.patch.object(self.dfactory,
+                                  '_init_forked_daemon') as init, \
+                mock.patch(self.base_path + '.run_daemon') as run_daemon:
+            fork.return_value = 0
+            run_daemon.return_value = 0
+            self.dfactory.fork_python_daemon(
+                'storleta', 'path/to/uds/a', 'DEBUG', '2', 'path/to/a')
+            init.assert_called_once_with('path/to/a')
+            run_daemon.assert_called_once_with(
+                'storleta', 'path/to/uds/a', 'DEBUG', 2, self.container_id)
+            _exit.assert_called_once_with(0)
+
+        with mock.patch.object(self.dfactory,
+                               '_fork_with_stderr') as fork, \
+                mock.patch(self.base_path + '.os._exit') as _exit, \
+                mock.patch.object(self.dfactory,
+                                  '_init_forked_daemon') as init, \
+                mock.patch(self.base_path + '.run_daemon') as run_daemon:
+            fork.return_value = 0
+            init.side_effect = OSError()
+            with self.assertRaises(OSError):
+                self.dfactory.fork_python_daemon(
+                    'storleta', 'path/to/uds/a', 'DEBUG', '2', 'path/to/a')
+            run_daemon.assert_not_called()
+            _exit.assert_called_once_with(EXIT_FAILURE)
+
+        with mock.patch.object(self.dfactory,
+                               '_fork_with_stderr') as fork:
+            fork.side_effect = OSError()
+            with self.assertRaises(SDaemonError):
+                self.dfactory.fork_python_daemon(
+                    'storleta', 'path/to/uds/a', 'DEBUG', '2', 'path/to/a')
+
+    def test_fork_with_stderr(self):
+        # In the factory process
+        with mock.patch(self.base_path + '.os.fork') as fork:
+            fork.return_value = 1000
+            self.assertEqual(1000,
+                             self.dfactory._fork_with_stderr('storleta'))
+        # The stderr of the forked daemon is watched in the main loop
+        self.assertEqual(1, len(self.dfactory.fd_handlers))
+        fd = list(self.dfactory.fd_handlers)[0]
+        self.assertEqual(
+            'storleta',
+            self.dfactory.stderr_collector.fd_to_stream[fd].storlet_name)
+
+        # In the forked daemon
+        with mock.patch(self.base_path + '.os.fork') as fork, \
+                mock.patch(self.base_path + '.os.pipe') as pipe, \
+                mock.patch(self.base_path + '.os.close') as close, \
+                mock.patch(self.base_path + '.os.dup2') as dup2:
+            fork.return_value = 0
+            pipe.return_value = (10, 11)
+            self.assertEqual(0, self.dfactory._fork_with_stderr('storleta'))
+            dup2.assert_called_once_with(11, 2)
+            self.assertEqual([mock.call(10), mock.call(11)],
+                             close.call_args_list)
+        self.assertEqual(1, len(self.dfactory.fd_handlers))
+
+        with mock.patch(self.base_path + '.os.fork') as fork, \
+                mock.patch(self.base_path + '.os.pipe') as pipe, \
+                mock.patch(self.base_path + '.os.close') as close:
+            fork.side_effect = OSError()
+            pipe.return_value = (10, 11)
+            with self.assertRaises(OSError):
+                self.dfactory._fork_with_stderr('storleta')
+            self.assertEqual([mock.call(10), mock.call(11)],
+                             close.call_args_list)
+
+    def test_wait_collecting_stderr(self):
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, write_fd)
+        self.dfactory.stderr_collector.rate_limit = 0
+        self.dfactory.collect_stderr('storleta', os.fdopen(read_fd, 'rb'))
+        # The output written while the factory waits is logged
+        os.write(write_fd, b'line\n' * 10)
+        with mock.patch(self.base_path + '.select', select), \
+                mock.patch(self.base_path + '.time.time') as fake_time:
+            fake_time.side_effect = [100, 100, 101]
+            self.dfactory.wait_collecting_stderr(1)
+        self.assertEqual(['[storleta] line'] * 10,
+                         self.logger.get_log_lines('warn'))
+
+        # Nothing to collect
+        self.dfactory.stderr_collector.close()
+        self.dfactory.fd_handlers.clear()
+        with mock.patch(self.base_path + '.time.sleep') as sleep, \
+                mock.patch(self.base_path + '.time.time') as fake_time:
+            fake_time.side_effect = [100, 100.25]
+            self.dfactory.wait_collecting_stderr(1)
+            sleep.assert_called_once_with(0.75)
+
+    def test_spawn_python_daemon(self):
+        self.dfactory.storlet_name_to_pipe_name = \
+            {'storleta': 'path/to/uds/a'}
+
+        with mock.patch(self.base_path + '.os.fork') as fork, \
+                mock.patch(self.base_path + '.time.sleep') as sleep, \
+                mock.patch(self.waitpid_path) as waitpid, \
+                self._mock_sbus_client('ping') as ping:
+            fork.return_value = 1000
+            waitpid.return_value = 0, 0
+            ping.return_value = SBusResponse(True, 'OK')
+            self.dfactory.spawn_python_daemon(
+                'storleta', 'path/to/uds/a', 'DEBUG', 1, 'path/to/a')
+            self.assertEqual((1000, 1), waitpid.call_args[0])
+            self.assertEqual({'storleta': 1000},
+                             self.dfactory.storlet_name_to_pid)
+            # The forked daemon is pinged without waiting
+            sleep.assert_not_called()
+
+        with mock.patch(self.base_path + '.os.fork') as fork, \
+                mock.patch(self.base_path + '.time.sleep'), \
+                mock.patch(self.waitpid_path) as waitpid:
+            fork.return_value = 1001
+            waitpid.return_value = 1001, -1
+            with self.assertRaises(SDaemonError):
+                self.dfactory.spawn_python_daemon(
+                    'storleta', 'path/to/uds/a', 'DEBUG', 1, 'path/to/a')
+
+    @mock.patch(base_path + '.DEFAULT_PY3',
+                float('%d.%d' % sys.version_info[:2]))
+    def test_can_host_python_daemon(self):
+        major = sys.version_info[0]
+        self.assertFalse(self.dfactory.can_host_python_daemon(
+            'storleta.StorletA', major))
+
+        self.dfactory.use_host_daemon = True
+        self.assertTrue(self.dfactory.can_host_python_daemon(
+            'storleta.StorletA', major))
+        self.assertFalse(self.dfactory.can_host_python_daemon(
+            'storleta.StorletA', major - 1))
+
+        # The storlets do not share their modules in the host daemon
+        self.dfactory.hosted_storlets = {'storleta.StorletA': 'path/to/a'}
+        self.assertTrue(self.dfactory.can_host_python_daemon(
+            'storleta.OtherStorlet', major))
+
+        self.dfactory.use_zygote = False
+        self.assertFalse(self.dfactory.can_host_python_daemon(
+            'storleta.StorletA', major))
+
+    def test_start_host_daemon(self):
+        # In the factory process
+        with mock.patch.object(self.dfactory,
+                               '_fork_with_stderr') as fork, \
+                mock.patch(self.base_path + '.os.pipe') as pipe, \
+                mock.patch(self.base_path + '.os.close') as close:
+            fork.return_value = 1000
+            pipe.return_value = (10, 11)
+            self.dfactory.start_host_daemon('DEBUG')
+            close.assert_called_once_with(10)
+        self.assertEqual(1000, self.dfactory.host_pid)
+        self.assertEqual(11, self.dfactory.host_control_fd)
+
+        # In the forked host daemon
+        with mock.patch.object(self.dfactory,
+                               '_fork_with_stderr') as fork, \
+                mock.patch(self.base_path + '.os.pipe') as pipe, \
+                mock.patch(self.base_path + '.os.close') as close, \
+                mock.patch(self.base_path + '.os._exit') as _exit, \
+                mock.patch.object(self.dfactory,
+                                  '_init_forked_daemon') as init, \
+                mock.patch(self.base_path + '.run_host_daemon') as run_host:
+            fork.return_value = 0
+            pipe.return_value = (10, 11)
+            run_host.return_value = 0
+            self.dfactory.start_host_daemon('DEBUG')
+            close.assert_called_once_with(11)
+            init.assert_called_once_with(None, keep_fds=(10,))
+            run_host.assert_called_once_with(
+                10, 'DEBUG', self.dfactory.host_pool_size,
+                self.container_id)
+            _exit.assert_called_once_with(0)
+
+        with mock.patch.object(self.dfactory,
+                               '_fork_with_stderr') as fork, \
+                mock.patch(self.base_path + '.os.pipe') as pipe, \
+                mock.patch(self.base_path + '.os.close') as close:
+            fork.side_effect = OSError()
+            pipe.return_value = (10, 11)
+            with self.assertRaises(SDaemonError):
+                self.dfactory.start_host_daemon('DEBUG')
+            self.assertEqual([mock.call(10), mock.call(11)],
+                             close.call_args_list)
+
+    def test_stop_host_daemon(self):
+        # Nothing to stop
+        self.dfactory.stop_host_daemon()
+
+        self.dfactory.host_pid = 1000
+        self.dfactory.host_control_fd = 11
+        self.dfactory.hosted_storlets = {'storleta': 'path/to/uds/a'}
+        self.dfactory.storlet_name_to_pid = {'storleta': 1000,
+                                             'storletb': 1001}
+        with mock.patch(self.base_path + '.os.close') as close, \
+                mock.patch(self.waitpid_path) as waitpid:
+            self.dfactory.stop_host_daemon()
+            close.assert_called_once_with(11)
+            waitpid.assert_called_once_with(1000, 0)
+        self.assertIsNone(self.dfactory.host_pid)
+        self.assertIsNone(self.dfactory.host_control_fd)
+        self.assertEqual({}, self.dfactory.hosted_storlets)
+        self.assertEqual({'storletb': 1001},
+                         self.dfactory.storlet_name_to_pid)
+
+    def test_spawn_hosted_daemon(self):
+        def fake_start_host_daemon(log_level):
+            self.dfactory.host_pid = 1000
+            self.dfactory.host_control_fd = 11
+
+        self.dfactory.storlet_name_to_pipe_name = \
+            {'storleta': 'path/to/uds/a', 'storletb': 'path/to/uds/b'}
+        with mock.patch.object(self.dfactory, 'start_host_daemon') as start, \
+                mock.patch(self.base_path + '.os.write') as write, \
+                mock.patch(self.waitpid_path) as waitpid, \
+                self._mock_sbus_client('ping') as ping:
+            start.side_effect = fake_start_host_daemon
+            waitpid.return_value = 0, 0
+            ping.return_value = SBusResponse(True, 'OK')
+            self.dfactory.spawn_hosted_daemon(
+                'storleta', 'path/to/uds/a', 'DEBUG', 'path/to/a')
+            self.dfactory.spawn_hosted_daemon(
+                'storletb', 'path/to/uds/b', 'DEBUG', 'path/to/b')
+            # The host daemon is started only once
+            start.assert_called_once_with('DEBUG')
+            self.assertEqual(2, write.call_count)
+            self.assertEqual(11, write.call_args[0][0])
+            self.assertEqual(
+                {'command': 'add', 'storlet_name': 'storletb',
+                 'uds_path': 'path/to/uds/b', 'python_path': 'path/to/b'},
+                json.loads(write.call_args[0][1].decode('utf-8')))
+        self.assertEqual({'storleta': 'path/to/uds/a',
+                          'storletb': 'path/to/uds/b'},
+                         self.dfactory.hosted_storlets)
+        self.assertEqual({'storleta': 1000, 'storletb': 1000},
+                         self.dfactory.storlet_name_to_pid)
+
+        # The host daemon is restarted when it is terminated
+        with mock.patch.object(self.dfactory, 'start_host_daemon') as start, \
+                mock.patch(self.base_path + '.os.close'), \
+                mock.patch(self.base_path + '.os.write'), \
+                mock.patch(self.waitpid_path) as waitpid, \
+                self._mock_sbus_client('ping') as ping:
+            start.side_effect = fake_start_host_daemon
+            waitpid.side_effect = [(1000, 9), OSError(errno.ECHILD, ''),
+                                   (0, 0)]
+            ping.return_value = SBusResponse(True, 'OK')
+            self.dfactory.spawn_hosted_daemon(
+                'storleta', 'path/to/uds/a', 'DEBUG', 'path/to/a')
+            start.assert_called_once_with('DEBUG')
+        self.assertEqual({'storleta': 'path/to/uds/a'},
+                         self.dfactory.hosted_storlets)
+        self.assertEqual({'storleta': 1000},
+                         self.dfactory.storlet_name_to_pid)
+
     def test_wait_for_daemon_to_initialize(self):
         self.dfactory.storlet_name_to_pipe_name = \
             {'storleta': 'path/to/uds/a'}
@@ -202,22 +551,18 @@ class TestStorletDaemonFactory(unittest.TestCase):
                 self.dfactory.NUM_OF_TRIES_PINGING_STARTING_DAEMON,
                 ping.call_count)
 
+    @mock.patch(base_path + '.DEFAULT_PY3',
+                float('%d.%d' % sys.version_info[:2]))
     def test_process_start_daemon(self):
         # Not running
         self.dfactory.storlet_name_to_pid = {}
         self.dfactory.storlet_name_to_pipe_name = {}
 
-        class FakePopenObject(object):
-            def __init__(self, pid):
-                self.pid = pid
-                self.stderr = mock.MagicMock()
-
         with mock.patch(self.base_path + '.subprocess.Popen') as popen, \
                 mock.patch(self.base_path + '.time.sleep'), \
                 mock.patch(self.waitpid_path) as waitpid, \
                 self._mock_sbus_client('ping') as ping:
-            popen.side_effect = [FakePopenObject(1000),
-                                 FakePopenObject(1001)]
+            popen.side_effect = [FakePopenObject(1000)]
             waitpid.return_value = 0, 0
             ping.return_value = SBusResponse(True, 'OK')
             self.assertTrue(self.dfactory.process_start_daemon(
@@ -226,6 +571,46 @@ class TestStorletDaemonFactory(unittest.TestCase):
             self.assertEqual({'storleta': 'path/to/uds/a'},
                              self.dfactory.storlet_name_to_pipe_name)
 
+        # Python storlet daemon is forked
+        self.dfactory.storlet_name_to_pid = {}
+        with mock.patch.object(self.dfactory,
+                               'spawn_python_daemon') as spawn_python, \
+                mock.patch.object(self.dfactory,
+                                  'spawn_subprocess') as spawn_subprocess:
+            self.assertTrue(self.dfactory.process_start_daemon(
+                'python', 'path/to/storlet/b', 'storletb', 1,
+                'path/to/uds/b', 'TRACE', sys.version_info[0]))
+            spawn_python.assert_called_once_with(
+                'storletb', 'path/to/uds/b', 'TRACE', 1, mock.ANY, True)
+            spawn_subprocess.assert_not_called()
+
+        # Python storlet is served by the host daemon
+        self.dfactory.storlet_name_to_pid = {}
+        self.dfactory.use_host_daemon = True
+        with mock.patch.object(self.dfactory,
+                               'spawn_hosted_daemon') as spawn_hosted, \
+                mock.patch.object(self.dfactory,
+                                  'spawn_python_daemon') as spawn_python:
+            self.assertTrue(self.dfactory.process_start_daemon(
+                'python', 'path/to/storlet/b', 'storletb', 1,
+                'path/to/uds/b', 'TRACE', sys.version_info[0]))
+            spawn_hosted.assert_called_once_with(
+                'storletb', 'path/to/uds/b', 'TRACE', mock.ANY, True)
+            spawn_python.assert_not_called()
+        self.dfactory.use_host_daemon = False
+
+        # Python storlet daemon with the different major version
+        self.dfactory.storlet_name_to_pid = {}
+        with mock.patch.object(self.dfactory,
+                               'spawn_python_daemon') as spawn_python, \
+                mock.patch.object(self.dfactory,
+                                  'spawn_subprocess') as spawn_subprocess:
+            self.assertTrue(self.dfactory.process_start_daemon(
+                'python', 'path/to/storlet/b', 'storletb', 1,
+                'path/to/uds/b', 'TRACE', sys.version_info[0] - 1))
+            spawn_python.assert_not_called()
+            self.assertEqual(1, spawn_subprocess.call_count)
+
         # Already running
         self.dfactory.storlet_name_to_pid = {'storleta': 1000}
         self.dfactory.storlet_name_to_pipe_name = {'storleta': 'path/to/uds/a'}
@@ -235,6 +620,18 @@ class TestStorletDaemonFactory(unittest.TestCase):
                 'java', 'path/to/storlet/a', 'storleta', 1, 'path/to/uds/a',
                 'TRACE'))
 
+        # Being restarted, so wait until it responds
+        self.dfactory.starting_daemons = {'storleta': 100}
+        with mock.patch(self.waitpid_path) as waitpid, \
+                self._mock_sbus_client('ping') as ping:
+            waitpid.return_value = 0, 0
+            ping.return_value = SBusResponse(True, 'OK')
+            self.assertFalse(self.dfactory.process_start_daemon(
+                'java', 'path/to/storlet/a', 'storleta', 1, 'path/to/uds/a',
+                'TRACE'))
+            self.assertEqual(1, ping.call_count)
+        self.assertEqual({}, self.dfactory.starting_daemons)
+
         # Unsupported language
         with self.assertRaises(SDaemonError):
             self.dfactory.process_start_daemon(
@@ -270,6 +667,17 @@ class TestStorletDaemonFactory(unittest.TestCase):
             self.assertEqual(1, waitpid.call_count)
             self.assertEqual((1000, 1), waitpid.call_args[0])
 
+        self.assertEqual({}, self.dfactory.reaped_statuses)
+
+        # The exit status is recorded for check_daemon_exits
+        self.dfactory.sigchld_fds = (-1, -1)
+        with mock.patch(self.waitpid_path) as waitpid:
+            waitpid.return_value = 1000, 0
+            self.assertFalse(
+                self.dfactory.get_process_status_by_pid(1000, 'storleta'))
+        self.assertEqual({1000: 0}, self.dfactory.reaped_statuses)
+        self.dfactory.sigchld_fds = None
+
         with mock.patch(self.waitpid_path) as waitpid:
             waitpid.side_effect = OSError(errno.ESRCH, '')
             self.assertFalse(
@@ -308,6 +716,26 @@ class TestStorletDaemonFactory(unittest.TestCase):
             self.assertEqual({'storletb': 1001},
                              self.dfactory.storlet_name_to_pid)
 
+        # Storlet served by the host daemon
+        self.dfactory.storlet_name_to_pid = \
+            {'storleta': 1000, 'storletb': 1000}
+        self.dfactory.hosted_storlets = \
+            {'storleta': 'path/to/uds/a', 'storletb': 'path/to/uds/b'}
+        self.dfactory.host_control_fd = 11
+        with mock.patch(self.kill_path) as kill, \
+                mock.patch(self.base_path + '.os.write') as write:
+            self.assertEqual((1000, 0),
+                             self.dfactory.process_kill('storleta'))
+            kill.assert_not_called()
+            self.assertEqual(
+                {'command': 'remove', 'storlet_name': 'storleta'},
+                json.loads(write.call_args[0][1].decode('utf-8')))
+            self.assertEqual({'storletb': 1000},
+                             self.dfactory.storlet_name_to_pid)
+            self.assertEqual({'storletb': 'path/to/uds/b'},
+                             self.dfactory.hosted_storlets)
+        self.dfactory.hosted_storlets = {}
+
         # When failed to send kill to the storlet daemon
         self.dfactory.storlet_name_to_pid = \
             {'storleta': 1000, 'storletb': 1001}
@@ -462,6 +890,23 @@ class TestStorletDaemonFactory(unittest.TestCase):
             self.assertEqual({'storletb': 1001},
                              self.dfactory.storlet_name_to_pid)
 
+        # Storlet served by the host daemon
+        self.dfactory.storlet_name_to_pid = \
+            {'storleta': 1000, 'storletb': 1000}
+        self.dfactory.hosted_storlets = \
+            {'storleta': 'path/to/uds/a', 'storletb': 'path/to/uds/b'}
+        with self._mock_sbus_client('halt') as halt, \
+                mock.patch(self.waitpid_path) as waitpid:
+            halt.return_value = SBusResponse(True, 'OK')
+            self.dfactory.shutdown_process('storleta')
+            # The host daemon keeps running for the other storlet
+            waitpid.assert_not_called()
+            self.assertEqual({'storletb': 1000},
+                             self.dfactory.storlet_name_to_pid)
+            self.assertEqual({'storletb': 'path/to/uds/b'},
+                             self.dfactory.hosted_storlets)
+        self.dfactory.hosted_storlets = {}
+
         # Failed to send a command to the storlet daemon
         self.dfactory.storlet_name_to_pid = \
             {'storleta': 1000, 'storletb': 1001}
@@ -498,6 +943,401 @@ class TestStorletDaemonFactory(unittest.TestCase):
         with self.assertRaises(SDaemonError):
             self.dfactory.shutdown_process('storletc')
 
+    def _mock_proc_files(self, files):
+        def fake_open(path):
+            if path not in files:
+                raise IOError()
+            return mock.mock_open(read_data=files[path])()
+        return mock.patch(self.base_path + '.open', side_effect=fake_open,
+                          create=True)
+
+    def test_get_process_rss(self):
+        # The proportional set size is used
+        smaps_rollup = ('00400000-7fff00000000 ---p 00000000 00:00 0 '
+                        '[rollup]\n'
+                        'Rss:                 800 kB\n'
+                        'Pss:                 300 kB\n'
+                        'Shared_Clean:        500 kB\n')
+        with self._mock_proc_files(
+                {'/proc/1000/smaps_rollup': smaps_rollup,
+                 '/proc/1000/statm': '100 20 3 4 0 5 0\n'}):
+            self.assertEqual(300 * 1024,
+                             self.dfactory.get_process_rss(1000))
+
+        # The shared pages are excluded from the resident pages
+        with self._mock_proc_files(
+                {'/proc/1000/statm': '100 20 3 4 0 5 0\n'}), \
+                mock.patch(self.base_path + '.os.sysconf') as sysconf:
+            sysconf.return_value = 4096
+            self.assertEqual(17 * 4096, self.dfactory.get_process_rss(1000))
+
+        with self._mock_proc_files({}):
+            self.assertEqual(0, self.dfactory.get_process_rss(1000))
+
+    def test_evict_daemon(self):
+        self.dfactory.storlet_name_to_pid = {'storleta': 1000}
+        self.dfactory.storlet_name_to_last_use = {'storleta': 1}
+        with mock.patch.object(self.dfactory, 'process_kill') as kill, \
+                mock.patch(self.waitpid_path) as waitpid:
+            # The killed daemon is not reaped yet
+            kill.return_value = (0, 0)
+            self.dfactory.evict_daemon('storleta', 'idle')
+            kill.assert_called_once_with('storleta')
+            waitpid.assert_called_once_with(1000, 0)
+        self.assertEqual({}, self.dfactory.storlet_name_to_last_use)
+
+        self.dfactory.storlet_name_to_last_use = {'storleta': 1}
+        with mock.patch.object(self.dfactory, 'process_kill') as kill:
+            kill.side_effect = SDaemonError()
+            self.dfactory.evict_daemon('storleta', 'idle')
+        self.assertEqual({'storleta': 1},
+                         self.dfactory.storlet_name_to_last_use)
+        self.assertEqual(1, len(self.logger.get_log_lines('exception')))
+
+    def test_evict_idle_daemons(self):
+        self.dfactory.daemon_idle_timeout = 60
+        self.dfactory.storlet_name_to_pid = \
+            {'storleta': 1000, 'storletb': 1001, 'storletc': 1002}
+        self.dfactory.storlet_name_to_last_use = \
+            {'storleta': 100, 'storletb': 50}
+        with mock.patch.object(self.dfactory, 'evict_daemon') as evict:
+            self.dfactory.evict_idle_daemons(120)
+            evict.assert_called_once_with('storletb', 'idle for 70 seconds')
+
+    def test_evict_daemons_over_budget(self):
+        self.dfactory.memory_budget = 250
+        self.dfactory.storlet_name_to_pid = \
+            {'storleta': 1000, 'storletb': 1001, 'storletc': 1002,
+             'storletd': 1003}
+        self.dfactory.storlet_name_to_last_use = \
+            {'storleta': 30, 'storletb': 10, 'storletc': 20, 'storletd': 990}
+        rss = {1000: 100, 1001: 100, 1002: 100, 1003: 100}
+
+        def fake_evict(storlet_name, reason):
+            self.dfactory.storlet_name_to_pid.pop(storlet_name)
+
+        with mock.patch.object(self.dfactory, 'get_process_rss',
+                               rss.get), \
+                mock.patch.object(self.dfactory, 'evict_daemon') as evict:
+            evict.side_effect = fake_evict
+            self.dfactory.evict_daemons_over_budget(1000)
+            # The least recently used ones are evicted
+            self.assertEqual(['storletb', 'storletc'],
+                             [c[0][0] for c in evict.call_args_list])
+
+        # Recently used daemons are not evicted
+        self.dfactory.memory_budget = 50
+        with mock.patch.object(self.dfactory, 'get_process_rss',
+                               rss.get), \
+                mock.patch.object(self.dfactory, 'evict_daemon') as evict:
+            evict.side_effect = fake_evict
+            self.dfactory.evict_daemons_over_budget(1000)
+            self.assertEqual(['storleta'],
+                             [c[0][0] for c in evict.call_args_list])
+
+        # The storlets served by the host daemon are not evicted
+        self.dfactory.storlet_name_to_pid = \
+            {'storleta': 1000, 'storletb': 1004}
+        self.dfactory.hosted_storlets = {'storletb': 'path/to/uds/b'}
+        self.dfactory.host_pid = 1004
+        rss[1004] = 1000
+        with mock.patch.object(self.dfactory, 'get_process_rss',
+                               rss.get), \
+                mock.patch.object(self.dfactory, 'evict_daemon') as evict:
+            evict.side_effect = fake_evict
+            self.dfactory.evict_daemons_over_budget(1000)
+            self.assertEqual(['storleta'],
+                             [c[0][0] for c in evict.call_args_list])
+
+    def _get_history_factory(self):
+        history_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, history_dir)
+        history_path = os.path.join(history_dir, 'history.json')
+        return StorletDaemonFactory(self.pipe_path, self.logger,
+                                    self.container_id,
+                                    history_path=history_path)
+
+    def test_record_use(self):
+        # The history is not kept without the path
+        self.dfactory.record_use('storleta', {'uds_path': 'path/to/uds/a'})
+        self.assertEqual({}, self.dfactory.history)
+        self.assertFalse(self.dfactory.history_updated)
+        self.assertIn('storleta', self.dfactory.storlet_name_to_last_use)
+
+        dfactory = self._get_history_factory()
+        dfactory.record_use('storleta', {'uds_path': 'path/to/uds/a'})
+        dfactory.record_use('storleta')
+        dfactory.record_use('storletb')
+        self.assertEqual(
+            {'storleta': {'count': 2,
+                          'params': {'uds_path': 'path/to/uds/a'}},
+             'storletb': {'count': 1}},
+            dfactory.history)
+        self.assertTrue(dfactory.history_updated)
+
+        # The start parameters are recorded when the daemon starts
+        with mock.patch.object(dfactory, 'get_process_status_by_name') \
+                as get_status:
+            get_status.return_value = True
+            self.assertFalse(dfactory.process_start_daemon(
+                'python', 'path/to/storlet/c', 'storletc', 1,
+                'path/to/uds/c', 'TRACE', 3))
+        self.assertEqual(
+            {'count': 1,
+             'params': {'daemon_language': 'python',
+                        'storlet_path': 'path/to/storlet/c',
+                        'pool_size': 1, 'uds_path': 'path/to/uds/c',
+                        'log_level': 'TRACE',
+                        'daemon_language_version': 3}},
+            dfactory.history['storletc'])
+
+    def test_save_and_load_history(self):
+        dfactory = self._get_history_factory()
+        self.assertEqual({}, dfactory.history)
+        with mock.patch(self.base_path + '.HISTORY_SIZE', 2):
+            for i, name in enumerate(['storleta', 'storletb', 'storletc']):
+                for _ in range(i + 1):
+                    dfactory.record_use(name, {'name': name})
+            # The entry without the start parameters is dropped
+            dfactory.record_use('storletd')
+            dfactory.record_use('storletd')
+            dfactory.record_use('storletd')
+            dfactory.record_use('storletd')
+            dfactory.save_history()
+        self.assertFalse(dfactory.history_updated)
+
+        expected = {'storletb': {'count': 2, 'params': {'name': 'storletb'}},
+                    'storletc': {'count': 3, 'params': {'name': 'storletc'}}}
+        self.assertEqual(expected, dfactory.history)
+        with open(dfactory.history_path) as f:
+            self.assertEqual(expected, json.load(f))
+
+        # The new factory process loads the history
+        new_factory = StorletDaemonFactory(
+            self.pipe_path, self.logger, self.container_id,
+            history_path=dfactory.history_path)
+        self.assertEqual(expected, new_factory.history)
+        self.assertEqual(10, new_factory.housekeeping_interval)
+
+        # Broken history is ignored
+        with open(dfactory.history_path, 'w') as f:
+            f.write('broken')
+        self.assertEqual({}, dfactory.load_history())
+
+        # Failed to save
+        dfactory.history_path = '/nonexistent/history.json'
+        dfactory.history_updated = True
+        dfactory.save_history()
+        self.assertTrue(dfactory.history_updated)
+        self.assertEqual(1, len(self.logger.get_log_lines('exception')))
+
+    def test_ready_file(self):
+        ready_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, ready_dir)
+        ready_path = os.path.join(ready_dir, 'factory_ready')
+        dfactory = StorletDaemonFactory(self.pipe_path, self.logger,
+                                        self.container_id,
+                                        ready_path=ready_path)
+        dfactory._ready()
+        self.assertTrue(os.path.exists(ready_path))
+        dfactory._terminate()
+        self.assertFalse(os.path.exists(ready_path))
+        # The file is already removed
+        dfactory._terminate()
+
+        # Failed to create the file
+        dfactory.ready_path = '/nonexistent/factory_ready'
+        dfactory._ready()
+        self.assertEqual(1, len(self.logger.get_log_lines('exception')))
+
+    def test_supervision(self):
+        dfactory = StorletDaemonFactory(self.pipe_path, self.logger,
+                                        self.container_id,
+                                        restart_crashed_daemons=True)
+        self.assertEqual(1, dfactory.housekeeping_interval)
+        dfactory._ready()
+        try:
+            read_fd = dfactory.sigchld_fds[0]
+            self.assertEqual({read_fd: dfactory.handle_sigchld},
+                             dfactory.fd_handlers)
+            os.kill(os.getpid(), signal.SIGCHLD)
+            # NOTE: The gateway modules monkey patch os module, but the
+            #       daemon factory runs without eventlet
+            with mock.patch(self.base_path + '.os.read',
+                            patcher.original('os').read), \
+                    mock.patch.object(dfactory,
+                                      'check_daemon_exits') as check:
+                dfactory.fd_handlers[read_fd]()
+            self.assertEqual(1, check.call_count)
+        finally:
+            dfactory._terminate()
+        self.assertIsNone(dfactory.sigchld_fds)
+        self.assertEqual({}, dfactory.fd_handlers)
+        self.assertEqual(signal.SIG_DFL, signal.getsignal(signal.SIGCHLD))
+
+    def test_check_daemon_exits(self):
+        self.dfactory.storlet_name_to_pid = {
+            'running': 1000, 'exited': 1001, 'crashed': 1002,
+            'reaped': 1003, 'hosted': 1004, 'reaped_crashed': 1005,
+            'lost': 1006}
+        self.dfactory.hosted_storlets = {'hosted': 'path/to/uds/hosted'}
+        # Reaped while their statuses were checked
+        self.dfactory.reaped_statuses = {1003: 0, 1005: signal.SIGSEGV}
+        self.dfactory.starting_daemons = {'crashed': 90}
+
+        def fake_waitpid(pid, flags):
+            if pid == 1000:
+                return 0, 0
+            elif pid == 1001:
+                return pid, 0
+            elif pid == 1002:
+                # Killed by SIGSEGV
+                return pid, signal.SIGSEGV
+            elif pid in (1003, 1005, 1006):
+                raise OSError(errno.ECHILD, os.strerror(errno.ECHILD))
+            self.fail('Unexpected pid %d' % pid)
+
+        with mock.patch(self.waitpid_path) as waitpid:
+            waitpid.side_effect = fake_waitpid
+            self.dfactory.check_daemon_exits(100)
+        self.assertEqual({'running': 1000, 'hosted': 1004},
+                         self.dfactory.storlet_name_to_pid)
+        # The daemons which exited normally are not restarted, and the one
+        # whose status is unknown is handled as crashed
+        self.assertEqual({'crashed': 100, 'reaped_crashed': 100,
+                          'lost': 100},
+                         self.dfactory.pending_restarts)
+        self.assertEqual({}, self.dfactory.reaped_statuses)
+        self.assertEqual({}, self.dfactory.starting_daemons)
+
+    def test_handle_daemon_crash(self):
+        # Restarted immediately for the first crash, and then with
+        # exponential backoff
+        for now, delay in ((100, 0), (110, 1), (120, 2), (130, 4)):
+            self.dfactory.handle_daemon_crash('storleta', now)
+            self.assertEqual({'storleta': now + delay},
+                             self.dfactory.pending_restarts)
+        self.assertEqual(4, len(self.logger.get_log_lines('warn')))
+
+        # Crash loop
+        self.dfactory.handle_daemon_crash('storleta', 140)
+        self.assertEqual({}, self.dfactory.pending_restarts)
+        self.assertEqual(1, len(self.logger.get_log_lines('error')))
+
+        # The old crashes are forgotten
+        self.dfactory.handle_daemon_crash('storleta', 500)
+        self.assertEqual({'storleta': 500}, self.dfactory.pending_restarts)
+
+    def test_restart_daemons(self):
+        params = {'daemon_language': 'python',
+                  'storlet_path': 'path/to/storlet/a',
+                  'pool_size': 1,
+                  'uds_path': 'path/to/uds/a',
+                  'log_level': 'TRACE',
+                  'daemon_language_version': None}
+        self.dfactory.storlet_name_to_params = {'storleta': params}
+        self.dfactory.pending_restarts = {'storleta': 100, 'storletb': 100,
+                                          'storletc': 200}
+        with mock.patch.object(self.dfactory,
+                               'process_start_daemon') as start:
+            start.return_value = True
+            self.dfactory.restart_daemons(100)
+        # The unknown storlet is just dropped
+        start.assert_called_once_with(
+            'python', 'path/to/storlet/a', 'storleta', 1, 'path/to/uds/a',
+            'TRACE', None, record=False, wait=False)
+        self.assertEqual({'storletc': 200}, self.dfactory.pending_restarts)
+
+        # Failed to restart
+        self.dfactory.pending_restarts = {'storleta': 100}
+        with mock.patch.object(self.dfactory,
+                               'process_start_daemon') as start:
+            start.side_effect = SDaemonError()
+            self.dfactory.restart_daemons(100)
+        self.assertEqual(1, len(self.logger.get_log_lines('exception')))
+        self.assertEqual({'storleta': 100}, self.dfactory.pending_restarts)
+        self.assertEqual([100], self.dfactory.storlet_name_to_crashes[
+            'storleta'])
+
+        # The restart is not recorded as a use
+        self.dfactory.history_path = 'path/to/history'
+        with mock.patch.object(self.dfactory,
+                               'get_process_status_by_name') as status:
+            status.return_value = True
+            self.assertFalse(self.dfactory.process_start_daemon(
+                'python', 'path/to/storlet/a', 'storleta', 1,
+                'path/to/uds/a', 'TRACE', record=False))
+        self.assertEqual({}, self.dfactory.history)
+        self.assertEqual(params,
+                         self.dfactory.storlet_name_to_params['storleta'])
+
+    def test_check_starting_daemons(self):
+        self.dfactory.storlet_name_to_pid = {
+            'ready': 1000, 'starting': 1001, 'stuck': 1002}
+        self.dfactory.storlet_name_to_pipe_name = {
+            'ready': 'path/to/uds/ready', 'starting': 'path/to/uds/starting',
+            'stuck': 'path/to/uds/stuck', 'stopped': 'path/to/uds/stopped'}
+        self.dfactory.starting_daemons = {
+            'ready': 100, 'starting': 100, 'stuck': 90, 'stopped': 100}
+
+        with mock.patch(self.base_path + '.SBusClient') as client, \
+                mock.patch(self.kill_path) as kill, \
+                mock.patch(self.waitpid_path) as waitpid:
+            client.side_effect = lambda path: mock.MagicMock(**{
+                'ping.return_value': SBusResponse(
+                    path == 'path/to/uds/ready', 'OK')})
+            waitpid.return_value = 1002, signal.SIGKILL
+            self.dfactory.check_starting_daemons(100)
+        # The daemon which is not ready in time is handled as crashed
+        kill.assert_called_once_with(1002, signal.SIGKILL)
+        self.assertEqual({'ready': 1000, 'starting': 1001},
+                         self.dfactory.storlet_name_to_pid)
+        self.assertEqual({'starting': 100}, self.dfactory.starting_daemons)
+        self.assertEqual({'stuck': 100}, self.dfactory.pending_restarts)
+        self.assertEqual(['Restarted the storlet daemon ready'],
+                         self.logger.get_log_lines('info'))
+
+        # Not listening yet
+        with mock.patch(self.base_path + '.SBusClient') as client:
+            client.return_value.ping.side_effect = SBusClientSendError()
+            self.dfactory.check_starting_daemons(105)
+        self.assertEqual({'starting': 100}, self.dfactory.starting_daemons)
+
+    def test_housekeep(self):
+        self.assertIsNone(self.dfactory.housekeeping_interval)
+        dfactory = StorletDaemonFactory(
+            self.pipe_path, self.logger, self.container_id,
+            daemon_idle_timeout=60, memory_budget=100)
+        self.assertEqual(10, dfactory.housekeeping_interval)
+
+        dfactory.last_housekeeping = 100
+        with mock.patch(self.base_path + '.time.time') as fake_time, \
+                mock.patch.object(dfactory, 'evict_idle_daemons') as idle, \
+                mock.patch.object(dfactory,
+                                  'evict_daemons_over_budget') as budget:
+            # Not yet
+            fake_time.return_value = 105
+            dfactory._housekeep()
+            idle.assert_not_called()
+            budget.assert_not_called()
+
+            fake_time.return_value = 110
+            dfactory._housekeep()
+            idle.assert_called_once_with(110)
+            budget.assert_called_once_with(110)
+            self.assertEqual(110, dfactory.last_housekeeping)
+
+        dfactory.last_housekeeping = 100
+        dfactory.history_path = 'path/to/history'
+        dfactory.history_updated = True
+        with mock.patch(self.base_path + '.time.time') as fake_time, \
+                mock.patch.object(dfactory, 'evict_idle_daemons'), \
+                mock.patch.object(dfactory, 'evict_daemons_over_budget'), \
+                mock.patch.object(dfactory, 'save_history') as save:
+            fake_time.return_value = 110
+            dfactory._housekeep()
+            save.assert_called_once_with()
+
     def test_start_daemon(self):
         prms = {'daemon_language': 'java',
                 'storlet_path': 'path/to/storlet/a',
@@ -509,18 +1349,12 @@ class TestStorletDaemonFactory(unittest.TestCase):
         self.dfactory.storlet_name_to_pid = {}
         self.dfactory.storlet_name_to_pipe_name = {}
 
-        class FakePopenObject(object):
-            def __init__(self, pid):
-                self.pid = pid
-                self.stderr = mock.MagicMock()
-
         with mock.patch(self.base_path + '.subprocess.Popen') as popen, \
                 mock.patch(self.base_path + '.time.sleep'), \
                 mock.patch(self.waitpid_path) as waitpid, \
                 self._mock_sbus_client('ping') as ping, \
                 self._mock_sbus_client('start_daemon') as start_daemon:
-            popen.side_effect = [FakePopenObject(1000),
-                                 FakePopenObject(1001)]
+            popen.side_effect = [FakePopenObject(1000)]
             waitpid.return_value = 0, 0
             ping.return_value = SBusResponse(True, 'OK')
             start_daemon.return_value = SBusResponse(True, 'OK')
@@ -578,14 +1412,35 @@ class TestStorletDaemonFactory(unittest.TestCase):
         self.dfactory.storlet_name_to_pid = \
             {'storleta': 1000, 'storletb': 1001}
 
-        with mock.patch(self.waitpid_path) as waitpid:
+        with mock.patch(self.waitpid_path) as waitpid, \
+                mock.patch(self.base_path + '.time.time') as fake_time:
             waitpid.return_value = 0, 0
+            fake_time.return_value = 100
             resp = self.dfactory.daemon_status(
                 DummyDatagram({'storlet_name': 'storleta'}))
             self.assertTrue(resp.status)
             self.assertEqual('The storlet daemon storleta seems to be OK',
                              resp.message)
             self.assertTrue(resp.iterable)
+            # The daemon is going to be used
+            self.assertEqual({'storleta': 100},
+                             self.dfactory.storlet_name_to_last_use)
+
+        # Being restarted, and not responsive
+        self.dfactory.storlet_name_to_pipe_name = \
+            {'storletb': 'path/to/uds/b'}
+        self.dfactory.starting_daemons = {'storletb': 100}
+        with mock.patch(self.waitpid_path) as waitpid, \
+                mock.patch(self.base_path + '.time.sleep'), \
+                self._mock_sbus_client('ping') as ping:
+            waitpid.return_value = 0, 0
+            ping.return_value = SBusResponse(False, 'NG')
+            resp = self.dfactory.daemon_status(
+                DummyDatagram({'storlet_name': 'storletb'}))
+            self.assertFalse(resp.status)
+            self.assertEqual('No response from the storlet daemon storletb',
+                             resp.message)
+        self.assertEqual({}, self.dfactory.starting_daemons)
 
         with mock.patch(self.waitpid_path) as waitpid:
             waitpid.return_value = 1000, 0
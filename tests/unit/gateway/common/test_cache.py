@@ -0,0 +1,118 @@
+# Copyright (c) 2010-2016 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from storlets.gateway.common.cache import StorletResultCache, \
+    DEFAULT_RESULT_CACHE_SIZE
+from tests.unit import FakeLogger
+
+
+class TestStorletResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = StorletResultCache(self.cache_dir, 30, FakeLogger())
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _store(self, key, metadata, chunks):
+        return list(self.cache.write_through(key, metadata, iter(chunks)))
+
+    def _entries(self):
+        return sorted(os.listdir(self.cache_dir))
+
+    def test_from_conf(self):
+        self.assertIsNone(StorletResultCache.from_conf({}, FakeLogger()))
+
+        cache = StorletResultCache.from_conf(
+            {'result_cache_dir': self.cache_dir}, FakeLogger())
+        self.assertEqual(self.cache_dir, cache.cache_dir)
+        self.assertEqual(DEFAULT_RESULT_CACHE_SIZE, cache.max_bytes)
+
+        cache = StorletResultCache.from_conf(
+            {'result_cache_dir': self.cache_dir, 'result_cache_size': '100'},
+            FakeLogger())
+        self.assertEqual(100, cache.max_bytes)
+
+    def test_make_key(self):
+        key = StorletResultCache.make_key('a', 'b', [('c', 'd')])
+        self.assertEqual(key, StorletResultCache.make_key(
+            'a', 'b', [('c', 'd')]))
+        self.assertNotEqual(key, StorletResultCache.make_key(
+            'a', 'b', [('c', 'e')]))
+
+    def test_write_through_and_get(self):
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual([b'abc', b'def'],
+                         self._store('key', {'foo': 'bar'},
+                                     [b'abc', b'def']))
+        self.assertEqual(['key'], self._entries())
+
+        metadata, data_iter = self.cache.get('key')
+        self.assertEqual({'foo': 'bar'}, metadata)
+        self.assertEqual(b'abcdef', b''.join(data_iter))
+
+    def test_write_through_empty_output(self):
+        self.assertEqual([], self._store('key', {}, []))
+        metadata, data_iter = self.cache.get('key')
+        self.assertEqual({}, metadata)
+        self.assertEqual(b'', b''.join(data_iter))
+
+    def test_write_through_closed_early(self):
+        data_iter = self.cache.write_through('key', {}, iter([b'abc', b'd']))
+        self.assertEqual(b'abc', next(data_iter))
+        data_iter.close()
+        self.assertEqual([], self._entries())
+        self.assertIsNone(self.cache.get('key'))
+
+    def test_write_through_too_large_output(self):
+        chunks = [b'a' * 20, b'b' * 20]
+        self.assertEqual(chunks, self._store('key', {}, chunks))
+        self.assertEqual([], self._entries())
+
+    def test_write_through_error(self):
+        def broken_iter():
+            yield b'abc'
+            raise IOError()
+
+        data_iter = self.cache.write_through('key', {}, broken_iter())
+        self.assertEqual(b'abc', next(data_iter))
+        with self.assertRaises(IOError):
+            next(data_iter)
+        self.assertEqual([], self._entries())
+
+    def test_evict_least_recently_used(self):
+        # Each entry has 3 bytes of metadata line and 4 bytes of data
+        self.cache.max_bytes = 14
+        self._store('key1', {}, [b'aaaa'])
+        os.utime(os.path.join(self.cache_dir, 'key1'), (1, 1))
+        self._store('key2', {}, [b'bbbb'])
+        os.utime(os.path.join(self.cache_dir, 'key2'), (2, 2))
+        self.assertEqual(['key1', 'key2'], self._entries())
+
+        # Using key1 makes key2 the least recently used one
+        _, data_iter = self.cache.get('key1')
+        data_iter.close()
+        self._store('key3', {}, [b'cccc'])
+        self.assertEqual(['key1', 'key3'], self._entries())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,7 +18,10 @@ import mock
 import os
 import tempfile
 import unittest
-from storlets.gateway.common.stob import FileDescriptorIterator
+from storlets.gateway.common.exceptions import StorletRuntimeException, \
+    StorletTimeout
+from storlets.gateway.common.stob import FileDescriptorIterator, \
+    StorletResponse
 
 
 class TestFileDescriptorIterator(unittest.TestCase):
@@ -114,6 +117,134 @@ class TestFileDescriptorIterator(unittest.TestCase):
                 [b'aaaa\n', b'bb'],
                 self.iter_like.readlines(7))
 
+    def _create_cancellable_iter(self, cancel):
+        # Use a duplicated fd, because self.iter_like closes self.fd
+        return FileDescriptorIterator(os.dup(self.fd), self.timeout, cancel)
+
+    def test_close_cancels_task(self):
+        cancel = mock.MagicMock()
+        iter_like = self._create_cancellable_iter(cancel)
+        with self._mock_select():
+            self.assertEqual(b'aaaa\nb', iter_like.next(6))
+        iter_like.close()
+        self.assertTrue(iter_like.closed)
+        cancel.assert_called_once_with()
+
+        # close again does nothing
+        iter_like.close()
+        cancel.assert_called_once_with()
+
+    def test_close_after_eof(self):
+        cancel = mock.MagicMock()
+        iter_like = self._create_cancellable_iter(cancel)
+        with self._mock_select():
+            self.assertEqual(self.content, b''.join(iter_like))
+        iter_like.close()
+        self.assertTrue(iter_like.closed)
+        cancel.assert_not_called()
+
+    def test_next_with_limit(self):
+        cancel = mock.MagicMock()
+        iter_like = FileDescriptorIterator(
+            os.dup(self.fd), self.timeout, cancel, limit=8)
+        with self._mock_select():
+            self.assertEqual(b'aaaa\nb', iter_like.next(6))
+            cancel.assert_not_called()
+            self.assertEqual(b'bb', iter_like.next(6))
+            # the task is canceled as soon as the limit is reached
+            cancel.assert_called_once_with()
+            with self.assertRaises(StopIteration):
+                iter_like.next(6)
+        iter_like.close()
+        cancel.assert_called_once_with()
+
+        # buffered data is returned up to the limit
+        self._reset_fd()
+        iter_like = FileDescriptorIterator(
+            os.dup(self.fd), self.timeout, None, limit=7)
+        with self._mock_select():
+            self.assertEqual([b'aaaa\n', b'bb'], iter_like.readlines())
+
+        # zero limit
+        iter_like = FileDescriptorIterator(
+            os.dup(self.fd), self.timeout, None, limit=0)
+        with self._mock_select():
+            self.assertEqual(b'', b''.join(iter_like))
+
+    def test_readline_with_limit(self):
+        # The limit cuts the second line in the middle
+        iter_like = FileDescriptorIterator(
+            os.dup(self.fd), self.timeout, None, limit=7)
+        with self._mock_select():
+            self.assertEqual(b'aaaa\n', iter_like.readline())
+            self.assertEqual(b'bb', iter_like.readline())
+            with self.assertRaises(StopIteration):
+                iter_like.readline()
+
+        self._reset_fd()
+        iter_like = FileDescriptorIterator(
+            os.dup(self.fd), self.timeout, None, limit=7)
+        with self._mock_select():
+            self.assertEqual(b'aaa', iter_like.readline(3))
+            self.assertEqual(b'a\n', iter_like.readline(3))
+            self.assertEqual(b'bb', iter_like.readline(3))
+            with self.assertRaises(StopIteration):
+                iter_like.readline(3)
+
+    def test_del_does_not_cancel_task(self):
+        cancel = mock.MagicMock()
+        iter_like = self._create_cancellable_iter(cancel)
+        fd = iter_like.fd
+        del iter_like
+        cancel.assert_not_called()
+        with self.assertRaises(OSError):
+            os.fstat(fd)
+
+    def test_close_cancel_failed(self):
+        cancel = mock.MagicMock(side_effect=StorletRuntimeException())
+        iter_like = self._create_cancellable_iter(cancel)
+        iter_like.close()
+        self.assertTrue(iter_like.closed)
+        cancel.assert_called_once_with()
+
+    def test_read_timeout_cancels_task_once(self):
+        cancel = mock.MagicMock()
+        iter_like = self._create_cancellable_iter(cancel)
+        with mock.patch('storlets.gateway.common.stob.os.read',
+                        side_effect=StorletTimeout()):
+            with self.assertRaises(StorletTimeout):
+                iter_like.read_with_timeout(6)
+        self.assertTrue(iter_like.closed)
+        cancel.assert_called_once_with()
+
+
+class TestStorletResponse(unittest.TestCase):
+
+    def test_read_trailing_metadata(self):
+        sresp = StorletResponse({'key1': 'value1'}, iter([]))
+        self.assertFalse(sresp.has_trailing_metadata)
+        self.assertEqual({}, sresp.read_trailing_metadata())
+
+        reader = mock.MagicMock(return_value={'key2': 'value2'})
+        sresp = StorletResponse({'key1': 'value1'}, iter([]),
+                                trailing_metadata_reader=reader)
+        self.assertTrue(sresp.has_trailing_metadata)
+        self.assertEqual({'key2': 'value2'}, sresp.read_trailing_metadata())
+        reader.assert_called_once_with(False)
+        self.assertEqual({'key1': 'value1', 'key2': 'value2'},
+                         sresp.user_metadata)
+        # the reader is called only once
+        self.assertFalse(sresp.has_trailing_metadata)
+        self.assertEqual({}, sresp.read_trailing_metadata())
+        self.assertEqual(1, reader.call_count)
+
+    def test_read_trailing_metadata_discard(self):
+        reader = mock.MagicMock(return_value={})
+        sresp = StorletResponse({}, iter([]),
+                                trailing_metadata_reader=reader)
+        self.assertEqual({}, sresp.read_trailing_metadata(discard=True))
+        reader.assert_called_once_with(True)
+
 
 if __name__ == '__main__':
     unittest.main()
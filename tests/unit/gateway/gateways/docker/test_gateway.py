@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import importlib.util
 import os
 import os.path
 from shutil import rmtree
@@ -22,11 +23,14 @@ import json
 from six import BytesIO, StringIO
 
 import mock
+import sys
 import unittest
 
 from swift.common.swob import Request, Response
 from swift.common.utils import FileLikeIter
 
+from storlets.gateway.common.exceptions import StorletRuntimeException
+from storlets.gateway.common.stob import StorletResponse
 from storlets.sbus.client import SBusResponse
 
 from tests.unit import FakeLogger
@@ -171,6 +175,19 @@ class TestDockerStorletRequest(unittest.TestCase):
         self.assertEqual(0, dsreq.start)
         self.assertEqual(0, dsreq.end)
 
+    def test_init_with_output_limit(self):
+        options = {'storlet_main': 'org.openstack.storlet.Storlet',
+                   'storlet_language': 'java',
+                   'file_manager': FakeFileManager('storlet', 'dep')}
+        dsreq = DockerStorletRequest('Storlet-1.0.jar', {}, {},
+                                     None, 0, options=options)
+        self.assertIsNone(dsreq.output_limit)
+
+        options['output_limit'] = 10
+        dsreq = DockerStorletRequest('Storlet-1.0.jar', {}, {},
+                                     None, 0, options=options)
+        self.assertEqual(10, dsreq.output_limit)
+
     def test_has_range(self):
         storlet_id = 'Storlet-1.0.jar'
         params = {}
@@ -460,18 +477,31 @@ use = egg:swift#catch_errors
 
         # TODO(kota_): need more efficient way for emuration of return value
         # from SDaemon
-        value_generator = iter([
-            # Forth is return value for invoking as task_id
-            'This is task id',
-            # Fifth is for getting meta
-            json.dumps({'metadata': 'return'}),
-            # At last return body and EOF
-            'something', '',
-        ])
+        # NOTE: task id is read asynchronously so return values are managed
+        # per read fd, which are created in the following order
+        # (input data), data, task id, metadata
+        read_fds = []
+        return_values = [
+            # return body and EOF
+            ['something', ''],
+            # return value for invoking as task_id
+            ['This is task id'],
+            # for getting meta
+            [json.dumps({'metadata': 'return'})],
+        ]
+        if not st_req.has_fd:
+            return_values.insert(0, [])
+        value_generators = [iter(values) for values in return_values]
+        real_pipe = os.pipe
+
+        def mock_pipe():
+            read_fd, write_fd = real_pipe()
+            read_fds.append(read_fd)
+            return read_fd, write_fd
 
         def mock_read(fd, size):
             try:
-                value = next(value_generator)
+                value = next(value_generators[read_fds.index(fd)])
             except StopIteration:
                 raise Exception('called more then expected')
             # NOTE(takashi): Make sure that we return bytes in PY3
@@ -499,6 +529,8 @@ use = egg:swift#catch_errors
         @mock.patch('storlets.gateway.gateways.docker.runtime.SBus', MockSBus)
         @mock.patch('storlets.gateway.gateways.docker.runtime.os.read',
                     mock_read)
+        @mock.patch('storlets.gateway.gateways.docker.runtime.os.pipe',
+                    mock_pipe)
         @mock.patch('storlets.gateway.gateways.docker.runtime.os.close',
                     mock_close)
         @mock.patch('storlets.gateway.gateways.docker.runtime.select.select',
@@ -536,6 +568,101 @@ use = egg:swift#catch_errors
         self.assertEqual('body', called_fd_and_bodies[0][1])
         return called_fd_and_bodies
 
+    def test_add_system_params(self):
+        options = {'storlet_main': 'org.openstack.storlet.Storlet',
+                   'storlet_language': 'java',
+                   'file_manager': FakeFileManager('storlet', 'dep')}
+        st_req = DockerStorletRequest(self.sobj, {}, {}, None, 0,
+                                      options=options)
+        self.gateway._add_system_params(st_req)
+        self.assertEqual(
+            {'storlet_execution_path':
+             '/home/swift/org.openstack.storlet.Storlet'},
+            st_req.params)
+
+        options['output_limit'] = 10
+        st_req = DockerStorletRequest(self.sobj, {}, {}, None, 0,
+                                      options=options)
+        self.gateway._add_system_params(st_req)
+        self.assertEqual('10', st_req.params['storlet_output_limit'])
+        self.assertNotIn('storlet_output_range_start', st_req.params)
+
+        options['output_range'] = (5, 14)
+        st_req = DockerStorletRequest(self.sobj, {}, {}, None, 0,
+                                      options=options)
+        self.gateway._add_system_params(st_req)
+        self.assertEqual('5', st_req.params['storlet_output_range_start'])
+        self.assertEqual('14', st_req.params['storlet_output_range_end'])
+
+    def _get_python_request(self, language_version=None):
+        file_manager = FakeFileManager('storlet', 'dep')
+        file_manager.get_dependency = \
+            lambda name: ([b'X = 1\n'], None)
+        options = {'storlet_main': 'storlet.Storlet',
+                   'storlet_language': 'python',
+                   'storlet_language_version': language_version,
+                   'file_manager': file_manager}
+        return DockerStorletRequest('storlet.py', {}, {}, None, 0,
+                                    options=options)
+
+    def test_precompile_python_module(self):
+        sreq = self._get_python_request()
+        current = float('%d.%d' % sys.version_info[:2])
+        path = os.path.join(self.tempdir, 'dep.py')
+        cache_path = importlib.util.cache_from_source(path)
+        with open(path, 'w') as f:
+            f.write('X = 1\n')
+
+        with mock.patch('storlets.gateway.gateways.docker.gateway.'
+                        'DEFAULT_PY3', current):
+            self.gateway.precompile_python_module(sreq, path)
+            self.assertTrue(os.path.isfile(cache_path))
+
+            # Not compiled again if the bytecode cache exists
+            with mock.patch('storlets.gateway.gateways.docker.gateway.'
+                            'py_compile.compile') as compile_:
+                self.gateway.precompile_python_module(sreq, path)
+                compile_.assert_not_called()
+                self.gateway.precompile_python_module(sreq, path,
+                                                      force=True)
+                self.assertEqual(1, compile_.call_count)
+
+            # Failed to compile
+            with open(path, 'w') as f:
+                f.write('invalid python')
+            self.gateway.precompile_python_module(sreq, path, force=True)
+            self.assertEqual(1, len(self.logger.get_log_lines('warn')))
+
+        # The storlet daemon runs another version of python
+        os.unlink(cache_path)
+        with mock.patch('storlets.gateway.gateways.docker.gateway.'
+                        'DEFAULT_PY3', current + 1):
+            self.gateway.precompile_python_module(sreq, path)
+        self.assertFalse(os.path.exists(cache_path))
+
+    def test_bring_from_cache_precompile(self):
+        sreq = self._get_python_request()
+        with mock.patch.object(self.gateway,
+                               'precompile_python_module') as precompile:
+            self.assertTrue(self.gateway.bring_from_cache(
+                'dep.py', sreq, False))
+            self.assertFalse(self.gateway.bring_from_cache(
+                'dep.py', sreq, False))
+        path = os.path.join(
+            self.gateway.paths.get_host_storlet_dir('storlet.Storlet'),
+            'dep.py')
+        self.assertEqual([mock.call(sreq, path, True),
+                          mock.call(sreq, path, False)],
+                         precompile.call_args_list)
+
+        # Only python modules are compiled
+        with mock.patch.object(self.gateway,
+                               'precompile_python_module') as precompile:
+            self.gateway.bring_from_cache('dep.txt', sreq, False)
+            self.gateway.precompile_python_storlets = False
+            self.gateway.bring_from_cache('dep.py', sreq, False)
+        precompile.assert_not_called()
+
     def test_docker_gateway_communicate(self):
         self._test_docker_gateway_communicate()
 
@@ -578,6 +705,121 @@ use = egg:swift#catch_errors
             # ensure all app_iters are drawn
             self.assertRaises(StopIteration, next, app_iter)
 
+    def _test_pipeline_invocation_flow(self, fail_stage=None):
+        options = {'storlet_main': 'org.openstack.storlet.Storlet',
+                   'storlet_language': 'java',
+                   'storlet_trailing_metadata': 'true',
+                   'scope': 'AUTH_account',
+                   'output_limit': 10,
+                   'file_manager': FakeFileManager('storlet', 'dep'),
+                   'pipeline': [
+                       {'storlet': 'second.py',
+                        'options': {'storlet_main': 'second.Second',
+                                    'storlet_language': 'python'},
+                        'params': {'foo': 'bar'}},
+                       {'storlet': 'third.py',
+                        'options': {'storlet_main': 'third.Third',
+                                    'storlet_language': 'python'},
+                        'params': {}}]}
+        st_req = DockerStorletRequest(self.sobj, {}, {'input': 'meta'},
+                                      iter([b'body']), options=options)
+
+        protocols = []
+        pipes = []
+
+        class FakeProtocol(object):
+            def __init__(self, srequest, storlet_pipe_path, slog_path,
+                         timeout, logger, extra_sources=None):
+                self.srequest = srequest
+                self.storlet_pipe_path = storlet_pipe_path
+                self.extra_sources = extra_sources
+                self.storlet_logger = mock.MagicMock(log_path=slog_path)
+                self._cancel = mock.MagicMock()
+                protocols.append(self)
+
+            def communicate(self):
+                if len(protocols) == fail_stage:
+                    raise StorletRuntimeException('failed')
+                read_fd, write_fd = os.pipe()
+                pipes.append((read_fd, write_fd))
+                return StorletResponse(
+                    {'stage': self.srequest.storlet_id}, data_fd=read_fd,
+                    cancel=self._cancel)
+
+        def fake_prepare(sreq):
+            return ('/log/%s' % sreq.storlet_main,
+                    '/pipe/%s' % sreq.storlet_main)
+
+        closed = []
+        real_close = os.close
+
+        def fake_close(fd):
+            closed.append(fd)
+            real_close(fd)
+
+        with mock.patch('storlets.gateway.gateways.docker.gateway.'
+                        'StorletInvocationProtocol', FakeProtocol), \
+                mock.patch.object(self.gateway, '_prepare_invocation',
+                                  side_effect=fake_prepare), \
+                mock.patch('storlets.gateway.gateways.docker.gateway.os.close',
+                           fake_close):
+            if fail_stage:
+                with self.assertRaises(StorletRuntimeException):
+                    self.gateway.invocation_flow(st_req)
+            else:
+                sresp = self.gateway.invocation_flow(st_req)
+
+        for read_fd, write_fd in pipes:
+            os.close(write_fd)
+        return (st_req, protocols, pipes, closed,
+                None if fail_stage else sresp)
+
+    def test_pipeline_invocation_flow(self):
+        st_req, protocols, pipes, closed, sresp = \
+            self._test_pipeline_invocation_flow()
+        self.assertEqual(3, len(protocols))
+        first, second, third = [p.srequest for p in protocols]
+        self.assertIs(st_req, first)
+        self.assertEqual(['second.py', 'third.py'],
+                         [second.storlet_id, third.storlet_id])
+        self.assertEqual(['/pipe/org.openstack.storlet.Storlet',
+                          '/pipe/second.Second', '/pipe/third.Third'],
+                         [p.storlet_pipe_path for p in protocols])
+
+        # Each stage reads the output of the previous stage directly, and
+        # the middleware side copy of the intermediate fds is closed
+        self.assertEqual(pipes[0][0], second.data_fd)
+        self.assertEqual(pipes[1][0], third.data_fd)
+        self.assertEqual({'stage': self.sobj}, second.user_metadata)
+        self.assertIn(pipes[0][0], closed)
+        self.assertIn(pipes[1][0], closed)
+        self.assertEqual({'foo': 'bar'}, second.params)
+
+        # The output limit is applied to the last output, and only the last
+        # stage can send metadata after the output
+        self.assertEqual([None, None, 10],
+                         [first.output_limit, second.output_limit,
+                          third.output_limit])
+        self.assertEqual([False, False, False],
+                         [first.trailing_metadata, second.trailing_metadata,
+                          third.trailing_metadata])
+
+        self.assertEqual(pipes[2][0], sresp.data_fd)
+        self.assertEqual({'stage': 'third.py'}, sresp.user_metadata)
+        sresp.cancel()
+        for sprotocol in protocols:
+            sprotocol._cancel.assert_called_once_with()
+        os.close(sresp.data_fd)
+
+    def test_pipeline_invocation_flow_failure(self):
+        st_req, protocols, pipes, closed, _ = \
+            self._test_pipeline_invocation_flow(fail_stage=2)
+        self.assertEqual(2, len(protocols))
+        self.assertEqual(1, len(pipes))
+        # The stage already started is canceled, and its output is closed
+        protocols[0]._cancel.assert_called_once_with()
+        self.assertIn(pipes[0][0], closed)
+
 
 if __name__ == '__main__':
     unittest.main()
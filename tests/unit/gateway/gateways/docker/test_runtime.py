@@ -13,15 +13,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import mock
 import os
+import shutil
 import unittest
 import tempfile
+import threading
 import errno
 from contextlib import contextmanager
 from six import StringIO
 from stat import ST_MODE
 
+from storlets.sbus import file_description as sbus_fd
 from storlets.sbus.client import SBusResponse
 from storlets.sbus.client.exceptions import SBusClientIOError, \
     SBusClientMalformedResponse, SBusClientSendError
@@ -29,7 +33,7 @@ from storlets.gateway.common.exceptions import StorletRuntimeException, \
     StorletTimeout
 from storlets.gateway.gateways.docker.gateway import DockerStorletRequest
 from storlets.gateway.gateways.docker.runtime import RunTimeSandbox, \
-    RunTimePaths, StorletInvocationProtocol
+    RunTimePaths, SandboxPool, StorletInvocationProtocol
 from tests.unit import FakeLogger, with_tempdir
 from tests.unit.gateway.gateways import FakeFileManager
 
@@ -293,15 +297,56 @@ class TestRunTimeSandbox(unittest.TestCase):
 
         with mock.patch('storlets.gateway.gateways.docker.runtime.'
                         'SBusClient.ping') as ping, \
+            mock.patch('storlets.gateway.gateways.docker.runtime.'
+                       'time.time') as fake_time, \
             mock.patch('storlets.gateway.gateways.docker.runtime.'
                        'time.sleep') as sleep:
+            fake_time.side_effect = [100, 100.3, 100.6]
             ping.side_effect = [SBusResponse(False, 'Error'),
                                 SBusResponse(True, 'OK')]
             self.sbox.wait()
-            self.assertEqual(sleep.call_count, 1)
+            # The sandbox is pinged every sandbox_ping_interval without
+            # the ready file
+            self.assertEqual(2, ping.call_count)
+            self.assertEqual(2, sleep.call_count)
 
         # TODO(takashi): should test timeout case
 
+    def test_wait_ready_file(self):
+        pipe_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, pipe_dir)
+        self.sbox.paths.host_pipe_root_dir = pipe_dir
+        os.mkdir(self.sbox.paths.host_pipe_dir)
+
+        def fake_sleep(interval):
+            # The daemon factory gets ready
+            open(self.sbox.paths.host_factory_ready_file, 'w').close()
+
+        with mock.patch('storlets.gateway.gateways.docker.runtime.'
+                        'SBusClient.ping') as ping, \
+            mock.patch('storlets.gateway.gateways.docker.runtime.'
+                       'time.time') as fake_time, \
+            mock.patch('storlets.gateway.gateways.docker.runtime.'
+                       'time.sleep') as sleep:
+            fake_time.side_effect = [100, 100.01]
+            sleep.side_effect = fake_sleep
+            ping.side_effect = [SBusClientSendError(),
+                                SBusResponse(True, 'OK')]
+            self.sbox.wait()
+            # The sandbox is pinged as soon as the ready file appears
+            self.assertEqual(2, ping.call_count)
+            sleep.assert_called_once_with(0.01)
+
+        # The ready file of the previous daemon factory is removed on
+        # restart
+        with mock.patch('storlets.gateway.gateways.docker.runtime.'
+                        'subprocess.Popen') as popen:
+            popen.return_value.communicate.return_value = ('', '')
+            popen.return_value.returncode = 0
+            self.sbox._restart('image')
+        self.assertFalse(os.path.exists(
+            self.sbox.paths.host_factory_ready_file))
+
     def test_restart(self):
 
         class FakeProc(object):
@@ -384,6 +429,80 @@ class TestRunTimeSandbox(unittest.TestCase):
                 self.sbox.restart()
             self.sbox.wait = _wait
 
+    def test_restart_prewarm(self):
+        self.sbox.prewarm_storlet_daemons = 2
+        with mock.patch.object(self.sbox, '_restart'), \
+                mock.patch.object(self.sbox, 'wait'), \
+                mock.patch('storlets.gateway.gateways.docker.runtime.'
+                           'RunTimePaths.create_host_pipe_dir'), \
+                mock.patch('storlets.gateway.gateways.docker.runtime.'
+                           'eventlet.spawn_n') as spawn_n:
+            self.sbox.restart()
+            spawn_n.assert_called_once_with(self.sbox.prewarm)
+
+        self.sbox.prewarm_storlet_daemons = 0
+        with mock.patch.object(self.sbox, '_restart'), \
+                mock.patch.object(self.sbox, 'wait'), \
+                mock.patch('storlets.gateway.gateways.docker.runtime.'
+                           'RunTimePaths.create_host_pipe_dir'), \
+                mock.patch('storlets.gateway.gateways.docker.runtime.'
+                           'eventlet.spawn_n') as spawn_n:
+            self.sbox.restart()
+            spawn_n.assert_not_called()
+
+    def _write_history(self, history):
+        pipe_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, pipe_dir)
+        self.sbox.paths.host_pipe_root_dir = pipe_dir
+        os.mkdir(self.sbox.paths.host_pipe_dir)
+        with open(os.path.join(self.sbox.paths.host_pipe_dir,
+                               'storlet_daemon_history.json'), 'w') as f:
+            f.write(history)
+
+    def test_get_daemon_history(self):
+        self.assertEqual([], self.sbox.get_daemon_history())
+
+        params = {'daemon_language': 'python'}
+        self._write_history(json.dumps({
+            'storleta': {'count': 1, 'params': params},
+            'storletb': {'count': 5, 'params': params},
+            'storletc': {'count': 3, 'params': params}}))
+        self.assertEqual(
+            [('storletb', params), ('storletc', params),
+             ('storleta', params)],
+            self.sbox.get_daemon_history())
+
+        self._write_history('broken')
+        self.assertEqual([], self.sbox.get_daemon_history())
+
+    def test_prewarm(self):
+        params = {'daemon_language': 'python',
+                  'storlet_path': '/home/swift/storleta',
+                  'pool_size': 5, 'uds_path': '/mnt/channels/storleta',
+                  'log_level': 'DEBUG', 'daemon_language_version': 3}
+        self._write_history(json.dumps({
+            'storleta': {'count': 5, 'params': params},
+            'storletb': {'count': 3, 'params': {}},
+            'storletc': {'count': 1, 'params': params}}))
+        self.sbox.prewarm_storlet_daemons = 2
+        with mock.patch('storlets.gateway.gateways.docker.runtime.'
+                        'SBusClient.start_daemon') as start_daemon:
+            start_daemon.return_value = SBusResponse(True, 'OK')
+            self.sbox.prewarm()
+            # Only the top 2 storlets are started, and the broken entry is
+            # skipped
+            start_daemon.assert_called_once_with(
+                'python', '/home/swift/storleta', 'storleta',
+                '/mnt/channels/storleta', 'DEBUG', 5, 3)
+        self.assertEqual(1, len(self.logger.get_log_lines('exception')))
+
+        with mock.patch('storlets.gateway.gateways.docker.runtime.'
+                        'SBusClient.start_daemon') as start_daemon:
+            start_daemon.return_value = SBusResponse(False, 'NG')
+            self.sbox.prewarm()
+        self.assertEqual(1, len(self.logger.get_log_lines('warn')))
+        self.assertEqual(2, len(self.logger.get_log_lines('exception')))
+
     def test_get_storlet_classpath(self):
         storlet_id = 'Storlet.jar'
         storlet_main = 'org.openstack.storlet.Storlet'
@@ -396,6 +515,179 @@ class TestRunTimeSandbox(unittest.TestCase):
                                              dependencies),)
 
 
+class TestSandboxPool(unittest.TestCase):
+    def setUp(self):
+        self.logger = FakeLogger()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.conf = {'pipes_dir': os.path.join(self.root, 'pipes'),
+                     'storlets_dir': os.path.join(self.root, 'storlets'),
+                     'sandbox_pool_size': '2'}
+        os.mkdir(self.conf['pipes_dir'])
+        os.mkdir(self.conf['storlets_dir'])
+        self.pool = SandboxPool(self.conf, self.logger, 2)
+
+    def _replenish(self):
+        with mock.patch('storlets.gateway.gateways.docker.runtime.'
+                        'RunTimeSandbox._restart') as restart, \
+                mock.patch('storlets.gateway.gateways.docker.runtime.'
+                           'RunTimeSandbox.wait'):
+            self.pool.replenish()
+        return restart
+
+    def test_replenish(self):
+        restart = self._replenish()
+        self.assertEqual(2, restart.call_count)
+        restart.assert_called_with('ubuntu_18.04_jre11_storlets')
+        slots = self.pool.list_slots()
+        self.assertEqual(2, len(slots))
+        for slot in slots:
+            paths = RunTimePaths(slot, self.conf)
+            self.assertTrue(os.path.isdir(paths.host_storlet_base_dir))
+            with open(os.path.join(paths.host_pipe_dir,
+                                   'sandbox_name')) as f:
+                self.assertTrue(f.read().startswith('tenant_.starting-'))
+
+        # The pool is already full
+        restart = self._replenish()
+        restart.assert_not_called()
+
+    def test_replenish_failure(self):
+        with mock.patch('storlets.gateway.gateways.docker.runtime.'
+                        'RunTimeSandbox._restart') as restart:
+            restart.side_effect = StorletRuntimeException()
+            self.pool.replenish()
+        self.assertEqual(1, restart.call_count)
+        self.assertEqual([], self.pool.list_slots())
+        self.assertEqual(['.sandbox_pool.lock'],
+                         os.listdir(self.conf['pipes_dir']))
+        self.assertEqual([], os.listdir(self.conf['storlets_dir']))
+        self.assertEqual(1, len(self.logger.get_log_lines('exception')))
+
+    def test_bind(self):
+        self._replenish()
+        slot = self.pool.list_slots()[0]
+        slot_paths = RunTimePaths(slot, self.conf)
+        with open(os.path.join(slot_paths.host_pipe_dir,
+                               'sandbox_name')) as f:
+            container_name = f.read()
+
+        sbox = RunTimeSandbox('0123456789abc', self.conf, self.logger)
+        with mock.patch('storlets.gateway.gateways.docker.runtime.'
+                        'eventlet.spawn_n') as spawn_n, \
+                mock.patch.object(sbox, 'has_scope_image') as has_image:
+            has_image.return_value = False
+            self.assertTrue(sbox.bind_pooled_sandbox())
+        self.assertEqual(1, spawn_n.call_count)
+        self.assertEqual(1, len(self.pool.list_slots()))
+        self.assertFalse(os.path.exists(slot_paths.host_pipe_dir))
+        self.assertTrue(os.path.isdir(sbox.paths.host_storlet_base_dir))
+        # The sandbox keeps the name of the pooled container
+        self.assertEqual(container_name, sbox.docker_container_name)
+
+        # The scope already has its sandbox
+        with mock.patch('storlets.gateway.gateways.docker.runtime.'
+                        'eventlet.spawn_n') as spawn_n:
+            self.assertFalse(sbox.bind_pooled_sandbox())
+        spawn_n.assert_not_called()
+        self.assertEqual(1, len(self.pool.list_slots()))
+
+    def test_bind_pipe_dir_exists(self):
+        self._replenish()
+        scope_paths = RunTimePaths('0123456789abc', self.conf)
+        os.mkdir(scope_paths.host_pipe_dir)
+        open(os.path.join(scope_paths.host_pipe_dir, 'factory_pipe'),
+             'w').close()
+        self.assertFalse(self.pool.bind(scope_paths))
+        # The sandbox is given back to the pool
+        self.assertEqual(2, len(self.pool.list_slots()))
+        self.assertFalse(os.path.exists(scope_paths.host_storlet_base_dir))
+
+    def test_bind_empty_pool(self):
+        scope_paths = RunTimePaths('0123456789abc', self.conf)
+        self.assertFalse(self.pool.bind(scope_paths))
+
+    def test_bind_scope_image(self):
+        self._replenish()
+        sbox = RunTimeSandbox('0123456789abc', self.conf, self.logger)
+        with mock.patch('storlets.gateway.gateways.docker.runtime.'
+                        'eventlet.spawn_n') as spawn_n, \
+                mock.patch.object(sbox, 'has_scope_image') as has_image:
+            has_image.return_value = True
+            self.assertFalse(sbox.bind_pooled_sandbox())
+        spawn_n.assert_not_called()
+        self.assertEqual(2, len(self.pool.list_slots()))
+        self.assertFalse(os.path.exists(sbox.paths.host_storlet_base_dir))
+
+    def _mock_docker_repo(self, https_status, http_status):
+        def fake_conn(status):
+            conn = mock.MagicMock()
+            if isinstance(status, Exception):
+                conn.return_value.request.side_effect = status
+            else:
+                conn.return_value.getresponse.return_value.status = status
+            return conn
+
+        https = fake_conn(https_status)
+        http = fake_conn(http_status)
+        base = 'storlets.gateway.gateways.docker.runtime.http_client.'
+        return https, http, mock.patch(base + 'HTTPSConnection', https), \
+            mock.patch(base + 'HTTPConnection', http)
+
+    def test_has_scope_image(self):
+        # The local images can not be looked up
+        sbox = RunTimeSandbox('0123456789abc', {}, self.logger)
+        self.assertTrue(sbox.has_scope_image())
+
+        sbox = RunTimeSandbox('0123456789abc',
+                              {'docker_repo': 'localhost:5001'}, self.logger)
+        for status, expected in ((200, True), (404, False), (401, True)):
+            https, http, https_patch, http_patch = \
+                self._mock_docker_repo(status, None)
+            with https_patch, http_patch:
+                self.assertEqual(expected, sbox.has_scope_image())
+            https.assert_called_once_with('localhost:5001', timeout=5)
+            https.return_value.request.assert_called_once_with(
+                'HEAD', '/v2/0123456789abc/manifests/latest',
+                headers={'Accept': mock.ANY})
+            http.assert_not_called()
+
+        # The insecure repository
+        https, http, https_patch, http_patch = \
+            self._mock_docker_repo(IOError(), 404)
+        with https_patch, http_patch:
+            self.assertFalse(sbox.has_scope_image())
+        http.assert_called_once_with('localhost:5001', timeout=5)
+
+        # The repository is not available
+        https, http, https_patch, http_patch = \
+            self._mock_docker_repo(IOError(), IOError())
+        with https_patch, http_patch:
+            self.assertTrue(sbox.has_scope_image())
+        self.assertEqual(1, len(self.logger.get_log_lines('warn')))
+
+        # The repository with the namespace
+        sbox = RunTimeSandbox('0123456789abc',
+                              {'docker_repo': 'repo:5000/storlets'},
+                              self.logger)
+        https, http, https_patch, http_patch = \
+            self._mock_docker_repo(404, None)
+        with https_patch, http_patch:
+            self.assertFalse(sbox.has_scope_image())
+        https.assert_called_once_with('repo:5000', timeout=5)
+        https.return_value.request.assert_called_once_with(
+            'HEAD', '/v2/storlets/0123456789abc/manifests/latest',
+            headers={'Accept': mock.ANY})
+
+    def test_bind_disabled(self):
+        sbox = RunTimeSandbox('0123456789abc', {}, self.logger)
+        with mock.patch('storlets.gateway.gateways.docker.runtime.'
+                        'SandboxPool.bind') as bind:
+            self.assertFalse(sbox.bind_pooled_sandbox())
+        bind.assert_not_called()
+        self.assertEqual('tenant_0123456789abc', sbox.docker_container_name)
+
+
 class TestStorletInvocationProtocol(unittest.TestCase):
     def setUp(self):
         self.pipe_path = tempfile.mktemp()
@@ -426,6 +718,9 @@ class TestStorletInvocationProtocol(unittest.TestCase):
             with mock.patch.object(
                     self.protocol, '_wait_for_read_with_timeout'):
                 self.protocol._invoke()
+                # task id is collected asynchronously
+                self.assertIsNone(self.protocol.task_id)
+                self.protocol._get_task_id()
 
             self.assertEqual(pipe_called, len(pipes))
             pipes = iter(pipes)
@@ -454,6 +749,79 @@ class TestStorletInvocationProtocol(unittest.TestCase):
             # sanity
             self.assertRaises(StopIteration, next, pipes)
 
+    def test_communicate_feeds_input_before_task_id(self):
+        # The fake daemon returns the task id only after it has consumed the
+        # whole input, so this times out if the input is fed only after the
+        # task id is read
+        def fake_daemon(in_fd, taskid_fd, out_fd, md_fd):
+            data = b''
+            while True:
+                chunk = os.read(in_fd, 65536)
+                if not chunk:
+                    break
+                data += chunk
+            os.close(in_fd)
+            os.write(taskid_fd, b'abcd1234')
+            os.close(taskid_fd)
+            os.write(md_fd, b'{"key": "value"}')
+            os.close(md_fd)
+            os.write(out_fd, data)
+            os.close(out_fd)
+
+        def fake_send(path, dtg):
+            fds = [os.dup(fd) for fd in dtg.fds[:4]]
+            threading.Thread(target=fake_daemon, args=fds).start()
+            return 0
+
+        storlet_request = DockerStorletRequest(
+            self.storlet_id, {}, {}, iter([b'x' * 1024]),
+            options=self.options)
+        protocol = StorletInvocationProtocol(
+            storlet_request, self.pipe_path, self.log_file, 1, self.logger)
+        with mock.patch('storlets.gateway.gateways.docker.runtime.'
+                        'SBus.send', fake_send):
+            sresp = protocol.communicate()
+            self.assertEqual({'key': 'value'}, sresp.user_metadata)
+            self.assertEqual(b'x' * 1024, b''.join(sresp.data_iter))
+            sresp.data_iter.close()
+        self.assertEqual('abcd1234', protocol._get_task_id())
+
+    def test_invoke_does_not_wait_for_task_id(self):
+        with _mock_sbus(0), _mock_os_pipe([''] * 4) as pipes, \
+                mock.patch.object(self.protocol,
+                                  '_wait_for_read_with_timeout') as wait:
+            self.protocol._invoke()
+            # we should not wait for any fd until task id reader runs
+            self.assertEqual(0, wait.call_count)
+            execution_read_fd, execution_write_fd = pipes[2]
+            self.assertFalse(execution_read_fd.closed)
+
+            execution_read_fd.rbuf = b'task1234'
+            self.assertEqual('task1234', self.protocol._get_task_id())
+            wait.assert_called_once_with(execution_read_fd)
+            self.assertTrue(execution_read_fd.closed)
+            self.assertIsNone(self.protocol.taskid_read_fd)
+
+    def test_cancel_without_task_id(self):
+        with _mock_sbus(0), _mock_os_pipe([''] * 4), \
+                mock.patch.object(self.protocol,
+                                  '_wait_for_read_with_timeout',
+                                  side_effect=StorletTimeout()), \
+                mock.patch('storlets.gateway.gateways.docker.runtime.'
+                           'SBusClient.cancel') as cancel:
+            self.protocol._invoke()
+            with self.assertRaises(StorletRuntimeException):
+                self.protocol._cancel()
+            self.assertEqual(0, cancel.call_count)
+
+    def test_close_local_side_descriptors_before_task_id(self):
+        with _mock_sbus(0), _mock_os_pipe([''] * 4) as pipes:
+            self.protocol._invoke()
+            self.protocol._close_local_side_descriptors()
+            for read_fd, write_fd in pipes[1:]:
+                self.assertTrue(read_fd.closed)
+            self.assertTrue(self.protocol._task_id_reader.dead)
+
     def test_invocation_protocol_remote_fds(self):
         # In default, we have 5 fds in remote_fds
         storlet_request = DockerStorletRequest(
@@ -478,6 +846,148 @@ class TestStorletInvocationProtocol(unittest.TestCase):
             extra_sources=[storlet_request] * 3)
         self.assertEqual(8, len(protocol.remote_fds))
 
+    def test_invocation_protocol_remote_fds_trailing_metadata(self):
+        self.assertEqual(
+            sbus_fd.SBUS_FD_OUTPUT_OBJECT,
+            self.protocol.remote_fds[2].fdtype)
+
+        options = dict(self.options, storlet_trailing_metadata='True')
+        storlet_request = DockerStorletRequest(
+            self.storlet_id, {}, {}, iter(StringIO()), options=options)
+        protocol = StorletInvocationProtocol(
+            storlet_request, self.pipe_path, self.log_file, 1, self.logger)
+        self.assertEqual(
+            sbus_fd.SBUS_FD_OUTPUT_OBJECT_AND_METADATA,
+            protocol.remote_fds[2].fdtype)
+
+    def test_invocation_protocol_remote_fds_extra_outputs(self):
+        options = dict(self.options, output_container='outputs',
+                       extra_outputs='2')
+        storlet_request = DockerStorletRequest(
+            self.storlet_id, {}, {}, iter(StringIO()), options=options)
+        protocol = StorletInvocationProtocol(
+            storlet_request, self.pipe_path, self.log_file, 1, self.logger,
+            extra_sources=[self.protocol.srequest])
+        remote_fds = protocol.remote_fds
+        self.assertEqual(
+            [sbus_fd.SBUS_FD_OUTPUT_CONTAINER,
+             sbus_fd.SBUS_FD_OUTPUT_OBJECT,
+             sbus_fd.SBUS_FD_OUTPUT_OBJECT_METADATA,
+             sbus_fd.SBUS_FD_OUTPUT_OBJECT,
+             sbus_fd.SBUS_FD_OUTPUT_OBJECT_METADATA,
+             sbus_fd.SBUS_FD_INPUT_OBJECT],
+            [sfd.fdtype for sfd in remote_fds[5:]])
+        self.assertEqual({'storlet_container_name': 'outputs'},
+                         remote_fds[5].storage_metadata)
+
+    def _make_extra_outputs_protocol(self):
+        options = dict(self.options, output_container='outputs',
+                       extra_outputs=2)
+        storlet_request = DockerStorletRequest(
+            self.storlet_id, {}, {}, iter(StringIO()), options=options)
+        protocol = StorletInvocationProtocol(
+            storlet_request, self.pipe_path, self.log_file, 1, self.logger)
+        protocol._prepare_invocation_descriptors()
+        self.addCleanup(protocol._close_input_data_descriptors)
+        self.addCleanup(protocol._close_local_side_descriptors)
+        return protocol
+
+    def _write_extra_output(self, protocol, index, name, metadata, body):
+        os.write(protocol.container_write_fd, json.dumps(
+            {'object_name': name, 'index': index}).encode('utf-8') + b'\n')
+        output = protocol.extra_outputs[index]
+        os.write(output['md_write_fd'], json.dumps(metadata).encode('utf-8'))
+        os.write(output['data_write_fd'], body)
+
+    def test_extra_outputs(self):
+        protocol = self._make_extra_outputs_protocol()
+        self._write_extra_output(protocol, 1, 'obj1', {'key': 'value'},
+                                 b'body1')
+        self._write_extra_output(protocol, 0, 'obj2', {}, b'body2')
+        os.write(protocol.container_write_fd, b'{"completed": true}\n')
+        protocol._close_remote_side_descriptors()
+
+        outputs = list(protocol._iter_extra_outputs())
+        self.assertEqual(['obj1', 'obj2'], [name for name, _ in outputs])
+        sresp = outputs[0][1]()
+        self.assertEqual({'key': 'value'}, sresp.user_metadata)
+        self.assertEqual(b'body1', b''.join(sresp.data_iter))
+        sresp = outputs[1][1]()
+        self.assertEqual({}, sresp.user_metadata)
+        self.assertEqual(b'body2', b''.join(sresp.data_iter))
+
+    def test_extra_outputs_not_completed(self):
+        protocol = self._make_extra_outputs_protocol()
+        self._write_extra_output(protocol, 0, 'obj1', {}, b'body1')
+        protocol._close_remote_side_descriptors()
+
+        outputs = list(protocol._iter_extra_outputs())
+        self.assertEqual(['obj1'], [name for name, _ in outputs])
+        sresp = outputs[0][1]()
+        with self.assertRaises(StorletRuntimeException):
+            b''.join(sresp.data_iter)
+
+    def test_extra_outputs_invalid(self):
+        for line in (b'foo\n',
+                     b'{"object_name": "obj1", "index": 2}\n',
+                     b'{"index": 0}\n'):
+            protocol = self._make_extra_outputs_protocol()
+            os.write(protocol.container_write_fd, line)
+            protocol._close_remote_side_descriptors()
+            with self.assertRaises(StorletRuntimeException):
+                list(protocol._iter_extra_outputs())
+
+    def test_is_metadata_ready(self):
+        with _mock_os_pipe([''] * 4) as pipes:
+            self.protocol._prepare_invocation_descriptors()
+            md_fd = pipes[3][0]
+            with mock.patch('storlets.gateway.gateways.docker.runtime.'
+                            'select.select',
+                            return_value=([md_fd], [], [])) as fake_select:
+                self.assertTrue(self.protocol._is_metadata_ready())
+            fake_select.assert_called_once_with([md_fd], [], [], 0)
+            with mock.patch('storlets.gateway.gateways.docker.runtime.'
+                            'select.select',
+                            return_value=([], [], [])):
+                self.assertFalse(self.protocol._is_metadata_ready())
+
+    def test_read_trailing_metadata(self):
+        with _mock_os_pipe(['', '', '', '{"key": "value"}']) as pipes:
+            self.protocol._prepare_invocation_descriptors()
+            with mock.patch.object(
+                    self.protocol, '_wait_for_read_with_timeout'):
+                self.assertEqual({'key': 'value'},
+                                 self.protocol._read_trailing_metadata())
+            self.assertTrue(pipes[3][0].closed)
+            self.assertIsNone(self.protocol.metadata_read_fd)
+
+        # No metadata is given
+        with _mock_os_pipe([''] * 4) as pipes:
+            self.protocol._prepare_invocation_descriptors()
+            with mock.patch.object(
+                    self.protocol, '_wait_for_read_with_timeout'):
+                self.assertEqual({}, self.protocol._read_trailing_metadata())
+            self.assertTrue(pipes[3][0].closed)
+
+        # Invalid metadata is given
+        with _mock_os_pipe(['', '', '', 'foo']) as pipes:
+            self.protocol._prepare_invocation_descriptors()
+            with mock.patch.object(
+                    self.protocol, '_wait_for_read_with_timeout'):
+                with self.assertRaises(StorletRuntimeException):
+                    self.protocol._read_trailing_metadata()
+            self.assertTrue(pipes[3][0].closed)
+
+        # Discard metadata
+        with _mock_os_pipe(['', '', '', '{"key": "value"}']) as pipes:
+            self.protocol._prepare_invocation_descriptors()
+            with mock.patch.object(
+                    self.protocol, '_wait_for_read_with_timeout') as wait:
+                self.assertEqual(
+                    {}, self.protocol._read_trailing_metadata(discard=True))
+            self.assertEqual(0, wait.call_count)
+            self.assertTrue(pipes[3][0].closed)
+
     def test_open_writer_with_invalid_fd(self):
         invalid_fds = (
             (None, TypeError), (-1, ValueError), ('blah', TypeError))
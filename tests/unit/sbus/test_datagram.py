@@ -207,9 +207,45 @@ class TestSBusExecuteDatagram(SBusDatagramTestMixin, unittest.TestCase):
         self.assertEqual(self.params, dtg.params)
         self.assertEqual(self.task_id, dtg.task_id)
 
+    def test_init_extra_outputs(self):
+        types = [sbus_fd.SBUS_FD_INPUT_OBJECT,
+                 sbus_fd.SBUS_FD_OUTPUT_TASK_ID,
+                 sbus_fd.SBUS_FD_OUTPUT_OBJECT,
+                 sbus_fd.SBUS_FD_OUTPUT_OBJECT_METADATA,
+                 sbus_fd.SBUS_FD_LOGGER,
+                 sbus_fd.SBUS_FD_OUTPUT_CONTAINER,
+                 sbus_fd.SBUS_FD_OUTPUT_OBJECT,
+                 sbus_fd.SBUS_FD_OUTPUT_OBJECT_METADATA,
+                 sbus_fd.SBUS_FD_OUTPUT_OBJECT,
+                 sbus_fd.SBUS_FD_OUTPUT_OBJECT_METADATA,
+                 sbus_fd.SBUS_FD_INPUT_OBJECT]
+        fds = [SBusFileDescriptor(types[i], i + 1)
+               for i in range(len(types))]
+        dtg = self._test_class(
+            self.command, fds, self.params, self.task_id)
+        self.assertEqual(types, [sfd.fdtype for sfd in dtg.sfds])
+        self.assertEqual(6, dtg.container_out_fd)
+        self.assertEqual([3, 7, 9], dtg.object_out_fds)
+        self.assertEqual([4, 8, 10], dtg.object_metadata_out_fds)
+        self.assertEqual([1, 11], dtg.object_in_fds)
+
+        with self.assertRaises(ValueError):
+            self._test_class(
+                self.command, fds + [SBusFileDescriptor(
+                    sbus_fd.SBUS_FD_OUTPUT_CONTAINER, 12)],
+                self.params, self.task_id)
+
+    def test_init_invalid_extra_fds(self):
+        fds = self.sfds + [SBusFileDescriptor(sbus_fd.SBUS_FD_LOGGER, 6)]
+        with self.assertRaises(ValueError):
+            self._test_class(self.command, fds, self.params, self.task_id)
+
     def test_object_out_fds(self):
         self.assertEqual([3], self.dtg.object_out_fds)
 
+    def test_container_out_fd(self):
+        self.assertIsNone(self.dtg.container_out_fd)
+
     def test_object_metadata_out_fds(self):
         self.assertEqual([4], self.dtg.object_metadata_out_fds)
 
@@ -222,6 +258,19 @@ class TestSBusExecuteDatagram(SBusDatagramTestMixin, unittest.TestCase):
     def test_object_in_fds(self):
         self.assertEqual([1], self.dtg.object_in_fds)
 
+    def test_object_and_metadata_out_fds(self):
+        self.assertEqual([], self.dtg.object_trailing_metadata_out_fds)
+
+        types = self.types[:]
+        types[2] = sbus_fd.SBUS_FD_OUTPUT_OBJECT_AND_METADATA
+        fds = [SBusFileDescriptor(types[i], i + 1)
+               for i in range(len(types))]
+        dtg = self._test_class(
+            self.command, fds, self.params, self.task_id)
+        self.assertEqual([3], dtg.object_out_fds)
+        self.assertEqual([3], dtg.object_trailing_metadata_out_fds)
+        self.assertEqual([4], dtg.object_metadata_out_fds)
+
     def test_check_required_fd_types_reverse_order_failed(self):
         types = self.types[:]
         types.reverse()  # reverse order
@@ -20,9 +20,10 @@ from six import StringIO
 
 from swift.common.swob import Request
 from storlets.gateway.common.exceptions import FileManagementError
+from storlets.gateway.common.stob import StorletResponse
 from storlets.swift_middleware.handlers import StorletBaseHandler
 from storlets.swift_middleware.handlers.base import get_container_names, \
-    SwiftFileManager
+    SwiftFileManager, TrailingMetadataIterator, OutputRangeIterator
 from tests.unit import FakeLogger
 
 
@@ -34,16 +35,18 @@ class TestUtils(unittest.TestCase):
         # Use default values
         self.assertEqual(
             {'storlet': 'storlet', 'dependency': 'dependency',
-             'log': 'storletlog'},
+             'log': 'storletlog', 'materialized': 'storletmaterialized'},
             get_container_names({}))
 
         # Use explicit values
         self.assertEqual(
-            {'storlet': 'conta', 'dependency': 'contb', 'log': 'contc'},
+            {'storlet': 'conta', 'dependency': 'contb', 'log': 'contc',
+             'materialized': 'contd'},
             get_container_names(
                 {'storlet_container': 'conta',
                  'storlet_dependency': 'contb',
-                 'storlet_logcontainer': 'contc'}))
+                 'storlet_logcontainer': 'contc',
+                 'storlet_materialized_container': 'contd'}))
 
 
 class TestSwiftFileManager(unittest.TestCase):
@@ -157,6 +160,105 @@ class TestSwiftFileManager(unittest.TestCase):
                 self.manager.put_log(name, mock.MagicMock())
 
 
+class TestTrailingMetadataIterator(unittest.TestCase):
+
+    def _create_response(self, metadata):
+        data_iter = mock.MagicMock()
+        data_iter.__iter__.return_value = iter([b'a', b'b'])
+        reader = mock.MagicMock(return_value=metadata)
+        sresp = StorletResponse({}, data_iter,
+                                trailing_metadata_reader=reader)
+        return sresp, data_iter, reader
+
+    def test_consume_body(self):
+        sresp, data_iter, reader = self._create_response({'key': 'value'})
+        callback = mock.MagicMock()
+        app_iter = TrailingMetadataIterator(sresp, callback)
+        self.assertEqual([b'a', b'b'], list(app_iter))
+        reader.assert_called_once_with(False)
+        callback.assert_called_once_with({'key': 'value'})
+        data_iter.close.assert_called_once_with()
+
+        # close after the body is consumed does nothing
+        app_iter.close()
+        reader.assert_called_once_with(False)
+        data_iter.close.assert_called_once_with()
+
+    def test_close_before_end(self):
+        sresp, data_iter, reader = self._create_response({})
+        callback = mock.MagicMock()
+        app_iter = TrailingMetadataIterator(sresp, callback)
+        self.assertEqual(b'a', next(app_iter))
+        app_iter.close()
+        data_iter.close.assert_called_once_with()
+        reader.assert_called_once_with(True)
+        callback.assert_not_called()
+        self.assertEqual([], list(app_iter))
+
+    def test_close_before_iteration(self):
+        sresp, data_iter, reader = self._create_response({})
+        callback = mock.MagicMock()
+        app_iter = TrailingMetadataIterator(sresp, callback)
+        app_iter.close()
+        data_iter.close.assert_called_once_with()
+        reader.assert_called_once_with(True)
+        callback.assert_not_called()
+
+    def test_error_in_iteration(self):
+        sresp, data_iter, reader = self._create_response({})
+
+        def broken_iter():
+            raise IOError()
+            yield
+
+        data_iter.__iter__.return_value = broken_iter()
+        callback = mock.MagicMock()
+        app_iter = TrailingMetadataIterator(sresp, callback)
+        with self.assertRaises(IOError):
+            next(app_iter)
+        data_iter.close.assert_called_once_with()
+        reader.assert_called_once_with(True)
+        callback.assert_not_called()
+
+
+class TestOutputRangeIterator(unittest.TestCase):
+
+    def _create_data_iter(self, chunks):
+        data_iter = mock.MagicMock()
+        data_iter.__iter__.return_value = iter(chunks)
+        return data_iter
+
+    def test_range(self):
+        data_iter = self._create_data_iter([b'abc', b'def', b'ghi', b'jkl'])
+        app_iter = OutputRangeIterator(data_iter, 4, 4)
+        self.assertEqual([b'ef', b'gh'], list(app_iter))
+        data_iter.close.assert_called_once_with()
+
+        # close after the range is returned does nothing
+        app_iter.close()
+        data_iter.close.assert_called_once_with()
+
+    def test_range_without_skip(self):
+        data_iter = self._create_data_iter([b'abc', b'def'])
+        app_iter = OutputRangeIterator(data_iter, 0, 4)
+        self.assertEqual([b'abc', b'd'], list(app_iter))
+        data_iter.close.assert_called_once_with()
+
+    def test_range_beyond_output(self):
+        data_iter = self._create_data_iter([b'abc', b'def'])
+        app_iter = OutputRangeIterator(data_iter, 4, 10)
+        self.assertEqual([b'ef'], list(app_iter))
+        app_iter.close()
+        data_iter.close.assert_called_once_with()
+
+    def test_close_before_end(self):
+        data_iter = self._create_data_iter([b'abc', b'def'])
+        app_iter = OutputRangeIterator(data_iter, 1, 4)
+        self.assertEqual(b'bc', next(app_iter))
+        app_iter.close()
+        data_iter.close.assert_called_once_with()
+
+
 class TestStorletBaseHandler(unittest.TestCase):
 
     def test_init_failed_via_base_handler(self):
@@ -13,10 +13,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import mock
+import shutil
+import tempfile
 import unittest
 
-from swift.common.swob import Request, HTTPOk, HTTPCreated
+from swift.common.swob import Request, Response, HTTPOk, HTTPCreated
+from storlets.gateway.common.stob import StorletResponse
 from storlets.swift_middleware.handlers import StorletObjectHandler
 
 from tests.unit.swift_middleware.handlers import \
@@ -247,6 +251,23 @@ class TestStorletObjectHandler(unittest.TestCase):
         options = handler._get_storlet_invocation_options(req)
         self.assertEqual('baa', options['storlet_foo'])
         self.assertTrue(options['generate_log'])
+        self.assertEqual([], options['pipeline'])
+
+        pipeline = [{'storlet': 'second.py', 'params': {},
+                     'options': {'storlet_main': 'second.Second'}}]
+        req = Request.blank(
+            '/dev/part/acc/cont/obj',
+            environ={'REQUEST_METHOD': 'GET'},
+            headers={'X-Backend-Storage-Policy-Index': '0',
+                     'X-Run-Storlet': 'Storlet-1.0.jar',
+                     'X-Storlet-Pipeline': json.dumps(pipeline)})
+        handler = self.handler_class(
+            req, self.conf, self.gateway_conf, mock.MagicMock(),
+            mock.MagicMock())
+
+        options = handler._get_storlet_invocation_options(req)
+        self.assertEqual(pipeline, options['pipeline'])
+        self.assertNotIn('storlet_pipeline', options)
 
         req = Request.blank(
             '/dev/part/acc/cont/obj',
@@ -267,6 +288,135 @@ class TestStorletObjectHandler(unittest.TestCase):
         self.assertEqual(1, options['range_start'])
         self.assertEqual(7, options['range_end'])
 
+    def _apply_storlet(self, headers=None, gateway_conf=None):
+        req_headers = {'X-Backend-Storage-Policy-Index': '0',
+                       'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'X-Storlet-X-Timestamp': '1500000000.00000',
+                       'X-Storlet-Deterministic': 'True'}
+        req_headers.update(headers or {})
+        req = Request.blank(
+            '/dev/part/acc/cont/obj', environ={'REQUEST_METHOD': 'GET'},
+            headers=req_headers)
+        handler = self.handler_class(
+            req, self.conf, gateway_conf or {},
+            mock.MagicMock(), mock.MagicMock())
+        resp = Response(headers={'Etag': 'etag', 'Content-Length': '8',
+                                 'Last-Modified':
+                                 'Thu, 01 Jun 2017 00:00:00 GMT'},
+                        body=b'FAKE APP')
+        sresp = StorletResponse({'Foo': 'bar'}, iter([b'FAKE', b' OUT']))
+        with mock.patch.object(handler, '_call_gateway',
+                               return_value=sresp) as call_gateway:
+            storlet_resp = handler.apply_storlet(resp)
+            body = storlet_resp.body
+        return storlet_resp, body, call_gateway
+
+    def test_apply_storlet_output_validators(self):
+        resp, body, call_gateway = self._apply_storlet()
+        self.assertEqual(b'FAKE OUT', body)
+        etag = resp.headers['Etag']
+        self.assertNotEqual('etag', etag)
+        # The storlet is newer than the object
+        self.assertEqual('Fri, 14 Jul 2017 02:40:00 GMT',
+                         resp.headers['Last-Modified'])
+
+        # The ETag depends on the parameters
+        resp, body, call_gateway = self._apply_storlet(
+            {'X-Storlet-Parameter-1': 'key:value'})
+        self.assertNotEqual(etag, resp.headers['Etag'])
+
+        # The latest timestamp of the storlet and its dependencies is used
+        resp, body, call_gateway = self._apply_storlet(
+            {'X-Storlet-X-Timestamp': '1400000000.00000',
+             'X-Storlet-Dependency': 'dep',
+             'X-Storlet-Dependency-Versions': 'dep:1600000000.50000'})
+        self.assertEqual('Sun, 13 Sep 2020 12:26:41 GMT',
+                         resp.headers['Last-Modified'])
+
+        # Non deterministic storlet keeps the original headers
+        resp, body, call_gateway = self._apply_storlet(
+            {'X-Storlet-Deterministic': 'False'})
+        self.assertEqual('etag', resp.headers['Etag'])
+
+    def test_apply_storlet_not_modified(self):
+        resp, body, call_gateway = self._apply_storlet()
+        etag = resp.headers['Etag']
+
+        for headers in ({'X-Storlet-If-None-Match': etag},
+                        {'X-Storlet-If-None-Match': '"%s"' % etag},
+                        {'X-Storlet-If-None-Match': '*'},
+                        {'X-Storlet-If-Modified-Since':
+                         'Fri, 14 Jul 2017 02:40:00 GMT'}):
+            resp, body, call_gateway = self._apply_storlet(headers)
+            self.assertEqual(304, resp.status_int)
+            self.assertEqual(etag, resp.headers['Etag'])
+            call_gateway.assert_not_called()
+
+        for headers in ({'X-Storlet-If-None-Match': 'etag'},
+                        {'X-Storlet-If-Modified-Since':
+                         'Fri, 14 Jul 2017 02:39:59 GMT'},
+                        {'X-Storlet-If-None-Match': 'etag',
+                         'X-Storlet-If-Modified-Since':
+                         'Fri, 14 Jul 2017 02:40:00 GMT'},
+                        {'X-Storlet-If-None-Match': etag,
+                         'X-Storlet-Deterministic': 'False'}):
+            resp, body, call_gateway = self._apply_storlet(headers)
+            self.assertEqual(200, resp.status_int)
+            self.assertEqual(b'FAKE OUT', body)
+            call_gateway.assert_called_once()
+
+    def test_apply_storlet_with_result_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+
+        resp, body, call_gateway = self._apply_storlet(
+            gateway_conf={'result_cache_dir': cache_dir})
+        self.assertEqual(b'FAKE OUT', body)
+        self.assertEqual('bar', resp.headers['X-Object-Meta-Foo'])
+        call_gateway.assert_called_once()
+
+        # The second invocation is served from the cache
+        resp, body, call_gateway = self._apply_storlet(
+            gateway_conf={'result_cache_dir': cache_dir})
+        self.assertEqual(b'FAKE OUT', body)
+        self.assertEqual('bar', resp.headers['X-Object-Meta-Foo'])
+        call_gateway.assert_not_called()
+
+        # Output range is served from the cache
+        resp, body, call_gateway = self._apply_storlet(
+            {'X-Storlet-Output-Range': 'bytes=2-5'},
+            {'result_cache_dir': cache_dir})
+        self.assertEqual(b'KE O', body)
+        self.assertEqual('bytes 2-5/*',
+                         resp.headers['X-Storlet-Output-Content-Range'])
+        call_gateway.assert_not_called()
+
+        # Different parameters make a different output
+        resp, body, call_gateway = self._apply_storlet(
+            {'X-Storlet-Parameter-1': 'key:value'},
+            {'result_cache_dir': cache_dir})
+        call_gateway.assert_called_once()
+
+    def test_apply_storlet_with_result_cache_not_cacheable(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+
+        for headers in ({'X-Storlet-Deterministic': 'False'},
+                        {'X-Storlet-Dependency': 'dep'},
+                        {'X-Storlet-Output-Range': 'bytes=2-5'}):
+            for _ in range(2):
+                resp, body, call_gateway = self._apply_storlet(
+                    headers, {'result_cache_dir': cache_dir})
+                call_gateway.assert_called_once()
+
+        # The dependency versions given by proxy make it cacheable
+        headers = {'X-Storlet-Dependency': 'dep',
+                   'X-Storlet-Dependency-Versions': 'dep:1500000000.00000'}
+        self._apply_storlet(headers, {'result_cache_dir': cache_dir})
+        resp, body, call_gateway = self._apply_storlet(
+            gateway_conf={'result_cache_dir': cache_dir}, headers=headers)
+        call_gateway.assert_not_called()
+
 
 if __name__ == '__main__':
     unittest.main()
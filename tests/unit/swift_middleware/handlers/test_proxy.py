@@ -13,15 +13,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import eventlet
+import json
 import mock
+import tarfile
 import unittest
 import itertools
 
 from contextlib import contextmanager
+from six import BytesIO
 from swift.common.swob import Request, HTTPOk, HTTPCreated, HTTPAccepted, \
-    HTTPNoContent, HTTPNotFound
+    HTTPNoContent, HTTPNotFound, HTTPForbidden
+from storlets.gateway.common.stob import StorletResponse
 from storlets.swift_middleware.handlers import StorletProxyHandler
-from storlets.swift_middleware.handlers.proxy import REFERER_PREFIX
+from storlets.gateway.common.exceptions import StorletRuntimeException
+from storlets.swift_middleware.handlers.proxy import REFERER_PREFIX, \
+    ParallelOutputIterator, StorletJobQueue
+from tests.unit import FakeLogger
 
 from tests.unit.swift_middleware.handlers import \
     BaseTestStorletMiddleware, create_handler_config
@@ -99,6 +107,99 @@ class TestStorletMiddlewareProxy(BaseTestStorletMiddleware):
             self.assertEqual(target, calls[-1][1])
             self.assertIn('X-Run-Storlet', calls[-1][2])
 
+    def test_GET_with_storlets_ignores_client_trailing_metadata(self):
+        target = '/v1/AUTH_a/c/o'
+        self.base_app.register('GET', target, HTTPOk, body=b'FAKE RESULT')
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register('GET', storlet, HTTPOk, headers={},
+                               body=b'jar binary')
+
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'X-Storlet-Trailing-Metadata': 'True'}
+            resp = self.get_request_response(target, 'GET', headers=headers)
+            self.assertEqual('200 OK', resp.status)
+            calls = self.base_app.get_calls()
+            self.assertEqual(target, calls[-1][1])
+            self.assertNotIn('X-Storlet-Trailing-Metadata', calls[-1][2])
+
+    def test_GET_with_deterministic_storlets(self):
+        target = '/v1/AUTH_a/c/o'
+        self.base_app.register('GET', target, HTTPOk, body=b'FAKE RESULT')
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register(
+            'GET', storlet, HTTPOk,
+            headers={'X-Object-Meta-Storlet-Deterministic': 'True',
+                     'X-Object-Meta-Storlet-Dependency': 'dep1,dep2'},
+            body=b'jar binary')
+        for dep, timestamp in (('dep1', '1.00000'), ('dep2', '2.00000')):
+            self.base_app.register(
+                'GET', '/v1/AUTH_a/dependency/%s' % dep, HTTPOk,
+                headers={'X-Timestamp': timestamp}, body=b'dep')
+
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'X-Storlet-Dependency-Versions': 'dep1:0'}
+            resp = self.get_request_response(target, 'GET', headers=headers)
+            self.assertEqual('200 OK', resp.status)
+            calls = self.base_app.get_calls()
+            self.assertEqual(target, calls[-1][1])
+            self.assertEqual('True', calls[-1][2]['X-Storlet-Deterministic'])
+            self.assertEqual('dep1:1.00000,dep2:2.00000',
+                             calls[-1][2]['X-Storlet-Dependency-Versions'])
+
+    def test_GET_with_storlets_conditional_headers(self):
+        target = '/v1/AUTH_a/c/o'
+        self.base_app.register('GET', target, HTTPOk, body=b'FAKE RESULT')
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        conditions = {'If-None-Match': 'etag',
+                      'If-Modified-Since': 'Fri, 14 Jul 2017 02:40:00 GMT'}
+
+        for deterministic in ('True', 'False'):
+            self.base_app.register(
+                'GET', storlet, HTTPOk,
+                headers={'X-Object-Meta-Storlet-Deterministic':
+                         deterministic},
+                body=b'jar binary')
+            with storlet_enabled():
+                headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                           'X-Storlet-If-None-Match': 'foo'}
+                headers.update(conditions)
+                resp = self.get_request_response(target, 'GET',
+                                                 headers=headers)
+                self.assertEqual('200 OK', resp.status)
+                req_headers = self.base_app.get_calls()[-1][2]
+
+            for key, value in conditions.items():
+                if deterministic == 'True':
+                    # Evaluated on the output in the object server
+                    self.assertNotIn(key, req_headers)
+                    self.assertEqual(value, req_headers['X-Storlet-' + key])
+                else:
+                    self.assertEqual(value, req_headers[key])
+                    self.assertNotIn('X-Storlet-' + key, req_headers)
+
+    def test_GET_with_deterministic_storlets_dependency_not_found(self):
+        target = '/v1/AUTH_a/c/o'
+        self.base_app.register('GET', target, HTTPOk, body=b'FAKE RESULT')
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register(
+            'GET', storlet, HTTPOk,
+            headers={'X-Object-Meta-Storlet-Deterministic': 'True',
+                     'X-Object-Meta-Storlet-Dependency': 'dep'},
+            body=b'jar binary')
+        self.base_app.register('HEAD', '/v1/AUTH_a/dependency/dep',
+                               HTTPNotFound)
+
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'X-Storlet-Dependency-Versions': 'dep:0'}
+            resp = self.get_request_response(target, 'GET', headers=headers)
+            self.assertEqual('200 OK', resp.status)
+            calls = self.base_app.get_calls()
+            self.assertEqual(target, calls[-1][1])
+            self.assertNotIn('X-Storlet-Dependency-Versions', calls[-1][2])
+
     def test_GET_with_storlets_disabled_account(self):
         target = '/v1/AUTH_a/c/o'
 
@@ -127,12 +228,84 @@ class TestStorletMiddlewareProxy(BaseTestStorletMiddleware):
 
     def test_GET_with_storlets_and_http_range(self):
         target = '/v1/AUTH_a/c/o'
+        self.base_app.register('GET', target, HTTPOk, body=b'FAKE APP')
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register('GET', storlet, HTTPOk, body=b'jar binary')
 
         with storlet_enabled():
             headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
-                       'Range': 'bytes=10-20'}
+                       'X-Storlet-Run-On-Proxy': '',
+                       'Range': 'bytes=1-3'}
             resp = self.get_request_response(target, 'GET', headers=headers)
+            self.assertEqual('206 Partial Content', resp.status)
+            self.assertEqual(b'AKE', resp.body)
+            self.assertEqual('bytes 1-3/*', resp.headers['Content-Range'])
+            self.assertNotIn('X-Storlet-Output-Content-Range', resp.headers)
+
+            # The whole object is given to the storlet
+            raw_req = self.base_app.get_calls('GET', target)[0]
+            self.assertNotIn('Range', raw_req[2])
+            self.assertEqual('bytes=1-3', raw_req[2]['X-Storlet-Output-Range'])
+
+    def test_GET_with_storlets_and_object_http_range(self):
+        target = '/v1/AUTH_a/c/o'
+        self.base_app.register(
+            'GET', target, HTTPOk, body=b'AKE',
+            headers={'X-Storlet-Output-Content-Range': 'bytes 1-3/*'})
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register('GET', storlet, HTTPOk, body=b'jar binary')
+
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'Range': 'bytes=1-3',
+                       'X-Storlet-Output-Seekable': 'True'}
+            resp = self.get_request_response(target, 'GET', headers=headers)
+            self.assertEqual('206 Partial Content', resp.status)
+            self.assertEqual(b'AKE', resp.body)
+            self.assertEqual('bytes 1-3/*', resp.headers['Content-Range'])
+
+            raw_req = self.base_app.get_calls('GET', target)[0]
+            self.assertNotIn('Range', raw_req[2])
+            self.assertEqual('bytes=1-3', raw_req[2]['X-Storlet-Output-Range'])
+            # Only the storlet registration can make the output seekable
+            self.assertNotIn('X-Storlet-Output-Seekable', raw_req[2])
+
+    def test_GET_with_storlets_and_invalid_http_range(self):
+        target = '/v1/AUTH_a/c/o'
+
+        for headers in ({'Range': 'bytes=1-3,5-6'},
+                        {'Range': 'bytes=10-'},
+                        {'Range': 'bytes=-10'},
+                        {'Range': 'bytes=1-3',
+                         'X-Storlet-Output-Limit': '10'}):
+            headers['X-Run-Storlet'] = 'Storlet-1.0.jar'
+            with storlet_enabled():
+                resp = self.get_request_response(target, 'GET',
+                                                 headers=headers)
+                self.assertEqual('400 Bad Request', resp.status)
+            self.assertEqual([], self.base_app.get_calls())
+
+    def test_GET_with_storlets_and_invalid_output_limit(self):
+        target = '/v1/AUTH_a/c/o'
+
+        for limit in ('foo', '-1', '1.5'):
+            with storlet_enabled():
+                headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                           'X-Storlet-Output-Limit': limit}
+                resp = self.get_request_response(target, 'GET',
+                                                 headers=headers)
+                self.assertEqual('400 Bad Request', resp.status)
+
+    def test_PUT_with_storlets_and_output_limit(self):
+        target = '/v1/AUTH_a/c/o'
+
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'X-Storlet-Output-Limit': '10'}
+            resp = self.get_request_response(target, 'PUT', headers=headers,
+                                             body=b'FAKE APP')
             self.assertEqual('400 Bad Request', resp.status)
+            self.assertEqual([], self.base_app.get_calls())
 
     def test_GET_with_storlets_and_storlet_range(self):
         target = '/v1/AUTH_a/c/o'
@@ -220,6 +393,666 @@ class TestStorletMiddlewareProxy(BaseTestStorletMiddleware):
             calls = self.base_app.get_calls()
             self.assertEqual(2, len(calls))
 
+    def _register_slo_manifest(self, target, manifest):
+        def manifest_resp(req, headers, body, conditional_response):
+            if req.params.get('multipart-manifest') == 'get':
+                return HTTPOk(req=req, body=json.dumps(manifest).encode(),
+                              headers={'Content-Type': 'application/json'})
+            return HTTPOk(req=req, headers=headers, body=body,
+                          conditional_response=conditional_response)
+
+        self.base_app.register('GET', target, manifest_resp,
+                               headers={'x-static-large-object': 'True'},
+                               body=b'FAKE APP')
+
+    def test_GET_slo_with_segment_mappable_storlets(self):
+        target = '/v1/AUTH_a/c/slo_manifest'
+        self._register_slo_manifest(target, [
+            {'name': '/segments/seg1'},
+            {'name': '/segments/seg2', 'range': '1-2'},
+            {'name': '/segments/seg3'}])
+        for i in range(1, 4):
+            self.base_app.register(
+                'GET', '/v1/AUTH_a/segments/seg%d' % i, HTTPOk,
+                headers={'Content-Type': 'text/plain'},
+                body=('output%d;' % i).encode())
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register(
+            'GET', storlet, HTTPOk,
+            headers={'X-Object-Meta-Storlet-Segment-Mappable': 'True'},
+            body=b'jar binary')
+
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'X-Storlet-Foo': 'bar'}
+            resp = self.get_request_response(target, 'GET', headers=headers)
+            self.assertEqual('200 OK', resp.status)
+            self.assertEqual(b'output1;output2;output3;', resp.body)
+            self.assertEqual('text/plain', resp.headers['Content-Type'])
+
+            # The storlet is invoked on each segment
+            for i in range(1, 4):
+                calls = self.base_app.get_calls(
+                    'GET', '/v1/AUTH_a/segments/seg%d' % i)
+                self.assertEqual(1, len(calls))
+                self.assertEqual('Storlet-1.0.jar',
+                                 calls[0][2]['X-Run-Storlet'])
+                self.assertEqual('bar', calls[0][2]['X-Storlet-Foo'])
+                if i == 2:
+                    self.assertEqual('bytes=1-2',
+                                     calls[0][2]['X-Storlet-Range'])
+                else:
+                    self.assertNotIn('X-Storlet-Range', calls[0][2])
+
+    def test_GET_slo_with_segment_mappable_storlets_quoted(self):
+        target = '/v1/AUTH_a/c/slo_manifest'
+        self._register_slo_manifest(target, [
+            {'name': u'/segments/seg 1%'},
+            {'name': u'/segments/seg\u00e92?'}])
+        self.base_app.register('GET', '/v1/AUTH_a/segments/seg%201%25',
+                               HTTPOk, body=b'output1;')
+        self.base_app.register('GET', '/v1/AUTH_a/segments/seg%C3%A92%3F',
+                               HTTPOk, body=b'output2;')
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register(
+            'GET', storlet, HTTPOk,
+            headers={'X-Object-Meta-Storlet-Segment-Mappable': 'True'},
+            body=b'jar binary')
+
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar'}
+            resp = self.get_request_response(target, 'GET', headers=headers)
+            self.assertEqual('200 OK', resp.status)
+            self.assertEqual(b'output1;output2;', resp.body)
+
+    def test_GET_slo_with_segment_mappable_storlets_failure(self):
+        target = '/v1/AUTH_a/c/slo_manifest'
+        self._register_slo_manifest(target, [
+            {'name': '/segments/seg1'}, {'name': '/segments/seg2'}])
+        self.base_app.register('GET', '/v1/AUTH_a/segments/seg1',
+                               HTTPNotFound, body=b'')
+        self.base_app.register('GET', '/v1/AUTH_a/segments/seg2',
+                               HTTPOk, body=b'output2')
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register(
+            'GET', storlet, HTTPOk,
+            headers={'X-Object-Meta-Storlet-Segment-Mappable': 'True'},
+            body=b'jar binary')
+
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar'}
+            resp = self.get_request_response(target, 'GET', headers=headers)
+            self.assertEqual('404 Not Found', resp.status)
+
+    def test_GET_slo_with_segment_mappable_storlets_sub_slo(self):
+        target = '/v1/AUTH_a/c/slo_manifest'
+        self._register_slo_manifest(target, [
+            {'name': '/segments/seg1'},
+            {'name': '/segments/sub_slo', 'sub_slo': True}])
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register(
+            'GET', storlet, HTTPOk,
+            headers={'X-Object-Meta-Storlet-Segment-Mappable': 'True'},
+            body=b'jar binary')
+
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar'}
+            resp = self.get_request_response(target, 'GET', headers=headers)
+            # The storlet is invoked on the whole object
+            self.assertEqual('200 OK', resp.status)
+            self.assertEqual(b'FAKE APP', resp.body)
+            self.assertEqual(
+                0, len(self.base_app.get_calls(
+                    'GET', '/v1/AUTH_a/segments/seg1')))
+
+    def test_GET_slo_with_storlets_and_reduce(self):
+        target = '/v1/AUTH_a/c/slo_manifest'
+        self.base_app.register('GET', target, HTTPOk,
+                               headers={'x-static-large-object': 'True'},
+                               body=b'FAKE APP')
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register('GET', storlet, HTTPOk, body=b'jar binary')
+        reduce_storlet = '/v1/AUTH_a/storlet/reduce.py'
+        self.base_app.register(
+            'GET', reduce_storlet, HTTPOk,
+            headers={'X-Object-Meta-Storlet-Language': 'python'},
+            body=b'reduce')
+
+        called = []
+
+        def fake_invocation_flow(sreq, extra_resources=None):
+            called.append(sreq)
+            data = b''.join(sreq.data_iter)
+            if sreq.storlet_id == 'reduce.py':
+                data = data.upper()
+            return StorletResponse({}, data_iter=iter([data]))
+
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'X-Storlet-Reduce': 'reduce.py'}
+            req = Request.blank(target, environ={'REQUEST_METHOD': 'GET'},
+                                headers=headers)
+            app = self.get_app(self.base_app, self.conf)
+            with mock.patch('storlets.gateway.gateways.stub.'
+                            'StorletGatewayStub.invocation_flow',
+                            side_effect=fake_invocation_flow):
+                resp = req.get_response(app)
+            self.assertEqual('200 OK', resp.status)
+            self.assertEqual(b'FAKE APP'.upper(), resp.body)
+            self.assertEqual(['Storlet-1.0.jar', 'reduce.py'],
+                             [sreq.storlet_id for sreq in called])
+            self.assertEqual(
+                1, len(self.base_app.get_calls('HEAD', reduce_storlet)))
+
+    def test_GET_with_storlets_and_reduce_and_http_range(self):
+        target = '/v1/AUTH_a/c/o'
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'X-Storlet-Reduce': 'reduce.py',
+                       'Range': 'bytes=1-3'}
+            resp = self.get_request_response(target, 'GET', headers=headers)
+            self.assertEqual('400 Bad Request', resp.status)
+
+    def _test_GET_with_storlets_and_output_container(self, put_resp_cls):
+        target = '/v1/AUTH_a/c/o'
+        self.base_app.register('GET', target, HTTPOk, body=b'FAKE APP')
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register(
+            'GET', storlet, HTTPOk, body=b'jar binary',
+            headers={'X-Object-Meta-Storlet-Deterministic': 'True'})
+        self.base_app.register('PUT', '/v1/AUTH_a/out/part1', HTTPCreated)
+        self.base_app.register('PUT', '/v1/AUTH_a/out/part2', put_resp_cls)
+
+        called = []
+
+        def fake_invocation_flow(sreq, extra_resources=None):
+            called.append(sreq)
+            extra_outputs = [
+                ('part1', lambda: StorletResponse(
+                    {'key': 'value'}, data_iter=iter([b'part', b'1']))),
+                ('part2', lambda: StorletResponse(
+                    {}, data_iter=iter([b'part2'])))]
+            return StorletResponse({}, data_iter=sreq.data_iter,
+                                   extra_outputs=extra_outputs)
+
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'X-Storlet-Output-Container': 'out',
+                       'X-Storlet-Outputs': '2'}
+            req = Request.blank(target, environ={'REQUEST_METHOD': 'GET'},
+                                headers=headers)
+            app = self.get_app(self.base_app, self.conf)
+            with mock.patch('storlets.gateway.gateways.stub.'
+                            'StorletGatewayStub.invocation_flow',
+                            side_effect=fake_invocation_flow):
+                resp = req.get_response(app)
+                self.assertEqual('200 OK', resp.status)
+                # The storlet runs on proxy, and has to run every time
+                self.assertNotIn('Etag', resp.headers)
+                self.assertEqual(1, len(called))
+                self.assertEqual('out', called[0].options['output_container'])
+                self.assertEqual(2, called[0].options['extra_outputs'])
+                return resp
+
+    def test_GET_with_storlets_and_output_container(self):
+        resp = self._test_GET_with_storlets_and_output_container(HTTPCreated)
+        self.assertEqual(b'FAKE APP', resp.body)
+
+        put_calls = [call for call in self.base_app.get_calls()
+                     if call[0] == 'PUT']
+        self.assertEqual(['/v1/AUTH_a/out/part1', '/v1/AUTH_a/out/part2'],
+                         sorted(call[1] for call in put_calls))
+        put_calls = dict((call[1], call) for call in put_calls)
+        part1 = put_calls['/v1/AUTH_a/out/part1']
+        self.assertEqual(b'part1', part1[3])
+        self.assertEqual('value', part1[2]['X-Object-Meta-Key'])
+        self.assertEqual(b'part2', put_calls['/v1/AUTH_a/out/part2'][3])
+
+    def test_GET_with_storlets_and_output_container_put_failure(self):
+        resp = self._test_GET_with_storlets_and_output_container(
+            HTTPForbidden)
+        with self.assertRaises(StorletRuntimeException):
+            resp.body
+
+    def test_GET_with_storlets_and_invalid_output_container(self):
+        target = '/v1/AUTH_a/c/o'
+        for method, extra_headers in (
+                ('GET', {'Range': 'bytes=1-3'}),
+                ('GET', {'X-Storlet-Output-Limit': '10'}),
+                ('GET', {'X-Storlet-Outputs': '0'}),
+                ('GET', {'X-Storlet-Outputs': '9'}),
+                ('GET', {'X-Storlet-Outputs': 'foo'}),
+                ('GET', {'X-Storlet-Output-Container': 'out/obj'}),
+                ('GET', {'X-Run-Storlet': 'a.py,b.py'}),
+                ('PUT', {})):
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'X-Storlet-Output-Container': 'out'}
+            headers.update(extra_headers)
+            with storlet_enabled():
+                resp = self.get_request_response(target, method,
+                                                 headers=headers)
+            self.assertEqual('400 Bad Request', resp.status, extra_headers)
+
+    def _wait_for_jobs(self, app):
+        job_queue = app.conf['storlet_job_queue']
+        while job_queue.jobs or job_queue.running:
+            eventlet.sleep(0)
+
+    def _get_job_statuses(self, path):
+        return [call[2]['X-Object-Meta-Storlet-Job-Status']
+                for call in self.base_app.get_calls()
+                if call[0] == 'PUT' and call[1] == path]
+
+    def test_GET_with_storlets_async(self):
+        target = '/v1/AUTH_a/c/o'
+        self.base_app.register('GET', target, HTTPOk, body=b'FAKE APP')
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register('GET', storlet, HTTPOk, body=b'jar binary')
+        dest = '/v1/AUTH_a/out/result'
+        self.base_app.register('PUT', dest, HTTPCreated)
+        self.base_app.register('PUT', dest + '.storlet-job', HTTPCreated)
+
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'X-Storlet-Async': 'out/result'}
+            req = Request.blank(target, environ={'REQUEST_METHOD': 'GET'},
+                                headers=headers)
+            app = self.get_app(self.base_app, self.conf)
+            resp = req.get_response(app)
+            self.assertEqual('202 Accepted', resp.status)
+            self.assertEqual('out/result.storlet-job',
+                             resp.headers['X-Storlet-Job-Status-Object'])
+            job_id = resp.headers['X-Storlet-Job-Id']
+            self.assertEqual(['queued'],
+                             self._get_job_statuses(dest + '.storlet-job'))
+
+            self._wait_for_jobs(app)
+
+        self.assertEqual(['queued', 'running', 'completed'],
+                         self._get_job_statuses(dest + '.storlet-job'))
+        status_call = self.base_app.get_calls()[-1]
+        status = json.loads(status_call[3])
+        self.assertEqual(job_id, status['job_id'])
+        self.assertEqual('c/o', status['source'])
+        self.assertEqual('out/result', status['destination'])
+        self.assertEqual('201 Created', status['detail'])
+
+        # The storlet is invoked on the object server, and the output is
+        # stored into the destination
+        get_call = self.base_app.get_calls('GET', target)[0]
+        self.assertEqual('Storlet-1.0.jar', get_call[2]['X-Run-Storlet'])
+        put_call = [call for call in self.base_app.get_calls()
+                    if call[0] == 'PUT' and call[1] == dest][0]
+        self.assertEqual(b'FAKE APP', put_call[3])
+        self.assertNotIn('X-Storlet-Async', put_call[2])
+
+    def test_GET_with_storlets_async_failure(self):
+        target = '/v1/AUTH_a/c/o'
+        self.base_app.register('GET', target, HTTPOk, body=b'FAKE APP')
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register('GET', storlet, HTTPOk, body=b'jar binary')
+        dest = '/v1/AUTH_a/out/result'
+        self.base_app.register('PUT', dest, HTTPForbidden)
+        self.base_app.register('PUT', dest + '.storlet-job', HTTPCreated)
+
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'X-Storlet-Async': 'out/result'}
+            req = Request.blank(target, environ={'REQUEST_METHOD': 'GET'},
+                                headers=headers)
+            app = self.get_app(self.base_app, self.conf)
+            resp = req.get_response(app)
+            self.assertEqual('202 Accepted', resp.status)
+            self._wait_for_jobs(app)
+
+        self.assertEqual(['queued', 'running', 'failed'],
+                         self._get_job_statuses(dest + '.storlet-job'))
+
+    def test_GET_with_storlets_async_not_accepted(self):
+        target = '/v1/AUTH_a/c/o'
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register('GET', storlet, HTTPOk, body=b'jar binary')
+        status_path = '/v1/AUTH_a/out/result.storlet-job'
+        headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                   'X-Storlet-Async': 'out/result'}
+
+        # The client can not write into the destination container
+        self.base_app.register('PUT', status_path, HTTPForbidden)
+        with storlet_enabled():
+            resp = self.get_request_response(target, 'GET', headers=headers)
+        self.assertEqual('403 Forbidden', resp.status)
+
+        # The job queue is full
+        self.base_app.register('PUT', status_path, HTTPCreated)
+        self.conf['storlet_job_queue_size'] = '0'
+        with storlet_enabled():
+            resp = self.get_request_response(target, 'GET', headers=headers)
+        self.assertEqual('503 Service Unavailable', resp.status)
+        self.assertEqual('failed', self._get_job_statuses(status_path)[-1])
+
+    def test_GET_with_storlets_async_bad_request(self):
+        for path, extra_headers in (
+                ('/v1/AUTH_a/c/o', {'X-Storlet-Async': 'out'}),
+                ('/v1/AUTH_a/c/o', {'Range': 'bytes=1-3'}),
+                ('/v1/AUTH_a/c/o', {'X-Storlet-Output-Limit': '10'}),
+                ('/v1/AUTH_a/c/o', {'X-Storlet-Output-Container': 'out'}),
+                ('/v1/AUTH_a/c', {'X-Storlet-Objects': 'o'})):
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'X-Storlet-Async': 'out/result'}
+            headers.update(extra_headers)
+            with storlet_enabled():
+                resp = self.get_request_response(path, 'GET',
+                                                 headers=headers)
+            self.assertEqual('400 Bad Request', resp.status, extra_headers)
+
+    def test_GET_with_storlets_and_partitions(self):
+        target = '/v1/AUTH_a/c/o'
+
+        def partition_resp(req, headers, body, conditional_response):
+            if req.method == 'HEAD':
+                return HTTPOk(req=req, headers={'Content-Length': '100'})
+            return HTTPOk(req=req, body=('%s-%s;' % (
+                req.params['start'], req.params['end'])).encode())
+
+        self.base_app.register('GET', target, partition_resp)
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register('GET', storlet, HTTPOk, body=b'jar binary')
+
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'X-Storlet-Partitions': '3',
+                       'X-Storlet-Max-Record-Line': '5',
+                       'X-Storlet-Parameter-1': 'foo:bar'}
+            resp = self.get_request_response(target, 'GET', headers=headers)
+            self.assertEqual('200 OK', resp.status)
+            self.assertEqual(b'0-33;33-66;66-100;', resp.body)
+
+            calls = self.base_app.get_calls('GET', target)
+            self.assertEqual(3, len(calls))
+            self.assertEqual(
+                ['bytes=0-38', 'bytes=33-71', 'bytes=66-99'],
+                [call[2]['X-Storlet-Range'] for call in calls])
+            for call in calls:
+                self.assertEqual('Storlet-1.0.jar', call[2]['X-Run-Storlet'])
+                self.assertNotIn('X-Storlet-Partitions', call[2])
+                self.assertNotIn('X-Storlet-Parameter-1', call[2])
+
+    def test_GET_with_storlets_and_invalid_partitions(self):
+        target = '/v1/AUTH_a/c/o'
+        with storlet_enabled():
+            for partitions, max_record_line, extra in (
+                    ('0', '5', {}),
+                    ('a', '5', {}),
+                    ('auto', None, {}),
+                    ('auto', '-1', {}),
+                    ('auto', '5', {'X-Storlet-Range': 'bytes=1-10'}),
+                    ('auto', '5', {'X-Storlet-Run-On-Proxy': ''})):
+                headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                           'X-Storlet-Partitions': partitions}
+                if max_record_line is not None:
+                    headers['X-Storlet-Max-Record-Line'] = max_record_line
+                headers.update(extra)
+                resp = self.get_request_response(
+                    target, 'GET', headers=headers)
+                self.assertEqual('400 Bad Request', resp.status)
+
+    def _register_container_listing(self, container, names, page_size=2):
+        def listing_resp(req, headers, body, conditional_response):
+            marker = req.params.get('marker', '')
+            prefix = req.params.get('prefix', '')
+            page = [{'name': name} for name in names
+                    if name > marker and name.startswith(prefix)]
+            return HTTPOk(req=req, body=json.dumps(page[:page_size]).encode(),
+                          headers={'Content-Type': 'application/json'})
+
+        self.base_app.register('GET', container, listing_resp)
+        for name in names:
+            self.base_app.register(
+                'GET', '%s/%s' % (container, name), HTTPOk,
+                headers={'Content-Type': 'text/plain'},
+                body=('%s;' % name).encode())
+
+    def test_GET_container_with_storlets_and_prefix(self):
+        container = '/v1/AUTH_a/c'
+        self._register_container_listing(
+            container, ['a1', 'a2', 'a3', 'b1'])
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register('GET', storlet, HTTPOk, body=b'jar binary')
+
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'X-Storlet-Prefix': 'a'}
+            resp = self.get_request_response(
+                container, 'GET', headers=headers)
+            self.assertEqual('200 OK', resp.status)
+            self.assertEqual(b'a1;a2;a3;', resp.body)
+            self.assertEqual('text/plain', resp.headers['Content-Type'])
+
+            # The storlet is verified only once
+            self.assertEqual(1, len(self.base_app.get_calls('HEAD', storlet)))
+            for name in ('a1', 'a2', 'a3'):
+                calls = self.base_app.get_calls(
+                    'GET', '%s/%s' % (container, name))
+                self.assertEqual(1, len(calls))
+                self.assertEqual('Storlet-1.0.jar',
+                                 calls[0][2]['X-Run-Storlet'])
+                self.assertNotIn('X-Storlet-Prefix', calls[0][2])
+            self.assertEqual(
+                0, len(self.base_app.get_calls('GET', container + '/b1')))
+
+    def test_GET_container_with_storlets_and_object_list(self):
+        container = '/v1/AUTH_a/c'
+        self._register_container_listing(container, ['a1', 'a2', 'b1'])
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register('GET', storlet, HTTPOk, body=b'jar binary')
+
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'X-Storlet-Objects': 'b1,a1'}
+            resp = self.get_request_response(
+                container, 'GET', headers=headers)
+            self.assertEqual('200 OK', resp.status)
+            self.assertEqual(b'b1;a1;', resp.body)
+            # The container is not listed
+            self.assertEqual(
+                0, len(self.base_app.get_calls('GET', container)))
+
+            # The failure after the first object breaks the output
+            self.base_app.register('GET', container + '/missing',
+                                   HTTPNotFound, body=b'')
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'X-Storlet-Objects': 'a1,missing'}
+            resp = self.get_request_response(
+                container, 'GET', headers=headers)
+            self.assertEqual('200 OK', resp.status)
+            with self.assertRaises(StorletRuntimeException):
+                resp.body
+
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'X-Storlet-Objects': ','}
+            resp = self.get_request_response(
+                container, 'GET', headers=headers)
+            self.assertEqual('400 Bad Request', resp.status)
+
+    def test_GET_container_with_storlets_empty(self):
+        container = '/v1/AUTH_a/c'
+        self._register_container_listing(container, [])
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register('GET', storlet, HTTPOk, body=b'jar binary')
+
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'X-Storlet-Prefix': ''}
+            resp = self.get_request_response(
+                container, 'GET', headers=headers)
+            self.assertEqual('200 OK', resp.status)
+            self.assertEqual(b'', resp.body)
+
+    def _register_bulk_objects(self):
+        for name in ('o1', 'o2'):
+            self.base_app.register(
+                'GET', '/v1/AUTH_a/c/%s' % name, HTTPOk,
+                headers={'Content-Type': 'text/plain'},
+                body=('output of %s' % name).encode())
+        self.base_app.register('GET', '/v1/AUTH_a/c/missing',
+                               HTTPNotFound, body=b'')
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register('GET', storlet, HTTPOk, body=b'jar binary')
+
+    def test_POST_bulk_with_storlets(self):
+        self._register_bulk_objects()
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'X-Storlet-Parameter-1': 'foo:bar'}
+            resp = self.get_request_response(
+                '/v1/AUTH_a?bulk-storlet', 'POST', headers=headers,
+                body=b'c/o1\n/c/missing\n\n/c/o2\n/bad\n')
+            self.assertEqual('200 OK', resp.status)
+            content_type, boundary = resp.headers['Content-Type'].split(
+                '; boundary=')
+            self.assertEqual('multipart/mixed', content_type)
+
+            parts = resp.body.split(('--%s' % boundary).encode())
+            self.assertEqual(b'--\r\n', parts[-1])
+            self.assertEqual(
+                [b'\r\nContent-Location: /c/o1\r\n'
+                 b'X-Storlet-Status: 200 OK\r\n'
+                 b'Content-Type: text/plain\r\n\r\n'
+                 b'output of o1\r\n',
+                 b'\r\nContent-Location: /c/missing\r\n'
+                 b'X-Storlet-Status: 404 Not Found\r\n\r\n\r\n',
+                 b'\r\nContent-Location: /c/o2\r\n'
+                 b'X-Storlet-Status: 200 OK\r\n'
+                 b'Content-Type: text/plain\r\n\r\n'
+                 b'output of o2\r\n',
+                 b'\r\nContent-Location: /bad\r\n'
+                 b'X-Storlet-Status: 400 Bad Request\r\n\r\n\r\n'],
+                parts[1:-1])
+
+            # The storlet is verified only once
+            self.assertEqual(1, len(self.base_app.get_calls(
+                'HEAD', '/v1/AUTH_a/storlet/Storlet-1.0.jar')))
+            calls = self.base_app.get_calls('GET', '/v1/AUTH_a/c/o1')
+            self.assertEqual('Storlet-1.0.jar', calls[0][2]['X-Run-Storlet'])
+            self.assertNotIn('X-Storlet-Parameter-1', calls[0][2])
+
+    def test_POST_bulk_with_storlets_tar(self):
+        self._register_bulk_objects()
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'Accept': 'application/x-tar'}
+            resp = self.get_request_response(
+                '/v1/AUTH_a?bulk-storlet', 'POST', headers=headers,
+                body=b'/c/o1\n/c/missing\n/c/o2\n')
+            self.assertEqual('200 OK', resp.status)
+            self.assertEqual('application/x-tar',
+                             resp.headers['Content-Type'])
+
+            with tarfile.open(fileobj=BytesIO(resp.body)) as tar:
+                self.assertEqual(
+                    ['c/o1', 'c/o2', 'storlet-bulk-status.json'],
+                    tar.getnames())
+                self.assertEqual(b'output of o2',
+                                 tar.extractfile('c/o2').read())
+                self.assertEqual(
+                    [{'name': '/c/o1', 'status': '200 OK'},
+                     {'name': '/c/missing', 'status': '404 Not Found'},
+                     {'name': '/c/o2', 'status': '200 OK'}],
+                    json.loads(tar.extractfile(
+                        'storlet-bulk-status.json').read()))
+
+    def test_POST_bulk_with_storlets_errors(self):
+        self._register_bulk_objects()
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'Accept': 'text/plain'}
+            resp = self.get_request_response(
+                '/v1/AUTH_a?bulk-storlet', 'POST', headers=headers,
+                body=b'/c/o1\n')
+            self.assertEqual('406 Not Acceptable', resp.status)
+
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'X-Storlet-Range': 'bytes=1-2'}
+            resp = self.get_request_response(
+                '/v1/AUTH_a?bulk-storlet', 'POST', headers=headers,
+                body=b'/c/o1\n')
+            self.assertEqual('400 Bad Request', resp.status)
+
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar'}
+            self.conf['storlet_bulk_max_objects'] = '1'
+            resp = self.get_request_response(
+                '/v1/AUTH_a?bulk-storlet', 'POST', headers=headers,
+                body=b'/c/o1\n/c/o2\n')
+            self.assertEqual('413 Request Entity Too Large', resp.status)
+
+    def test_GET_with_storlet_pipeline(self):
+        target = '/v1/AUTH_a/c/o'
+        self.base_app.register('GET', target, HTTPOk, body=b'FAKE RESULT')
+        self.base_app.register(
+            'GET', '/v1/AUTH_a/storlet/first.py', HTTPOk,
+            headers={'X-Object-Meta-Storlet-Main': 'first.First',
+                     'X-Object-Meta-Storlet-Deterministic': 'True'},
+            body=b'first')
+        self.base_app.register(
+            'GET', '/v1/AUTH_a/storlet/second.py', HTTPOk,
+            headers={'X-Object-Meta-Storlet-Main': 'second.Second',
+                     'X-Object-Meta-Storlet-Language': 'python',
+                     'X-Object-Meta-Storlet-Trailing-Metadata': 'True'},
+            body=b'second')
+
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'first.py,second.py',
+                       'X-Storlet-Parameter-1': 'foo:bar',
+                       'X-Storlet-Stage-2-Parameter-1': 'baz:qux',
+                       'X-Storlet-Pipeline': 'forged'}
+            resp = self.get_request_response(target, 'GET', headers=headers)
+            self.assertEqual('200 OK', resp.status)
+
+            # Access to each storlet is verified
+            for storlet in ('first.py', 'second.py'):
+                self.assertEqual(1, len(self.base_app.get_calls(
+                    'HEAD', '/v1/AUTH_a/storlet/%s' % storlet)))
+
+            req_headers = self.base_app.get_calls('GET', target)[0][2]
+            self.assertEqual('first.py', req_headers['X-Run-Storlet'])
+            self.assertEqual('first.First', req_headers['X-Storlet-Main'])
+            self.assertEqual('foo:bar', req_headers['X-Storlet-Parameter-1'])
+            self.assertNotIn('X-Storlet-Stage-2-Parameter-1', req_headers)
+            # The properties of the first storlet do not hold for the
+            # pipeline, while the last one sends the output
+            self.assertNotIn('X-Storlet-Deterministic', req_headers)
+            self.assertEqual('True',
+                             req_headers['X-Storlet-Trailing-Metadata'])
+
+            pipeline = json.loads(req_headers['X-Storlet-Pipeline'])
+            self.assertEqual(1, len(pipeline))
+            self.assertEqual('second.py', pipeline[0]['storlet'])
+            self.assertEqual({'baz': 'qux'}, pipeline[0]['params'])
+            self.assertEqual('second.Second',
+                             pipeline[0]['options']['storlet_main'])
+            self.assertEqual('python',
+                             pipeline[0]['options']['storlet_language'])
+
+    def test_GET_with_storlet_pipeline_errors(self):
+        target = '/v1/AUTH_a/c/o'
+        self.base_app.register('GET', target, HTTPOk, body=b'FAKE RESULT')
+        self.base_app.register('GET', '/v1/AUTH_a/storlet/first.py', HTTPOk,
+                               body=b'first')
+        self.base_app.register('GET', '/v1/AUTH_a/storlet/second.py',
+                               HTTPNotFound, body=b'')
+
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'first.py,second.py'}
+            resp = self.get_request_response(target, 'GET', headers=headers)
+            self.assertEqual('401 Unauthorized', resp.status)
+
+            self.base_app.register('GET', '/v1/AUTH_a/storlet/second.py',
+                                   HTTPOk, body=b'second')
+            headers = {'X-Run-Storlet': 'first.py,second.py',
+                       'X-Storlet-Stage-3-Parameter-1': 'baz:qux'}
+            resp = self.get_request_response(target, 'GET', headers=headers)
+            self.assertEqual('400 Bad Request', resp.status)
+
     def test_GET_with_storlets_no_object(self):
         target = '/v1/AUTH_a/c/'
         self.base_app.register('GET', target, HTTPOk,
@@ -272,6 +1105,314 @@ class TestStorletMiddlewareProxy(BaseTestStorletMiddleware):
             self.assertEqual(target, calls[-1][1])
             self.assertEqual(b'FAKE APP', calls[-1][3])
 
+    def test_PUT_with_materialized_storlets(self):
+        target = '/v1/AUTH_a/c/o'
+        self.base_app.register('PUT', target, HTTPCreated, body=b'')
+        self.base_app.register('GET', target, HTTPOk, body=b'FAKE APP',
+                               headers={'X-Timestamp': '1500000000.00000',
+                                        'X-Object-Meta-Key': 'value'})
+        materialized = '/v1/AUTH_a/storletmaterialized/' \
+            'Storlet-1.0.jar/c/o'
+        self.base_app.register('PUT', materialized, HTTPCreated, body=b'')
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register(
+            'GET', storlet, HTTPOk, body=b'jar binary',
+            headers={'X-Object-Meta-Storlet-Materialize': 'True'})
+
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'If-None-Match': '*'}
+            resp = self.get_request_response(
+                target + '?param=value', 'PUT', headers=headers,
+                body=b'FAKE APP')
+            self.assertEqual('201 Created', resp.status)
+
+            # The object is stored as it is
+            put_calls = self.base_app.get_calls('PUT', target)
+            self.assertEqual(1, len(put_calls))
+            self.assertEqual(b'FAKE APP', put_calls[0][3])
+            self.assertNotIn('X-Run-Storlet', put_calls[0][2])
+            self.assertEqual('*', put_calls[0][2]['If-None-Match'])
+
+            # The storlet is run on the stored object
+            get_calls = self.base_app.get_calls('GET', target)
+            self.assertEqual(1, len(get_calls))
+            self.assertEqual('Storlet-1.0.jar',
+                             get_calls[0][2]['X-Run-Storlet'])
+            self.assertNotIn('If-None-Match', get_calls[0][2])
+
+            put_calls = self.base_app.get_calls('PUT', materialized)
+            self.assertEqual(1, len(put_calls))
+            self.assertEqual(b'FAKE APP', put_calls[0][3])
+            self.assertEqual('value', put_calls[0][2]['X-Object-Meta-Key'])
+            self.assertEqual(
+                '1500000000.00000',
+                put_calls[0][2]['X-Object-Sysmeta-Storlet-Source-Timestamp'])
+            self.assertEqual(
+                '[["param", "value"]]',
+                put_calls[0][2]['X-Object-Sysmeta-Storlet-Parameters'])
+
+    def test_PUT_with_materialized_storlets_failure(self):
+        target = '/v1/AUTH_a/c/o'
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register(
+            'GET', storlet, HTTPOk, body=b'jar binary',
+            headers={'X-Object-Meta-Storlet-Materialize': 'True'})
+        materialized = '/v1/AUTH_a/storletmaterialized/' \
+            'Storlet-1.0.jar/c/o'
+
+        # The object PUT fails
+        self.base_app.register('PUT', target, HTTPNotFound, body=b'')
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar'}
+            resp = self.get_request_response(target, 'PUT', headers=headers,
+                                             body=b'FAKE APP')
+            self.assertEqual('404 Not Found', resp.status)
+            self.assertEqual([], self.base_app.get_calls('GET', target))
+
+        # The materialized output PUT fails
+        self.base_app.reset_calls()
+        self.base_app.register('PUT', target, HTTPCreated, body=b'')
+        self.base_app.register('GET', target, HTTPOk, body=b'FAKE APP',
+                               headers={'X-Timestamp': '1500000000.00000'})
+        self.base_app.register('PUT', materialized, HTTPNotFound, body=b'')
+        with storlet_enabled():
+            resp = self.get_request_response(target, 'PUT', headers=headers,
+                                             body=b'FAKE APP')
+            self.assertEqual('201 Created', resp.status)
+            self.assertEqual(
+                1, len(self.base_app.get_calls('PUT', materialized)))
+
+    def _get_authorizing_app(self, denied):
+        # Authorize the requests like the proxy server does, with the
+        # swift.authorize callback the client request comes with
+        def fake_app(env, start_response):
+            if 'swift.authorize' in env:
+                resp = env['swift.authorize'](Request(env))
+                if resp:
+                    return resp(env, start_response)
+            return self.base_app(env, start_response)
+
+        def authorize(req):
+            if (req.method, req.path) in denied:
+                return HTTPForbidden(request=req)
+
+        return self.get_app(fake_app, self.conf), authorize
+
+    def test_PUT_with_materialized_storlets_authorization(self):
+        target = '/v1/AUTH_a/c/o'
+        self.base_app.register('PUT', target, HTTPCreated, body=b'')
+        self.base_app.register('GET', target, HTTPOk, body=b'FAKE APP',
+                               headers={'X-Timestamp': '1500000000.00000'})
+        materialized = '/v1/AUTH_a/storletmaterialized/' \
+            'Storlet-1.0.jar/c/o'
+        self.base_app.register('PUT', materialized, HTTPCreated, body=b'')
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register(
+            'GET', storlet, HTTPOk, body=b'jar binary',
+            headers={'X-Object-Meta-Storlet-Materialize': 'True'})
+
+        # The client can not access the materialized container directly
+        app, authorize = self._get_authorizing_app(
+            [('PUT', materialized)])
+        with storlet_enabled():
+            req = Request.blank(
+                target, headers={'X-Run-Storlet': 'Storlet-1.0.jar'},
+                environ={'REQUEST_METHOD': 'PUT',
+                         'swift.authorize': authorize},
+                body=b'FAKE APP')
+            resp = req.get_response(app)
+            self.assertEqual('201 Created', resp.status)
+            self.assertEqual(
+                1, len(self.base_app.get_calls('PUT', materialized)))
+
+        # The client can write the object, but can not read it
+        self.base_app.reset_calls()
+        app, authorize = self._get_authorizing_app(
+            [('PUT', materialized), ('GET', target)])
+        with storlet_enabled():
+            req = Request.blank(
+                target, headers={'X-Run-Storlet': 'Storlet-1.0.jar'},
+                environ={'REQUEST_METHOD': 'PUT',
+                         'swift.authorize': authorize},
+                body=b'FAKE APP')
+            resp = req.get_response(app)
+            self.assertEqual('201 Created', resp.status)
+            self.assertEqual([], self.base_app.get_calls('GET', target))
+            self.assertEqual(
+                [], self.base_app.get_calls('PUT', materialized))
+
+    def test_PUT_with_materialized_storlets_extra_resources(self):
+        target = '/v1/AUTH_a/c/o'
+        self.base_app.register('PUT', target, HTTPCreated, body=b'')
+        self.base_app.register('GET', target, HTTPOk, body=b'FAKE APP',
+                               headers={'X-Timestamp': '1500000000.00000'})
+        extra_target = '/v1/AUTH_a/c2/o2'
+        self.base_app.register('GET', extra_target, HTTPOk, body=b'Whooa')
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register(
+            'GET', storlet, HTTPOk, body=b'jar binary',
+            headers={'X-Object-Meta-Storlet-Materialize': 'True'})
+
+        # The output is not materialized
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'X-Storlet-Extra-Resources': '/c2/o2'}
+            resp = self.get_request_response(target, 'PUT', headers=headers,
+                                             body=b'FAKE APP')
+            self.assertEqual('201 Created', resp.status)
+            calls = self.base_app.get_calls()
+            self.assertEqual(['HEAD', 'PUT'], [call[0] for call in calls])
+            self.assertEqual(target, calls[-1][1])
+
+    def test_GET_with_storlets_unreadable_extra_resource(self):
+        target = '/v1/AUTH_a/c/o'
+        self.base_app.register('GET', target, HTTPOk, body=b'FAKE APP')
+        extra_target = '/v1/AUTH_a/c2/o2'
+        self.base_app.register('GET', extra_target, HTTPOk, body=b'Whooa')
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register(
+            'GET', storlet, HTTPOk, body=b'jar binary',
+            headers={'X-Object-Meta-Storlet-Materialize': 'True'})
+
+        app, authorize = self._get_authorizing_app(
+            [('GET', extra_target)])
+        with storlet_enabled():
+            req = Request.blank(
+                target, headers={'X-Run-Storlet': 'Storlet-1.0.jar',
+                                 'X-Storlet-Extra-Resources': '/c2/o2'},
+                environ={'REQUEST_METHOD': 'GET',
+                         'swift.authorize': authorize})
+            resp = req.get_response(app)
+            self.assertEqual('403 Forbidden', resp.status)
+            self.assertEqual(
+                [], self.base_app.get_calls('GET', extra_target))
+
+    def _register_materialized_output(self, source_timestamp, params):
+        target = '/v1/AUTH_a/c/o'
+        self.base_app.register('GET', target, HTTPOk, body=b'FAKE APP',
+                               headers={'X-Timestamp': '1500000000.00000'})
+        materialized = '/v1/AUTH_a/storletmaterialized/' \
+            'Storlet-1.0.jar/c/o'
+        self.base_app.register(
+            'GET', materialized, HTTPOk, body=b'MATERIALIZED',
+            headers={'X-Object-Sysmeta-Storlet-Source-Timestamp':
+                     source_timestamp,
+                     'X-Object-Sysmeta-Storlet-Parameters': params})
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register(
+            'GET', storlet, HTTPOk, body=b'jar binary',
+            headers={'X-Object-Meta-Storlet-Materialize': 'True'})
+        return target, materialized
+
+    def test_GET_with_materialized_storlets(self):
+        target, materialized = self._register_materialized_output(
+            '1500000000.00000', '[]')
+
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar'}
+            resp = self.get_request_response(target, 'GET', headers=headers)
+            self.assertEqual('200 OK', resp.status)
+            self.assertEqual(b'MATERIALIZED', resp.body)
+            self.assertNotIn('X-Object-Sysmeta-Storlet-Source-Timestamp',
+                             resp.headers)
+            self.assertEqual([], self.base_app.get_calls('GET', target))
+            self.assertEqual(1, len(self.base_app.get_calls('HEAD', target)))
+
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'Range': 'bytes=1-3'}
+            resp = self.get_request_response(target, 'GET', headers=headers)
+            self.assertEqual('206 Partial Content', resp.status)
+            self.assertEqual(b'ATE', resp.body)
+            self.assertEqual('bytes 1-3/12', resp.headers['Content-Range'])
+
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar',
+                       'X-Storlet-Output-Limit': '3'}
+            resp = self.get_request_response(target, 'GET', headers=headers)
+            self.assertEqual('200 OK', resp.status)
+            self.assertEqual(b'MAT', resp.body)
+            self.assertNotIn('Content-Range', resp.headers)
+
+    def test_GET_with_materialized_storlets_quoted(self):
+        target = '/v1/AUTH_a/c/o%25%3F%20'
+        self.base_app.register('HEAD', target, HTTPOk,
+                               headers={'X-Timestamp': '1500000000.00000'})
+        materialized = '/v1/AUTH_a/storletmaterialized/' \
+            'Storlet-1.0.jar/c/o%25%3F%20'
+        self.base_app.register(
+            'GET', materialized, HTTPOk, body=b'MATERIALIZED',
+            headers={'X-Object-Sysmeta-Storlet-Source-Timestamp':
+                     '1500000000.00000',
+                     'X-Object-Sysmeta-Storlet-Parameters': '[]'})
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register(
+            'GET', storlet, HTTPOk, body=b'jar binary',
+            headers={'X-Object-Meta-Storlet-Materialize': 'True'})
+
+        with storlet_enabled():
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar'}
+            resp = self.get_request_response(target, 'GET', headers=headers)
+            self.assertEqual('200 OK', resp.status)
+            self.assertEqual(b'MATERIALIZED', resp.body)
+
+    def test_GET_with_materialized_storlets_outdated(self):
+        for timestamp, params in (('1400000000.00000', '[]'),
+                                  ('1500000000.00000', '[["a", "b"]]')):
+            self.base_app.reset_all()
+            target, materialized = self._register_materialized_output(
+                timestamp, params)
+            with storlet_enabled():
+                headers = {'X-Run-Storlet': 'Storlet-1.0.jar'}
+                resp = self.get_request_response(target, 'GET',
+                                                 headers=headers)
+                self.assertEqual('200 OK', resp.status)
+                self.assertEqual(b'FAKE APP', resp.body)
+                self.assertEqual(
+                    1, len(self.base_app.get_calls('GET', materialized)))
+                self.assertEqual(
+                    1, len(self.base_app.get_calls('GET', target)))
+
+    def test_PUT_with_storlets_trailing_metadata(self):
+        target = '/v1/AUTH_a/c/o'
+        self.base_app.register('PUT', target, HTTPCreated, body=b'')
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register(
+            'GET', storlet, HTTPOk, body=b'jar binary',
+            headers={'X-Object-Meta-Storlet-Trailing-Metadata': 'True'})
+
+        footers = {}
+
+        def fake_app(env, start_response):
+            resp = self.base_app(env, start_response)
+            if env['REQUEST_METHOD'] == 'PUT':
+                env['swift.callback.update_footers'](footers)
+            return resp
+
+        def fake_invocation_flow(sreq, extra_resources=None):
+            self.assertEqual(
+                'True', sreq.options.get('storlet_trailing_metadata'))
+            return StorletResponse(
+                {}, sreq.data_iter,
+                trailing_metadata_reader=lambda discard: {'Key': 'Value'})
+
+        with storlet_enabled(), \
+                mock.patch('storlets.gateway.gateways.stub.'
+                           'StorletGatewayStub.invocation_flow',
+                           side_effect=fake_invocation_flow):
+            app = self.get_app(fake_app, self.conf)
+            headers = {'X-Run-Storlet': 'Storlet-1.0.jar'}
+            req = Request.blank(target, environ={'REQUEST_METHOD': 'PUT'},
+                                headers=headers, body=b'FAKE APP')
+            resp = req.get_response(app)
+            self.assertEqual('201 Created', resp.status)
+
+            calls = self.base_app.get_calls()
+            self.assertEqual('PUT', calls[-1][0])
+            self.assertEqual(b'FAKE APP', calls[-1][3])
+            self.assertEqual({'X-Object-Meta-Key': 'Value'}, footers)
+
     def test_PUT_with_storlets_no_object(self):
         target = '/v1/AUTH_a/c/'
         self.base_app.register('PUT', target, HTTPCreated)
@@ -655,6 +1796,123 @@ class TestStorletMiddlewareProxy(BaseTestStorletMiddleware):
             self.assertEqual('403 Forbidden', resp.status)
 
 
+class FakeAppIter(object):
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.closed = False
+
+    def __iter__(self):
+        return self.chunks
+
+    def close(self):
+        self.closed = True
+
+
+class TestStorletJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = StorletJobQueue(2, 1, FakeLogger())
+        self.events = {}
+        self.done = []
+
+    def _job(self, name):
+        self.events[name] = eventlet.event.Event()
+        self.events[name].wait()
+        self.done.append(name)
+
+    def test_from_conf(self):
+        queue = StorletJobQueue.from_conf({}, FakeLogger())
+        self.assertEqual(4, queue.max_running)
+        self.assertEqual(100, queue.max_queued)
+        queue = StorletJobQueue.from_conf(
+            {'storlet_max_jobs': '2', 'storlet_job_queue_size': '5'},
+            FakeLogger())
+        self.assertEqual(2, queue.max_running)
+        self.assertEqual(5, queue.max_queued)
+
+    def test_submit(self):
+        self.assertTrue(self.queue.submit(self._job, 'a'))
+        self.assertTrue(self.queue.submit(self._job, 'b'))
+        self.assertTrue(self.queue.submit(self._job, 'c'))
+        # Both of the running jobs and the waiting job use the queue up
+        self.assertFalse(self.queue.submit(self._job, 'd'))
+        eventlet.sleep(0)
+        self.assertEqual(['a', 'b'], sorted(self.events))
+        self.assertEqual(1, len(self.queue.jobs))
+
+        self.events['a'].send()
+        eventlet.sleep(0)
+        eventlet.sleep(0)
+        self.assertEqual(['a'], self.done)
+        self.assertEqual(['a', 'b', 'c'], sorted(self.events))
+        self.assertEqual(2, self.queue.running)
+
+        self.events['b'].send()
+        self.events['c'].send()
+        while self.queue.running:
+            eventlet.sleep(0)
+        self.assertEqual(['a', 'b', 'c'], sorted(self.done))
+
+    def test_failed_job(self):
+        def failed_job():
+            raise Exception('boom')
+
+        self.assertTrue(self.queue.submit(failed_job))
+        while self.queue.running:
+            eventlet.sleep(0)
+        self.assertEqual(
+            1, len(self.queue.logger.get_log_lines('exception')))
+
+
+class TestParallelOutputIterator(unittest.TestCase):
+
+    def setUp(self):
+        self.invoked = []
+        self.app_iters = {}
+
+    def _invoke(self, item):
+        self.invoked.append(item)
+        if item == 'error':
+            return HTTPNotFound()
+        app_iter = FakeAppIter([item.encode(), b';'])
+        self.app_iters[item] = app_iter
+        return HTTPOk(app_iter=app_iter)
+
+    def test_iter(self):
+        items = ['a', 'b', 'c', 'd']
+        app_iter = ParallelOutputIterator(self._invoke, items, 2)
+        self.assertEqual(b'a;b;c;d;', b''.join(app_iter))
+        self.assertEqual(items, self.invoked)
+        self.assertTrue(all(i.closed for i in self.app_iters.values()))
+
+    def test_bounded_concurrency(self):
+        app_iter = ParallelOutputIterator(self._invoke, ['a', 'b', 'c'], 2)
+        # Only the first two invocations are spawned
+        self.assertEqual(2, len(app_iter.pending))
+        self.assertEqual(b'a', next(app_iter))
+        self.assertEqual(2, len(app_iter.pending))
+        self.assertEqual(b';', next(app_iter))
+        self.assertEqual(b'b', next(app_iter))
+        self.assertEqual(1, len(app_iter.pending))
+
+    def test_failure(self):
+        app_iter = ParallelOutputIterator(
+            self._invoke, ['a', 'error', 'c'], 3)
+        self.assertEqual(b'a', next(app_iter))
+        self.assertEqual(b';', next(app_iter))
+        with self.assertRaises(StorletRuntimeException):
+            next(app_iter)
+        self.assertEqual(0, len(app_iter.pending))
+        self.assertTrue(self.app_iters['c'].closed)
+
+    def test_close(self):
+        app_iter = ParallelOutputIterator(self._invoke, ['a', 'b', 'c'], 2)
+        self.assertEqual(b'a', next(app_iter))
+        app_iter.close()
+        self.assertEqual(0, len(app_iter.pending))
+        self.assertTrue(all(i.closed for i in self.app_iters.values()))
+
+
 class TestStorletProxyHandler(unittest.TestCase):
     def setUp(self):
         self.handler_class = StorletProxyHandler
@@ -725,6 +1983,37 @@ class TestStorletProxyHandler(unittest.TestCase):
         self.assertNotIn('X-Object-Meta-Storlet-Key3', headers)
         self.assertEqual('Value4', headers['X-Object-Meta-Key4'])
 
+    def test_get_partitions(self):
+        req = Request.blank(
+            '/v1/acc/cont/obj', environ={'REQUEST_METHOD': 'GET'},
+            headers={'X-Run-Storlet': 'Storlet-1.0.jar',
+                     'X-Storlet-Partitions': 'auto',
+                     'X-Storlet-Max-Record-Line': '10'})
+        with storlet_enabled():
+            handler = self.handler_class(
+                req, self.conf, self.gateway_conf, mock.MagicMock(),
+                mock.MagicMock())
+        handler.partition_size = 100
+        handler.max_partitions = 4
+
+        def get_ranges(size):
+            return [part[1] for part in handler._get_partitions(size)]
+
+        # The number of partitions is adaptive to the object size
+        self.assertEqual([None], get_ranges(0))
+        self.assertEqual(['0-49'], get_ranges(50))
+        self.assertEqual(['0-85', '75-149'], get_ranges(150))
+        self.assertEqual(4, len(get_ranges(1000)))
+
+        # Each partition holds at least max_record_line bytes
+        req.headers['X-Storlet-Partitions'] = '4'
+        self.assertEqual(['0-19', '10-19'], get_ranges(20))
+
+        params = handler._get_partitions(20)[1][2]
+        self.assertEqual({'start': '10', 'end': '20',
+                          'max_record_line': '10',
+                          'first_partition': 'false'}, params)
+
     def test_get_storlet_invocation_options(self):
         req = Request.blank(
             '/v1/acc/cont/obj',
@@ -754,6 +2043,41 @@ class TestStorletProxyHandler(unittest.TestCase):
         options = handler._get_storlet_invocation_options(req)
         self.assertEqual('baa', options['storlet_foo'])
         self.assertTrue(options['generate_log'])
+        self.assertIsNone(options['output_limit'])
+
+        req = Request.blank(
+            '/v1/acc/cont/obj',
+            environ={'REQUEST_METHOD': 'GET'},
+            headers={'X-Run-Storlet': 'Storlet-1.0.jar',
+                     'X-Storlet-Output-Limit': '1024'})
+        with storlet_enabled():
+            handler = self.handler_class(
+                req, self.conf, self.gateway_conf, mock.MagicMock(),
+                mock.MagicMock())
+
+        options = handler._get_storlet_invocation_options(req)
+        self.assertEqual(1024, options['output_limit'])
+        self.assertNotIn('storlet_output_limit', options)
+
+        req = Request.blank(
+            '/v1/acc/cont/obj',
+            environ={'REQUEST_METHOD': 'GET'},
+            headers={'X-Run-Storlet': 'Storlet-1.0.jar',
+                     'X-Storlet-Output-Range': 'bytes=10-19'})
+        with storlet_enabled():
+            handler = self.handler_class(
+                req, self.conf, self.gateway_conf, mock.MagicMock(),
+                mock.MagicMock())
+
+        options = handler._get_storlet_invocation_options(req)
+        self.assertEqual(20, options['output_limit'])
+        self.assertIsNone(options['output_range'])
+        self.assertNotIn('storlet_output_range', options)
+
+        req.headers['X-Storlet-Output-Seekable'] = 'True'
+        options = handler._get_storlet_invocation_options(req)
+        self.assertEqual(10, options['output_limit'])
+        self.assertEqual((10, 19), options['output_range'])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,143 @@
+# Copyright (c) 2010-2016 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Cold start benchmark for the python storlet daemons
+
+This compares the time to start a python storlet daemon as a new
+interpreter (the subprocess path) with the time to fork it from the daemon
+factory process (the zygote path). The time is measured from the request
+until the storlet daemon has imported the storlet and entered its main loop.
+No docker container nor SBus library is required, because the main loop is
+replaced by a stub which only reports that the daemon is ready.
+
+Run it from the top of the source tree, e.g.
+
+    python tools/bench_daemon_spawn.py --spawns 20
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOP_DIR)
+
+STORLET_NAME = 'simple.SimpleStorlet'
+STORLET_PATH = os.path.join(TOP_DIR, 'StorletSamples', 'python',
+                            'storlet_samples', 'simple')
+
+# Run the storlet daemon in a new interpreter, with the same stubs as the
+# forked one
+BOOTSTRAP = '''
+import sys
+sys.path.insert(0, %r)
+import bench_daemon_spawn
+bench_daemon_spawn.stub_daemon()
+from storlets.agent.daemon import server
+sys.argv[0] = 'storlets-daemon'
+server.main()
+''' % os.path.dirname(os.path.abspath(__file__))
+
+
+def stub_daemon():
+    """
+    Replace the parts of the storlet daemon which require the storlets
+    container, so that the daemon exits as soon as it gets ready
+    """
+    from storlets.agent.daemon import server
+
+    def main_loop(self):
+        # Tell that the daemon is ready, as SBus creates the socket file
+        open(self.sbus_path, 'w').close()
+        return 0
+
+    class FakePasswd(object):
+        pw_uid = os.getuid()
+        pw_gid = os.getgid()
+
+    server.SBus.start_logger = staticmethod(lambda *args, **kwargs: None)
+    server.pwd.getpwnam = lambda name: FakePasswd()
+    server.StorletDaemon.main_loop = main_loop
+
+
+def wait_ready(path, pid):
+    while not os.path.exists(path):
+        time.sleep(0.0005)
+    os.waitpid(pid, 0)
+
+
+def spawn_subprocess(factory, uds_path):
+    pargs, env = factory.get_python_args(
+        'python', STORLET_PATH, STORLET_NAME, 1, uds_path, 'ERROR', None)
+    # Replace the interpreter and the storlets-daemon command, and keep the
+    # interpreter options and the daemon arguments
+    main_index = pargs.index('/usr/local/libexec/storlets/storlets-daemon')
+    pargs = [sys.executable] + pargs[1:main_index] + ['-c', BOOTSTRAP] + \
+        pargs[main_index + 1:]
+    env['PYTHONPATH'] = ':'.join([TOP_DIR, STORLET_PATH])
+    with open(os.devnull, 'wb') as dn:
+        daemon_p = subprocess.Popen(pargs, stdout=dn, close_fds=True,
+                                    shell=False, env=env)
+    return daemon_p.pid
+
+
+def spawn_zygote(factory, uds_path):
+    return factory.fork_python_daemon(
+        STORLET_NAME, uds_path, 'ERROR', 1, STORLET_PATH)
+
+
+def measure(spawn, factory, spawns, work_dir):
+    elapsed = []
+    for i in range(spawns):
+        uds_path = os.path.join(work_dir, 'uds-%d' % i)
+        start = time.time()
+        pid = spawn(factory, uds_path)
+        wait_ready(uds_path, pid)
+        elapsed.append(time.time() - start)
+        os.unlink(uds_path)
+    elapsed.sort()
+    return elapsed[len(elapsed) // 2], sum(elapsed) / len(elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark cold start of python storlet daemons')
+    parser.add_argument('--spawns', type=int, default=20,
+                        help='the number of daemons started for each path')
+    opts = parser.parse_args()
+
+    stub_daemon()
+    from storlets.agent.daemon_factory.server import StorletDaemonFactory
+    from tests.unit import FakeLogger
+    factory = StorletDaemonFactory('path/to/factory', FakeLogger(), 'bench')
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        for name, spawn in (('subprocess', spawn_subprocess),
+                            ('zygote', spawn_zygote)):
+            median, mean = measure(spawn, factory, opts.spawns, work_dir)
+            print('%-10s %d spawns: median %.2f ms, mean %.2f ms' %
+                  (name, opts.spawns, median * 1000, mean * 1000))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# Copyright (c) 2010-2016 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Small object benchmark for the gateway side of the storlet invocation
+
+This runs StorletInvocationProtocol.communicate against a simulated storlet
+daemon, which echoes the input back, so that only the gateway side overhead
+is measured. No docker container is required.
+
+The simulated daemon starts the task right away, but returns the task id
+only after --task-id-delay (e.g. the time to get a pool slot and to fork
+the task process).
+
+Run it from the top of the source tree, e.g.
+
+    python tools/bench_invocation.py --concurrency 16
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import eventlet
+import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storlets.gateway.gateways.docker import runtime  # noqa: E402
+from storlets.gateway.gateways.docker.gateway import \
+    DockerStorletRequest  # noqa: E402
+from tests.unit import FakeLogger  # noqa: E402
+from tests.unit.gateway.gateways import FakeFileManager  # noqa: E402
+
+
+def fake_daemon(fds, task_id_delay):
+    in_fd, taskid_fd, out_fd, md_fd = fds
+
+    def write_task_id():
+        time.sleep(task_id_delay)
+        os.write(taskid_fd, b'abcd1234')
+        os.close(taskid_fd)
+
+    threading.Thread(target=write_task_id).start()
+
+    data = b''
+    while True:
+        chunk = os.read(in_fd, 65536)
+        if not chunk:
+            break
+        data += chunk
+    os.close(in_fd)
+    os.write(md_fd, json.dumps({}).encode('utf-8'))
+    os.close(md_fd)
+    os.write(out_fd, data)
+    os.close(out_fd)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark storlet invocation on small objects')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='the number of requests')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='the number of concurrent requests')
+    parser.add_argument('--object-size', type=int, default=1024,
+                        help='the input object size in bytes')
+    parser.add_argument('--task-id-delay', type=float, default=0.005,
+                        help='seconds the daemon takes to return the task id')
+    opts = parser.parse_args()
+
+    def fake_send(path, dtg):
+        fds = [os.dup(fd) for fd in dtg.fds[:4]]
+        threading.Thread(target=fake_daemon,
+                         args=(fds, opts.task_id_delay)).start()
+        return 0
+
+    options = {'storlet_main': 'storlet.Storlet',
+               'storlet_language': 'python',
+               'file_manager': FakeFileManager('storlet', 'dep')}
+    log_file = tempfile.mktemp()
+    body = b'x' * opts.object_size
+
+    def invoke():
+        sreq = DockerStorletRequest('storlet.py', {}, {}, iter([body]),
+                                    options=options)
+        protocol = runtime.StorletInvocationProtocol(
+            sreq, tempfile.mktemp(), log_file, 10, FakeLogger())
+        sresp = protocol.communicate()
+        b''.join(sresp.data_iter)
+        sresp.data_iter.close()
+
+    with mock.patch.object(runtime.SBus, 'send', fake_send):
+        pool = eventlet.GreenPool(opts.concurrency)
+        start = time.time()
+        for _ in range(opts.requests):
+            pool.spawn(invoke)
+        pool.waitall()
+        elapsed = time.time() - start
+
+    print('%d requests, concurrency %d: %.2f ms per request' %
+          (opts.requests, opts.concurrency,
+           elapsed / opts.requests * 1000))
+    if os.path.exists(log_file):
+        os.unlink(log_file)
+
+
+if __name__ == '__main__':
+    main()